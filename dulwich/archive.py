@@ -0,0 +1,382 @@
+# archive.py -- Creating archives of trees
+# Copyright (C) 2014 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Generating tar and zip archives of trees, like git archive.
+
+Archives are generated in-process and returned as iterators over chunks
+of data, so they can be written to a file or streamed to e.g. a WSGI
+client without holding the whole archive in memory.
+
+Blobs are read in batches, sorted by their position in the packs of the
+object store, so that reading a tree from disk is mostly sequential.
+Compression can be spread over a number of threads; zlib releases the GIL
+while compressing. Zip members are compressed individually; gzipped tar
+archives are written as a series of gzip members of COMPRESS_BLOCK_SIZE
+bytes each, which any gzip implementation reads as a single stream. The
+output does not depend on the number of threads used.
+"""
+
+from functools import partial
+from itertools import islice
+import stat
+import struct
+import tarfile
+import time
+import zlib
+
+from dulwich.objects import (
+    S_ISGITLINK,
+    )
+from dulwich.pack import (
+    _parallel_map,
+    _worker_count,
+    )
+
+# Number of tree entries for which blobs are read at once.
+READ_BATCH_SIZE = 256
+
+# Size of the blocks of a tar archive that are compressed independently.
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+
+# Largest sizes and offsets, and number of entries, that fit in a zip
+# archive without the zip64 extensions.
+ZIP64_LIMIT = 0xffffffff
+ZIP_FILECOUNT_LIMIT = 0xffff
+
+_GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+_ZIP_LOCAL_HEADER = '<4sHHHHHLLLHH'
+_ZIP_CENTRAL_HEADER = '<4sHHHHHHLLLHHHHHLL'
+_ZIP_END_OF_CENTRAL_DIR = '<4sHHHHLLH'
+_ZIP64_END_OF_CENTRAL_DIR = '<4sQHHLLQQQQ'
+_ZIP64_END_OF_CENTRAL_DIR_LOCATOR = '<4sLQL'
+
+
+def iter_tree_blobs(store, tree_id, batch_size=READ_BATCH_SIZE):
+    """Iterate over the contents of a tree, including the blob data.
+
+    :param store: Object store to read from
+    :param tree_id: SHA1 of the tree
+    :param batch_size: Number of entries for which to read blobs at once
+    :return: Iterator over (path, mode, data) tuples, depth-first pre-order
+        as for iter_tree_contents. data is None for trees and submodules,
+        and the raw blob contents otherwise.
+    """
+    entries = iter(store.iter_tree_contents(tree_id, include_trees=True))
+    # Skip the root tree
+    next(entries)
+    while True:
+        batch = list(islice(entries, batch_size))
+        if not batch:
+            break
+        shas = set(entry.sha for entry in batch
+                   if not stat.S_ISDIR(entry.mode)
+                   and not S_ISGITLINK(entry.mode))
+        contents = dict((obj.id, obj.as_raw_string())
+                        for obj in store.iter_objects(shas))
+        for entry in batch:
+            yield entry.path, entry.mode, contents.get(entry.sha)
+
+
+def _tar_member(entry, mtime):
+    """Create the records for a single tar archive member.
+
+    :param entry: Tuple with path, mode and data, as from iter_tree_blobs
+    :param mtime: Modification time for the member
+    :return: String with the header(s) and padded contents
+    """
+    path, mode, data = entry
+    info = tarfile.TarInfo(path)
+    info.mtime = mtime
+    info.uname = info.gname = 'root'
+    if data is None:
+        # Submodules are archived as empty directories, like C git does.
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o775
+    elif stat.S_ISLNK(mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = data
+        info.mode = 0o777
+    else:
+        info.size = len(data)
+        if mode & 0o111:
+            info.mode = 0o775
+        else:
+            info.mode = 0o664
+    try:
+        buf = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'strict')
+    except UnicodeDecodeError:
+        # Paths in pax headers have to be UTF-8; store any other paths as
+        # raw bytes, with the GNU extension for long names.
+        buf = info.tobuf(tarfile.GNU_FORMAT)
+    if info.type != tarfile.REGTYPE:
+        return buf
+    remainder = len(data) % tarfile.BLOCKSIZE
+    if remainder:
+        data += tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+    return buf + data
+
+
+def _iter_tar(entries, mtime):
+    """Generate an uncompressed tar archive.
+
+    :param entries: Iterator over (path, mode, data) tuples
+    :param mtime: Modification time for all members
+    :return: Iterator over chunks of the archive
+    """
+    size = 0
+    for entry in entries:
+        chunk = _tar_member(entry, mtime)
+        size += len(chunk)
+        yield chunk
+    size += 2 * tarfile.BLOCKSIZE
+    trailer = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+    remainder = size % tarfile.RECORDSIZE
+    if remainder:
+        trailer += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+    yield trailer
+
+
+def _iter_blocks(chunks, block_size):
+    """Regroup chunks of data into blocks of a fixed size.
+
+    :param chunks: Iterator over strings
+    :param block_size: Size of the blocks
+    :return: Iterator over blocks; only the last one may be shorter
+    """
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size < block_size:
+            continue
+        data = ''.join(pending)
+        end = len(data) - len(data) % block_size
+        for i in range(0, end, block_size):
+            yield data[i:i+block_size]
+        pending = [data[end:]]
+        pending_size = len(pending[0])
+    if pending_size:
+        yield ''.join(pending)
+
+
+def _gzip_member(data, compresslevel):
+    """Compress data into a complete gzip member."""
+    compressobj = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                   -zlib.MAX_WBITS)
+    return ''.join([
+        _GZIP_HEADER, compressobj.compress(data), compressobj.flush(),
+        struct.pack('<LL', zlib.crc32(data) & 0xffffffff,
+                    len(data) & 0xffffffff)])
+
+
+def tar_stream(store, tree_id, mtime, prefix='', format='',
+               compresslevel=zlib.Z_DEFAULT_COMPRESSION, threads=None):
+    """Generate a tar archive of a tree.
+
+    :param store: Object store to read from
+    :param tree_id: SHA1 of the tree to archive
+    :param mtime: Modification time for all members, in seconds since the
+        epoch (usually the commit time)
+    :param prefix: String to prepend to all paths (include a trailing
+        slash to put the contents in a directory)
+    :param format: Compression; '' for none or 'gz' for gzip
+    :param compresslevel: zlib compression level
+    :param threads: Number of threads to compress in; None for no threads
+        and 0 for one per CPU
+    :return: Iterator over chunks of the archive
+    """
+    entries = ((prefix + path, mode, data)
+               for (path, mode, data) in iter_tree_blobs(store, tree_id))
+    chunks = _iter_tar(entries, int(mtime))
+    if format == '':
+        return chunks
+    elif format == 'gz':
+        return _parallel_map(
+            partial(_gzip_member, compresslevel=compresslevel),
+            _iter_blocks(chunks, COMPRESS_BLOCK_SIZE),
+            _worker_count(threads), batch_size=2)
+    else:
+        raise ValueError('Unknown tar compression format: %r' % format)
+
+
+def _dos_date_time(mtime):
+    """Convert a timestamp to a zip (MS-DOS) date and time.
+
+    :return: Tuple with the date and time as integers
+    """
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return (1 << 5) | 1, 0
+    return (((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+            (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2))
+
+
+def _zip_compress(entry, compresslevel):
+    """Compress the contents of a zip archive member.
+
+    Contents are stored uncompressed if deflating them does not make them
+    any smaller.
+
+    :param entry: Tuple with path, mode and data, as from iter_tree_blobs
+    :param compresslevel: zlib compression level
+    :return: Tuple with path, mode, size, CRC32, compression method and
+        (compressed) contents
+    """
+    path, mode, data = entry
+    if data is None:
+        return path + '/', stat.S_IFDIR | 0o755, 0, 0, 0, ''
+    crc = zlib.crc32(data) & 0xffffffff
+    if stat.S_ISLNK(mode):
+        mode = stat.S_IFLNK | 0o777
+    elif mode & 0o111:
+        mode = stat.S_IFREG | 0o755
+    else:
+        mode = stat.S_IFREG | 0o644
+    compressobj = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                   -zlib.MAX_WBITS)
+    compressed = compressobj.compress(data) + compressobj.flush()
+    if len(compressed) < len(data):
+        return path, mode, len(data), crc, zlib.DEFLATED, compressed
+    return path, mode, len(data), crc, 0, data
+
+
+def zip_stream(store, tree_id, mtime, prefix='',
+               compresslevel=zlib.Z_DEFAULT_COMPRESSION, threads=None):
+    """Generate a zip archive of a tree.
+
+    The zip64 extensions are used for archives and members that are too
+    large for the original zip format.
+
+    :param store: Object store to read from
+    :param tree_id: SHA1 of the tree to archive
+    :param mtime: Modification time for all members, in seconds since the
+        epoch (usually the commit time)
+    :param prefix: String to prepend to all paths (include a trailing
+        slash to put the contents in a directory)
+    :param compresslevel: zlib compression level
+    :param threads: Number of threads to compress in; None for no threads
+        and 0 for one per CPU
+    :return: Iterator over chunks of the archive
+    """
+    dos_date, dos_time = _dos_date_time(mtime)
+    entries = ((prefix + path, mode, data)
+               for (path, mode, data) in iter_tree_blobs(store, tree_id))
+    members = _parallel_map(
+        partial(_zip_compress, compresslevel=compresslevel), entries,
+        _worker_count(threads))
+    offset = 0
+    central_dir = []
+    for path, mode, size, crc, method, contents in members:
+        flags = 0
+        try:
+            path.decode('ascii')
+        except UnicodeDecodeError:
+            try:
+                path.decode('utf-8')
+            except UnicodeDecodeError:
+                # Stored as raw bytes, like C git does.
+                pass
+            else:
+                flags |= 0x800
+        version = 20
+        local_extra = ''
+        central_extra = []
+        if size >= ZIP64_LIMIT or len(contents) >= ZIP64_LIMIT:
+            version = 45
+            local_extra = struct.pack('<HHQQ', 1, 16, size, len(contents))
+            central_extra.extend([size, len(contents)])
+            sizes = (0xffffffff, 0xffffffff)
+        else:
+            sizes = (len(contents), size)
+        header = struct.pack(
+            _ZIP_LOCAL_HEADER, 'PK\003\004', version, flags, method,
+            dos_time, dos_date, crc, sizes[0], sizes[1], len(path),
+            len(local_extra))
+        yield header + path + local_extra
+        yield contents
+        if offset >= ZIP64_LIMIT:
+            version = 45
+            central_extra.append(offset)
+            header_offset = 0xffffffff
+        else:
+            header_offset = offset
+        if central_extra:
+            extra = struct.pack('<HH%dQ' % len(central_extra), 1,
+                                8 * len(central_extra), *central_extra)
+        else:
+            extra = ''
+        attributes = mode << 16
+        if stat.S_ISDIR(mode):
+            attributes |= 0x10
+        central_dir.append(struct.pack(
+            _ZIP_CENTRAL_HEADER, 'PK\001\002', (3 << 8) | version, version,
+            flags, method, dos_time, dos_date, crc, sizes[0], sizes[1],
+            len(path), len(extra), 0, 0, 0, attributes, header_offset)
+            + path + extra)
+        offset += len(header) + len(path) + len(local_extra) + len(contents)
+
+    count = len(central_dir)
+    central_dir = ''.join(central_dir)
+    trailer = []
+    if (count >= ZIP_FILECOUNT_LIMIT or offset >= ZIP64_LIMIT or
+            len(central_dir) >= ZIP64_LIMIT):
+        trailer.append(struct.pack(
+            _ZIP64_END_OF_CENTRAL_DIR, 'PK\006\006', 44, (3 << 8) | 45, 45,
+            0, 0, count, count, len(central_dir), offset))
+        trailer.append(struct.pack(
+            _ZIP64_END_OF_CENTRAL_DIR_LOCATOR, 'PK\006\007', 0,
+            offset + len(central_dir), 1))
+        end = (0xffff, 0xffff, 0xffffffff, 0xffffffff)
+    else:
+        end = (count, count, len(central_dir), offset)
+    trailer.append(struct.pack(
+        _ZIP_END_OF_CENTRAL_DIR, 'PK\005\006', 0, 0, end[0], end[1], end[2],
+        end[3], 0))
+    yield central_dir
+    yield ''.join(trailer)
+
+
+def archive_stream(store, tree_id, mtime, format='tar', prefix='',
+                   compresslevel=zlib.Z_DEFAULT_COMPRESSION, threads=None):
+    """Generate an archive of a tree.
+
+    :param store: Object store to read from
+    :param tree_id: SHA1 of the tree to archive
+    :param mtime: Modification time for all members, in seconds since the
+        epoch (usually the commit time)
+    :param format: Archive format: 'tar', 'tar.gz' (or 'tgz') or 'zip'
+    :param prefix: String to prepend to all paths
+    :param compresslevel: zlib compression level
+    :param threads: Number of threads to compress in; None for no threads
+        and 0 for one per CPU
+    :return: Iterator over chunks of the archive
+    :raise ValueError: If the format is not supported
+    """
+    if format == 'tar':
+        return tar_stream(store, tree_id, mtime, prefix)
+    elif format in ('tar.gz', 'tgz'):
+        return tar_stream(store, tree_id, mtime, prefix, 'gz',
+                          compresslevel, threads)
+    elif format == 'zip':
+        return zip_stream(store, tree_id, mtime, prefix, compresslevel,
+                          threads)
+    else:
+        raise ValueError('Unknown archive format: %r' % format)
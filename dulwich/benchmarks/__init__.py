@@ -0,0 +1,255 @@
+# __init__.py -- Benchmarks for Dulwich
+# Copyright (C) 2014 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Benchmarks for the performance-critical parts of Dulwich.
+
+The benchmarks run against a synthetic repository generated by
+`dulwich.benchmarks.synthetic`, so results from different versions of
+Dulwich can be compared. Run them with::
+
+    python -m dulwich.benchmarks [--scale=small|medium|large] [NAME...]
+
+The results are written as JSON. A previous result file can be passed with
+--compare, in which case benchmarks that got slower are reported and the
+exit code is non-zero.
+"""
+
+import importlib
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+import dulwich
+from dulwich.benchmarks.synthetic import (
+    build_synthetic_repo,
+    )
+from dulwich.repo import (
+    Repo,
+    )
+
+# Parameters for build_synthetic_repo, by scale.
+SCALES = {
+    'small': dict(num_commits=10, tree_width=20, blob_size=512, num_packs=2),
+    'medium': dict(num_commits=50, tree_width=50, blob_size=1024,
+                   num_packs=3),
+    'large': dict(num_commits=200, tree_width=200, blob_size=2048,
+                  num_packs=5),
+    }
+
+DEFAULT_SCALE = 'medium'
+
+DEFAULT_REPEAT = 3
+
+# Slowdown, relative to the baseline, above which a benchmark is considered
+# to have regressed.
+DEFAULT_TOLERANCE = 0.1
+
+_benchmarks = []
+
+
+def benchmark(func):
+    """Register a benchmark.
+
+    A benchmark is a function that takes a `SyntheticRepo` and does any
+    setup that should not be timed. It returns the function to time, which
+    takes no arguments and returns the number of items it processed.
+    """
+    _benchmarks.append(func)
+    return func
+
+
+def benchmark_name(func):
+    name = func.__name__
+    if name.startswith('bench_'):
+        name = name[len('bench_'):]
+    return name
+
+
+def get_benchmarks(names=None):
+    """Get registered benchmarks.
+
+    :param names: Names of the benchmarks to return, or None for all
+    :return: List of benchmark functions
+    :raise KeyError: if one of the names is not a known benchmark
+    """
+    # Importing the benchmarks registers them.
+    importlib.import_module('dulwich.benchmarks.core')
+    if names is None:
+        return list(_benchmarks)
+    by_name = dict((benchmark_name(func), func) for func in _benchmarks)
+    return [by_name[name] for name in names]
+
+
+class SyntheticRepo(object):
+    """A synthetic repository on disk, for benchmarks to run against.
+
+    :ivar repo: The `Repo`
+    :ivar commit_ids: The ids of the synthetic commits, oldest first
+    :ivar params: Parameters it was generated with
+    """
+
+    def __init__(self, path, **params):
+        self.path = path
+        self.params = params
+        self.repo = Repo.init_bare(path)
+        self.commit_ids = build_synthetic_repo(self.repo, **params)
+
+    @classmethod
+    def create(cls, **params):
+        """Create a synthetic repository in a temporary directory."""
+        path = tempfile.mkdtemp(prefix='dulwich-bench-')
+        try:
+            return cls(path, **params)
+        except:
+            shutil.rmtree(path)
+            raise
+
+    def close(self):
+        """Remove the repository."""
+        self.repo.object_store.close()
+        shutil.rmtree(self.path)
+
+
+def time_benchmark(func, fixture, repeat=DEFAULT_REPEAT):
+    """Time a benchmark.
+
+    :param func: Benchmark function, as registered with `benchmark`
+    :param fixture: `SyntheticRepo` to run it against
+    :param repeat: Number of times to run it
+    :return: Dictionary with the results
+    """
+    run = func(fixture)
+    times = []
+    items = None
+    for i in range(repeat):
+        start = timeit.default_timer()
+        items = run()
+        times.append(timeit.default_timer() - start)
+    best = min(times)
+    result = {
+        'name': benchmark_name(func),
+        'times': times,
+        'min': best,
+        'mean': sum(times) / len(times),
+        'items': items,
+        }
+    if items is not None and best > 0:
+        result['items_per_second'] = items / best
+    return result
+
+
+def run_benchmarks(names=None, params=None, repeat=DEFAULT_REPEAT):
+    """Run benchmarks against a new synthetic repository.
+
+    :param names: Names of the benchmarks to run, or None for all
+    :param params: Parameters for the synthetic repository; defaults to
+        those of the default scale
+    :param repeat: Number of times to run each benchmark
+    :return: Dictionary with the results, suitable for serializing as JSON
+    """
+    if params is None:
+        params = SCALES[DEFAULT_SCALE]
+    funcs = get_benchmarks(names)
+    fixture = SyntheticRepo.create(**params)
+    try:
+        results = [time_benchmark(func, fixture, repeat) for func in funcs]
+    finally:
+        fixture.close()
+    return {
+        'dulwich': '.'.join(map(str, dulwich.__version__)),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'params': params,
+        'repeat': repeat,
+        'results': results,
+        }
+
+
+def compare_results(baseline, current, tolerance=DEFAULT_TOLERANCE):
+    """Find benchmarks that got slower.
+
+    Benchmarks are compared by their fastest run.
+
+    :param baseline: Results from `run_benchmarks` to compare against
+    :param current: Results from `run_benchmarks`
+    :param tolerance: Slowdown that is not considered a regression
+    :return: List of (name, baseline time, current time) tuples for the
+        benchmarks that regressed
+    """
+    old = dict((r['name'], r['min']) for r in baseline['results'])
+    regressions = []
+    for result in current['results']:
+        name = result['name']
+        if name in old and result['min'] > old[name] * (1 + tolerance):
+            regressions.append((name, old[name], result['min']))
+    return regressions
+
+
+def main(argv=sys.argv):
+    """Entry point for running the benchmarks."""
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options] [NAME...]")
+    parser.add_option("-s", "--scale", dest="scale", default=DEFAULT_SCALE,
+                      choices=sorted(SCALES),
+                      help="Size of the synthetic repository.")
+    parser.add_option("-n", "--repeat", dest="repeat", type=int,
+                      default=DEFAULT_REPEAT,
+                      help="Number of times to run each benchmark.")
+    parser.add_option("-o", "--output", dest="output",
+                      help="File to write the results to.")
+    parser.add_option("-c", "--compare", dest="compare",
+                      help="Results file to compare against.")
+    parser.add_option("-t", "--tolerance", dest="tolerance", type=float,
+                      default=DEFAULT_TOLERANCE,
+                      help="Slowdown to tolerate when comparing.")
+    parser.add_option("-l", "--list", dest="list", action="store_true",
+                      help="List the available benchmarks.")
+    options, args = parser.parse_args(argv[1:])
+
+    if options.list:
+        for func in get_benchmarks():
+            sys.stdout.write("%s\n" % benchmark_name(func))
+        return 0
+    try:
+        get_benchmarks(args or None)
+    except KeyError as e:
+        parser.error("unknown benchmark: %s" % e.args[0])
+    results = run_benchmarks(args or None, SCALES[options.scale],
+                             options.repeat)
+    results['scale'] = options.scale
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    if options.compare:
+        with open(options.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, results, options.tolerance)
+        for name, old, new in regressions:
+            sys.stderr.write("%s: %.4fs -> %.4fs (%+.0f%%)\n" % (
+                name, old, new, (new / old - 1) * 100))
+        if regressions:
+            return 1
+    return 0
@@ -0,0 +1,375 @@
+# core.py -- Benchmarks for the core hot paths
+# Copyright (C) 2014 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Benchmarks for the core hot paths of Dulwich.
+
+Each benchmark does its setup when called with a `SyntheticRepo` and
+returns the function to time; see `dulwich.benchmarks.benchmark`.
+"""
+
+from io import BytesIO
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import dulwich
+from dulwich.benchmarks import (
+    benchmark,
+    )
+from dulwich.diff_tree import (
+    CHANGE_MODIFY,
+    RenameDetector,
+    tree_changes,
+    )
+from dulwich.index import (
+    IndexEntry,
+    read_index_dict,
+    write_index_dict,
+    )
+from dulwich.object_store import (
+    MissingObjectFinder,
+    ObjectStoreIterator,
+    )
+from dulwich.pack import (
+    PackIndexer,
+    apply_delta,
+    create_delta,
+    deltify_pack_objects,
+    )
+from dulwich.protocol import (
+    Protocol,
+    pkt_line,
+    )
+from dulwich.server import (
+    DictBackend,
+    UploadPackHandler,
+    )
+from dulwich.walk import (
+    ORDER_TOPO,
+    Walker,
+    )
+
+
+def _head(fixture):
+    return fixture.commit_ids[-1]
+
+
+def _commit_pairs(fixture):
+    """Return (parent, commit) pairs for the synthetic history."""
+    store = fixture.repo.object_store
+    commits = [store[commit_id] for commit_id in fixture.commit_ids]
+    return list(zip(commits, commits[1:]))
+
+
+def _modified_blob_pairs(fixture):
+    """Return (old, new) contents of the blobs modified by each commit."""
+    store = fixture.repo.object_store
+    pairs = []
+    for parent, commit in _commit_pairs(fixture):
+        for change in tree_changes(store, parent.tree, commit.tree):
+            if change.type == CHANGE_MODIFY:
+                pairs.append((store[change.old.sha].as_raw_string(),
+                               store[change.new.sha].as_raw_string()))
+    return pairs
+
+
+@benchmark
+def bench_pack_data_iteration(fixture):
+    packs = list(fixture.repo.object_store.packs)
+
+    def run():
+        count = 0
+        for pack in packs:
+            for entry in pack.data.iterobjects(compute_crc32=False):
+                count += 1
+        return count
+    return run
+
+
+@benchmark
+def bench_pack_indexer(fixture):
+    packs = list(fixture.repo.object_store.packs)
+
+    def run():
+        count = 0
+        for pack in packs:
+            indexer = PackIndexer.for_pack_data(
+                pack.data, resolve_ext_ref=pack.resolve_ext_ref)
+            for entry in indexer:
+                count += 1
+        return count
+    return run
+
+
+@benchmark
+def bench_create_delta(fixture):
+    pairs = _modified_blob_pairs(fixture)
+
+    def run():
+        for old, new in pairs:
+            create_delta(old, new)
+        return len(pairs)
+    return run
+
+
+@benchmark
+def bench_apply_delta(fixture):
+    deltas = [(old, ''.join(create_delta(old, new)))
+              for (old, new) in _modified_blob_pairs(fixture)]
+
+    def run():
+        for old, delta in deltas:
+            apply_delta(old, delta)
+        return len(deltas)
+    return run
+
+
+@benchmark
+def bench_deltify_pack_objects(fixture):
+    store = fixture.repo.object_store
+    objects = [(store[sha], None) for sha in store]
+
+    def run():
+        count = 0
+        for entry in deltify_pack_objects(objects):
+            count += 1
+        return count
+    return run
+
+
+@benchmark
+def bench_deltify_pack_objects_streaming(fixture):
+    store = fixture.repo.object_store
+    shas = [(sha, None) for sha in store]
+
+    def run():
+        count = 0
+        objects = ObjectStoreIterator(store, iter(shas))
+        for entry in deltify_pack_objects(objects, get_raw=store.get_raw):
+            count += 1
+        return count
+    return run
+
+
+@benchmark
+def bench_missing_object_finder(fixture):
+    store = fixture.repo.object_store
+    head = _head(fixture)
+
+    def run():
+        finder = MissingObjectFinder(store, [], [head])
+        count = 0
+        for entry in iter(finder.next, None):
+            count += 1
+        return count
+    return run
+
+
+@benchmark
+def bench_walker(fixture):
+    store = fixture.repo.object_store
+    head = _head(fixture)
+
+    def run():
+        return len(list(Walker(store, [head])))
+    return run
+
+
+@benchmark
+def bench_walker_topo(fixture):
+    store = fixture.repo.object_store
+    head = _head(fixture)
+
+    def run():
+        return len(list(Walker(store, [head], order=ORDER_TOPO)))
+    return run
+
+
+@benchmark
+def bench_tree_changes(fixture):
+    store = fixture.repo.object_store
+    pairs = [(parent.tree, commit.tree)
+             for (parent, commit) in _commit_pairs(fixture)]
+
+    def run():
+        count = 0
+        for old, new in pairs:
+            for change in tree_changes(store, old, new):
+                count += 1
+        return count
+    return run
+
+
+@benchmark
+def bench_rename_detector(fixture):
+    store = fixture.repo.object_store
+    pairs = [(parent.tree, commit.tree)
+             for (parent, commit) in _commit_pairs(fixture)]
+
+    def run():
+        count = 0
+        for old, new in pairs:
+            detector = RenameDetector(store)
+            for change in tree_changes(store, old, new,
+                                       rename_detector=detector):
+                count += 1
+        return count
+    return run
+
+
+def _index_entries(fixture):
+    store = fixture.repo.object_store
+    tree = store[_head(fixture)].tree
+    entries = {}
+    for i, entry in enumerate(store.iter_tree_contents(tree)):
+        entries[entry.path] = IndexEntry(
+            (1400000000, 0), (1400000000, 0), 2049, i, entry.mode, 1000,
+            1000, 0, entry.sha, 0)
+    return entries
+
+
+@benchmark
+def bench_index_write(fixture):
+    entries = _index_entries(fixture)
+
+    def run():
+        write_index_dict(BytesIO(), entries)
+        return len(entries)
+    return run
+
+
+@benchmark
+def bench_index_read(fixture):
+    f = BytesIO()
+    write_index_dict(f, _index_entries(fixture))
+    data = f.getvalue()
+
+    def run():
+        return len(read_index_dict(BytesIO(data)))
+    return run
+
+
+def upload_pack(repo, wants, haves=()):
+    """Serve a fetch from a repository over an in-memory protocol.
+
+    :param repo: Repository to serve
+    :param wants: Object ids to ask for
+    :param haves: Object ids to claim to have
+    :return: Everything upload-pack wrote
+    """
+    request = [pkt_line("want %s side-band-64k ofs-delta thin-pack "
+                        "no-progress\n" % wants[0])]
+    request.extend(pkt_line("want %s\n" % want) for want in wants[1:])
+    request.append("0000")
+    request.extend(pkt_line("have %s\n" % have) for have in haves)
+    request.append(pkt_line("done\n"))
+    inf = BytesIO(''.join(request))
+    outf = BytesIO()
+    handler = UploadPackHandler(DictBackend({'/': repo}), ['/'],
+                                Protocol(inf.read, outf.write))
+    handler.handle()
+    return outf.getvalue()
+
+
+@benchmark
+def bench_upload_pack_clone(fixture):
+    head = _head(fixture)
+
+    def run():
+        return len(upload_pack(fixture.repo, [head]))
+    return run
+
+
+@benchmark
+def bench_upload_pack_fetch(fixture):
+    commit_ids = fixture.commit_ids
+    head = _head(fixture)
+    have = commit_ids[len(commit_ids) // 2]
+
+    def run():
+        return len(upload_pack(fixture.repo, [head], [have]))
+    return run
+
+
+def _clone(fixture, **kwargs):
+    path = tempfile.mkdtemp(prefix='dulwich-bench-')
+    try:
+        target = fixture.repo.clone(path, mkdir=False, bare=True, **kwargs)
+        target.object_store.close()
+    finally:
+        shutil.rmtree(path)
+    return len(fixture.commit_ids)
+
+
+@benchmark
+def bench_clone(fixture):
+
+    def run():
+        return _clone(fixture)
+    return run
+
+
+@benchmark
+def bench_clone_local(fixture):
+
+    def run():
+        return _clone(fixture, local=True)
+    return run
+
+
+@benchmark
+def bench_clone_shared(fixture):
+
+    def run():
+        return _clone(fixture, shared=True)
+    return run
+
+
+def _import_module(name):
+    """Import a module in a new interpreter, as a short-lived script would.
+
+    The time includes interpreter startup, which is what the users of
+    e.g. hooks actually pay for.
+    """
+    env = dict(os.environ)
+    path = os.path.dirname(os.path.dirname(os.path.abspath(dulwich.__file__)))
+    if env.get('PYTHONPATH'):
+        path += os.pathsep + env['PYTHONPATH']
+    env['PYTHONPATH'] = path
+    subprocess.check_call([sys.executable, '-c', 'import %s' % name],
+                          env=env)
+    return 1
+
+
+@benchmark
+def bench_import_repo(fixture):
+
+    def run():
+        return _import_module('dulwich.repo')
+    return run
+
+
+@benchmark
+def bench_import_porcelain(fixture):
+
+    def run():
+        return _import_module('dulwich.porcelain')
+    return run
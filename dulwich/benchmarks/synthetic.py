@@ -0,0 +1,205 @@
+# synthetic.py -- Deterministic synthetic repositories for benchmarks
+# Copyright (C) 2014 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Deterministic synthetic repositories for benchmarks.
+
+The histories generated here only depend on their parameters and the seed,
+so timings taken from different versions of Dulwich are comparable.
+"""
+
+import posixpath
+import random
+
+from dulwich.index import (
+    commit_tree,
+    )
+from dulwich.objects import (
+    Blob,
+    Commit,
+    )
+from dulwich.object_store import (
+    DiskObjectStore,
+    )
+from dulwich.pack import (
+    write_pack_objects,
+    )
+
+# Words the contents of the synthetic blobs are made up of.
+WORDS = ("alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf",
+         "hotel", "india", "juliet", "kilo", "lima", "mike", "november",
+         "oscar", "papa", "quebec", "romeo", "sierra", "tango", "uniform",
+         "victor", "whiskey", "xray", "yankee", "zulu", "0", "1", "2", "3",
+         "4", "5", "6", "7", "8", "9", "(", ")", "{", "}", "=", ";")
+
+WORDS_PER_LINE = 8
+
+# Author, committer and start time of the synthetic commits.
+AUTHOR = "Synthetic Author <synthetic@example.com>"
+START_TIME = 1400000000
+COMMIT_INTERVAL = 3600
+
+
+def _random_line(rng):
+    return " ".join(rng.choice(WORDS) for i in range(WORDS_PER_LINE)) + "\n"
+
+
+def _random_lines(rng, size):
+    lines = []
+    length = 0
+    while length < size:
+        line = _random_line(rng)
+        lines.append(line)
+        length += len(line)
+    return lines
+
+
+def _edit_lines(rng, lines, edits):
+    """Replace, insert or delete a few lines, keeping the size roughly stable.
+    """
+    lines = list(lines)
+    for i in range(edits):
+        pos = rng.randrange(len(lines) + 1)
+        action = rng.randrange(3)
+        if action == 0 or not lines:
+            lines.insert(pos, _random_line(rng))
+        elif action == 1 and pos < len(lines):
+            lines[pos] = _random_line(rng)
+        elif len(lines) > 1:
+            del lines[min(pos, len(lines) - 1)]
+    return lines
+
+
+def _file_path(index, tree_width):
+    """Path of the index'th file, spread over roughly sqrt(tree_width) dirs."""
+    num_dirs = max(1, int(tree_width ** 0.5))
+    return "dir%03d/file%05d.txt" % (index % num_dirs, index)
+
+
+class _ObjectCollector(object):
+    """Minimal object store that records objects not seen before."""
+
+    def __init__(self, seen):
+        self._seen = seen
+        self.objects = []
+
+    def add_object(self, obj):
+        if obj.id not in self._seen:
+            self._seen.add(obj.id)
+            self.objects.append(obj)
+
+
+def generate_history(num_commits=50, tree_width=50, blob_size=1024,
+                     change_rate=0.1, delta_heavy=True, rename_rate=0.01,
+                     seed=0):
+    """Generate a deterministic linear history.
+
+    :param num_commits: Number of commits to generate
+    :param tree_width: Number of files in each tree
+    :param blob_size: Approximate size of each file, in bytes
+    :param change_rate: Fraction of the files changed by each commit
+    :param delta_heavy: Whether changes are small edits to the existing
+        contents, so that most blobs delta well against earlier versions.
+        If False, changed files get entirely new contents.
+    :param rename_rate: Fraction of the files renamed by each commit
+    :param seed: Seed for the random number generator
+    :return: Iterator over lists of objects first introduced by each
+        commit, ending with the commit itself
+    """
+    rng = random.Random(seed)
+    files = {}
+    for i in range(tree_width):
+        files[_file_path(i, tree_width)] = _random_lines(rng, blob_size)
+    next_index = tree_width
+    seen = set()
+    parents = []
+    for n in range(num_commits):
+        if n > 0:
+            paths = sorted(files)
+            num_changes = max(1, int(round(len(paths) * change_rate)))
+            for path in rng.sample(paths, min(num_changes, len(paths))):
+                if delta_heavy:
+                    files[path] = _edit_lines(rng, files[path],
+                                              rng.randint(1, 3))
+                else:
+                    files[path] = _random_lines(rng, blob_size)
+            num_renames = int(round(len(paths) * rename_rate))
+            for path in rng.sample(paths, min(num_renames, len(paths))):
+                new_path = posixpath.join(posixpath.dirname(path),
+                                          "file%05d.txt" % next_index)
+                next_index += 1
+                files[new_path] = _edit_lines(rng, files.pop(path), 1)
+        collector = _ObjectCollector(seen)
+        entries = []
+        for path in sorted(files):
+            blob = Blob.from_string("".join(files[path]))
+            collector.add_object(blob)
+            entries.append((path, blob.id, 0o100644))
+        commit = Commit()
+        commit.tree = commit_tree(collector, entries)
+        commit.parents = parents
+        commit.author = commit.committer = AUTHOR
+        commit.author_time = commit.commit_time = (
+            START_TIME + n * COMMIT_INTERVAL)
+        commit.author_timezone = commit.commit_timezone = 0
+        commit.message = "Synthetic commit %d\n" % n
+        collector.add_object(commit)
+        parents = [commit.id]
+        yield collector.objects
+
+
+def build_synthetic_repo(repo, num_packs=1, deltify=True, **kwargs):
+    """Fill a repository with a synthetic history.
+
+    The history is written to num_packs packs of roughly the same number of
+    commits if the repository's object store is a DiskObjectStore, and
+    added object by object otherwise. refs/heads/master and HEAD point at
+    the last commit.
+
+    :param repo: Repository to fill; usually empty
+    :param num_packs: Number of packs to spread the history over
+    :param deltify: Whether to search for deltas when writing the packs
+    :param kwargs: Parameters for `generate_history`
+    :return: List of commit ids, oldest first
+    """
+    object_store = repo.object_store
+    batches = list(generate_history(**kwargs))
+    commit_ids = [batch[-1].id for batch in batches]
+    if isinstance(object_store, DiskObjectStore) and batches:
+        num_packs = max(1, min(num_packs, len(batches)))
+        for i in range(num_packs):
+            start = i * len(batches) // num_packs
+            end = (i + 1) * len(batches) // num_packs
+            objects = [(obj, None) for batch in batches[start:end]
+                       for obj in batch]
+            f, commit, abort = object_store.add_pack()
+            try:
+                write_pack_objects(f, objects, deltify=deltify)
+            except:
+                abort()
+                raise
+            else:
+                commit()
+    else:
+        for batch in batches:
+            for obj in batch:
+                object_store.add_object(obj)
+    if commit_ids:
+        repo.refs['refs/heads/master'] = commit_ids[-1]
+        repo.refs.set_symbolic_ref('HEAD', 'refs/heads/master')
+    return commit_ids
@@ -28,10 +28,13 @@ The Dulwich client supports the following capabilities:
  * ofs-delta
  * report-status
  * delete-refs
+ * filter
+ * shallow
+ * deepen-since
+ * deepen-not
 
 Known capabilities that are not supported:
 
- * shallow
  * no-progress
  * include-tag
 """
@@ -44,7 +47,6 @@ import select
 import socket
 import subprocess
 import sys
-import urllib2
 import urlparse
 
 from dulwich.errors import (
@@ -53,6 +55,13 @@ from dulwich.errors import (
     SendPackError,
     UpdateRefsError,
     )
+from dulwich.object_store import (
+    ThinPackBaseFinder,
+    )
+from dulwich.partial_clone import (
+    parse_filter_spec,
+    )
+from dulwich.progress import TextProgressReporter
 from dulwich.protocol import (
     _RBUFSIZE,
     PktLineParser,
@@ -167,11 +176,13 @@ class GitClient(object):
         """Create a new GitClient instance.
 
         :param thin_packs: Whether or not thin packs should be retrieved
+            and sent
         :param report_activity: Optional callback for reporting transport
             activity.
         """
         self._report_activity = report_activity
         self._report_status_parser = None
+        self._send_thin_packs = thin_packs
         self._fetch_capabilities = set(FETCH_CAPABILITIES)
         self._send_capabilities = set(SEND_CAPABILITIES)
         if not thin_packs:
@@ -192,7 +203,9 @@ class GitClient(object):
         """
         raise NotImplementedError(self.send_pack)
 
-    def fetch(self, path, target, determine_wants=None, progress=None):
+    def fetch(self, path, target, determine_wants=None, progress=None,
+              filter_spec=None, depth=None, deepen_since=None,
+              deepen_not=None):
         """Fetch into a target repository.
 
         :param path: Path to fetch from
@@ -200,30 +213,53 @@ class GitClient(object):
         :param determine_wants: Optional function to determine what refs
             to fetch
         :param progress: Optional progress function
+        :param filter_spec: Optional object filter specification, such as
+            "blob:none", for a partial clone (see dulwich.partial_clone).
+            The pack that is received is marked as a promisor pack.
+        :param depth: Optional depth to limit the fetched history to
+        :param deepen_since: Optional timestamp; history older than this is
+            not fetched
+        :param deepen_not: Optional list of refs whose history is not fetched
         :return: remote refs as dictionary
         """
         if determine_wants is None:
-            determine_wants = target.object_store.determine_wants_all
+            determine_wants = lambda refs: (
+                target.object_store.determine_wants_all(refs, depth))
+        graph_walker = target.get_graph_walker()
+        shallow = set(graph_walker.shallow)
         f, commit, abort = target.object_store.add_pack()
         try:
             result = self.fetch_pack(
-                path, determine_wants, target.get_graph_walker(), f.write,
-                progress)
+                path, determine_wants, graph_walker, f.write,
+                progress, filter_spec=filter_spec, depth=depth,
+                deepen_since=deepen_since, deepen_not=deepen_not)
         except:
             abort()
             raise
         else:
-            commit()
+            pack = commit()
+            if filter_spec is not None and pack is not None:
+                pack.mark_promisor()
+        if graph_walker.shallow != shallow or graph_walker.unshallow:
+            target.update_shallow(graph_walker.shallow - shallow,
+                                  graph_walker.unshallow)
         return result
 
     def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-                   progress=None):
+                   progress=None, filter_spec=None, depth=None,
+                   deepen_since=None, deepen_not=None):
         """Retrieve a pack from a git smart server.
 
         :param determine_wants: Callback that returns list of commits to fetch
         :param graph_walker: Object with next() and ack().
         :param pack_data: Callback called for each bit of data in the pack
         :param progress: Callback for progress reports (strings)
+        :param filter_spec: Optional object filter specification; ignored if
+            the server does not support filtering
+        :param depth: Optional depth to limit the fetched history to
+        :param deepen_since: Optional timestamp; history older than this is
+            not fetched
+        :param deepen_not: Optional list of refs whose history is not fetched
         """
         raise NotImplementedError(self.fetch_pack)
 
@@ -317,6 +353,25 @@ class GitClient(object):
         proto.write_pkt_line(None)
         return (have, want)
 
+    def _get_external_base_finder(self, objects, have, server_capabilities):
+        """Find delta bases for a thin pack that is pushed.
+
+        Thin packs can only be sent if the objects to upload were retrieved
+        from an object store (e.g. by BaseObjectStore.generate_pack_contents),
+        as the bases are looked up in the commits the server has.
+
+        :param objects: Objects to upload, as returned by
+            generate_pack_contents
+        :param have: SHAs of the commits the server has
+        :param server_capabilities: Capabilities advertised by the server
+        :return: A ThinPackBaseFinder, or None if no thin pack should be sent
+        """
+        store = getattr(objects, 'store', None)
+        if (not self._send_thin_packs or store is None or not have or
+                'no-thin' in server_capabilities):
+            return None
+        return ThinPackBaseFinder(store, have)
+
     def _handle_receive_pack_tail(self, proto, capabilities, progress=None):
         """Handle the tail of a 'git-receive-pack' request.
 
@@ -339,8 +394,88 @@ class GitClient(object):
         if self._report_status_parser is not None:
             self._report_status_parser.check()
 
+    def _negotiate_filter(self, filter_spec, server_capabilities,
+                          negotiated_capabilities):
+        """Check whether an object filter can be used for a fetch.
+
+        :param filter_spec: Object filter specification, or None
+        :param server_capabilities: Capabilities advertised by the server
+        :param negotiated_capabilities: Set of negotiated capabilities; the
+            filter capability is added to it if the filter is used
+        :return: The filter specification to send, or None
+        """
+        if filter_spec is None or 'filter' not in server_capabilities:
+            return None
+        # Fail early rather than have the server reject the request
+        parse_filter_spec(filter_spec)
+        negotiated_capabilities.add('filter')
+        return filter_spec
+
+    def _negotiate_shallow(self, graph_walker, depth, deepen_since,
+                           deepen_not, server_capabilities,
+                           negotiated_capabilities):
+        """Determine the shallow and deepen lines to send for a fetch.
+
+        :param graph_walker: GraphWalker of the local repository; its shallow
+            attribute, if any, lists the local shallow commits
+        :param depth: Depth to limit the history to, or None
+        :param deepen_since: Timestamp to limit the history to, or None
+        :param deepen_not: List of refs to exclude the history of, or None
+        :param server_capabilities: Capabilities advertised by the server
+        :param negotiated_capabilities: Set of negotiated capabilities; the
+            capabilities required for the shallow request are added to it
+        :return: Tuple with the list of lines to send, and a boolean
+            indicating whether the server will send shallow updates
+        :raise GitProtocolError: if the server does not support the request
+        """
+        lines = ['shallow %s\n' % sha
+                 for sha in sorted(getattr(graph_walker, 'shallow', ()))]
+        deepen = []
+        if depth is not None:
+            deepen.append('deepen %d\n' % depth)
+        if deepen_since is not None:
+            if 'deepen-since' not in server_capabilities:
+                raise GitProtocolError(
+                    "server does not support deepen-since")
+            negotiated_capabilities.add('deepen-since')
+            deepen.append('deepen-since %d\n' % deepen_since)
+        if deepen_not:
+            if 'deepen-not' not in server_capabilities:
+                raise GitProtocolError("server does not support deepen-not")
+            negotiated_capabilities.add('deepen-not')
+            deepen.extend('deepen-not %s\n' % ref for ref in deepen_not)
+        if not lines and not deepen:
+            return [], False
+        if 'shallow' not in server_capabilities:
+            raise GitProtocolError("server does not support shallow clients")
+        negotiated_capabilities.add('shallow')
+        return lines + deepen, bool(deepen)
+
+    def _read_shallow_updates(self, proto, graph_walker):
+        """Read the shallow updates sent in reply to a deepen request.
+
+        :param proto: Protocol object to read from
+        :param graph_walker: GraphWalker to report the updates to
+        """
+        new_shallow = set()
+        new_unshallow = set()
+        pkt = proto.read_pkt_line()
+        while pkt:
+            cmd, sha = pkt.rstrip('\n').split(' ', 1)
+            if cmd == 'shallow':
+                new_shallow.add(sha)
+            elif cmd == 'unshallow':
+                new_unshallow.add(sha)
+            else:
+                raise GitProtocolError("unknown command %s" % pkt)
+            pkt = proto.read_pkt_line()
+        update_shallow = getattr(graph_walker, 'update_shallow', None)
+        if update_shallow is not None:
+            update_shallow(new_shallow, new_unshallow)
+
     def _handle_upload_pack_head(self, proto, capabilities, graph_walker,
-                                 wants, can_read):
+                                 wants, can_read, filter_spec=None,
+                                 shallow_lines=None, read_shallow=False):
         """Handle the head of a 'git-upload-pack' request.
 
         :param proto: Protocol object to read from
@@ -349,13 +484,24 @@ class GitClient(object):
         :param wants: List of commits to fetch
         :param can_read: function that returns a boolean that indicates
             whether there is extra graph data to read on proto
+        :param filter_spec: Object filter specification to send, or None
+        :param shallow_lines: Optional list of shallow and deepen lines to
+            send, as returned by _negotiate_shallow
+        :param read_shallow: Whether to read the shallow updates the server
+            sends in reply to the deepen lines
         """
         assert isinstance(wants, list) and isinstance(wants[0], str)
         proto.write_pkt_line('want %s %s\n' % (
             wants[0], ' '.join(capabilities)))
         for want in wants[1:]:
             proto.write_pkt_line('want %s\n' % want)
+        for line in shallow_lines or []:
+            proto.write_pkt_line(line)
+        if filter_spec is not None:
+            proto.write_pkt_line('filter %s\n' % filter_spec)
         proto.write_pkt_line(None)
+        if read_shallow:
+            self._read_shallow_updates(proto, graph_walker)
         have = next(graph_walker)
         while have:
             proto.write_pkt_line('have %s\n' % have)
@@ -431,7 +577,9 @@ class TraditionalGitClient(GitClient):
 
         :param path: Repository path
         :param generate_pack_contents: Function that can return a sequence of
-            the shas of the objects to upload.
+            the shas of the objects to upload. If it returns an iterator
+            over an object store, such as
+            BaseObjectStore.generate_pack_contents does, a thin pack is sent.
         :param progress: Optional callback called with progress updates
 
         :raises SendPackError: if server rejects the pack data
@@ -487,8 +635,12 @@ class TraditionalGitClient(GitClient):
             if not want and old_refs == new_refs:
                 return new_refs
             objects = generate_pack_contents(have, want)
+            pack_progress = progress and TextProgressReporter(progress)
             if len(objects) > 0:
-                entries, sha = write_pack_objects(proto.write_file(), objects)
+                entries, sha = write_pack_objects(proto.write_file(), objects,
+                    progress=pack_progress,
+                    get_external_base=self._get_external_base_finder(
+                        objects, have, server_capabilities))
             elif len(set(new_refs.values()) - set([ZERO_SHA])) > 0:
                 # Check for valid create/update refs
                 filtered_new_refs = \
@@ -496,26 +648,43 @@ class TraditionalGitClient(GitClient):
                          if sha != ZERO_SHA])
                 if len(set(filtered_new_refs.iteritems()) -
                         set(old_refs.iteritems())) > 0:
-                    entries, sha = write_pack_objects(proto.write_file(), objects)
+                    entries, sha = write_pack_objects(proto.write_file(), objects,
+                                                      progress=pack_progress)
 
             self._handle_receive_pack_tail(
                 proto, negotiated_capabilities, progress)
             return new_refs
 
     def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-                   progress=None):
+                   progress=None, filter_spec=None, depth=None,
+                   deepen_since=None, deepen_not=None):
         """Retrieve a pack from a git smart server.
 
         :param determine_wants: Callback that returns list of commits to fetch
         :param graph_walker: Object with next() and ack().
         :param pack_data: Callback called for each bit of data in the pack
         :param progress: Callback for progress reports (strings)
+        :param filter_spec: Optional object filter specification; ignored if
+            the server does not support filtering
+        :param depth: Optional depth to limit the fetched history to
+        :param deepen_since: Optional timestamp; history older than this is
+            not fetched
+        :param deepen_not: Optional list of refs whose history is not fetched
         """
         proto, can_read = self._connect('upload-pack', path)
         with proto:
             refs, server_capabilities = read_pkt_refs(proto)
             negotiated_capabilities = (
                 self._fetch_capabilities & server_capabilities)
+            filter_spec = self._negotiate_filter(
+                filter_spec, server_capabilities, negotiated_capabilities)
+            try:
+                shallow_lines, deepen = self._negotiate_shallow(
+                    graph_walker, depth, deepen_since, deepen_not,
+                    server_capabilities, negotiated_capabilities)
+            except:
+                proto.write_pkt_line(None)
+                raise
 
             if refs is None:
                 proto.write_pkt_line(None)
@@ -532,15 +701,30 @@ class TraditionalGitClient(GitClient):
                 proto.write_pkt_line(None)
                 return refs
             self._handle_upload_pack_head(
-                proto, negotiated_capabilities, graph_walker, wants, can_read)
+                proto, negotiated_capabilities, graph_walker, wants, can_read,
+                filter_spec, shallow_lines, read_shallow=deepen)
             self._handle_upload_pack_tail(
                 proto, negotiated_capabilities, graph_walker, pack_data, progress)
             return refs
 
     def archive(self, path, committish, write_data, progress=None,
-                write_error=None):
+                write_error=None, format=None, prefix=None):
+        """Retrieve an archive of a tree from the server.
+
+        :param path: Path of the repository on the server
+        :param committish: Commit SHA1 or ref to archive
+        :param write_data: Function to call with chunks of the archive
+        :param progress: Optional progress reporting function
+        :param write_error: Optional function to call with error messages
+        :param format: Optional archive format (e.g. "tar" or "zip")
+        :param prefix: Optional prefix to prepend to paths in the archive
+        """
         proto, can_read = self._connect(b'upload-archive', path)
         with proto:
+            if format is not None:
+                proto.write_pkt_line("argument --format=%s" % format)
+            if prefix is not None:
+                proto.write_pkt_line("argument --prefix=%s" % prefix)
             proto.write_pkt_line("argument %s" % committish)
             proto.write_pkt_line(None)
             pkt = proto.read_pkt_line()
@@ -679,7 +863,9 @@ class LocalGitClient(GitClient):
         """
         raise NotImplementedError(self.send_pack)
 
-    def fetch(self, path, target, determine_wants=None, progress=None):
+    def fetch(self, path, target, determine_wants=None, progress=None,
+              filter_spec=None, depth=None, deepen_since=None,
+              deepen_not=None):
         """Fetch into a target repository.
 
         :param path: Path to fetch from
@@ -687,25 +873,50 @@ class LocalGitClient(GitClient):
         :param determine_wants: Optional function to determine what refs
             to fetch
         :param progress: Optional progress function
+        :param filter_spec: Optional object filter specification, such as
+            "blob:none", for a partial clone
+        :param depth: Optional depth to limit the fetched history to
+        :param deepen_since: Optional timestamp; history older than this is
+            not fetched
+        :param deepen_not: Optional list of refs whose history is not fetched
         :return: remote refs as dictionary
         """
+        if filter_spec is not None:
+            # Go through a pack, so that it can be marked as promisor pack
+            return GitClient.fetch(self, path, target, determine_wants,
+                                   progress, filter_spec, depth,
+                                   deepen_since, deepen_not)
         from dulwich.repo import Repo
         r = Repo(path)
         return r.fetch(target, determine_wants=determine_wants,
-                       progress=progress)
+                       progress=progress, depth=depth,
+                       deepen_since=deepen_since, deepen_not=deepen_not)
 
     def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-                   progress=None):
+                   progress=None, filter_spec=None, depth=None,
+                   deepen_since=None, deepen_not=None):
         """Retrieve a pack from a git smart server.
 
         :param determine_wants: Callback that returns list of commits to fetch
         :param graph_walker: Object with next() and ack().
         :param pack_data: Callback called for each bit of data in the pack
         :param progress: Callback for progress reports (strings)
+        :param filter_spec: Optional object filter specification
+        :param depth: Optional depth to limit the fetched history to
+        :param deepen_since: Optional timestamp; history older than this is
+            not fetched
+        :param deepen_not: Optional list of refs whose history is not fetched
         """
         from dulwich.repo import Repo
         r = Repo(path)
-        objects_iter = r.fetch_objects(determine_wants, graph_walker, progress)
+        if filter_spec is not None:
+            object_filter = parse_filter_spec(filter_spec)
+        else:
+            object_filter = None
+        objects_iter = r.fetch_objects(determine_wants, graph_walker, progress,
+                                       object_filter=object_filter,
+                                       depth=depth, deepen_since=deepen_since,
+                                       deepen_not=deepen_not)
 
         # Did the process short-circuit (e.g. in a stateless RPC call)? Note
         # that the client still expects a 0-object pack in most cases.
@@ -902,6 +1113,8 @@ def default_user_agent_string():
 
 
 def default_urllib2_opener(config):
+    # urllib2 pulls in httplib, ssl and email; only import it for HTTP.
+    import urllib2
     if config is not None:
         proxy_server = config.get("http", "proxy")
     else:
@@ -936,6 +1149,7 @@ class HttpGitClient(GitClient):
         return urlparse.urljoin(self.base_url, path).rstrip("/") + "/"
 
     def _http_request(self, url, headers={}, data=None):
+        import urllib2
         req = urllib2.Request(url, headers=headers, data=data)
         try:
             resp = self.opener.open(req)
@@ -1013,7 +1227,10 @@ class HttpGitClient(GitClient):
             return new_refs
         objects = generate_pack_contents(have, want)
         if len(objects) > 0:
-            entries, sha = write_pack_objects(req_proto.write_file(), objects)
+            entries, sha = write_pack_objects(req_proto.write_file(), objects,
+                progress=progress and TextProgressReporter(progress),
+                get_external_base=self._get_external_base_finder(
+                    objects, have, server_capabilities))
         resp = self._smart_request("git-receive-pack", url,
                                    data=req_data.getvalue())
         try:
@@ -1026,19 +1243,31 @@ class HttpGitClient(GitClient):
 
 
     def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-                   progress=None):
+                   progress=None, filter_spec=None, depth=None,
+                   deepen_since=None, deepen_not=None):
         """Retrieve a pack from a git smart server.
 
         :param determine_wants: Callback that returns list of commits to fetch
         :param graph_walker: Object with next() and ack().
         :param pack_data: Callback called for each bit of data in the pack
         :param progress: Callback for progress reports (strings)
+        :param filter_spec: Optional object filter specification; ignored if
+            the server does not support filtering
+        :param depth: Optional depth to limit the fetched history to
+        :param deepen_since: Optional timestamp; history older than this is
+            not fetched
+        :param deepen_not: Optional list of refs whose history is not fetched
         :return: Dictionary with the refs of the remote repository
         """
         url = self._get_url(path)
         refs, server_capabilities = self._discover_references(
             "git-upload-pack", url)
         negotiated_capabilities = self._fetch_capabilities & server_capabilities
+        filter_spec = self._negotiate_filter(
+            filter_spec, server_capabilities, negotiated_capabilities)
+        shallow_lines, deepen = self._negotiate_shallow(
+            graph_walker, depth, deepen_since, deepen_not,
+            server_capabilities, negotiated_capabilities)
         wants = determine_wants(refs)
         if wants is not None:
             wants = [cid for cid in wants if cid != ZERO_SHA]
@@ -1050,11 +1279,14 @@ class HttpGitClient(GitClient):
         req_proto = Protocol(None, req_data.write)
         self._handle_upload_pack_head(
             req_proto, negotiated_capabilities, graph_walker, wants,
-            lambda: False)
+            lambda: False, filter_spec, shallow_lines)
         resp = self._smart_request(
             "git-upload-pack", url, data=req_data.getvalue())
         try:
             resp_proto = Protocol(resp.read, None)
+            if deepen:
+                # The shallow updates precede the acknowledgements
+                self._read_shallow_updates(resp_proto, graph_walker)
             self._handle_upload_pack_tail(resp_proto, negotiated_capabilities,
                 graph_walker, pack_data, progress)
             return refs
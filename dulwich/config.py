@@ -27,14 +27,20 @@ TODO:
 import errno
 import os
 import re
+import threading
+import time
 
 from collections import (
     OrderedDict,
     MutableMapping,
     )
 
-
-from dulwich.file import GitFile
+from dulwich.file import (
+    GitFile,
+    RACY_TIMESTAMP_INTERVAL,
+    )
+from dulwich.lru_cache import LRUCache
+from dulwich.metrics import get_metrics
 
 
 class Config(object):
@@ -310,6 +316,16 @@ class ConfigFile(ConfigDict):
             ret.path = path
             return ret
 
+    def copy(self):
+        """Return a copy of this configuration that can be modified without
+        affecting the original."""
+        ret = self.__class__(OrderedDict(
+            (section, OrderedDict(values))
+            for section, values in self._values.iteritems()))
+        if hasattr(self, 'path'):
+            ret.path = self.path
+        return ret
+
     def write_to_path(self, path=None):
         """Write configuration to a file on disk."""
         if path is None:
@@ -348,21 +364,17 @@ class StackedConfig(Config):
         """Retrieve the default configuration.
 
         This will look in the users' home directory and the system
-        configuration.
+        configuration. The returned `ConfigFile` objects are shared (see
+        `get_config_file`) and should not be modified.
         """
         paths = []
         paths.append(os.path.expanduser("~/.gitconfig"))
         paths.append("/etc/gitconfig")
         backends = []
         for path in paths:
-            try:
-                cf = ConfigFile.from_path(path)
-            except (IOError, OSError) as e:
-                if e.errno != errno.ENOENT:
-                    raise
-                else:
-                    continue
-            backends.append(cf)
+            cf = get_config_file(path)
+            if cf is not None:
+                backends.append(cf)
         return backends
 
     def get(self, section, name):
@@ -377,3 +389,74 @@ class StackedConfig(Config):
         if self.writable is None:
             raise NotImplementedError(self.set)
         return self.writable.set(section, name, value)
+
+
+class ConfigFileCache(object):
+    """Cache of parsed configuration files, keyed by path.
+
+    A file is parsed again when its mtime, size or inode changes. Files that
+    were modified too recently for their timestamp to be trusted are not
+    cached.
+    """
+
+    def __init__(self, max_files=1000):
+        self._cache = LRUCache(max_files)
+        self._lock = threading.Lock()
+
+    def _stat_file(self, path):
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def get(self, path):
+        """Get the parsed contents of a configuration file.
+
+        :param path: Path to the configuration file
+        :return: A `ConfigFile`, shared with other callers, or None if the
+            file does not exist
+        """
+        key = os.path.abspath(path)
+        # Stat before reading, so that changes made while parsing
+        # invalidate the entry.
+        st = self._stat_file(key)
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is not None and entry[0] == st:
+            get_metrics().incr('config.cache_hits')
+            return entry[1]
+        get_metrics().incr('config.cache_misses')
+        cf = None
+        if st is not None:
+            try:
+                cf = ConfigFile.from_path(path)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        if st is None or time.time() - st[0] >= RACY_TIMESTAMP_INTERVAL:
+            with self._lock:
+                self._cache[key] = (st, cf)
+        return cf
+
+    def clear(self):
+        """Remove all cached files."""
+        with self._lock:
+            self._cache.clear()
+
+
+_config_file_cache = ConfigFileCache()
+
+
+def get_config_file(path):
+    """Get the (possibly cached) parsed contents of a configuration file.
+
+    The returned object is shared by all callers in this process, so it
+    should not be modified; use `ConfigFile.copy` to get a private copy.
+
+    :param path: Path to the configuration file
+    :return: A `ConfigFile`, or None if the file does not exist
+    """
+    return _config_file_cache.get(path)
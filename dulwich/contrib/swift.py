@@ -48,6 +48,7 @@ from dulwich.objects import (
     Tree,
     Tag,
     S_ISGITLINK,
+    ZERO_SHA,
     )
 from dulwich.object_store import (
     PackBasedObjectStore,
@@ -70,8 +71,15 @@ from dulwich.pack import (
     write_pack_object,
     )
 from dulwich.protocol import TCP_GIT_PORT
+from dulwich.errors import (
+    RefFormatError,
+    )
 from dulwich.refs import (
     InfoRefsContainer,
+    UPDATE_BAD_REF,
+    UPDATE_OLD_VALUE_MISMATCH,
+    _fail_atomic,
+    _old_ref_matches,
     read_info_refs,
     write_info_refs,
     )
@@ -137,6 +145,7 @@ class PackInfoMissingObjectFinder(GreenThreadsMissingObjectFinder):
     def next(self):
         while True:
             if not self.objects_to_send:
+                self._update_progress(done=True)
                 return None
             (sha, name, leaf) = self.objects_to_send.pop()
             if sha not in self.sha_done:
@@ -152,7 +161,7 @@ class PackInfoMissingObjectFinder(GreenThreadsMissingObjectFinder):
             if sha in self._tagged:
                 self.add_todo([(self._tagged[sha], None, True)])
         self.sha_done.add(sha)
-        self.progress("counting objects: %d\r" % len(self.sha_done))
+        self._update_progress()
         return (sha, name)
 
 
@@ -887,6 +896,46 @@ class SwiftInfoRefsContainer(InfoRefsContainer):
         del self._refs[name]
         return True
 
+    def update_refs(self, updates, atomic=False):
+        """Apply a batch of ref updates with a single write of info/refs.
+
+        See RefsContainer.update_refs for the parameters and return value.
+        """
+        updates = list(updates)
+        f = self.scon.get_object(self.filename)
+        if f:
+            refs = read_info_refs(f)
+        else:
+            refs = {}
+        failed = {}
+        changes = {}
+        for name, old_ref, new_ref in updates:
+            if name == 'HEAD':
+                continue
+            try:
+                self._check_refname(name)
+            except RefFormatError:
+                failed[name] = UPDATE_BAD_REF
+                continue
+            if not _old_ref_matches(refs.get(name), old_ref):
+                failed[name] = UPDATE_OLD_VALUE_MISMATCH
+                continue
+            if new_ref == ZERO_SHA:
+                refs.pop(name, None)
+            else:
+                refs[name] = new_ref
+            changes[name] = new_ref
+        if atomic and failed:
+            return _fail_atomic(updates, failed)
+        if changes:
+            self._write_refs(refs)
+        for name, new_ref in changes.iteritems():
+            if new_ref == ZERO_SHA:
+                self._refs.pop(name, None)
+            else:
+                self._refs[name] = new_ref
+        return failed
+
     def allkeys(self):
         try:
             self._refs['HEAD'] = self._refs['refs/heads/master']
@@ -501,6 +501,25 @@ class TestSwiftInfoRefsContainer(TestCase):
                              "cca703b0e1399008b53a1a236d6b4584737649e4")
         self.assertNotIn('refs/heads/dev', irc.allkeys())
 
+    def test_update_refs(self):
+        self.fsc.store = self.store
+        irc = swift.SwiftInfoRefsContainer(self.fsc, self.object_store)
+        failed = irc.update_refs([
+            ('refs/heads/dev', "cca703b0e1399008b53a1a236d6b4584737649e4",
+             '0' * 40),
+            ('refs/heads/new', '0' * 40, '1' * 40),
+            ('refs/heads/master', '2' * 40, '3' * 40)], atomic=True)
+        self.assertEqual({'refs/heads/dev': 'atomic transaction failed',
+                          'refs/heads/new': 'atomic transaction failed',
+                          'refs/heads/master': 'old value mismatch'}, failed)
+        self.assertIn('refs/heads/dev', irc.allkeys())
+        self.assertEqual({}, irc.update_refs([
+            ('refs/heads/dev', "cca703b0e1399008b53a1a236d6b4584737649e4",
+             '0' * 40),
+            ('refs/heads/new', '0' * 40, '1' * 40)]))
+        self.assertNotIn('refs/heads/dev', irc.allkeys())
+        self.assertEqual('1' * 40, irc['refs/heads/new'])
+
 
 @skipIf(missing_libs, skipmsg)
 class TestSwiftConnector(TestCase):
@@ -157,10 +157,23 @@ class PackedRefsException(FileFormatException):
     """Indicates an error parsing a packed-refs file."""
 
 
+class ReftableFormatError(FileFormatException):
+    """Indicates an error parsing a reftable file."""
+
+
 class ObjectFormatException(FileFormatException):
     """Indicates an error parsing an object."""
 
 
+class AmbiguousShortId(Exception):
+    """A short object id matches more than one object."""
+
+    def __init__(self, prefix, options):
+        self.prefix = prefix
+        self.options = options
+        Exception.__init__(self, "short SHA1 %s is ambiguous" % prefix)
+
+
 class NoIndexPresent(Exception):
     """No index is present."""
 
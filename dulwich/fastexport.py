@@ -121,22 +121,57 @@ class GitImportProcessor(processor.ImportProcessor):
         self.last_commit = None
         self.markers = {}
         self._contents = {}
+        self._importer = None
+        self._ref_updates = {}
+
+    @property
+    def object_store(self):
+        """Object store that imported objects are added to.
+
+        While a stream is being imported this is an ObjectImporter, which
+        streams the new objects into a single pack.
+        """
+        if self._importer is not None:
+            return self._importer
+        return self.repo.object_store
+
+    def _set_ref(self, name, sha):
+        # Refs can only point at the objects of a stream once the pack they
+        # are in has been committed; see _finish_import.
+        if self._importer is not None:
+            self._ref_updates[name] = sha
+        else:
+            self.repo.refs[name] = sha
+
+    def _finish_import(self):
+        if self._importer is not None:
+            self._importer.finish()
+            self._importer = None
+        ref_updates, self._ref_updates = self._ref_updates, {}
+        for name, sha in ref_updates.iteritems():
+            self.repo.refs[name] = sha
 
     def import_stream(self, stream):
         p = parser.ImportParser(stream)
-        self.process(p.iter_commands)
+        self._importer = self.repo.object_store.get_importer()
+        try:
+            self.process(p.iter_commands)
+        finally:
+            self._finish_import()
         return self.markers
 
     def blob_handler(self, cmd):
         """Process a BlobCommand."""
         blob = Blob.from_string(cmd.data)
-        self.repo.object_store.add_object(blob)
+        self.object_store.add_object(blob)
         if cmd.mark:
             self.markers[cmd.mark] = blob.id
 
     def checkpoint_handler(self, cmd):
         """Process a CheckpointCommand."""
-        pass
+        if self._importer is not None:
+            self._finish_import()
+            self._importer = self.repo.object_store.get_importer()
 
     def commit_handler(self, cmd):
         """Process a CommitCommand."""
@@ -162,7 +197,7 @@ class GitImportProcessor(processor.ImportProcessor):
             if filecmd.name == "filemodify":
                 if filecmd.data is not None:
                     blob = Blob.from_string(filecmd.data)
-                    self.repo.object_store.add(blob)
+                    self.object_store.add_object(blob)
                     blob_id = blob.id
                 else:
                     assert filecmd.dataref[0] == ":", \
@@ -182,14 +217,14 @@ class GitImportProcessor(processor.ImportProcessor):
                 self._contents = {}
             else:
                 raise Exception("Command %s not supported" % filecmd.name)
-        commit.tree = commit_tree(self.repo.object_store,
+        commit.tree = commit_tree(self.object_store,
             ((path, hexsha, mode) for (path, (mode, hexsha)) in
                 self._contents.iteritems()))
         if self.last_commit is not None:
             commit.parents.append(self.last_commit)
         commit.parents += cmd.merges
-        self.repo.object_store.add_object(commit)
-        self.repo[cmd.ref] = commit.id
+        self.object_store.add_object(commit)
+        self._set_ref(cmd.ref, commit.id)
         self.last_commit = commit.id
         if cmd.mark:
             self.markers[cmd.mark] = commit.id
@@ -203,15 +238,15 @@ class GitImportProcessor(processor.ImportProcessor):
             return
         self.last_commit = commit_id
         self._contents = {}
-        tree_id = self.repo[commit_id].tree
+        tree_id = self.object_store[commit_id].tree
         for (path, mode, hexsha) in (
-                self.repo.object_store.iter_tree_contents(tree_id)):
+                self.object_store.iter_tree_contents(tree_id)):
             self._contents[path] = (mode, hexsha)
 
     def reset_handler(self, cmd):
         """Process a ResetCommand."""
         self._reset_base(cmd.from_)
-        self.repo.refs[cmd.ref] = cmd.from_
+        self._set_ref(cmd.ref, cmd.from_)
 
     def tag_handler(self, cmd):
         """Process a TagCommand."""
@@ -219,8 +254,8 @@ class GitImportProcessor(processor.ImportProcessor):
         tag.tagger = cmd.tagger
         tag.message = cmd.message
         tag.name = cmd.tag
-        self.repo.add_object(tag)
-        self.repo.refs["refs/tags/" + tag.name] = tag.id
+        self.object_store.add_object(tag)
+        self._set_ref("refs/tags/" + tag.name, tag.id)
 
     def feature_handler(self, cmd):
         """Process a FeatureCommand."""
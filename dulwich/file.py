@@ -20,9 +20,23 @@
 
 import errno
 import os
+import shutil
+import sys
 import tempfile
 import io
 
+# Errors from os.link() that mean a hardlink can not be made, rather than
+# that something is wrong.
+_LINK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP)
+
+# Linux ioctl that clones the extents of one file into another (FICLONE).
+_FICLONE = 0x40049409
+
+# Seconds within which a file modification may share its timestamp with a
+# later one on coarse-grained filesystems
+RACY_TIMESTAMP_INTERVAL = 2
+
+
 def ensure_dir_exists(dirname):
     """Ensure a directory exists, creating if necessary."""
     try:
@@ -62,6 +76,53 @@ def fancy_rename(oldname, newname):
     os.remove(tmpfile)
 
 
+def _reflink(src, dst):
+    """Try to make a file a copy-on-write clone of another.
+
+    :param src: File object to clone
+    :param dst: Empty file object to clone into
+    :return: Whether the clone was made
+    """
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    try:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def link_or_copy(src, dst):
+    """Create a file with the contents of another, sharing storage if possible.
+
+    A hardlink is made if possible. If not, e.g. because the files are on
+    different filesystems, a reflink is tried on Linux before falling back
+    to a plain copy.
+
+    :param src: Path of the existing file
+    :param dst: Path of the file to create
+    """
+    link = getattr(os, 'link', None)
+    if link is not None:
+        try:
+            link(src, dst)
+        except OSError as e:
+            if e.errno not in _LINK_ERRORS:
+                raise
+        else:
+            return
+    with open(src, 'rb') as srcf:
+        dstf = GitFile(dst, 'wb')
+        try:
+            if not _reflink(srcf, dstf):
+                shutil.copyfileobj(srcf, dstf)
+        except:
+            dstf.abort()
+            raise
+        dstf.close()
+
+
 def GitFile(filename, mode='rb', bufsize=-1):
     """Create a file object that obeys the git file locking protocol.
 
@@ -19,7 +19,6 @@
 """Access to hooks."""
 
 import os
-import subprocess
 import tempfile
 
 from dulwich.errors import (
@@ -82,6 +81,8 @@ class ShellHook(Hook):
         if (self.pre_exec_callback is not None):
             args = self.pre_exec_callback(*args)
 
+        # Imported here, as it is only needed when hooks exist.
+        import subprocess
         try:
             ret = subprocess.call([self.filepath] + list(args))
             if ret != 0:
@@ -20,6 +20,7 @@
 
 import collections
 import errno
+from itertools import islice
 import os
 import stat
 import struct
@@ -38,6 +39,9 @@ from dulwich.pack import (
     SHA1Writer,
     )
 
+# Number of blobs build_index_from_tree reads at once.
+READ_BATCH_SIZE = 256
+
 
 IndexEntry = collections.namedtuple(
     'IndexEntry', [
@@ -448,19 +452,27 @@ def build_index_from_tree(prefix, index_path, object_store, tree_id,
 
     index = Index(index_path)
 
-    for entry in object_store.iter_tree_contents(tree_id):
-        full_path = os.path.join(prefix, entry.path)
-
-        if not os.path.exists(os.path.dirname(full_path)):
-            os.makedirs(os.path.dirname(full_path))
-
-        # FIXME: Merge new index into working tree
-        obj = object_store[entry.sha]
-        build_file_from_blob(obj, entry.mode, full_path,
-            honor_filemode=honor_filemode)
-        # Add file to index
-        st = os.lstat(full_path)
-        index[entry.path] = index_entry_from_stat(st, entry.sha, 0)
+    entries = iter(object_store.iter_tree_contents(tree_id))
+    while True:
+        batch = list(islice(entries, READ_BATCH_SIZE))
+        if not batch:
+            break
+        # Read the blobs of a batch at once, in the order that is cheapest
+        # for the object store, fetching those left out of a partial clone.
+        blobs = dict((obj.id, obj) for obj in object_store.iter_objects(
+            set(entry.sha for entry in batch), fetch_missing=True))
+        for entry in batch:
+            full_path = os.path.join(prefix, entry.path)
+
+            if not os.path.exists(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+
+            # FIXME: Merge new index into working tree
+            build_file_from_blob(blobs[entry.sha], entry.mode, full_path,
+                honor_filemode=honor_filemode)
+            # Add file to index
+            st = os.lstat(full_path)
+            index[entry.path] = index_entry_from_stat(st, entry.sha, 0)
 
     index.write()
 
@@ -0,0 +1,260 @@
+# metrics.py -- Counters and timers for hot paths
+# Copyright (C) 2014 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Counters and timers for hot paths.
+
+Instrumented code reports to the collector returned by get_metrics(). By
+default that is a NullMetrics, which ignores everything, so instrumentation
+costs little more than a function call when nobody is collecting. To
+collect, install a Metrics for the current thread::
+
+    with collect_metrics() as metrics:
+        repo.object_store[sha]
+    print metrics.as_dict()
+
+Three kinds of metrics are kept:
+
+ * counters, incremented with incr()
+ * distributions (count, total and maximum of observed values), recorded
+   with observe()
+ * timers, recorded with timer() or timed_iter(). Timers nest: besides the
+   total time spent in a timer, its "self" time excludes the time spent in
+   timers started while it was running, so time can be attributed to the
+   innermost phase it was spent in.
+
+Names are dotted, starting with the area of code they are reported from,
+e.g. "object_store.pack_hits" or "pack.inflate". Server handlers collect
+the metrics of each session in their metrics attribute.
+
+Metrics are kept per thread; work done in worker threads (such as the
+compression threads of write_pack_data) is attributed to whichever timer
+the calling thread is waiting in.
+"""
+
+try:
+    # Avoid importing threading just for thread-local storage.
+    from thread import _local as local
+except ImportError:
+    from threading import local
+import time
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class NullMetrics(object):
+    """Metrics collector that ignores everything reported to it."""
+
+    enabled = False
+
+    def incr(self, name, value=1):
+        """Increment a counter.
+
+        :param name: Name of the counter
+        :param value: Amount to increment it by
+        """
+
+    def observe(self, name, value):
+        """Record a value in a distribution.
+
+        :param name: Name of the distribution
+        :param value: Value to record
+        """
+
+    def add_time(self, name, seconds):
+        """Record time spent, outside of any other timer.
+
+        :param name: Name of the timer
+        :param seconds: Time spent
+        """
+
+    def timer(self, name):
+        """Time a block of code.
+
+        :param name: Name of the timer
+        :return: Context manager
+        """
+        return _null_timer
+
+    def timed_iter(self, iterable, name):
+        """Time the production of the items of an iterable.
+
+        :param iterable: Iterable to time
+        :param name: Name of the timer
+        :return: Iterator over the items of iterable
+        """
+        return iterable
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+        self._child_time = 0
+
+    def __enter__(self):
+        self._metrics._active.append(self)
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.time() - self._start
+        active = self._metrics._active
+        active.pop()
+        if active:
+            active[-1]._child_time += elapsed
+        self._metrics._record_time(
+            self._name, elapsed, elapsed - self._child_time)
+        return False
+
+
+class Metrics(NullMetrics):
+    """Metrics collector that keeps everything reported to it.
+
+    A Metrics should only be installed in one thread at a time.
+
+    :ivar counters: Dictionary mapping counter names to values
+    :ivar distributions: Dictionary mapping distribution names to lists of
+        count, total and maximum
+    :ivar timers: Dictionary mapping timer names to lists of count, total
+        time and self time
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.counters = {}
+        self.distributions = {}
+        self.timers = {}
+        self._active = []
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        try:
+            dist = self.distributions[name]
+        except KeyError:
+            self.distributions[name] = [1, value, value]
+        else:
+            dist[0] += 1
+            dist[1] += value
+            if value > dist[2]:
+                dist[2] = value
+
+    def _record_time(self, name, total, self_time):
+        try:
+            timer = self.timers[name]
+        except KeyError:
+            self.timers[name] = [1, total, self_time]
+        else:
+            timer[0] += 1
+            timer[1] += total
+            timer[2] += self_time
+
+    def add_time(self, name, seconds):
+        self._record_time(name, seconds, seconds)
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def timed_iter(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            with _Timer(self, name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def hit_ratio(self, name):
+        """Return the hit ratio of a cache.
+
+        :param name: Prefix of the cache's counters; hits and misses are
+            counted in name + "_hits" and name + "_misses"
+        :return: Fraction of the lookups that were hits, or None if there
+            were no lookups
+        """
+        hits = self.counters.get(name + "_hits", 0)
+        misses = self.counters.get(name + "_misses", 0)
+        if not hits + misses:
+            return None
+        return float(hits) / (hits + misses)
+
+    def as_dict(self):
+        """Return the collected metrics as a dictionary.
+
+        :return: Dictionary with "counters", "distributions" and "timers"
+            dictionaries, suitable for serializing as JSON
+        """
+        return {
+            "counters": dict(self.counters),
+            "distributions": dict(
+                (name, {"count": count, "total": total, "max": maximum})
+                for (name, (count, total, maximum))
+                in self.distributions.items()),
+            "timers": dict(
+                (name, {"count": count, "total": total, "self": self_time})
+                for (name, (count, total, self_time))
+                in self.timers.items()),
+            }
+
+
+_null_metrics = NullMetrics()
+
+_local = local()
+
+
+def get_metrics():
+    """Return the metrics collector for the current thread."""
+    return getattr(_local, "metrics", _null_metrics)
+
+
+class collect_metrics(object):
+    """Context manager that installs a metrics collector.
+
+    The previous collector is restored on exit.
+
+    :param metrics: Collector to install; a new Metrics if None
+    """
+
+    def __init__(self, metrics=None):
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+
+    def __enter__(self):
+        self._previous = get_metrics()
+        _local.metrics = self.metrics
+        return self.metrics
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local.metrics = self._previous
+        return False
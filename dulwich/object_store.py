@@ -23,20 +23,32 @@
 
 from io import BytesIO
 import errno
-from itertools import chain
+import heapq
+from itertools import chain, count, imap, islice
 import os
 import stat
 import tempfile
+import zlib
 
 from dulwich.diff_tree import (
     tree_changes,
     walk_trees,
     )
 from dulwich.errors import (
+    GitProtocolError,
     NotTreeError,
     )
-from dulwich.file import GitFile
+from dulwich.file import (
+    GitFile,
+    ensure_dir_exists,
+    link_or_copy,
+    )
+from dulwich.lru_cache import LRUCache
+from dulwich.metrics import (
+    get_metrics,
+    )
 from dulwich.objects import (
+    Blob,
     Commit,
     ShaFile,
     Tag,
@@ -60,19 +72,69 @@ from dulwich.pack import (
     compute_file_sha,
     PackIndexer,
     PackStreamCopier,
+    SHA1Writer,
+    unpack_object,
+    _inflate_prefix,
     )
+from dulwich.progress import (
+    COUNTING_OBJECTS,
+    ProgressMeter,
+    TextProgressReporter,
+    )
+
 
 INFODIR = 'info'
 PACKDIR = 'pack'
 
+# Number of objects ObjectStoreIterator reads at once.
+READ_BATCH_SIZE = 256
+
 
 class BaseObjectStore(object):
     """Object store interface."""
 
-    def determine_wants_all(self, refs):
+    def determine_wants_all(self, refs, depth=None):
+        """Determine the refs to fetch to get all objects.
+
+        :param refs: Dictionary with the remote refs
+        :param depth: Optional depth of a shallow fetch; refs whose history
+            is available locally to a smaller depth are fetched again, so
+            that their history can be deepened
+        :return: List of SHA1s to fetch
+        """
+        def want_deepen(sha):
+            if not depth:
+                return False
+            return self._get_depth(sha, max_depth=depth) < depth
         return [sha for (ref, sha) in refs.iteritems()
-                if not sha in self and not ref.endswith("^{}") and
-                   not sha == ZERO_SHA]
+                if (not sha in self or want_deepen(sha)) and
+                   not ref.endswith("^{}") and not sha == ZERO_SHA]
+
+    def _get_depth(self, head, max_depth=None):
+        """Return the depth of the history available for a commit.
+
+        :param head: SHA1 of the commit, or of a tag pointing at it
+        :param max_depth: Optional depth at which to stop looking
+        :return: The number of commits along the longest available path
+            from head, or 0 if head is not present
+        """
+        if head not in self:
+            return 0
+        obj = self.peel_sha(head)
+        if not isinstance(obj, Commit):
+            return 0
+        current_depth = 1
+        seen = {}
+        todo = [(obj, 1)]
+        while todo and (max_depth is None or current_depth < max_depth):
+            commit, depth = todo.pop()
+            if seen.get(commit.id, 0) >= depth:
+                continue
+            seen[commit.id] = depth
+            current_depth = max(current_depth, depth)
+            todo.extend((self[p], depth + 1) for p in commit.parents
+                        if p in self)
+        return current_depth
 
     def iter_shas(self, shas):
         """Iterate over the objects for the specified shas.
@@ -110,15 +172,60 @@ class BaseObjectStore(object):
         """
         raise NotImplementedError(self.get_raw)
 
+    def get_object_size(self, name):
+        """Obtain the size of the contents of an object.
+
+        Object stores that can read the size from the object header do so
+        without inflating the object.
+
+        :param name: sha for the object.
+        :return: Size of the object contents.
+        """
+        type_num, uncomp = self.get_raw(name)
+        return len(uncomp)
+
     def __getitem__(self, sha):
         """Obtain an object by SHA1."""
         type_num, uncomp = self.get_raw(sha)
-        return ShaFile.from_raw_string(type_num, uncomp, sha=sha)
+        return ShaFile.from_raw_string(type_num, uncomp, sha=sha, lazy=True)
+
+    def iter_objects(self, shas, allow_missing=False, fetch_missing=False):
+        """Obtain several objects at once.
+
+        The objects are returned in whatever order is cheapest to read them
+        in, which is not necessarily the order of shas.
+
+        :param shas: Iterable of hex SHA1s
+        :param allow_missing: Whether to skip missing objects, rather than
+            raising KeyError
+        :param fetch_missing: Whether to fetch objects that are missing from
+            a partial clone from its promisor remote
+        :return: Iterator over ShaFile objects
+        """
+        for sha in shas:
+            try:
+                obj = self[sha]
+            except KeyError:
+                if not allow_missing:
+                    raise
+            else:
+                yield obj
 
     def __iter__(self):
         """Iterate over the SHAs that are present in this store."""
         raise NotImplementedError(self.__iter__)
 
+    def iter_prefix(self, prefix):
+        """Iterate over the SHAs in this store that start with a prefix.
+
+        :param prefix: Lowercase hex SHA1 prefix, of any length
+        :return: Iterator over hex SHAs; a SHA may be returned more than
+            once if the object is stored more than once
+        """
+        for sha in self:
+            if sha.startswith(prefix):
+                yield sha
+
     def add_object(self, obj):
         """Add a single object to this object store.
 
@@ -132,6 +239,15 @@ class BaseObjectStore(object):
         """
         raise NotImplementedError(self.add_objects)
 
+    def get_importer(self, count=None):
+        """Start importing a large number of objects into this store.
+
+        :param count: Number of objects that's going to be imported, if known
+        :return: An ObjectImporter; objects added to it become part of
+            this store when its finish() method is called.
+        """
+        return ObjectImporter(self, count)
+
     def tree_changes(self, source, target, want_unchanged=False):
         """Find the differences between the contents of two trees
 
@@ -163,7 +279,8 @@ class BaseObjectStore(object):
 
     def find_missing_objects(self, haves, wants, progress=None,
                              get_tagged=None,
-                             get_parents=lambda commit: commit.parents):
+                             get_parents=lambda commit: commit.parents,
+                             object_filter=None):
         """Find the missing objects required for a set of revisions.
 
         :param haves: Iterable over SHAs already in common.
@@ -173,11 +290,98 @@ class BaseObjectStore(object):
         :param get_tagged: Function that returns a dict of pointed-to sha -> tag
             sha for including tags.
         :param get_parents: Optional function for getting the parents of a commit.
+        :param object_filter: Optional ObjectFilter selecting the trees and
+            blobs to include, for partial clones.
         :return: Iterator over (sha, path) pairs.
         """
-        finder = MissingObjectFinder(self, haves, wants, progress, get_tagged, get_parents=get_parents)
+        finder = MissingObjectFinder(self, haves, wants, progress, get_tagged,
+                                     get_parents=get_parents,
+                                     object_filter=object_filter)
         return iter(finder.next, None)
 
+    def find_merge_bases(self, commit_ids,
+                         get_parents=lambda commit: commit.parents,
+                         get_generation=None):
+        """Find the best common ancestors of commits, like git merge-base --all.
+
+        With more than two commits, the merge bases of the first commit and
+        a hypothetical merge of the others are found.
+
+        :param commit_ids: List of at least two commit SHAs
+        :param get_parents: Optional function for getting the parents of a
+            commit.
+        :param get_generation: Optional function returning the generation
+            number of a commit SHA (e.g. from a commit-graph file), used to
+            order the walk instead of just commit dates
+        :return: List of merge base SHAs, newest first; none of them is an
+            ancestor of another
+        """
+        one, twos = commit_ids[0], commit_ids[1:]
+        if one in twos:
+            return [one]
+        flags, candidates = _paint_down_to_common(
+            self, one, twos, get_parents, get_generation)
+        if len(candidates) <= 1:
+            return candidates
+        return [sha for sha in candidates
+                if not any(self.is_ancestor(sha, other, get_parents,
+                                            get_generation)
+                           for other in candidates if other != sha)]
+
+    def is_ancestor(self, ancestor, descendant,
+                    get_parents=lambda commit: commit.parents,
+                    get_generation=None):
+        """Check whether a commit is an ancestor of another commit.
+
+        A commit is considered to be an ancestor of itself.
+
+        :param ancestor: SHA of the possible ancestor
+        :param descendant: SHA of the possible descendant
+        :param get_parents: Optional function for getting the parents of a
+            commit.
+        :param get_generation: Optional function returning the generation
+            number of a commit SHA; commits older than ancestor by
+            generation are not walked
+        :return: True if ancestor is reachable from descendant
+        """
+        if ancestor == descendant:
+            return True
+        if get_generation is None:
+            min_generation = 0
+        else:
+            min_generation = get_generation(ancestor)
+        flags, _ = _paint_down_to_common(
+            self, ancestor, [descendant], get_parents, get_generation,
+            min_generation=min_generation, stop_at=ancestor)
+        return bool(flags[ancestor] & _PARENT2)
+
+    def ahead_behind(self, one, two, get_parents=lambda commit: commit.parents,
+                     get_generation=None):
+        """Count the commits that are only reachable from one of two commits.
+
+        The counts are exact unless commits are newer than their children,
+        in which case only generation numbers give exact results.
+
+        :param one: SHA of the first commit
+        :param two: SHA of the second commit
+        :param get_parents: Optional function for getting the parents of a
+            commit.
+        :param get_generation: Optional function returning the generation
+            number of a commit SHA
+        :return: Tuple with the number of commits reachable from one but
+            not from two, and the number reachable from two but not from one
+        """
+        flags, _ = _paint_down_to_common(
+            self, one, [two], get_parents, get_generation, exact=True)
+        ahead = behind = 0
+        for flag in flags.itervalues():
+            flag &= _PARENT1 | _PARENT2
+            if flag == _PARENT1:
+                ahead += 1
+            elif flag == _PARENT2:
+                behind += 1
+        return ahead, behind
+
     def find_common_revisions(self, graphwalker):
         """Find which revisions this store has in common using graphwalker.
 
@@ -250,6 +454,10 @@ class BaseObjectStore(object):
 
 class PackBasedObjectStore(BaseObjectStore):
 
+    # PromisorRemote (see dulwich.partial_clone) that missing objects can be
+    # fetched from with iter_objects, if the repository is a partial clone
+    promisor = None
+
     def __init__(self):
         self._pack_cache = {}
 
@@ -317,6 +525,12 @@ class PackBasedObjectStore(BaseObjectStore):
     def _get_loose_object(self, sha):
         raise NotImplementedError(self._get_loose_object)
 
+    def _get_loose_object_size(self, sha):
+        obj = self._get_loose_object(sha)
+        if obj is None:
+            return None
+        return obj.raw_length()
+
     def _remove_loose_object(self, sha):
         raise NotImplementedError(self._remove_loose_object)
 
@@ -325,19 +539,45 @@ class PackBasedObjectStore(BaseObjectStore):
 
         :return: Number of objects packed
         """
-        objects = set()
-        for sha in self._iter_loose_objects():
-            objects.add((self._get_loose_object(sha), None))
-        self.add_objects(list(objects))
-        for obj, path in objects:
-            self._remove_loose_object(obj.id)
-        return len(objects)
+        shas = list(self._iter_loose_objects())
+        if not shas:
+            return 0
+        importer = self.get_importer(len(shas))
+        try:
+            for sha in shas:
+                importer.add_object(self._get_loose_object(sha))
+        except:
+            importer.abort()
+            raise
+        importer.finish()
+        for sha in shas:
+            self._remove_loose_object(sha)
+        return len(shas)
 
     def __iter__(self):
         """Iterate over the SHAs that are present in this store."""
         iterables = self.packs + [self._iter_loose_objects()] + [self._iter_alternate_objects()]
         return chain(*iterables)
 
+    def _iter_loose_prefix(self, prefix):
+        """Iterate over the SHAs of loose objects that start with a prefix."""
+        for sha in self._iter_loose_objects():
+            if sha.startswith(prefix):
+                yield sha
+
+    def iter_prefix(self, prefix):
+        """Iterate over the SHAs in this store that start with a prefix.
+
+        :param prefix: Lowercase hex SHA1 prefix, of any length
+        :return: Iterator over hex SHAs; a SHA may be returned more than
+            once if the object is stored more than once
+        """
+        iterables = ([pack.index.iter_prefix(prefix) for pack in self.packs] +
+                     [self._iter_loose_prefix(prefix)] +
+                     [alternate.iter_prefix(prefix)
+                      for alternate in self.alternates])
+        return chain(*iterables)
+
     def contains_loose(self, sha):
         """Check if a particular object is present by SHA1 and is loose.
 
@@ -359,23 +599,149 @@ class PackBasedObjectStore(BaseObjectStore):
             hexsha = None
         else:
             raise AssertionError("Invalid object name %r" % name)
+        metrics = get_metrics()
         for pack in self.packs:
+            metrics.incr('object_store.pack_lookups')
             try:
-                return pack.get_raw(sha)
+                ret = pack.get_raw(sha)
             except KeyError:
                 pass
+            else:
+                metrics.incr('object_store.pack_hits')
+                if metrics.enabled:
+                    metrics.incr('object_store.pack_hits.%s' %
+                                 os.path.basename(pack._basename))
+                return ret
         if hexsha is None:
             hexsha = sha_to_hex(name)
         ret = self._get_loose_object(hexsha)
         if ret is not None:
+            metrics.incr('object_store.loose_hits')
             return ret.type_num, ret.as_raw_string()
         for alternate in self.alternates:
             try:
-                return alternate.get_raw(hexsha)
+                ret = alternate.get_raw(hexsha)
+            except KeyError:
+                pass
+            else:
+                metrics.incr('object_store.alternate_hits')
+                return ret
+        metrics.incr('object_store.misses')
+        raise KeyError(hexsha)
+
+    def get_object_size(self, name):
+        """Obtain the size of the contents of an object.
+
+        The size is read from the pack or loose object header, without
+        inflating the object.
+
+        :param name: sha for the object.
+        :return: Size of the object contents.
+        """
+        if len(name) == 40:
+            sha = hex_to_sha(name)
+            hexsha = name
+        elif len(name) == 20:
+            sha = name
+            hexsha = None
+        else:
+            raise AssertionError("Invalid object name %r" % name)
+        for pack in self.packs:
+            try:
+                return pack.get_object_size(sha)
+            except KeyError:
+                pass
+        if hexsha is None:
+            hexsha = sha_to_hex(name)
+        ret = self._get_loose_object_size(hexsha)
+        if ret is not None:
+            return ret
+        for alternate in self.alternates:
+            try:
+                return alternate.get_object_size(hexsha)
             except KeyError:
                 pass
         raise KeyError(hexsha)
 
+    def _iter_packed_objects(self, todo):
+        """Obtain the packed objects among a set, removing them from it.
+
+        :param todo: Set of hex SHA1s
+        :return: Iterator over ShaFile objects
+        """
+        metrics = get_metrics()
+        for pack in self.packs:
+            if not todo:
+                break
+            found = [sha for sha in todo if sha in pack]
+            if not found:
+                continue
+            metrics.incr('object_store.pack_hits', len(found))
+            todo.difference_update(found)
+            for obj in pack.resolve_objects(found):
+                yield obj
+
+    def _fetch_promised(self, shas):
+        """Fetch objects from the promisor remote.
+
+        :param shas: Hex SHA1s of the objects to fetch
+        :return: Whether the objects were fetched; if the remote could not
+            be reached, they are treated as missing
+        """
+        try:
+            self.promisor.fetch(shas)
+        except (GitProtocolError, EnvironmentError):
+            return False
+        return True
+
+    def iter_objects(self, shas, allow_missing=False, fetch_missing=False):
+        """Obtain several objects at once.
+
+        Packed objects are read pack by pack in the order they are stored
+        in, and delta bases shared by several of them are only inflated
+        once (see Pack.resolve_objects). Loose objects and objects in
+        alternates follow.
+
+        :param shas: Iterable of hex SHA1s
+        :param allow_missing: Whether to skip missing objects, rather than
+            raising KeyError
+        :param fetch_missing: Whether to fetch objects that are missing from
+            a partial clone from its promisor remote, in a single request.
+            Other lookups never contact the promisor remote.
+        :return: Iterator over ShaFile objects
+        """
+        metrics = get_metrics()
+        todo = set(shas)
+        for obj in self._iter_packed_objects(todo):
+            yield obj
+        missing = []
+        for sha in sorted(todo):
+            obj = self._get_loose_object(sha)
+            if obj is None:
+                missing.append(sha)
+            else:
+                metrics.incr('object_store.loose_hits')
+                yield obj
+        for alternate in self.alternates:
+            if not missing:
+                break
+            found = set()
+            for obj in alternate.iter_objects(missing, allow_missing=True):
+                metrics.incr('object_store.alternate_hits')
+                found.add(obj.id)
+                yield obj
+            missing = [sha for sha in missing if sha not in found]
+        if (missing and fetch_missing and self.promisor is not None and
+                self._fetch_promised(missing)):
+            todo = set(missing)
+            for obj in self._iter_packed_objects(todo):
+                yield obj
+            missing = sorted(todo)
+        if missing:
+            metrics.incr('object_store.misses', len(missing))
+            if not allow_missing:
+                raise KeyError(missing[0])
+
     def add_objects(self, objects):
         """Add a set of objects to this object store.
 
@@ -466,6 +832,39 @@ class DiskObjectStore(PackBasedObjectStore):
             path = os.path.join(self.path, path)
         self.alternates.append(DiskObjectStore(path))
 
+    def copy_from(self, source):
+        """Add all objects in another object store on the same machine.
+
+        The pack files and loose objects of the source are hardlinked where
+        possible (see `dulwich.file.link_or_copy`), so no objects are
+        unpacked or compressed again. The .keep and .promisor markers of the
+        packs are copied along. The alternates of the source are added to
+        this store.
+
+        :param source: `DiskObjectStore` to copy the objects of
+        """
+        for path in source._read_alternate_paths():
+            self.add_alternate_path(os.path.abspath(path))
+        for pack in source.packs:
+            basename = os.path.join(self.pack_dir,
+                                    os.path.basename(pack._basename))
+            if os.path.exists(basename + ".pack"):
+                continue
+            # Link the index and markers first, as the pack file is what
+            # makes the pack visible.
+            for ext in (".keep", ".promisor"):
+                if os.path.exists(pack._basename + ext):
+                    link_or_copy(pack._basename + ext, basename + ext)
+            link_or_copy(pack._basename + ".idx", basename + ".idx")
+            link_or_copy(pack._basename + ".pack", basename + ".pack")
+            self._add_known_pack(basename, Pack(basename))
+        for sha in source._iter_loose_objects():
+            path = self._get_shafile_path(sha)
+            if os.path.exists(path):
+                continue
+            ensure_dir_exists(os.path.dirname(path))
+            link_or_copy(source._get_shafile_path(sha), path)
+
     def _update_pack_cache(self):
         try:
             pack_dir_contents = os.listdir(self.pack_dir)
@@ -509,6 +908,23 @@ class DiskObjectStore(PackBasedObjectStore):
             for rest in os.listdir(os.path.join(self.path, base)):
                 yield base+rest
 
+    def _iter_loose_prefix(self, prefix):
+        if len(prefix) < 2:
+            bases = [base for base in os.listdir(self.path)
+                     if len(base) == 2 and base.startswith(prefix)]
+        else:
+            bases = [prefix[:2]]
+        for base in bases:
+            try:
+                names = os.listdir(os.path.join(self.path, base))
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            for rest in names:
+                if (base + rest).startswith(prefix):
+                    yield base + rest
+
     def _get_loose_object(self, sha):
         path = self._get_shafile_path(sha)
         try:
@@ -518,10 +934,30 @@ class DiskObjectStore(PackBasedObjectStore):
                 return None
             raise
 
+    def _get_loose_object_size(self, sha):
+        path = self._get_shafile_path(sha)
+        try:
+            f = GitFile(path, 'rb')
+        except (OSError, IOError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        with f:
+            try:
+                header = _inflate_prefix(f.read, 32)
+            except zlib.error:
+                # Not zlib-compressed as a whole, i.e. an object in the
+                # experimental loose format.
+                header = ''
+        if '\0' not in header:
+            return super(DiskObjectStore, self)._get_loose_object_size(sha)
+        type_name, size = header[:header.index('\0')].split(' ', 1)
+        return int(size)
+
     def _remove_loose_object(self, sha):
         os.remove(self._get_shafile_path(sha))
 
-    def _complete_thin_pack(self, f, path, copier, indexer):
+    def _complete_thin_pack(self, f, path, entries, ext_refs):
         """Move a specific file containing a pack into the pack directory.
 
         :note: The file should be on the same file system as the
@@ -529,14 +965,16 @@ class DiskObjectStore(PackBasedObjectStore):
 
         :param f: Open file object for the pack.
         :param path: Path to the pack file.
-        :param copier: A PackStreamCopier to use for writing pack data.
-        :param indexer: A PackIndexer for indexing the pack.
+        :param entries: List of (sha, offset, crc32) tuples for the objects
+            in the pack.
+        :param ext_refs: Binary SHAs of the external objects the deltas in the
+            pack are based on.
         """
-        entries = list(indexer)
+        entries = list(entries)
 
         # Update the header with the new number of objects.
         f.seek(0)
-        write_pack_header(f, len(entries) + len(indexer.ext_refs()))
+        write_pack_header(f, len(entries) + len(ext_refs))
 
         # Must flush before reading (http://bugs.python.org/issue3207)
         f.flush()
@@ -548,7 +986,7 @@ class DiskObjectStore(PackBasedObjectStore):
         f.seek(0, os.SEEK_CUR)
 
         # Complete the pack.
-        for ext_sha in indexer.ext_refs():
+        for ext_sha in ext_refs:
             assert len(ext_sha) == 20
             type_num, data = self.get_raw(ext_sha)
             offset = f.tell()
@@ -578,7 +1016,7 @@ class DiskObjectStore(PackBasedObjectStore):
         self._add_known_pack(pack_base_name, final_pack)
         return final_pack
 
-    def add_thin_pack(self, read_all, read_some):
+    def add_thin_pack(self, read_all, read_some, progress=None):
         """Add a new thin pack to this object store.
 
         Thin packs are packs that contain deltas with parents that exist outside
@@ -589,16 +1027,21 @@ class DiskObjectStore(PackBasedObjectStore):
             bytes are read.
         :param read_some: Read function that returns at least one byte, but may
             not return the number of bytes requested.
+        :param progress: Optional progress reporter for resolving deltas;
+            see dulwich.progress
         :return: A Pack object pointing at the now-completed thin pack in the
             objects/pack directory.
         """
         fd, path = tempfile.mkstemp(dir=self.path, prefix='tmp_pack_')
         with os.fdopen(fd, 'w+b') as f:
-            indexer = PackIndexer(f, resolve_ext_ref=self.get_raw)
+            indexer = PackIndexer(f, resolve_ext_ref=self.get_raw,
+                                  progress=progress)
             copier = PackStreamCopier(read_all, read_some, f,
                                       delta_iter=indexer)
             copier.verify()
-            return self._complete_thin_pack(f, path, copier, indexer)
+            entries = list(indexer)
+            return self._complete_thin_pack(f, path, entries,
+                                            indexer.ext_refs())
 
     def move_in_pack(self, path):
         """Move a specific file containing a pack into the pack directory.
@@ -609,11 +1052,31 @@ class DiskObjectStore(PackBasedObjectStore):
         :param path: Path to the pack file.
         """
         with PackData(path) as p:
-            entries = p.sorted_entries()
-            basename = os.path.join(self.pack_dir,
-                "pack-%s" % iter_sha1(entry[0] for entry in entries))
-            with GitFile(basename+".idx", "wb") as f:
-                write_pack_index_v2(f, entries, p.get_stored_checksum())
+            indexer = PackIndexer.for_pack_data(p,
+                resolve_ext_ref=self.get_raw)
+            entries = list(indexer)
+            pack_checksum = p.get_stored_checksum()
+        if indexer.ext_refs():
+            # A thin pack; add the objects its deltas are based on.
+            with open(path, 'r+b') as f:
+                return self._complete_thin_pack(f, path, entries,
+                                                indexer.ext_refs())
+        entries.sort()
+        return self._install_pack(path, entries, pack_checksum)
+
+    def _install_pack(self, path, entries, pack_checksum):
+        """Write the index for a complete pack and move it into place.
+
+        :param path: Path to the pack file.
+        :param entries: Sorted list of (sha, offset, crc32) tuples for the
+            objects in the pack.
+        :param pack_checksum: Checksum of the pack.
+        :return: The new Pack object
+        """
+        basename = os.path.join(self.pack_dir,
+            "pack-%s" % iter_sha1(entry[0] for entry in entries))
+        with GitFile(basename+".idx", "wb") as f:
+            write_pack_index_v2(f, entries, pack_checksum)
         os.rename(path, basename + ".pack")
         final_pack = Pack(basename)
         self._add_known_pack(basename, final_pack)
@@ -641,6 +1104,15 @@ class DiskObjectStore(PackBasedObjectStore):
             os.remove(path)
         return f, commit, abort
 
+    def get_importer(self, count=None):
+        """Start importing a large number of objects into this store.
+
+        :param count: Number of objects that's going to be imported, if known
+        :return: An ObjectImporter; objects added to it become part of
+            this store when its finish() method is called.
+        """
+        return DiskObjectImporter(self, count)
+
     def add_object(self, obj):
         """Add a single object to this object store.
 
@@ -745,7 +1217,8 @@ class MemoryObjectStore(BaseObjectStore):
         def commit():
             p = PackData.from_file(BytesIO(f.getvalue()), f.tell())
             f.close()
-            for obj in PackInflater.for_pack_data(p):
+            for obj in PackInflater.for_pack_data(
+                    p, resolve_ext_ref=self.get_raw):
                 self._data[obj.id] = obj
         def abort():
             pass
@@ -774,7 +1247,7 @@ class MemoryObjectStore(BaseObjectStore):
         pack_sha = new_sha.digest()
         f.write(pack_sha)
 
-    def add_thin_pack(self, read_all, read_some):
+    def add_thin_pack(self, read_all, read_some, progress=None):
         """Add a new thin pack to this object store.
 
         Thin packs are packs that contain deltas with parents that exist outside
@@ -785,10 +1258,13 @@ class MemoryObjectStore(BaseObjectStore):
             bytes are read.
         :param read_some: Read function that returns at least one byte, but may
             not return the number of bytes requested.
+        :param progress: Optional progress reporter for resolving deltas;
+            see dulwich.progress
         """
         f, commit, abort = self.add_pack()
         try:
-            indexer = PackIndexer(f, resolve_ext_ref=self.get_raw)
+            indexer = PackIndexer(f, resolve_ext_ref=self.get_raw,
+                                  progress=progress)
             copier = PackStreamCopier(read_all, read_some, f, delta_iter=indexer)
             copier.verify()
             self._complete_thin_pack(f, indexer)
@@ -799,23 +1275,201 @@ class MemoryObjectStore(BaseObjectStore):
             commit()
 
 
-class ObjectImporter(object):
-    """Interface for importing objects."""
+class ObjectImporter(BaseObjectStore):
+    """Importer that streams a large number of objects into a single pack.
+
+    Objects are compressed and appended to a new pack as they are added,
+    rather than being stored one at a time. An in-memory index of the
+    objects written so far is kept, so that they can be read back before
+    the import has finished; the importer can be used as an object store
+    in the meantime, falling back to the store that is imported into.
+
+    Nothing is added to that object store until finish() is called.
+    """
 
-    def __init__(self, count):
+    def __init__(self, object_store, count=None):
         """Create a new ObjectImporter.
 
-        :param count: Number of objects that's going to be imported.
+        :param object_store: Object store to import into
+        :param count: Number of objects that's going to be imported, if
+            known. If it is not, the pack header is rewritten when finishing.
         """
+        super(ObjectImporter, self).__init__()
+        self.object_store = object_store
         self.count = count
+        self._entries = {}
+        self._f = self._open_pack()
+        self._write = SHA1Writer(self._f)
+        write_pack_header(self._write, count or 0)
 
-    def add_object(self, object):
-        """Add an object."""
-        raise NotImplementedError(self.add_object)
+    def _open_pack(self):
+        """Open the file the new pack is written to.
+
+        :return: A file-like object that supports reading, writing and seeking
+        """
+        f, self._commit, self._abort = self.object_store.add_pack()
+        return f
+
+    def _commit_pack(self, entries, pack_checksum):
+        """Add the finished pack to the object store.
+
+        :param entries: Sorted list of (sha, offset, crc32) tuples for the
+            objects in the pack
+        :param pack_checksum: Checksum of the pack
+        :return: Pack object of the objects written, if any
+        """
+        return self._commit()
+
+    def __len__(self):
+        """Return the number of objects added so far."""
+        return len(self._entries)
+
+    def contains_loose(self, sha):
+        """Check if a particular object is present by SHA1 and is loose."""
+        return self.object_store.contains_loose(sha)
+
+    def contains_packed(self, sha):
+        """Check if a particular object is present by SHA1 and is packed.
+
+        Objects that have been added to this importer count as packed.
+        """
+        if len(sha) == 40:
+            bin_sha = hex_to_sha(sha)
+        else:
+            bin_sha = sha
+        return (bin_sha in self._entries or
+                self.object_store.contains_packed(sha))
+
+    @property
+    def packs(self):
+        """List with pack objects."""
+        return self.object_store.packs
+
+    def __iter__(self):
+        """Iterate over the SHAs that are present in this importer and the
+        object store that is imported into."""
+        return chain((sha_to_hex(sha) for sha in self._entries),
+                     iter(self.object_store))
+
+    def iter_prefix(self, prefix):
+        """Iterate over the SHAs in this importer and the object store that
+        is imported into that start with a prefix."""
+        return chain((sha for sha in imap(sha_to_hex, self._entries)
+                      if sha.startswith(prefix)),
+                     self.object_store.iter_prefix(prefix))
+
+    def get_raw(self, name):
+        """Obtain the raw text for an object.
+
+        :param name: sha for the object.
+        :return: tuple with numeric type and object contents.
+        """
+        if len(name) == 40:
+            sha = hex_to_sha(name)
+        else:
+            sha = name
+        try:
+            offset, crc32 = self._entries[sha]
+        except KeyError:
+            return self.object_store.get_raw(name)
+        def read(size):
+            # The pack trailer hasn't been written yet; pad the file so that
+            # the end of the zlib stream of the last object can be detected.
+            return self._f.read(size) or '\0' * 20
+        self._f.seek(offset)
+        try:
+            unpacked, unused = unpack_object(read)
+        finally:
+            self._f.seek(0, os.SEEK_END)
+        return unpacked.pack_type_num, ''.join(unpacked.decomp_chunks)
+
+    def get_object_size(self, name):
+        """Obtain the size of the contents of an object.
+
+        :param name: sha for the object.
+        :return: Size of the object contents.
+        """
+        if len(name) == 40:
+            sha = hex_to_sha(name)
+        else:
+            sha = name
+        if sha not in self._entries:
+            return self.object_store.get_object_size(name)
+        return super(ObjectImporter, self).get_object_size(name)
+
+    def add_object(self, obj):
+        """Add a single object to the pack being imported.
+
+        Objects that have already been added are skipped.
+
+        :param obj: Object to add
+        """
+        sha = obj.sha().digest()
+        if sha in self._entries:
+            return
+        offset = self._write.offset()
+        crc32 = write_pack_object(self._write, obj.type_num,
+                                  obj.as_raw_string())
+        self._entries[sha] = (offset, crc32)
+
+    def add_objects(self, objects):
+        """Add a set of objects to the pack being imported.
+
+        :param objects: Iterable over (object, path) tuples
+        """
+        for obj, path in objects:
+            self.add_object(obj)
+
+    def finish(self):
+        """Finish the import and add the new pack to the object store.
+
+        :return: Pack object of the objects written, or None if no objects
+            were added.
+        """
+        if not self._entries:
+            self.abort()
+            return None
+        if len(self._entries) != self.count:
+            # The number of objects in the header was a guess; fix it up
+            # and rehash the pack.
+            self._f.seek(0)
+            write_pack_header(self._f, len(self._entries))
+            pack_checksum = compute_file_sha(self._f).digest()
+            self._f.seek(0, os.SEEK_END)
+            self._f.write(pack_checksum)
+        else:
+            pack_checksum = self._write.write_sha()
+        entries = sorted((sha, offset, crc32)
+                         for (sha, (offset, crc32)) in self._entries.iteritems())
+        return self._commit_pack(entries, pack_checksum)
+
+    def abort(self):
+        """Abort the import, discarding all objects added so far."""
+        self._abort()
+
+
+class DiskObjectImporter(ObjectImporter):
+    """ObjectImporter for a DiskObjectStore.
 
-    def finish(self, object):
-        """Finish the import and write objects to disk."""
-        raise NotImplementedError(self.finish)
+    Since the offsets of all objects are known, the pack index is written
+    directly rather than by re-reading the new pack.
+    """
+
+    def _open_pack(self):
+        fd, self._path = tempfile.mkstemp(dir=self.object_store.pack_dir,
+                                          suffix=".pack")
+        return os.fdopen(fd, 'w+b')
+
+    def _commit_pack(self, entries, pack_checksum):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        return self.object_store._install_pack(self._path, entries,
+                                               pack_checksum)
+
+    def abort(self):
+        self._f.close()
+        os.remove(self._path)
 
 
 class ObjectIterator(object):
@@ -840,8 +1494,15 @@ class ObjectStoreIterator(ObjectIterator):
 
     def __iter__(self):
         """Yield tuple with next object and path."""
-        for sha, path in self.itershas():
-            yield self.store[sha], path
+        shas = self.itershas()
+        while True:
+            batch = list(islice(shas, READ_BATCH_SIZE))
+            if not batch:
+                break
+            objects = dict((obj.id, obj) for obj in self.store.iter_objects(
+                set(sha for sha, path in batch)))
+            for sha, path in batch:
+                yield objects[sha], path
 
     def iterobjects(self):
         """Iterate over just the objects."""
@@ -910,7 +1571,8 @@ def _collect_filetree_revs(obj_store, tree_sha, kset):
                 _collect_filetree_revs(obj_store, sha, kset)
 
 
-def _split_commits_and_tags(obj_store, lst, ignore_unknown=False):
+def _split_commits_and_tags(obj_store, lst, ignore_unknown=False,
+                            others=None):
     """Split object id list into two list with commit SHA1s and tag SHA1s.
 
     Commits referenced by tags are included into commits
@@ -922,6 +1584,8 @@ def _split_commits_and_tags(obj_store, lst, ignore_unknown=False):
     :param lst: Collection of commit and tag SHAs
     :param ignore_unknown: True to skip SHA1 missing in the repository
         silently.
+    :param others: Optional set to add the SHA1s of other objects to;
+        if not given, KeyError is thrown for them
     :return: A tuple of (commits, tags) SHA1s
     """
     commits = set()
@@ -938,6 +1602,8 @@ def _split_commits_and_tags(obj_store, lst, ignore_unknown=False):
             elif isinstance(o, Tag):
                 tags.add(e)
                 commits.add(o.object[1])
+            elif others is not None:
+                others.add(e)
             else:
                 raise KeyError('Not a commit or a tag: %s' % e)
     return (commits, tags)
@@ -950,17 +1616,24 @@ class MissingObjectFinder(object):
         sent
     :param haves: SHA1s of commits not to send (already present in target)
     :param wants: SHA1s of commits to send
-    :param progress: Optional function to report progress to.
+    :param progress: Optional function to report progress to. It is called
+        with git-style progress lines, at most about once a second.
     :param get_tagged: Function that returns a dict of pointed-to sha -> tag
         sha for including tags.
     :param get_parents: Optional function for getting the parents of a commit.
     :param tagged: dict of pointed-to sha -> tag sha for including tags
+    :param object_filter: Optional ObjectFilter (see dulwich.partial_clone)
+        that selects the trees and blobs to send
     """
 
+    _progress_meter = None
+
     def __init__(self, object_store, haves, wants, progress=None,
-                 get_tagged=None, get_parents=lambda commit: commit.parents):
+                 get_tagged=None, get_parents=lambda commit: commit.parents,
+                 object_filter=None):
         self.object_store = object_store
         self._get_parents = get_parents
+        self._object_filter = object_filter
         # process Commits and Tags differently
         # Note, while haves may list commits/tags not available locally,
         # and such SHAs would get filtered out by _split_commits_and_tags,
@@ -968,8 +1641,10 @@ class MissingObjectFinder(object):
         # _split_commits_and_tags fails with KeyError
         have_commits, have_tags = (
             _split_commits_and_tags(object_store, haves, True))
+        # Other objects can be wanted by partial clones that are missing them
+        want_others = set()
         want_commits, want_tags = (
-            _split_commits_and_tags(object_store, wants, False))
+            _split_commits_and_tags(object_store, wants, False, want_others))
         # all_ancestors is a set of commits that shall not be sent
         # (complete repository up to 'haves')
         all_ancestors = object_store._collect_ancestors(
@@ -995,7 +1670,7 @@ class MissingObjectFinder(object):
         missing_tags = want_tags.difference(have_tags)
         # in fact, what we 'want' is commits and tags
         # we've found missing
-        wants = missing_commits.union(missing_tags)
+        wants = missing_commits.union(missing_tags, want_others)
 
         self.objects_to_send = set([(w, None, False) for w in wants])
 
@@ -1009,19 +1684,43 @@ class MissingObjectFinder(object):
         self.objects_to_send.update([e for e in entries
                                      if not e[0] in self.sha_done])
 
+    def _update_progress(self, done=False):
+        meter = self._progress_meter
+        if meter is None:
+            meter = self._progress_meter = ProgressMeter(
+                TextProgressReporter(self.progress), COUNTING_OBJECTS)
+        if not done:
+            meter.increment()
+        elif meter.current and meter.reporter is not None:
+            meter.finish()
+            # Only report the phase as done once.
+            meter.reporter = None
+
+    def _is_filtered(self, name, sha, leaf):
+        if self._object_filter is None or name is None:
+            return False
+        depth = name and name.count("/") + 1 or 0
+        if leaf:
+            return not self._object_filter.include_blob(
+                self.object_store, sha, depth)
+        return not self._object_filter.include_tree(depth)
+
     def next(self):
         while True:
             if not self.objects_to_send:
+                self._update_progress(done=True)
                 return None
             (sha, name, leaf) = self.objects_to_send.pop()
-            if sha not in self.sha_done:
+            if (sha not in self.sha_done and
+                    not self._is_filtered(name, sha, leaf)):
                 break
         if not leaf:
             o = self.object_store[sha]
             if isinstance(o, Commit):
                 self.add_todo([(o.tree, "", False)])
             elif isinstance(o, Tree):
-                self.add_todo([(s, n, not stat.S_ISDIR(m))
+                self.add_todo([(s, name and "%s/%s" % (name, n) or n,
+                                not stat.S_ISDIR(m))
                                for n, m, s in o.iteritems()
                                if not S_ISGITLINK(m)])
             elif isinstance(o, Tag):
@@ -1029,28 +1728,306 @@ class MissingObjectFinder(object):
         if sha in self._tagged:
             self.add_todo([(self._tagged[sha], None, True)])
         self.sha_done.add(sha)
-        self.progress("counting objects: %d\r" % len(self.sha_done))
+        self._update_progress()
         return (sha, name)
 
     __next__ = next
 
 
+class ThinPackBaseFinder(object):
+    """Find delta bases for a thin pack among objects the receiver has.
+
+    The candidate base for an object is the object at the same path in the
+    tree of one of the commits the receiver has. It is not included in the
+    pack; the receiver resolves the delta against its own copy.
+
+    :param object_store: Object store containing the commits the receiver has
+    :param haves: SHAs of commits the receiver has; only the first few are
+        considered
+    """
+
+    max_commits = 10
+
+    def __init__(self, object_store, haves):
+        self.object_store = object_store
+        self._haves = list(haves)[:self.max_commits]
+        self._root_trees = None
+        self._trees = LRUCache(max_cache=1000)
+
+    def _get_tree(self, sha):
+        try:
+            tree = self._trees[sha]
+        except KeyError:
+            get_metrics().incr('thin_pack.tree_cache_misses')
+            tree = self.object_store[sha]
+            self._trees[sha] = tree
+        else:
+            get_metrics().incr('thin_pack.tree_cache_hits')
+        return tree
+
+    def _get_root_trees(self):
+        if self._root_trees is None:
+            self._root_trees = []
+            for sha in self._haves:
+                try:
+                    obj = self.object_store[sha]
+                except KeyError:
+                    continue
+                if isinstance(obj, Commit):
+                    self._root_trees.append(obj.tree)
+        return self._root_trees
+
+    def __call__(self, obj, path):
+        """Find a delta base for an object.
+
+        :param obj: Object that is sent
+        :param path: Path of the object, relative to the root tree; None if
+            the object is not part of a tree
+        :return: Tuple with binary SHA and raw text of the base, or None
+        """
+        if path is None or obj.type_num not in (Blob.type_num, Tree.type_num):
+            return None
+        for tree_id in self._get_root_trees():
+            try:
+                mode, sha = tree_lookup_path(self._get_tree, tree_id, path)
+            except (KeyError, NotTreeError):
+                continue
+            if sha == obj.id:
+                continue
+            type_num, raw = self.object_store.get_raw(sha)
+            if type_num == obj.type_num:
+                return hex_to_sha(sha), raw
+        return None
+
+
+_PARENT1 = 1
+_PARENT2 = 2
+_STALE = 4
+_RESULT = 8
+
+
+def _paint_down_to_common(store, one, twos, get_parents, get_generation,
+                          min_generation=0, stop_at=None, exact=False):
+    """Mark the ancestors of commits down to their common ancestors.
+
+    This is the walk C git uses to find merge bases. Commits are visited
+    newest first (by generation number if available, then by commit date)
+    and marked with the side(s) they are reachable from. Commits reachable
+    from both sides are merge base candidates, and their ancestors are
+    marked stale. The walk ends when only stale commits are left to visit,
+    so history below the merge bases is not read.
+
+    :param store: Object store to read commits from
+    :param one: SHA of the commit on the first side
+    :param twos: SHAs of the commits on the second side
+    :param get_parents: Function for getting the parents of a commit
+    :param get_generation: Function returning the generation number of a
+        commit SHA, or None
+    :param min_generation: Stop at commits with a lower generation number
+    :param stop_at: Stop as soon as this commit is reached from the second
+        side
+    :param exact: Keep walking until no commit that was only reached from
+        one side can still be reached from the other side, assuming
+        commits are not newer than their children
+    :return: Tuple with a dict mapping the SHAs of visited commits to their
+        flags, and a list of merge base candidates (possibly redundant)
+    """
+    queue = []
+    flags = {}
+    counter = count()
+
+    def push(sha):
+        commit = store[sha]
+        if get_generation is None:
+            generation = 0
+        else:
+            generation = get_generation(sha)
+        heapq.heappush(queue, (-generation, -commit.commit_time,
+                               next(counter), commit))
+
+    flags[one] = _PARENT1
+    push(one)
+    for two in twos:
+        flags[two] = flags.get(two, 0) | _PARENT2
+        push(two)
+    candidates = []
+    # Generation and commit time of the oldest commit visited with just one
+    # side's flag.
+    oldest_single = None
+    while queue:
+        if all(flags[entry[3].id] & _STALE for entry in queue):
+            newest = (-queue[0][0], -queue[0][1])
+            if (not exact or oldest_single is None or
+                    newest < oldest_single):
+                break
+        neg_generation, neg_time, _, commit = heapq.heappop(queue)
+        if -neg_generation < min_generation:
+            break
+        sha = commit.id
+        flag = flags[sha] & (_PARENT1 | _PARENT2 | _STALE)
+        if flag == _PARENT1 | _PARENT2:
+            if not flags[sha] & _RESULT:
+                flags[sha] |= _RESULT
+                candidates.append(sha)
+            flag |= _STALE
+        elif not flag & _STALE:
+            key = (-neg_generation, -neg_time)
+            if oldest_single is None or key < oldest_single:
+                oldest_single = key
+        for parent in get_parents(commit):
+            if flags.get(parent, 0) & flag == flag:
+                continue
+            flags[parent] = flags.get(parent, 0) | flag
+            push(parent)
+        if stop_at is not None and flags[stop_at] & _PARENT2:
+            break
+    return flags, candidates
+
+
+def _peel_commits(store, heads):
+    """Peel a list of heads to the commits they refer to.
+
+    :param store: An ObjectStore for looking up objects.
+    :param heads: Iterable of SHAs of commits or tags.
+    :return: List of commit SHAs, without duplicates; heads that do not
+        refer to a commit are left out
+    """
+    commits = []
+    seen = set()
+    for head_sha in heads:
+        obj = store.peel_sha(head_sha)
+        if isinstance(obj, Commit) and obj.id not in seen:
+            seen.add(obj.id)
+            commits.append(obj.id)
+    return commits
+
+
+def find_shallow(store, heads, depth):
+    """Find shallow commits according to a given depth.
+
+    The history is walked breadth-first, so every commit is looked at once,
+    at the smallest depth at which it is reachable from the heads. Only the
+    parents of the commits are looked up, which does not require a full parse
+    of the commit objects.
+
+    :param store: An ObjectStore for looking up objects.
+    :param heads: Iterable of head SHAs to start walking from.
+    :param depth: The number of commits to include along each path from the
+        heads, as in a "deepen" request; the commits at that depth are shallow.
+    :return: A tuple of (shallow, not_shallow), disjoint sets of SHAs that
+        should be considered shallow and unshallow according to the arguments.
+    """
+    shallow = set()
+    not_shallow = set()
+    current = _peel_commits(store, heads)
+    seen = set(current)
+    cur_depth = 1
+    while current:
+        if cur_depth >= depth:
+            shallow.update(current)
+            break
+        not_shallow.update(current)
+        parents = []
+        for sha in current:
+            for parent in store[sha].parents:
+                if parent not in seen:
+                    seen.add(parent)
+                    parents.append(parent)
+        current = parents
+        cur_depth += 1
+    return shallow, not_shallow
+
+
+def find_shallow_since(store, heads, since=None, exclude=None):
+    """Find shallow commits for a deepen-since or deepen-not request.
+
+    Commits older than a timestamp and commits reachable from a set of
+    excluded commits are left out. The commits that are included but have a
+    parent that is left out are shallow.
+
+    :param store: An ObjectStore for looking up objects.
+    :param heads: Iterable of head SHAs to start walking from.
+    :param since: Optional timestamp; commits with an older commit time are
+        left out
+    :param exclude: Optional iterable of SHAs of commits whose ancestors are
+        left out
+    :return: A tuple of (shallow, not_shallow), disjoint sets of SHAs that
+        should be considered shallow and unshallow according to the arguments.
+    """
+    excluded = set()
+    todo = _peel_commits(store, exclude or [])
+    while todo:
+        sha = todo.pop()
+        if sha not in excluded:
+            excluded.add(sha)
+            todo.extend(store[sha].parents)
+
+    included = {}
+    def is_included(sha):
+        ret = included.get(sha)
+        if ret is None:
+            ret = sha not in excluded and (
+                since is None or store[sha].commit_time >= since)
+            included[sha] = ret
+        return ret
+
+    shallow = set()
+    not_shallow = set()
+    todo = [head for head in _peel_commits(store, heads) if is_included(head)]
+    seen = set(todo)
+    while todo:
+        sha = todo.pop()
+        boundary = False
+        for parent in store[sha].parents:
+            if not is_included(parent):
+                boundary = True
+            elif parent not in seen:
+                seen.add(parent)
+                todo.append(parent)
+        if boundary:
+            shallow.add(sha)
+        else:
+            not_shallow.add(sha)
+    return shallow, not_shallow
+
+
 class ObjectStoreGraphWalker(object):
     """Graph walker that finds what commits are missing from an object store.
 
     :ivar heads: Revisions without descendants in the local repo
     :ivar get_parents: Function to retrieve parents in the local repo
+    :ivar shallow: Set of shallow commits in the local repo, whose parents
+        are not present
+    :ivar unshallow: Set of commits that the remote end no longer considers
+        shallow
     """
 
-    def __init__(self, local_heads, get_parents):
+    def __init__(self, local_heads, get_parents, shallow=None):
         """Create a new instance.
 
         :param local_heads: Heads to start search with
         :param get_parents: Function for finding the parents of a SHA1.
+        :param shallow: Optional set of shallow commits in the local repo
         """
         self.heads = set(local_heads)
         self.get_parents = get_parents
         self.parents = {}
+        if shallow is None:
+            shallow = set()
+        self.shallow = set(shallow)
+        self.unshallow = set()
+
+    def update_shallow(self, new_shallow, new_unshallow):
+        """Record the shallow commits announced by the remote end.
+
+        :param new_shallow: Commits that have become shallow
+        :param new_unshallow: Commits that are no longer shallow
+        """
+        if new_shallow:
+            self.shallow.update(new_shallow)
+        if new_unshallow:
+            self.shallow.difference_update(new_unshallow)
+            self.unshallow.update(new_unshallow)
 
     def ack(self, sha):
         """Ack that a revision and its ancestors are present in the source."""
@@ -1082,7 +2059,11 @@ class ObjectStoreGraphWalker(object):
         """Iterate over ancestors of heads in the target."""
         if self.heads:
             ret = self.heads.pop()
-            ps = self.get_parents(ret)
+            if ret in self.shallow:
+                # The parents of a shallow commit are not present locally
+                ps = []
+            else:
+                ps = self.get_parents(ret)
             self.parents[ret] = ps
             self.heads.update([p for p in ps if not p in self.parents])
             return ret
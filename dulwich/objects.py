@@ -55,6 +55,28 @@ _TYPE_HEADER = "type"
 _TAG_HEADER = "tag"
 _TAGGER_HEADER = "tagger"
 
+# Groups of fields that can be decoded without parsing a whole object
+_LAZY_COMMIT_TREE = 1
+_LAZY_COMMIT_PARENTS = 2
+_LAZY_COMMIT_AUTHOR = 4
+_LAZY_COMMIT_COMMITTER = 8
+_COMMIT_LAZY_FIELDS = {
+    "tree": _LAZY_COMMIT_TREE,
+    "parents": _LAZY_COMMIT_PARENTS,
+    "author": _LAZY_COMMIT_AUTHOR,
+    "author_time": _LAZY_COMMIT_AUTHOR,
+    "author_timezone": _LAZY_COMMIT_AUTHOR,
+    "committer": _LAZY_COMMIT_COMMITTER,
+    "commit_time": _LAZY_COMMIT_COMMITTER,
+    "commit_timezone": _LAZY_COMMIT_COMMITTER,
+    }
+_LAZY_TAG_OBJECT = 1
+_LAZY_TAG_NAME = 2
+_TAG_LAZY_FIELDS = {
+    "object": _LAZY_TAG_OBJECT,
+    "name": _LAZY_TAG_NAME,
+    }
+
 
 S_IFGITLINK = 0o160000
 
@@ -127,7 +149,8 @@ def serializable_property(name, docstring=None):
         setattr(obj, "_"+name, value)
         obj._needs_serialization = True
     def get(obj):
-        obj._ensure_parsed()
+        if obj._needs_parsing:
+            obj._ensure_field(name)
         return getattr(obj, "_"+name)
     return property(get, set, doc=docstring)
 
@@ -194,7 +217,7 @@ class ShaFile(object):
     """A git SHA file."""
 
     __slots__ = ('_needs_parsing', '_chunked_text', '_file', '_path',
-                 '_sha', '_needs_serialization', '_magic')
+                 '_sha', '_needs_serialization', '_magic', '_lazy_fields')
 
     @staticmethod
     def _parse_legacy_object_header(magic, f):
@@ -226,7 +249,7 @@ class ShaFile(object):
         header_end = text.find('\0')
         if header_end < 0:
             raise ObjectFormatException("Invalid object header, no \\0")
-        self.set_raw_string(text[header_end+1:])
+        self.set_raw_string(text[header_end+1:], lazy=True)
 
     def as_legacy_object_chunks(self):
         """Return chunks representing the object in the experimental format.
@@ -250,7 +273,8 @@ class ShaFile(object):
         :return: List of strings, not necessarily one per line
         """
         if self._needs_parsing:
-            self._ensure_parsed()
+            # Unparsed objects can not have been modified.
+            self._ensure_loaded()
         elif self._needs_serialization:
             self._chunked_text = self._serialize()
         return self._chunked_text
@@ -274,35 +298,69 @@ class ShaFile(object):
         """Return a string representing this object, fit for display."""
         return self.as_raw_string()
 
+    def _ensure_loaded(self):
+        """Make sure the raw text of this object has been read."""
+        if not self._chunked_text:
+            if self._file is not None:
+                self._parse_file(self._file)
+                self._file = None
+            elif self._path is not None:
+                self._parse_path()
+            else:
+                raise AssertionError(
+                    "ShaFile needs either text or filename")
+
     def _ensure_parsed(self):
         if self._needs_parsing:
-            if not self._chunked_text:
-                if self._file is not None:
-                    self._parse_file(self._file)
-                    self._file = None
-                elif self._path is not None:
-                    self._parse_path()
-                else:
-                    raise AssertionError(
-                        "ShaFile needs either text or filename")
+            self._ensure_loaded()
             self._deserialize(self._chunked_text)
             self._needs_parsing = False
 
-    def set_raw_string(self, text, sha=None):
+    def _ensure_field(self, name):
+        """Make sure a single field of an unparsed object is available.
+
+        Subclasses that can decode some of their fields straight from the
+        raw text override this; by default the whole object is parsed.
+
+        :param name: Name of the field, without leading underscore
+        """
+        self._ensure_parsed()
+
+    def _get_lazy_text(self):
+        """Return the raw text of an unparsed object as a single string."""
+        self._ensure_loaded()
+        if len(self._chunked_text) != 1:
+            self._chunked_text = ["".join(self._chunked_text)]
+        return self._chunked_text[0]
+
+    def set_raw_string(self, text, sha=None, lazy=False):
         """Set the contents of this object from a serialized string."""
         if not isinstance(text, str):
             raise TypeError(text)
-        self.set_raw_chunks([text], sha)
+        self.set_raw_chunks([text], sha, lazy=lazy)
+
+    def set_raw_chunks(self, chunks, sha=None, lazy=False):
+        """Set the contents of this object from a list of chunks.
 
-    def set_raw_chunks(self, chunks, sha=None):
-        """Set the contents of this object from a list of chunks."""
+        :param chunks: Chunks with the serialized contents
+        :param sha: Optional known sha for the object
+        :param lazy: Whether to defer parsing the contents until they are
+            first accessed. Only the raw text is kept until then, and some
+            fields (such as the parents of a commit) can be decoded without
+            parsing the rest of the object. Errors in the contents are not
+            raised until the object is parsed.
+        """
         self._chunked_text = chunks
-        self._deserialize(chunks)
+        if lazy and chunks:
+            self._lazy_fields = 0
+            self._needs_parsing = True
+        else:
+            self._deserialize(chunks)
+            self._needs_parsing = False
         if sha is None:
             self._sha = None
         else:
             self._sha = FixedSha(sha)
-        self._needs_parsing = False
         self._needs_serialization = False
 
     @staticmethod
@@ -326,7 +384,7 @@ class ShaFile(object):
             byte = ord(map[used])
             used += 1
         raw = map[used:]
-        self.set_raw_string(_decompress(raw))
+        self.set_raw_string(_decompress(raw), lazy=True)
 
     @classmethod
     def _is_legacy_object(cls, magic):
@@ -351,6 +409,7 @@ class ShaFile(object):
         self._chunked_text = []
         self._needs_parsing = False
         self._needs_serialization = True
+        self._lazy_fields = 0
 
     def _deserialize(self, chunks):
         raise NotImplementedError(self._deserialize)
@@ -397,27 +456,29 @@ class ShaFile(object):
             raise ObjectFormatException("invalid object header")
 
     @staticmethod
-    def from_raw_string(type_num, string, sha=None):
+    def from_raw_string(type_num, string, sha=None, lazy=False):
         """Creates an object of the indicated type from the raw string given.
 
         :param type_num: The numeric type of the object.
         :param string: The raw uncompressed contents.
         :param sha: Optional known sha for the object
+        :param lazy: Whether to defer parsing until the contents are accessed
         """
         obj = object_class(type_num)()
-        obj.set_raw_string(string, sha)
+        obj.set_raw_string(string, sha, lazy=lazy)
         return obj
 
     @staticmethod
-    def from_raw_chunks(type_num, chunks, sha=None):
+    def from_raw_chunks(type_num, chunks, sha=None, lazy=False):
         """Creates an object of the indicated type from the raw chunks given.
 
         :param type_num: The numeric type of the object.
         :param chunks: An iterable of the raw uncompressed contents.
         :param sha: Optional known sha for the object
+        :param lazy: Whether to defer parsing until the contents are accessed
         """
         obj = object_class(type_num)()
-        obj.set_raw_chunks(chunks, sha)
+        obj.set_raw_chunks(chunks, sha, lazy=lazy)
         return obj
 
     @classmethod
@@ -452,6 +513,7 @@ class ShaFile(object):
         old_sha = self.id
         try:
             self._deserialize(self.as_raw_chunks())
+            self._needs_parsing = False
             self._sha = None
             new_sha = self.id
         except Exception as e:
@@ -600,6 +662,28 @@ def _parse_message(chunks):
     f.close()
 
 
+def _iter_leading_headers(text):
+    """Iterate over the simple header lines at the start of a message.
+
+    Iteration stops at the end of the headers, at the first header that is
+    continued on the next line and at the first malformed line, so that
+    those can be left to a full parse.
+
+    :param text: the raw text of a tag or commit object
+    :return: iterator over (field, value) tuples
+    """
+    pos = 0
+    while True:
+        end = text.find("\n", pos)
+        if end <= pos or text.startswith(" ", end + 1):
+            return
+        sep = text.find(" ", pos, end)
+        if sep < 0:
+            return
+        yield text[pos:sep], text[sep+1:end]
+        pos = end + 1
+
+
 class Tag(ShaFile):
     """A Git Tag object."""
 
@@ -703,12 +787,48 @@ class Tag(ShaFile):
             else:
                 raise ObjectFormatException("Unknown field %s" % field)
 
+    def _ensure_field(self, name):
+        mask = _TAG_LAZY_FIELDS.get(name)
+        if mask is None:
+            self._ensure_parsed()
+        elif not self._lazy_fields & mask:
+            if self._decode_leading_headers(mask):
+                self._lazy_fields |= mask
+            else:
+                # Unusual layout or malformed; let the full parser decide.
+                self._ensure_parsed()
+
+    def _decode_leading_headers(self, mask):
+        """Decode a field from the object, type and tag headers.
+
+        :param mask: The _LAZY_TAG_* value for the field group to decode
+        :return: Whether the field could be decoded
+        """
+        headers = _iter_leading_headers(self._get_lazy_text())
+        field, object_sha = next(headers, (None, None))
+        if field != _OBJECT_HEADER:
+            return False
+        field, value = next(headers, (None, None))
+        obj_class = object_class(value)
+        if field != _TYPE_HEADER or not obj_class:
+            return False
+        if mask == _LAZY_TAG_OBJECT:
+            self._object_sha = object_sha
+            self._object_class = obj_class
+            return True
+        field, value = next(headers, (None, None))
+        if field != _TAG_HEADER:
+            return False
+        self._name = value
+        return True
+
     def _get_object(self):
         """Get the object pointed to by this tag.
 
         :return: tuple of (object class, sha).
         """
-        self._ensure_parsed()
+        if self._needs_parsing:
+            self._ensure_field("object")
         return (self._object_class, self._object_sha)
 
     def _set_object(self, value):
@@ -1016,6 +1136,17 @@ def format_timezone(offset, unnecessary_negative_timezone=False):
     return '%c%02d%02d' % (sign, offset / 3600, (offset / 60) % 60)
 
 
+def parse_time_entry(value):
+    """Parse an identity with a timestamp, as found in commits and tags.
+
+    :param value: Header value, e.g. "Joe <joe@example.com> 1234 +0100"
+    :return: Tuple of (identity, time, (timezone, timezone_neg_utc))
+    :raise ValueError: if the value is malformed
+    """
+    identity, timetext, timezonetext = value.rsplit(" ", 2)
+    return (identity, int(timetext), parse_timezone(timezonetext))
+
+
 def parse_commit(chunks):
     """Parse a commit object from chunks.
 
@@ -1038,13 +1169,9 @@ def parse_commit(chunks):
         elif field == _PARENT_HEADER:
             parents.append(value)
         elif field == _AUTHOR_HEADER:
-            author, timetext, timezonetext = value.rsplit(" ", 2)
-            author_time = int(timetext)
-            author_info = (author, author_time, parse_timezone(timezonetext))
+            author_info = parse_time_entry(value)
         elif field == _COMMITTER_HEADER:
-            committer, timetext, timezonetext = value.rsplit(" ", 2)
-            commit_time = int(timetext)
-            commit_info = (committer, commit_time, parse_timezone(timezonetext))
+            commit_info = parse_time_entry(value)
         elif field == _ENCODING_HEADER:
             encoding = value
         elif field == _MERGETAG_HEADER:
@@ -1094,6 +1221,55 @@ class Commit(ShaFile):
         (self._committer, self._commit_time, (self._commit_timezone,
              self._commit_timezone_neg_utc)) = commit_info
 
+    def _ensure_field(self, name):
+        mask = _COMMIT_LAZY_FIELDS.get(name)
+        if mask is None:
+            self._ensure_parsed()
+        elif not self._lazy_fields & mask:
+            try:
+                decoded = self._decode_leading_headers(mask)
+            except ValueError:
+                decoded = False
+            if decoded:
+                self._lazy_fields |= mask
+            else:
+                # Unusual layout or malformed; let the full parser decide.
+                self._ensure_parsed()
+
+    def _decode_leading_headers(self, mask):
+        """Decode a field from the tree, parent, author and committer headers.
+
+        :param mask: The _LAZY_COMMIT_* value for the field group to decode
+        :return: Whether the field could be decoded
+        """
+        headers = _iter_leading_headers(self._get_lazy_text())
+        field, value = next(headers, (None, None))
+        if field != _TREE_HEADER:
+            return False
+        if mask == _LAZY_COMMIT_TREE:
+            self._tree = value
+            return True
+        parents = []
+        field, value = next(headers, (None, None))
+        while field == _PARENT_HEADER:
+            parents.append(value)
+            field, value = next(headers, (None, None))
+        if field != _AUTHOR_HEADER:
+            return False
+        if mask == _LAZY_COMMIT_PARENTS:
+            self._parents = parents
+            return True
+        if mask == _LAZY_COMMIT_AUTHOR:
+            (self._author, self._author_time, (self._author_timezone,
+                self._author_timezone_neg_utc)) = parse_time_entry(value)
+            return True
+        field, value = next(headers, (None, None))
+        if field != _COMMITTER_HEADER:
+            return False
+        (self._committer, self._commit_time, (self._commit_timezone,
+            self._commit_timezone_neg_utc)) = parse_time_entry(value)
+        return True
+
     def check(self):
         """Check this object for internal consistency.
 
@@ -1169,7 +1345,8 @@ class Commit(ShaFile):
 
     def _get_parents(self):
         """Return a list of parents of this commit."""
-        self._ensure_parsed()
+        if self._needs_parsing:
+            self._ensure_field("parents")
         return self._parents
 
     def _set_parents(self, value):
@@ -16,7 +16,103 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA  02110-1301, USA.
 
-"""Object specification."""
+"""Object specification.
+
+Supported are a subset of the revision expressions described in
+gitrevisions(7):
+
+ * full and abbreviated (at least MIN_ABBREV characters) SHA1s
+ * ref names, looked up like C git does (e.g. "master" may refer to
+   refs/heads/master)
+ * <rev>^, <rev>^N, <rev>~ and <rev>~N for parents and ancestors
+ * <rev>^{type} and <rev>^{} for peeling tags and commits
+ * <rev1>..<rev2> and <rev1>...<rev2> for commit ranges
+"""
+
+import re
+
+from dulwich.errors import (
+    AmbiguousShortId,
+    RefFormatError,
+    )
+from dulwich.objects import (
+    Blob,
+    Commit,
+    Tag,
+    Tree,
+    )
+
+# Shortest abbreviated SHA1 that is accepted.
+MIN_ABBREV = 4
+
+_HEX_RE = re.compile('^[0-9a-fA-F]+$')
+_SUFFIX_RE = re.compile(r'\^\{([a-z]*)\}|\^([0-9]*)|~([0-9]*)')
+
+_PEEL_TYPES = {
+    'commit': Commit,
+    'tree': Tree,
+    'blob': Blob,
+    'tag': Tag,
+    }
+
+
+def parse_short_sha(object_store, prefix):
+    """Expand an abbreviated SHA1.
+
+    :param object_store: Object store to look in
+    :param prefix: Abbreviated hex SHA1
+    :return: Full hex SHA1 of the only object that starts with prefix
+    :raise KeyError: If no object starts with prefix
+    :raise AmbiguousShortId: If more than one object starts with prefix
+    """
+    prefix = prefix.lower()
+    found = set()
+    for sha in object_store.iter_prefix(prefix):
+        found.add(sha)
+        if len(found) > 1:
+            raise AmbiguousShortId(prefix, sorted(found))
+    if not found:
+        raise KeyError(prefix)
+    return found.pop()
+
+
+def _ref_candidates(name):
+    """Return the refs that a short ref name may refer to, in order."""
+    return [name, 'refs/' + name, 'refs/tags/' + name, 'refs/heads/' + name,
+            'refs/remotes/' + name, 'refs/remotes/%s/HEAD' % name]
+
+
+def _parse_name(repo, name):
+    """Look up a SHA1, ref name or abbreviated SHA1.
+
+    :return: SHA1 of the object referred to
+    """
+    is_hex = _HEX_RE.match(name) is not None
+    if len(name) == 40 and is_hex and name.lower() in repo.object_store:
+        return name.lower()
+    for ref in _ref_candidates(name):
+        try:
+            return repo.refs[ref]
+        except (KeyError, RefFormatError):
+            pass
+    if len(name) >= MIN_ABBREV and len(name) < 40 and is_hex:
+        return parse_short_sha(repo.object_store, name)
+    raise KeyError(name)
+
+
+def _peel(repo, obj, cls=None):
+    """Peel tags (and commits, for trees) until an object of a type is found.
+
+    :param cls: Class of the object to find, or None to peel all tags
+    :raise ValueError: If the object can not be peeled to cls
+    """
+    while isinstance(obj, Tag) and cls is not Tag:
+        obj = repo[obj.object[1]]
+    if cls is Tree and isinstance(obj, Commit):
+        obj = repo[obj.tree]
+    if cls is not None and not isinstance(obj, cls):
+        raise ValueError("%s is not a %s" % (obj.id, cls.type_name))
+    return obj
 
 
 def parse_object(repo, objectish):
@@ -26,17 +122,92 @@ def parse_object(repo, objectish):
     :param objectish: A string referring to an object
     :return: A git object
     :raise KeyError: If the object can not be found
+    :raise AmbiguousShortId: If an abbreviated SHA1 matches more than one
+        object
+    :raise ValueError: If the expression can not be parsed or applied
     """
-    return repo[objectish]
+    end = len(objectish)
+    for c in '^~':
+        i = objectish.find(c)
+        if i != -1:
+            end = min(end, i)
+    obj = repo[_parse_name(repo, objectish[:end])]
+    pos = end
+    while pos < len(objectish):
+        m = _SUFFIX_RE.match(objectish, pos)
+        if m is None:
+            raise ValueError("Invalid revision expression %r" % objectish)
+        pos = m.end()
+        peel_type, parent, ancestor = m.groups()
+        if peel_type is not None:
+            if peel_type == '':
+                obj = _peel(repo, obj)
+            elif peel_type == 'object':
+                pass
+            elif peel_type in _PEEL_TYPES:
+                obj = _peel(repo, obj, _PEEL_TYPES[peel_type])
+            else:
+                raise ValueError("Invalid object type %r" % peel_type)
+        elif parent is not None:
+            obj = _peel(repo, obj, Commit)
+            n = int(parent or 1)
+            if n == 0:
+                continue
+            if n > len(obj.parents):
+                raise KeyError(objectish)
+            obj = repo[obj.parents[n - 1]]
+        else:
+            obj = _peel(repo, obj, Commit)
+            for _ in range(int(ancestor or 1)):
+                if not obj.parents:
+                    raise KeyError(objectish)
+                obj = repo[obj.parents[0]]
+    return obj
+
+
+def parse_commit(repo, committish):
+    """Parse a string referring to a single commit.
+
+    :param repo: A `Repo` object
+    :param committish: A string referring to a commit (or a tag of one)
+    :return: A `Commit` object
+    :raise KeyError: If the commit can not be found
+    :raise ValueError: If the object is not a commit
+    """
+    return _peel(repo, parse_object(repo, committish), Commit)
 
 
 def parse_commit_range(repo, committishs):
     """Parse a string referring to a range of commits.
 
+    "A..B" refers to the commits reachable from B but not from A, "A...B"
+    to the commits reachable from either A or B but not from both. An
+    omitted side defaults to HEAD. A single commit refers to just that
+    commit.
+
     :param repo: A `Repo` object
     :param committishs: A string referring to a range of commits.
     :return: An iterator over `Commit` objects
     :raise KeyError: When the reference commits can not be found
     :raise ValueError: If the range can not be parsed
     """
-    return iter([repo[committishs]])
+    if '...' in committishs:
+        left, right = committishs.split('...', 1)
+        symmetric = True
+    elif '..' in committishs:
+        left, right = committishs.split('..', 1)
+        symmetric = False
+    else:
+        return iter([parse_commit(repo, committishs)])
+    left = parse_commit(repo, left or 'HEAD').id
+    right = parse_commit(repo, right or 'HEAD').id
+    if symmetric:
+        include = [left, right]
+        exclude = repo.object_store.find_merge_bases(
+            [left, right],
+            get_parents=lambda commit: repo.get_parents(commit.id, commit))
+    else:
+        include = [right]
+        exclude = [left]
+    return (entry.commit
+            for entry in repo.get_walker(include, exclude=exclude))
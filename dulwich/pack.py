@@ -35,11 +35,10 @@ from collections import defaultdict
 import binascii
 from io import BytesIO
 from collections import (
+    OrderedDict,
     deque,
     )
-import difflib
-
-from itertools import chain, imap, izip
+from itertools import imap, islice, izip
 
 try:
     import mmap
@@ -66,12 +65,21 @@ from dulwich.file import GitFile
 from dulwich.lru_cache import (
     LRUSizeCache,
     )
+from dulwich.metrics import (
+    get_metrics,
+    )
 from dulwich.objects import (
     ShaFile,
     hex_to_sha,
     sha_to_hex,
     object_header,
     )
+from dulwich.progress import (
+    COMPRESSING_OBJECTS,
+    ProgressMeter,
+    RESOLVING_DELTAS,
+    WRITING_OBJECTS,
+    )
 
 
 OFS_DELTA = 6
@@ -82,6 +90,22 @@ DELTA_TYPES = (OFS_DELTA, REF_DELTA)
 
 DEFAULT_PACK_DELTA_WINDOW_SIZE = 10
 
+# Default maximum length of delta chains; matches git's pack.depth
+DEFAULT_PACK_DELTA_DEPTH = 50
+
+# Default limit on the memory used for delta bases kept around while
+# resolving delta chains; matches git's core.deltaBaseCacheLimit
+DEFAULT_MAX_BASE_MEMORY = 96 * 1024 * 1024
+
+# Number of objects handed to a single worker process when searching for
+# deltas in parallel. The chunks don't depend on the number of workers, so
+# the generated pack doesn't either.
+DELTIFY_CHUNK_SIZE = 1000
+
+# Number of records per worker thread that are compressed in one go when
+# writing pack data in parallel.
+COMPRESS_BATCH_SIZE = 32
+
 
 def take_msb_bytes(read, crc32=None):
     """Read bytes marked with most significant bit.
@@ -149,7 +173,12 @@ class UnpackedObject(object):
 
     def sha_file(self):
         """Return a ShaFile from this object."""
-        return ShaFile.from_raw_chunks(self.obj_type_num, self.obj_chunks)
+        if self._sha is None:
+            sha = None
+        else:
+            sha = sha_to_hex(self._sha)
+        return ShaFile.from_raw_chunks(self.obj_type_num, self.obj_chunks,
+                                       sha=sha, lazy=True)
 
     # Only provided for backwards compatibility with code that expects either
     # chunks or a delta tuple.
@@ -201,6 +230,17 @@ def read_zlib_chunks(read_some, unpacked, include_comp=False,
     :return: Leftover unused data from the decompression.
     :raise zlib.error: if a decompression error occurred.
     """
+    metrics = get_metrics()
+    if metrics.enabled:
+        with metrics.timer('pack.inflate'):
+            unused = _read_zlib_chunks(read_some, unpacked, include_comp,
+                                       buffer_size)
+        metrics.incr('pack.inflated_bytes', unpacked.decomp_len)
+        return unused
+    return _read_zlib_chunks(read_some, unpacked, include_comp, buffer_size)
+
+
+def _read_zlib_chunks(read_some, unpacked, include_comp, buffer_size):
     if unpacked.decomp_len <= -1:
         raise ValueError('non-negative zlib data stream size expected')
     decomp_obj = zlib.decompressobj()
@@ -240,6 +280,26 @@ def read_zlib_chunks(read_some, unpacked, include_comp=False,
     return unused
 
 
+def _inflate_prefix(read_some, size):
+    """Inflate just the start of a zlib stream.
+
+    :param read_some: Read function that returns at least one byte, but may
+        return less than the requested size.
+    :param size: Number of bytes to inflate
+    :return: The first size bytes of the decompressed data, or as much as
+        could be decompressed if the stream (or the input) is shorter.
+    :raise zlib.error: if a decompression error occurred.
+    """
+    decomp_obj = zlib.decompressobj()
+    ret = ''
+    while len(ret) < size and not decomp_obj.unused_data:
+        add = decomp_obj.unconsumed_tail or read_some(64)
+        if not add:
+            break
+        ret += decomp_obj.decompress(add, size - len(ret))
+    return ret
+
+
 def iter_sha1(iter):
     """Return the hexdigest of the SHA1 over a set of names.
 
@@ -392,6 +452,16 @@ class PackIndex(object):
         """
         return iter_sha1(self._itersha())
 
+    def iter_prefix(self, prefix):
+        """Iterate over the SHAs in this index that start with a prefix.
+
+        :param prefix: Lowercase hex SHA1 prefix, of any length
+        :return: Iterator over hex SHAs
+        """
+        for sha in self:
+            if sha.startswith(prefix):
+                yield sha
+
     def _itersha(self):
         """Yield all the SHA1's of the objects in the index, sorted."""
         raise NotImplementedError(self._itersha)
@@ -559,6 +629,34 @@ class FilePackIndex(PackIndex):
             raise KeyError(sha)
         return self._unpack_offset(i)
 
+    def iter_prefix(self, prefix):
+        """Iterate over the SHAs in this index that start with a prefix.
+
+        The first SHA with the prefix is found by bisecting the fan-out
+        bucket of the prefix's first byte; the matching SHAs follow it.
+
+        :param prefix: Lowercase hex SHA1 prefix, of any length
+        :return: Iterator over hex SHAs
+        """
+        lowest = hex_to_sha(prefix.ljust(40, '0'))
+        idx = ord(lowest[0])
+        if idx == 0:
+            start = 0
+        else:
+            start = self._fan_out_table[idx-1]
+        end = self._fan_out_table[idx]
+        while start < end:
+            i = (start + end) // 2
+            if self._unpack_name(i) < lowest:
+                start = i + 1
+            else:
+                end = i
+        for i in xrange(start, len(self)):
+            sha = sha_to_hex(self._unpack_name(i))
+            if not sha.startswith(prefix):
+                break
+            yield sha
+
 
 class PackIndex1(FilePackIndex):
     """Version 1 Pack Index file."""
@@ -648,6 +746,40 @@ def chunks_length(chunks):
     return sum(imap(len, chunks))
 
 
+def _unpack_object_header(read_all, crc32=None):
+    """Read the header of a packed object.
+
+    :param read_all: Read function that blocks until the number of requested
+        bytes are read.
+    :param crc32: CRC32 to update with the header, or None
+    :return: Tuple with the pack type number, the delta base (None for
+        non-delta types), the decompressed size and the CRC32
+    """
+    bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
+    type_num = (bytes[0] >> 4) & 0x07
+    size = bytes[0] & 0x0f
+    for i, byte in enumerate(bytes[1:]):
+        size += (byte & 0x7f) << ((i * 7) + 4)
+
+    if type_num == OFS_DELTA:
+        bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
+        if bytes[-1] & 0x80:
+            raise AssertionError
+        delta_base_offset = bytes[0] & 0x7f
+        for byte in bytes[1:]:
+            delta_base_offset += 1
+            delta_base_offset <<= 7
+            delta_base_offset += (byte & 0x7f)
+        delta_base = delta_base_offset
+    elif type_num == REF_DELTA:
+        delta_base = read_all(20)
+        if crc32 is not None:
+            crc32 = binascii.crc32(delta_base, crc32)
+    else:
+        delta_base = None
+    return type_num, delta_base, size, crc32
+
+
 def unpack_object(read_all, read_some=None, compute_crc32=False,
                   include_comp=False, zlib_bufsize=_ZLIB_BUFSIZE):
     """Unpack a Git object.
@@ -679,32 +811,8 @@ def unpack_object(read_all, read_some=None, compute_crc32=False,
     else:
         crc32 = None
 
-    bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
-    type_num = (bytes[0] >> 4) & 0x07
-    size = bytes[0] & 0x0f
-    for i, byte in enumerate(bytes[1:]):
-        size += (byte & 0x7f) << ((i * 7) + 4)
-
-    raw_base = len(bytes)
-    if type_num == OFS_DELTA:
-        bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
-        raw_base += len(bytes)
-        if bytes[-1] & 0x80:
-            raise AssertionError
-        delta_base_offset = bytes[0] & 0x7f
-        for byte in bytes[1:]:
-            delta_base_offset += 1
-            delta_base_offset <<= 7
-            delta_base_offset += (byte & 0x7f)
-        delta_base = delta_base_offset
-    elif type_num == REF_DELTA:
-        delta_base = read_all(20)
-        if compute_crc32:
-            crc32 = binascii.crc32(delta_base, crc32)
-        raw_base += 20
-    else:
-        delta_base = None
-
+    type_num, delta_base, size, crc32 = _unpack_object_header(
+        read_all, crc32=crc32)
     unpacked = UnpackedObject(type_num, delta_base, size, crc32)
     unused = read_zlib_chunks(read_some, unpacked, buffer_size=zlib_bufsize,
                               include_comp=include_comp)
@@ -1045,9 +1153,18 @@ class PackData(object):
         """
         if type not in DELTA_TYPES:
             return type, obj
-
         if get_ref is None:
             get_ref = self.get_ref
+        type, chunks, depth = self._resolve_delta(offset, type, obj, get_ref)
+        get_metrics().observe('pack.delta_chain_length', depth)
+        return type, chunks
+
+    def _resolve_delta(self, offset, type, obj, get_ref):
+        """Resolve a delta.
+
+        :return: Tuple with object type, contents and the number of deltas
+            applied
+        """
         if type == OFS_DELTA:
             (delta_offset, delta) = obj
             # TODO: clean up asserts and replace with nicer error messages
@@ -1061,7 +1178,11 @@ class PackData(object):
             assert isinstance(basename, str) and len(basename) == 20
             base_offset, type, base_obj = get_ref(basename)
             assert isinstance(type, int)
-        type, base_chunks = self.resolve_object(base_offset, type, base_obj)
+        if type in DELTA_TYPES:
+            type, base_chunks, depth = self._resolve_delta(
+                base_offset, type, base_obj, get_ref)
+        else:
+            base_chunks, depth = base_obj, 0
         chunks = apply_delta(base_chunks, delta)
         # TODO(dborowitz): This can result in poor performance if large base
         # objects are separated from deltas in the pack. We should reorganize
@@ -1069,7 +1190,7 @@ class PackData(object):
         # to optimize cache performance.
         if offset is not None:
             self._offset_cache[offset] = type, chunks
-        return type, chunks
+        return type, chunks, depth + 1
 
     def iterobjects(self, progress=None, compute_crc32=True):
         self._file.seek(self._header_size)
@@ -1180,9 +1301,12 @@ class PackData(object):
         function.
         """
         try:
-            return self._offset_cache[offset]
+            ret = self._offset_cache[offset]
         except KeyError:
-            pass
+            get_metrics().incr('pack.offset_cache_misses')
+        else:
+            get_metrics().incr('pack.offset_cache_hits')
+            return ret
         assert isinstance(offset, long) or isinstance(offset, int),\
                 'offset was %r' % offset
         assert offset >= self._header_size
@@ -1190,13 +1314,83 @@ class PackData(object):
         unpacked, _ = unpack_object(self._file.read)
         return (unpacked.pack_type_num, unpacked._obj())
 
+    def get_object_header_at(self, offset):
+        """Read the header of the object at an offset, without inflating it.
+
+        :param offset: Offset of the object
+        :return: UnpackedObject with offset, pack_type_num, delta_base and
+            decomp_len set
+        """
+        self._file.seek(offset)
+        type_num, delta_base, size, _ = _unpack_object_header(self._file.read)
+        unpacked = UnpackedObject(type_num, delta_base, size, None)
+        unpacked.offset = offset
+        return unpacked
+
+    def get_object_size_at(self, offset):
+        """Find the size of the object at an offset, without inflating it.
+
+        For deltas, only the start of the delta is inflated, to read the size
+        of the object it results in.
+
+        :param offset: Offset of the object
+        :return: Size of the object contents
+        """
+        self._file.seek(offset)
+        type_num, _, size, _ = _unpack_object_header(self._file.read)
+        if type_num not in DELTA_TYPES:
+            return size
+        # A delta starts with the sizes of its base and of the result, each
+        # at most 10 bytes long.
+        delta = _inflate_prefix(self._file.read, 20)
+        index = 0
+        for _ in range(2):
+            size = 0
+            shift = 0
+            byte = 0x80
+            while byte & 0x80:
+                byte = ord(delta[index])
+                index += 1
+                size |= (byte & 0x7f) << shift
+                shift += 7
+        return size
+
+
+class _DeltaBase(object):
+    """An inflated object that other objects in a pack are deltas against.
+
+    :ivar chunks: Inflated contents, or None if they were dropped to stay
+        within the memory budget and need to be re-inflated.
+    :ivar parent: _DeltaBase this object is itself a delta against, if any
+    :ivar pending: Number of deltas against this object not yet resolved
+    """
+
+    __slots__ = ('offset', 'sha', 'type_num', 'chunks', 'size', 'parent',
+                 'pending')
+
+    def __init__(self, offset, sha, type_num, chunks, parent, pending):
+        self.offset = offset
+        self.sha = sha
+        self.type_num = type_num
+        self.chunks = chunks
+        self.size = sum(imap(len, chunks))
+        self.parent = parent
+        self.pending = pending
+
 
 class DeltaChainIterator(object):
     """Abstract iterator over pack data based on delta chains.
 
     Each object in the pack is guaranteed to be inflated exactly once,
-    regardless of how many objects reference it as a delta base. As a result,
-    memory usage is proportional to the length of the longest delta chain.
+    regardless of how many objects reference it as a delta base. Chains are
+    walked with an explicit stack, so their depth is not limited by the
+    recursion limit. Objects are kept in memory while deltas against them
+    are still pending; once they take up more than max_base_memory bytes,
+    the bases that were inflated first are dropped and re-inflated from the
+    pack data when needed again.
+
+    An iterator created with for_offsets only reads the objects at the given
+    offsets and the delta bases they need, and only yields the former.
 
     Subclasses can override _result to define the result type of the iterator.
     By default, results are UnpackedObjects with the following members set:
@@ -1215,23 +1409,90 @@ class DeltaChainIterator(object):
     _compute_crc32 = False
     _include_comp = False
 
-    def __init__(self, file_obj, resolve_ext_ref=None):
+    def __init__(self, file_obj, resolve_ext_ref=None,
+                 max_base_memory=DEFAULT_MAX_BASE_MEMORY, progress=None):
         self._file = file_obj
         self._resolve_ext_ref = resolve_ext_ref
+        self._max_base_memory = max_base_memory
+        self._progress = progress
+        self._delta_meter = None
         self._pending_ofs = defaultdict(list)
         self._pending_ref = defaultdict(list)
         self._full_ofs = []
         self._shas = {}
         self._ext_refs = []
+        self._wanted = None
+        # Contents of objects that are already known, by offset.
+        self._known = {}
+        # Bases holding inflated contents, in the order they were inflated.
+        self._held_bases = OrderedDict()
+        self._held_memory = 0
 
     @classmethod
-    def for_pack_data(cls, pack_data, resolve_ext_ref=None):
-        walker = cls(None, resolve_ext_ref=resolve_ext_ref)
+    def for_pack_data(cls, pack_data, resolve_ext_ref=None,
+                      max_base_memory=DEFAULT_MAX_BASE_MEMORY, progress=None):
+        walker = cls(None, resolve_ext_ref=resolve_ext_ref,
+                     max_base_memory=max_base_memory, progress=progress)
         walker.set_pack_data(pack_data)
         for unpacked in pack_data._iter_unpacked():
             walker.record(unpacked)
         return walker
 
+    @classmethod
+    def for_offsets(cls, pack_data, offsets, get_offset=None,
+                    resolve_ext_ref=None,
+                    max_base_memory=DEFAULT_MAX_BASE_MEMORY):
+        """Create an iterator over some of the objects in a pack.
+
+        Only object headers are read up front, to find the delta chains of
+        the objects. Each object in those chains is then inflated once,
+        however many of the objects are deltas against it. Objects in the
+        delta cache of the pack data are not inflated at all.
+
+        :param pack_data: PackData to read from, which has to be backed by
+            a local file
+        :param offsets: Offsets of the objects to iterate over
+        :param get_offset: Function that returns the offset of an object in
+            the pack by binary SHA, or raises KeyError; used to find the bases
+            of REF_DELTA objects, which are otherwise resolved as external
+            refs
+        :param resolve_ext_ref: Optional function to resolve external refs
+        :param max_base_memory: Memory budget for delta bases, in bytes
+        """
+        walker = cls(None, resolve_ext_ref=resolve_ext_ref,
+                     max_base_memory=max_base_memory)
+        walker.set_pack_data(pack_data)
+        walker._wanted = set(offsets)
+        use_cache = not (cls._compute_crc32 or cls._include_comp)
+        recorded = set()
+        for offset in walker._wanted:
+            while offset is not None and offset not in recorded:
+                recorded.add(offset)
+                if use_cache and offset in pack_data._offset_cache:
+                    type_num, chunks = pack_data._offset_cache[offset]
+                    walker._known[offset] = (type_num, list(chunks))
+                    walker._full_ofs.append((offset, type_num))
+                    break
+                unpacked = pack_data.get_object_header_at(offset)
+                walker.record(unpacked)
+                if unpacked.pack_type_num == OFS_DELTA:
+                    offset -= unpacked.delta_base
+                elif (unpacked.pack_type_num == REF_DELTA and
+                      get_offset is not None):
+                    try:
+                        offset = get_offset(unpacked.delta_base)
+                    except KeyError:
+                        offset = None
+                else:
+                    offset = None
+        # Walk the chains in pack order
+        walker._full_ofs.sort()
+        for pending in walker._pending_ofs.itervalues():
+            pending.sort()
+        for pending in walker._pending_ref.itervalues():
+            pending.sort()
+        return walker
+
     def record(self, unpacked):
         type_num = unpacked.pack_type_num
         offset = unpacked.offset
@@ -1247,12 +1508,18 @@ class DeltaChainIterator(object):
         self._file = pack_data._file
 
     def _walk_all_chains(self):
+        num_deltas = (sum(imap(len, self._pending_ofs.itervalues())) +
+                      sum(imap(len, self._pending_ref.itervalues())))
+        self._delta_meter = ProgressMeter(self._progress, RESOLVING_DELTAS,
+                                          num_deltas)
         for offset, type_num in self._full_ofs:
-            for result in self._follow_chain(offset, type_num, None):
+            for result in self._follow_chains([(offset, type_num, None)]):
                 yield result
         for result in self._walk_ref_chains():
             yield result
         assert not self._pending_ofs
+        if num_deltas:
+            self._delta_meter.finish()
 
     def _ensure_no_pending(self):
         if self._pending_ref:
@@ -1270,14 +1537,17 @@ class DeltaChainIterator(object):
                 type_num, chunks = self._resolve_ext_ref(base_sha)
             except KeyError:
                 # Not an external ref, but may depend on one. Either it will get
-                # popped via a _follow_chain call, or we will raise an error
+                # popped via a _follow_chains call, or we will raise an error
                 # below.
                 continue
             self._ext_refs.append(base_sha)
             self._pending_ref.pop(base_sha)
-            for new_offset in pending:
-                for result in self._follow_chain(new_offset, type_num, chunks):
-                    yield result
+            base = _DeltaBase(None, base_sha, type_num, chunks, None,
+                              len(pending))
+            self._hold(base)
+            stack = [(offset, type_num, base) for offset in reversed(pending)]
+            for result in self._follow_chains(stack):
+                yield result
 
         self._ensure_no_pending()
 
@@ -1285,6 +1555,12 @@ class DeltaChainIterator(object):
         return unpacked
 
     def _resolve_object(self, offset, obj_type_num, base_chunks):
+        known = self._known.pop(offset, None)
+        if known is not None:
+            unpacked = UnpackedObject(known[0], None, None, None)
+            unpacked.offset = offset
+            unpacked.obj_chunks = known[1]
+            return unpacked
         self._file.seek(offset)
         unpacked, _ = unpack_object(
           self._file.read, include_comp=self._include_comp,
@@ -1299,18 +1575,85 @@ class DeltaChainIterator(object):
                                               unpacked.decomp_chunks)
         return unpacked
 
-    def _follow_chain(self, offset, obj_type_num, base_chunks):
+    def _hold(self, base):
+        """Keep the contents of a base in memory, within the memory budget."""
+        self._held_bases[id(base)] = base
+        self._held_memory += base.size
+        while (self._held_memory > self._max_base_memory and
+               len(self._held_bases) > 1):
+            _, oldest = self._held_bases.popitem(last=False)
+            self._held_memory -= oldest.size
+            oldest.chunks = None
+
+    def _release(self, base):
+        """Drop the contents of a base that is no longer needed."""
+        if self._held_bases.pop(id(base), None) is not None:
+            self._held_memory -= base.size
+        base.chunks = None
+
+    def _reinflate(self, base):
+        """Re-inflate the contents of a base that were dropped earlier."""
+        path = []
+        while base.chunks is None:
+            path.append(base)
+            if base.parent is None:
+                break
+            base = base.parent
+        chunks = base.chunks
+        for base in reversed(path):
+            if base.offset is None:
+                # External ref
+                chunks = self._resolve_ext_ref(base.sha)[1]
+                continue
+            self._file.seek(base.offset)
+            unpacked, _ = unpack_object(self._file.read)
+            if chunks is None:
+                chunks = unpacked.decomp_chunks
+            else:
+                chunks = apply_delta(chunks, unpacked.decomp_chunks)
+        base.chunks = chunks
+        self._hold(base)
+        return chunks
+
+    def _follow_chains(self, stack):
+        """Resolve objects and everything that is a delta against them.
+
+        :param stack: List of (offset, type_num, base) tuples for the objects
+            to resolve, last one first. base is the held _DeltaBase an object
+            is a delta against, or None for full objects.
+        :return: Iterator over results
+        """
         # Unlike PackData.get_object_at, there is no need to cache offsets as
         # this approach by design inflates each object exactly once.
-        unpacked = self._resolve_object(offset, obj_type_num, base_chunks)
-        yield self._result(unpacked)
-
-        pending = chain(self._pending_ofs.pop(unpacked.offset, []),
-                        self._pending_ref.pop(unpacked.sha(), []))
-        for new_offset in pending:
-            for new_result in self._follow_chain(
-              new_offset, unpacked.obj_type_num, unpacked.obj_chunks):
-                yield new_result
+        while stack:
+            offset, type_num, base = stack.pop()
+            if base is None:
+                base_chunks = None
+            else:
+                base_chunks = base.chunks
+                if base_chunks is None:
+                    base_chunks = self._reinflate(base)
+            unpacked = self._resolve_object(offset, type_num, base_chunks)
+            del base_chunks
+            if base is not None:
+                base.pending -= 1
+                if not base.pending:
+                    self._release(base)
+                self._delta_meter.increment()
+            if self._wanted is None or unpacked.offset in self._wanted:
+                yield self._result(unpacked)
+
+            deltas = self._pending_ofs.pop(unpacked.offset, [])
+            if self._pending_ref:
+                # Only hash the object if something may refer to it by SHA.
+                deltas = deltas + self._pending_ref.pop(unpacked.sha(), [])
+            if deltas:
+                new_base = _DeltaBase(
+                    unpacked.offset, unpacked.sha(), unpacked.obj_type_num,
+                    unpacked.obj_chunks, base, len(deltas))
+                self._hold(new_base)
+                stack.extend((new_offset, new_base.type_num, new_base)
+                             for new_offset in reversed(deltas))
 
     def __iter__(self):
         return self._walk_all_chains()
@@ -1421,12 +1764,13 @@ def pack_object_header(type_num, delta_base, size):
     return header
 
 
-def write_pack_object(f, type, object, sha=None):
+def write_pack_object(f, type, object, sha=None, comp_data=None):
     """Write pack object to a file.
 
     :param f: File to write to
     :param type: Numeric type of the object
     :param object: Object to write
+    :param comp_data: The compressed object contents, if already available
     :return: Tuple with offset at which the object was written, and crc32
     """
     if type in DELTA_TYPES:
@@ -1434,7 +1778,8 @@ def write_pack_object(f, type, object, sha=None):
     else:
         delta_base = None
     header = pack_object_header(type, delta_base, len(object))
-    comp_data = zlib.compress(object)
+    if comp_data is None:
+        comp_data = zlib.compress(object)
     crc32 = 0
     for data in (header, comp_data):
         f.write(data)
@@ -1444,7 +1789,8 @@ def write_pack_object(f, type, object, sha=None):
     return crc32 & 0xffffffff
 
 
-def write_pack(filename, objects, deltify=None, delta_window_size=None):
+def write_pack(filename, objects, deltify=None, delta_window_size=None,
+               threads=None, progress=None, get_raw=None):
     """Write a new pack data file.
 
     :param filename: Path to the new pack file (without .pack extension)
@@ -1452,11 +1798,16 @@ def write_pack(filename, objects, deltify=None, delta_window_size=None):
         Should provide __len__
     :param window_size: Delta window size
     :param deltify: Whether to deltify pack objects
+    :param threads: Number of workers to use; see write_pack_objects
+    :param progress: Optional progress reporter; see dulwich.progress
+    :param get_raw: Optional function to retrieve objects while deltifying;
+        see write_pack_objects
     :return: Tuple with checksum of pack file and index file
     """
     with GitFile(filename + '.pack', 'wb') as f:
         entries, data_sum = write_pack_objects(f, objects,
-            delta_window_size=delta_window_size, deltify=deltify)
+            delta_window_size=delta_window_size, deltify=deltify,
+            threads=threads, progress=progress, get_raw=get_raw)
     entries = [(k, v[0], v[1]) for (k, v) in entries.iteritems()]
     entries.sort()
     with GitFile(filename + '.idx', 'wb') as f:
@@ -1470,43 +1821,212 @@ def write_pack_header(f, num_objects):
     f.write(struct.pack('>L', num_objects))  # Number of objects in pack
 
 
-def deltify_pack_objects(objects, window_size=None):
+def _worker_count(workers):
+    """Determine the number of workers to use.
+
+    :param workers: Requested number of workers; None for no workers and
+        0 for one per CPU
+    """
+    if workers is None:
+        return 1
+    if workers == 0:
+        import multiprocessing
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+    return workers
+
+
+def _find_deltas(entries, window_size, skip=0, depth=None,
+                 window_memory=None):
+    """Search for deltas between objects.
+
+    The depth of the objects that are only used as bases is not known, so
+    it is taken to be zero. Entries with a delta chain that goes through
+    one of them are marked, so their real depth can be checked later.
+
+    :param entries: Iterable over (type_num, sha, raw) tuples, in the order
+        in which the objects are written
+    :param window_size: Number of preceding objects to consider as bases
+    :param skip: Number of leading entries that are only used as bases
+    :param depth: Maximum length of delta chains, or None for no limit
+    :param window_memory: Maximum total size of the objects in the window,
+        or None for no limit
+    :return: Iterator over type_num, object id, delta_base, content, the
+        depth of the delta chain and, for entries with a chain going through
+        one of the skipped entries, the full text (None otherwise). Skipped
+        entries are not included.
+    """
+    # Window entries are (type_num, sha, raw, depth, chained_to_skipped)
+    possible_bases = deque()
+    window_used = 0
+    for i, (type_num, sha, raw) in enumerate(entries):
+        if i < skip:
+            possible_bases.appendleft((type_num, sha, raw, 0, True))
+        else:
+            winner = raw
+            winner_base = None
+            winner_depth = 0
+            winner_chained = False
+            for (base_type_num, base_sha, base_raw, base_depth,
+                 base_chained) in possible_bases:
+                if base_type_num != type_num:
+                    continue
+                if depth is not None and base_depth >= depth:
+                    continue
+                delta = create_delta(base_raw, raw)
+                if len(delta) < len(winner):
+                    winner_base = base_sha
+                    winner = delta
+                    winner_depth = base_depth + 1
+                    winner_chained = base_chained
+            yield (type_num, sha, winner_base, winner, winner_depth,
+                   winner_chained and raw or None)
+            possible_bases.appendleft(
+                (type_num, sha, raw, winner_depth, winner_chained))
+        window_used += len(raw)
+        while (len(possible_bases) > window_size or
+               (window_memory is not None and window_used > window_memory and
+                len(possible_bases) > 1)):
+            window_used -= len(possible_bases.pop()[2])
+
+
+def _find_deltas_in_chunk(args):
+    # Runs in a worker process.
+    return list(_find_deltas(*args))
+
+
+def deltify_pack_objects(objects, window_size=None, processes=None,
+                         depth=None, window_memory=None, get_raw=None,
+                         progress=None):
     """Generate deltas for pack objects.
 
+    Objects are sorted and then searched in chunks of DELTIFY_CHUNK_SIZE,
+    each preceded by the window of objects before it.
+
     :param objects: An iterable of (object, path) tuples to deltify.
     :param window_size: Window size; None for default
+    :param processes: Number of worker processes to search for deltas in;
+        None to search on the calling thread and 0 for one per CPU.
+        The result does not depend on the number of processes.
+    :param depth: Maximum length of delta chains; None for default
+    :param window_memory: Maximum total size of the objects in the window,
+        in addition to the window size; None for no limit
+    :param get_raw: Optional function to retrieve the (type_num, raw) of an
+        object by binary SHA. If given, the objects are not kept in memory
+        while sorting them, but retrieved again when they enter the window.
+    :param progress: Optional progress reporter; see dulwich.progress
     :return: Iterator over type_num, object id, delta_base, content
         delta_base is None for full text entries
     """
     if window_size is None:
         window_size = DEFAULT_PACK_DELTA_WINDOW_SIZE
+    if depth is None:
+        depth = DEFAULT_PACK_DELTA_DEPTH
     # Build a list of objects ordered by the magic Linus heuristic
     # This helps us find good objects to diff against us
     magic = []
     for obj, path in objects:
-        magic.append((obj.type_num, path, -obj.raw_length(), obj))
+        if get_raw is None:
+            raw = obj.as_raw_string()
+            length = len(raw)
+        else:
+            raw = None
+            length = obj.raw_length()
+        magic.append((obj.type_num, path, -length, obj.sha().digest(), raw))
     magic.sort()
 
-    possible_bases = deque()
-
-    for type_num, path, neg_length, o in magic:
-        raw = o.as_raw_string()
-        winner = raw
-        winner_base = None
-        for base in possible_bases:
-            if base.type_num != type_num:
+    def iter_entries(start, end):
+        for type_num, path, neg_length, sha, raw in magic[start:end]:
+            if raw is None:
+                raw = get_raw(sha)[1]
+            yield type_num, sha, raw
+
+    def iter_chunks():
+        for start in xrange(0, len(magic), DELTIFY_CHUNK_SIZE):
+            skip = min(start, window_size)
+            yield (iter_entries(start - skip, start + DELTIFY_CHUNK_SIZE),
+                   window_size, skip, depth, window_memory)
+
+    processes = _worker_count(processes)
+    if processes <= 1 or len(magic) <= DELTIFY_CHUNK_SIZE:
+        chunk_records = (_find_deltas(*chunk) for chunk in iter_chunks())
+    else:
+        chunk_records = _find_deltas_in_processes(iter_chunks(), processes)
+
+    # Delta chains that go through objects preceding a chunk may turn out
+    # to be too deep; write those objects as full texts.
+    depths = {}
+    meter = ProgressMeter(progress, COMPRESSING_OBJECTS, len(magic))
+    for records in chunk_records:
+        for (type_num, sha, delta_base, content, delta_depth,
+             raw) in records:
+            if raw is not None:
+                delta_depth = depths[delta_base] + 1
+                if delta_depth > depth:
+                    delta_base = None
+                    content = raw
+                    delta_depth = 0
+            depths[sha] = delta_depth
+            meter.increment()
+            yield type_num, sha, delta_base, content
+    meter.finish()
+
+
+def _find_deltas_in_processes(chunks, processes):
+    """Search for deltas in chunks of objects in worker processes.
+
+    :param chunks: Iterator over arguments for _find_deltas; the entries
+        are read as the chunks are handed out
+    :param processes: Number of worker processes
+    :return: Iterator over lists of records from _find_deltas, in order
+    """
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    try:
+        # Only keep a few chunks per worker in flight, to bound the memory
+        # used by objects waiting to be searched.
+        pending = deque()
+        for chunk in chunks:
+            entries = list(chunk[0])
+            pending.append(pool.apply_async(
+                _find_deltas_in_chunk, ((entries,) + chunk[1:],)))
+            if len(pending) >= processes * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def deltify_thin_pack_objects(objects, get_external_base):
+    """Generate deltas against objects outside the pack, for thin packs.
+
+    :param objects: An iterable of (object, path) tuples.
+    :param get_external_base: Function that is called with an object and
+        its path, and returns a (sha, raw) tuple for an object that is
+        not in the pack but that the receiver has, or None.
+    :return: Iterator over type_num, object id, delta_base, content
+        delta_base is None for full text entries
+    """
+    for obj, path in objects:
+        raw = obj.as_raw_string()
+        base = get_external_base(obj, path)
+        if base is not None:
+            base_sha, base_raw = base
+            delta = create_delta(base_raw, raw)
+            if len(delta) < len(raw):
+                yield obj.type_num, obj.sha().digest(), base_sha, delta
                 continue
-            delta = create_delta(base.as_raw_string(), raw)
-            if len(delta) < len(winner):
-                winner_base = base.sha().digest()
-                winner = delta
-        yield type_num, o.sha().digest(), winner_base, winner
-        possible_bases.appendleft(o)
-        while len(possible_bases) > window_size:
-            possible_bases.pop()
+        yield obj.type_num, obj.sha().digest(), None, raw
 
 
-def write_pack_objects(f, objects, delta_window_size=None, deltify=False):
+def write_pack_objects(f, objects, delta_window_size=None, deltify=False,
+                       threads=None, delta_depth=None,
+                       delta_window_memory=None, progress=None,
+                       get_external_base=None, get_raw=None):
     """Write a new pack data file.
 
     :param f: File to write to
@@ -1515,31 +2035,123 @@ def write_pack_objects(f, objects, delta_window_size=None, deltify=False):
     :param window_size: Sliding window size for searching for deltas;
                         Set to None for default window size.
     :param deltify: Whether to deltify objects
+    :param threads: Number of workers to use, similar to git's pack.threads:
+        deltas are searched for in this many processes and objects are
+        compressed in this many threads. None to do all work on the calling
+        thread, 0 for one worker per CPU. The pack written is the same
+        regardless.
+    :param delta_depth: Maximum length of delta chains; None for default
+    :param delta_window_memory: Maximum total size of the objects in the
+        delta search window; None for no limit
+    :param progress: Optional progress reporter; see dulwich.progress
+    :param get_external_base: Optional function to find delta bases outside
+        the pack, to write a thin pack; see deltify_thin_pack_objects.
+        Only used if deltify is not set.
+    :param get_raw: Optional function to retrieve the (type_num, raw) of an
+        object by binary SHA, such as ObjectStore.get_raw. If given while
+        deltifying, objects are not kept in memory until they enter the
+        delta window; this bounds memory use if objects are produced
+        lazily, e.g. by an ObjectStoreIterator. See deltify_pack_objects.
     :return: Dict mapping id -> (offset, crc32 checksum), pack checksum
     """
+    metrics = get_metrics()
+    with metrics.timer('pack.count_objects'):
+        num_objects = len(objects)
+    objects = metrics.timed_iter(objects, 'pack.read_objects')
     if deltify:
-        pack_contents = deltify_pack_objects(objects, delta_window_size)
+        pack_contents = deltify_pack_objects(objects, delta_window_size,
+            processes=threads, depth=delta_depth,
+            window_memory=delta_window_memory, get_raw=get_raw,
+            progress=progress)
+    elif get_external_base is not None:
+        pack_contents = deltify_thin_pack_objects(objects, get_external_base)
     else:
         pack_contents = (
             (o.type_num, o.sha().digest(), None, o.as_raw_string())
             for (o, path) in objects)
+    if deltify or get_external_base is not None:
+        pack_contents = metrics.timed_iter(pack_contents, 'pack.find_deltas')
+
+    with metrics.timer('pack.write'):
+        return write_pack_data(f, num_objects, pack_contents,
+                               threads=threads, progress=progress)
+
 
-    return write_pack_data(f, len(objects), pack_contents)
+def _compress_record(record):
+    # zlib releases the GIL while compressing, so this can run in parallel.
+    return record + (zlib.compress(record[3]),)
 
 
-def write_pack_data(f, num_records, records):
+def _parallel_map(func, items, threads, batch_size=COMPRESS_BATCH_SIZE):
+    """Apply a function to items in a pool of threads.
+
+    Items are processed in batches; the next batch is taken from items
+    while the previous one is being processed, and the results of a batch
+    are only yielded once the next one has been started.
+
+    :param func: Function to apply; should release the GIL for most of its
+        work (e.g. zlib) to benefit from threads
+    :param items: Iterator over items
+    :param threads: Number of threads to use
+    :param batch_size: Number of items per thread in a batch
+    :return: Iterator over the results, in the order of items
+    """
+    if threads <= 1:
+        for item in items:
+            yield func(item)
+        return
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(threads)
+    try:
+        items = iter(items)
+        batch_size = threads * batch_size
+        pending = None
+        while True:
+            batch = list(islice(items, batch_size))
+            if batch:
+                result = pool.map_async(func, batch)
+            else:
+                result = None
+            if pending is not None:
+                for value in pending.get():
+                    yield value
+            if result is None:
+                break
+            pending = result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _compress_records(records, threads):
+    """Compress the contents of pack records.
+
+    :param records: Iterator over type_num, object_id, delta_base, raw
+    :param threads: Number of threads to compress in
+    :return: Iterator over type_num, object_id, delta_base, raw and the
+        compressed raw data, in the original order
+    """
+    return _parallel_map(_compress_record, records, threads)
+
+
+def write_pack_data(f, num_records, records, threads=None, progress=None):
     """Write a new pack data file.
 
     :param f: File to write to
     :param num_records: Number of records
     :param records: Iterator over type_num, object_id, delta_base, raw
+    :param threads: Number of threads to compress records in; None to
+        compress on the calling thread and 0 for one per CPU
+    :param progress: Optional progress reporter; see dulwich.progress
     :return: Dict mapping id -> (offset, crc32 checksum), pack checksum
     """
     # Write the pack
     entries = {}
+    meter = ProgressMeter(progress, WRITING_OBJECTS, num_records)
     f = SHA1Writer(f)
     write_pack_header(f, num_records)
-    for type_num, object_id, delta_base, raw in records:
+    for type_num, object_id, delta_base, raw, comp_data in _compress_records(
+            records, _worker_count(threads)):
         offset = f.offset()
         if delta_base is not None:
             try:
@@ -1550,8 +2162,10 @@ def write_pack_data(f, num_records, records):
             else:
                 type_num = OFS_DELTA
                 raw = (offset - base_offset, raw)
-        crc32 = write_pack_object(f, type_num, raw)
+        crc32 = write_pack_object(f, type_num, raw, comp_data=comp_data)
         entries[object_id] = (offset, crc32)
+        meter.increment()
+    meter.finish()
     return entries, f.write_sha()
 
 
@@ -1618,6 +2232,8 @@ def create_delta(base_buf, target_buf):
     :param base_buf: Base buffer
     :param target_buf: Target buffer
     """
+    # difflib is only needed when writing deltas.
+    import difflib
     assert isinstance(base_buf, str)
     assert isinstance(target_buf, str)
     out_buf = ''
@@ -1874,10 +2490,45 @@ class Pack(object):
         type_num, chunks = self.data.resolve_object(offset, obj_type, obj)
         return type_num, ''.join(chunks)
 
+    def get_object_size(self, sha1):
+        """Find the size of an object in this pack, without inflating it.
+
+        :param sha1: SHA1 of the object
+        :return: Size of the object contents
+        :raise KeyError: if the object is not in this pack
+        """
+        offset = self.index.object_index(sha1)
+        if getattr(self.data, '_file', None) is None:
+            # Pack data that is not read from a local file, such as
+            # SwiftPackData, only supports reading whole objects.
+            return len(self.get_raw(sha1)[1])
+        return self.data.get_object_size_at(offset)
+
     def __getitem__(self, sha1):
         """Retrieve the specified SHA1."""
         type, uncomp = self.get_raw(sha1)
-        return ShaFile.from_raw_string(type, uncomp, sha=sha1)
+        return ShaFile.from_raw_string(type, uncomp, sha=sha1, lazy=True)
+
+    def resolve_objects(self, shas):
+        """Retrieve several objects from this pack at once.
+
+        The objects are read in the order they are stored in, and delta
+        bases shared by several of them are only inflated once; see
+        DeltaChainIterator.for_offsets.
+
+        :param shas: Iterable of SHA1s of objects in this pack
+        :return: Iterator over ShaFile objects, in pack order
+        :raise KeyError: if an object is not in this pack
+        """
+        shas = list(shas)
+        offsets = [self.index.object_index(sha) for sha in shas]
+        if getattr(self.data, '_file', None) is None:
+            # Pack data that is not read from a local file, such as
+            # SwiftPackData, only supports reading objects one at a time.
+            return (self[sha] for (offset, sha) in sorted(zip(offsets, shas)))
+        return iter(PackInflater.for_offsets(
+            self.data, offsets, get_offset=self.index.object_index,
+            resolve_ext_ref=self.resolve_ext_ref))
 
     def iterobjects(self):
         """Iterate over the objects in this pack."""
@@ -1917,6 +2568,20 @@ class Pack(object):
                 keepfile.write('\n')
         return keepfile_name
 
+    def mark_promisor(self):
+        """Add a .promisor file for the pack, marking it as fetched from a
+        promisor remote.
+
+        Objects referenced by objects in the pack may be missing from the
+        repository; see dulwich.partial_clone.
+
+        :return: The path of the .promisor file, as a string.
+        """
+        promisorfile_name = '%s.promisor' % self._basename
+        with GitFile(promisorfile_name, 'wb'):
+            pass
+        return promisorfile_name
+
 
 try:
     from dulwich._pack import apply_delta, bisect_find_sha
@@ -0,0 +1,244 @@
+# partial_clone.py -- Partial clone support
+# Copyright (C) 2014 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Partial clone support.
+
+A partial clone omits some objects, selected by an object filter, when
+fetching from a remote. That remote then becomes a promisor remote: objects
+that are missing locally are fetched from it when they are needed, such as
+when checking out a tree. Plain lookups in the object store never contact the
+promisor remote; they raise KeyError for missing objects as usual. See
+Documentation/technical/partial-clone.txt in the C git tree.
+
+The filters that are supported are those of the --filter option of git:
+
+ * blob:none omits all blobs
+ * blob:limit=<n>[kmg] omits blobs of at least n bytes (or KiB, MiB, GiB)
+ * tree:<depth> omits trees and blobs at a depth of <depth> or more below
+   the root tree; tree:0 omits all trees and blobs
+"""
+
+import stat
+
+from dulwich.objects import S_ISGITLINK
+
+
+class ObjectFilter(object):
+    """Selects the objects that are sent to the client of a partial clone.
+
+    Objects that were explicitly asked for are always sent; the filter is
+    only applied to the trees and blobs found while walking the trees of the
+    commits that are sent.
+    """
+
+    spec = None
+
+    def include_blob(self, object_store, sha, depth):
+        """Check whether a blob should be sent.
+
+        :param object_store: Object store containing the blob
+        :param sha: Hex SHA of the blob
+        :param depth: Depth of the blob below the root tree
+        :return: Boolean
+        """
+        return True
+
+    def include_tree(self, depth):
+        """Check whether a tree should be sent.
+
+        :param depth: Depth of the tree below the root tree, 0 for root trees
+        :return: Boolean
+        """
+        return True
+
+    def __eq__(self, other):
+        return (isinstance(other, self.__class__) and
+                self.spec == other.spec)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.spec)
+
+
+class BlobNoneFilter(ObjectFilter):
+    """Filter that omits all blobs."""
+
+    spec = "blob:none"
+
+    def include_blob(self, object_store, sha, depth):
+        return False
+
+
+class BlobLimitFilter(ObjectFilter):
+    """Filter that omits blobs of at least a particular size.
+
+    :param limit: Size in bytes
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.spec = "blob:limit=%d" % limit
+
+    def include_blob(self, object_store, sha, depth):
+        return object_store.get_object_size(sha) < self.limit
+
+
+class TreeDepthFilter(ObjectFilter):
+    """Filter that omits trees and blobs at or below a particular depth.
+
+    :param depth: Depth below the root tree; 0 omits all trees and blobs
+    """
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.spec = "tree:%d" % depth
+
+    def include_blob(self, object_store, sha, depth):
+        return depth < self.depth
+
+    def include_tree(self, depth):
+        return depth < self.depth
+
+
+_SIZE_UNITS = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+
+def _parse_size(text):
+    factor = _SIZE_UNITS.get(text[-1:].lower())
+    if factor is not None:
+        text = text[:-1]
+    else:
+        factor = 1
+    if not text.isdigit():
+        raise ValueError("invalid size %r" % text)
+    return int(text) * factor
+
+
+def parse_filter_spec(spec):
+    """Parse an object filter specification, as passed to git --filter.
+
+    :param spec: Filter specification, e.g. "blob:none"
+    :return: An ObjectFilter
+    :raise ValueError: if the specification is invalid or not supported
+    """
+    kind, sep, arg = spec.partition(":")
+    try:
+        if kind == "blob" and arg == "none":
+            return BlobNoneFilter()
+        elif kind == "blob" and arg.startswith("limit="):
+            return BlobLimitFilter(_parse_size(arg[len("limit="):]))
+        elif kind == "tree":
+            return TreeDepthFilter(_parse_size(arg))
+    except ValueError:
+        pass
+    raise ValueError("invalid filter spec %r" % spec)
+
+
+def configure_promisor_remote(config, name, url, filter_spec):
+    """Record in a repository configuration that it is a partial clone.
+
+    This uses the same settings as C git, so that git can also fetch
+    missing objects in the repository.
+
+    :param config: Configuration of the repository that is a partial clone
+    :param name: Name of the remote that the clone was made from
+    :param url: URL of the remote
+    :param filter_spec: Filter specification used for the clone
+    """
+    config.set(("core", ), "repositoryformatversion", "1")
+    config.set(("extensions", ), "partialclone", name)
+    config.set(("remote", name), "url", url)
+    config.set(("remote", name), "promisor", "true")
+    config.set(("remote", name), "partialclonefilter", filter_spec)
+
+
+class PromisorRemote(object):
+    """A remote that objects missing from a partial clone are fetched from.
+
+    :param repo: Repository that is a partial clone
+    :param url: URL of the remote
+    :param filter_spec: Filter specification to use when fetching, or None
+    """
+
+    def __init__(self, repo, url, filter_spec=None):
+        self.repo = repo
+        self.url = url
+        self.filter_spec = filter_spec
+
+    @classmethod
+    def from_repo(cls, repo):
+        """Find the promisor remote of a repository.
+
+        :param repo: A repository
+        :return: A PromisorRemote, or None if the repository is not a partial
+            clone
+        """
+        config = repo.get_config()
+        try:
+            name = config.get(("extensions", ), "partialclone")
+            url = config.get(("remote", name), "url")
+        except KeyError:
+            return None
+        try:
+            filter_spec = config.get(("remote", name), "partialclonefilter")
+        except KeyError:
+            filter_spec = None
+        return cls(repo, url, filter_spec)
+
+    def fetch(self, shas):
+        """Fetch objects from the remote.
+
+        The remote has to allow wanting objects that it does not advertise
+        (uploadpack.allowAnySHA1InWant).
+
+        :param shas: Hex SHAs of the objects to fetch
+        """
+        shas = list(shas)
+        if not shas:
+            return
+        from dulwich.client import get_transport_and_path
+        client, path = get_transport_and_path(self.url)
+        client.fetch(path, self.repo, determine_wants=lambda refs: shas,
+                     filter_spec=self.filter_spec)
+
+    def fetch_missing_blobs(self, tree_id):
+        """Fetch the blobs in a tree that are missing, in a single request.
+
+        Missing subtrees are fetched first, one request per level of the
+        tree.
+
+        :param tree_id: SHA of the tree
+        """
+        object_store = self.repo.object_store
+        missing = set()
+        trees = [tree_id]
+        while trees:
+            subtrees = []
+            for tree in object_store.iter_objects(trees, fetch_missing=True):
+                for entry in tree.iteritems():
+                    if stat.S_ISDIR(entry.mode):
+                        subtrees.append(entry.sha)
+                    elif (not S_ISGITLINK(entry.mode) and
+                          entry.sha not in object_store):
+                        missing.add(entry.sha)
+            trees = subtrees
+        self.fetch(missing)
+
@@ -43,6 +43,10 @@ Currently implemented:
 
 These functions are meant to behave similarly to the git subcommands.
 Differences in behaviour are considered bugs.
+
+Modules that are only needed by some of these functions, such as the
+client, server and diff code, are imported by those functions, to keep
+importing this module cheap for scripts that only use a few of them.
 """
 
 __docformat__ = 'restructuredText'
@@ -53,27 +57,20 @@ import sys
 import time
 
 from dulwich import index
-from dulwich.client import get_transport_and_path
 from dulwich.errors import (
+    NotTreeError,
     SendPackError,
     UpdateRefsError,
     )
 from dulwich.index import get_unstaged_changes
 from dulwich.objects import (
+    Commit,
     Tag,
+    Tree,
     parse_timezone,
     )
 from dulwich.objectspec import parse_object
-from dulwich.patch import write_tree_diff
-from dulwich.protocol import Protocol
 from dulwich.repo import (BaseRepo, Repo)
-from dulwich.server import (
-    FileSystemBackend,
-    TCPGitServer,
-    ReceivePackHandler,
-    UploadPackHandler,
-    update_server_info as server_update_server_info,
-    )
 
 
 # Module level tuple definition for status output
@@ -88,22 +85,48 @@ def open_repo(path_or_repo):
 
 
 def archive(location, committish=None, outstream=sys.stdout,
-            errstream=sys.stderr):
+            errstream=sys.stderr, format=None, prefix=None):
     """Create an archive.
 
+    Archives of local repositories are generated by dulwich itself; for
+    remote repositories, the server is asked to generate the archive.
+
     :param location: Location of repository for which to generate an archive.
     :param committish: Commit SHA1 or ref to use
     :param outstream: Output stream (defaults to stdout)
     :param errstream: Error stream (defaults to stderr)
+    :param format: Archive format: "tar" (the default), "tar.gz" or "zip"
+    :param prefix: Prefix to prepend to all paths in the archive
     """
+    from dulwich.archive import archive_stream
+    from dulwich.client import (
+        LocalGitClient,
+        SubprocessGitClient,
+        get_transport_and_path,
+        )
 
     client, path = get_transport_and_path(location)
     if committish is None:
         committish = "HEAD"
-    # TODO(jelmer): This invokes C git; this introduces a dependency.
-    # Instead, dulwich should have its own archiver implementation.
-    client.archive(path, committish, outstream.write, errstream.write,
-                   errstream.write)
+    if not isinstance(client, (LocalGitClient, SubprocessGitClient)):
+        client.archive(path, committish, outstream.write, errstream.write,
+                       errstream.write, format=format, prefix=prefix)
+        return
+    r = open_repo(path)
+    obj = parse_object(r, committish)
+    while isinstance(obj, Tag):
+        obj = r[obj.object[1]]
+    if isinstance(obj, Commit):
+        tree_id = obj.tree
+        mtime = obj.commit_time
+    elif isinstance(obj, Tree):
+        tree_id = obj.id
+        mtime = time.time()
+    else:
+        raise NotTreeError(obj.id)
+    for chunk in archive_stream(r.object_store, tree_id, mtime,
+                                format=format or 'tar', prefix=prefix or ''):
+        outstream.write(chunk)
 
 
 def update_server_info(repo="."):
@@ -111,6 +134,7 @@ def update_server_info(repo="."):
 
     :param repo: path to the repository
     """
+    from dulwich.server import update_server_info as server_update_server_info
     r = open_repo(repo)
     server_update_server_info(r)
 
@@ -174,20 +198,53 @@ def init(path=".", bare=False):
         return Repo.init(path)
 
 
-def clone(source, target=None, bare=False, checkout=None, outstream=sys.stdout):
+def clone(source, target=None, bare=False, checkout=None, outstream=sys.stdout,
+          filter_spec=None, depth=None, deepen_since=None, deepen_not=None,
+          local=False, shared=False):
     """Clone a local or remote git repository.
 
     :param source: Path or URL for source repository
     :param target: Path to target repository (optional)
     :param bare: Whether or not to create a bare repository
     :param outstream: Optional stream to write progress to
+    :param filter_spec: Optional object filter specification, such as
+        "blob:none", to create a partial clone; objects that are left out are
+        fetched from the source when they are needed
+    :param depth: Optional depth for a shallow clone
+    :param deepen_since: Optional timestamp; history older than this is not
+        cloned
+    :param deepen_not: Optional list of refs whose history is not cloned
+    :param local: Whether to hardlink the objects of a local source
+        repository rather than fetching them
+    :param shared: Whether to use a local source repository as an alternate
+        of the new repository rather than fetching its objects
     :return: The new repository
     """
+    from dulwich.client import (
+        LocalGitClient,
+        SubprocessGitClient,
+        get_transport_and_path,
+        )
+    from dulwich.partial_clone import (
+        PromisorRemote,
+        configure_promisor_remote,
+        )
     if checkout is None:
         checkout = (not bare)
     if checkout and bare:
         raise ValueError("checkout and bare are incompatible")
+    if (local or shared) and (filter_spec is not None or depth is not None
+                              or deepen_since is not None or deepen_not):
+        raise ValueError(
+            "local and shared clones can not be partial or shallow")
     client, host_path = get_transport_and_path(source)
+    if local or shared:
+        if not isinstance(client, (LocalGitClient, SubprocessGitClient)):
+            raise ValueError("local and shared clones require a local source")
+        source_repo = Repo(host_path)
+        if source_repo.object_store.promisor is not None:
+            raise ValueError(
+                "local and shared clones of a partial clone are not supported")
 
     if target is None:
         target = host_path.split("/")[-1]
@@ -198,14 +255,28 @@ def clone(source, target=None, bare=False, checkout=None, outstream=sys.stdout):
         r = Repo.init_bare(target)
     else:
         r = Repo.init(target)
-    remote_refs = client.fetch(host_path, r,
-        determine_wants=r.object_store.determine_wants_all,
-        progress=outstream.write)
+    if local or shared:
+        remote_refs = source_repo.copy_objects(r, shared=shared)
+    else:
+        remote_refs = client.fetch(host_path, r,
+            determine_wants=r.object_store.determine_wants_all,
+            progress=outstream.write, filter_spec=filter_spec, depth=depth,
+            deepen_since=deepen_since, deepen_not=deepen_not)
+    if filter_spec is not None:
+        if os.path.exists(source):
+            source = os.path.abspath(source)
+        config = r.get_config()
+        configure_promisor_remote(config, "origin", source, filter_spec)
+        config.write_to_path()
+        r.object_store.promisor = PromisorRemote(r, source, filter_spec)
     r["HEAD"] = remote_refs["HEAD"]
     if checkout:
         outstream.write('Checking out HEAD')
+        tree_id = r["HEAD"].tree
+        if r.object_store.promisor is not None:
+            r.object_store.promisor.fetch_missing_blobs(tree_id)
         index.build_index_from_tree(r.path, r.index_path(),
-                                    r.object_store, r["HEAD"].tree)
+                                    r.object_store, tree_id)
 
     return r
 
@@ -290,6 +361,7 @@ def show_commit(repo, commit, outstream=sys.stdout):
     :param commit: A `Commit` object
     :param outstream: Stream to write to
     """
+    from dulwich.patch import write_tree_diff
     print_commit(commit, outstream)
     parent_commit = repo[commit.parents[0]]
     write_tree_diff(outstream, repo.object_store, parent_commit.tree, commit.tree)
@@ -363,6 +435,7 @@ def diff_tree(repo, old_tree, new_tree, outstream=sys.stdout):
     :param new_tree: Id of new tree
     :param outstream: Stream to write to
     """
+    from dulwich.patch import write_tree_diff
     r = open_repo(repo)
     write_tree_diff(outstream, r.object_store, old_tree, new_tree)
 
@@ -491,6 +564,7 @@ def push(repo, remote_location, refs_path,
     :param outstream: A stream file to write output
     :param errstream: A stream file to write errors
     """
+    from dulwich.client import get_transport_and_path
 
     # Open the repo
     r = open_repo(repo)
@@ -523,6 +597,7 @@ def pull(repo, remote_location, refs_path,
     :param outstream: A stream file to write to output
     :param errstream: A stream file to write to errors
     """
+    from dulwich.client import get_transport_and_path
 
     # Open the repo
     r = open_repo(repo)
@@ -593,6 +668,10 @@ def daemon(path=".", address=None, port=None):
     :param address: Optional address to listen on (defaults to ::)
     :param port: Optional port to listen on (defaults to TCP_GIT_PORT)
     """
+    from dulwich.server import (
+        FileSystemBackend,
+        TCPGitServer,
+        )
     # TODO(jelmer): Support git-daemon-export-ok and --export-all.
     backend = FileSystemBackend(path)
     server = TCPGitServer(backend, address, port)
@@ -606,6 +685,7 @@ def web_daemon(path=".", address=None, port=None):
     :param address: Optional address to listen on (defaults to ::)
     :param port: Optional port to listen on (defaults to 80)
     """
+    from dulwich.server import FileSystemBackend
     from dulwich.web import (
         make_wsgi_chain,
         make_server,
@@ -627,6 +707,11 @@ def upload_pack(path=".", inf=sys.stdin, outf=sys.stdout):
     :param inf: Input stream to communicate with client
     :param outf: Output stream to communicate with client
     """
+    from dulwich.protocol import Protocol
+    from dulwich.server import (
+        FileSystemBackend,
+        UploadPackHandler,
+        )
     backend = FileSystemBackend()
     def send_fn(data):
         outf.write(data)
@@ -645,6 +730,11 @@ def receive_pack(path=".", inf=sys.stdin, outf=sys.stdout):
     :param inf: Input stream to communicate with client
     :param outf: Output stream to communicate with client
     """
+    from dulwich.protocol import Protocol
+    from dulwich.server import (
+        FileSystemBackend,
+        ReceivePackHandler,
+        )
     backend = FileSystemBackend()
     def send_fn(data):
         outf.write(data)
@@ -706,16 +796,19 @@ def branch_list(repo):
     return r.refs.keys(base="refs/heads/")
 
 
-def fetch(repo, remote_location, outstream=sys.stdout, errstream=sys.stderr):
+def fetch(repo, remote_location, outstream=sys.stdout, errstream=sys.stderr,
+          depth=None):
     """Fetch objects from a remote server.
 
     :param repo: Path to the repository
     :param remote_location: String identifying a remote server
     :param outstream: Output stream (defaults to stdout)
     :param errstream: Error stream (defaults to stderr)
+    :param depth: Optional depth to limit the fetched history to
     :return: Dictionary with refs on the remote
     """
+    from dulwich.client import get_transport_and_path
     r = open_repo(repo)
     client, path = get_transport_and_path(remote_location)
-    remote_refs = client.fetch(path, r, progress=errstream.write)
+    remote_refs = client.fetch(path, r, progress=errstream.write, depth=depth)
     return remote_refs
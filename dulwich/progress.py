@@ -0,0 +1,140 @@
+# progress.py -- Progress reporting
+# Copyright (C) 2014 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Progress reporting.
+
+Long-running operations, such as generating or indexing packs, report their
+progress to a reporter: a callable that is called with the name of the
+phase (for example "Counting objects"), the number of items processed so
+far, the total number of items (or None if unknown) and whether the phase
+is done. TextProgressReporter turns these reports into the progress lines
+git prints, for writing to a terminal or a side-band channel.
+
+Reports are throttled by ProgressMeter: a new report is only made when the
+percentage done changes or, if the total is not known, after some time has
+passed, rather than for every item.
+"""
+
+import time
+
+
+COUNTING_OBJECTS = "Counting objects"
+COMPRESSING_OBJECTS = "Compressing objects"
+WRITING_OBJECTS = "Writing objects"
+RESOLVING_DELTAS = "Resolving deltas"
+
+# Minimum number of seconds between progress reports that don't change the
+# percentage done.
+DEFAULT_PROGRESS_INTERVAL = 1.0
+
+
+def format_progress(phase, current, total, done):
+    """Format a progress report the way git does.
+
+    :param phase: Name of the phase
+    :param current: Number of items processed
+    :param total: Total number of items, or None if not known
+    :param done: Whether the phase is done
+    :return: Progress line; terminated by a carriage return unless the
+        phase is done
+    """
+    if total:
+        line = "%s: %3d%% (%d/%d)" % (
+            phase, current * 100 // total, current, total)
+    else:
+        line = "%s: %d" % (phase, current)
+    if done:
+        return line + ", done.\n"
+    return line + "\r"
+
+
+class TextProgressReporter(object):
+    """Progress reporter that writes git-style progress lines.
+
+    :param write: Function to call with each progress line, e.g.
+        sys.stderr.write or a side-band writer
+    """
+
+    def __init__(self, write):
+        self.write = write
+
+    def __call__(self, phase, current, total, done):
+        self.write(format_progress(phase, current, total, done))
+
+
+class ProgressMeter(object):
+    """Throttled progress of a single phase.
+
+    :param reporter: Progress reporter to send reports to, or None to not
+        report anything
+    :param phase: Name of the phase
+    :param total: Total number of items, or None if not known
+    :param interval: Minimum number of seconds between reports that don't
+        change the percentage done
+    :param clock: Function returning the current time in seconds
+    """
+
+    def __init__(self, reporter, phase, total=None,
+                 interval=DEFAULT_PROGRESS_INTERVAL, clock=time.time):
+        self.reporter = reporter
+        self.phase = phase
+        self.total = total
+        self.current = 0
+        self._interval = interval
+        self._clock = clock
+        self._last_percent = None
+        self._last_time = None
+
+    def update(self, current):
+        """Update the number of items processed, reporting it if due.
+
+        :param current: Number of items processed so far
+        """
+        self.current = current
+        if self.reporter is None:
+            return
+        if self.total:
+            percent = current * 100 // self.total
+            if percent != self._last_percent:
+                self._last_percent = percent
+                self._report(False)
+                return
+        now = self._clock()
+        if self._last_time is None:
+            self._last_time = now
+        elif now - self._last_time >= self._interval:
+            self._report(False, now)
+
+    def increment(self, count=1):
+        """Update the number of items processed by a relative amount.
+
+        :param count: Number of items processed since the last update
+        """
+        self.update(self.current + count)
+
+    def finish(self):
+        """Report the phase as done."""
+        if self.reporter is not None:
+            self._report(True)
+
+    def _report(self, done, now=None):
+        if now is None:
+            now = self._clock()
+        self._last_time = now
+        self.reporter(self.phase, self.current, self.total, done)
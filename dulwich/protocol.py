@@ -29,6 +29,9 @@ from dulwich.errors import (
     HangupException,
     GitProtocolError,
     )
+from dulwich.metrics import (
+    get_metrics,
+    )
 
 TCP_GIT_PORT = 9418
 
@@ -113,10 +116,14 @@ class Protocol(object):
             if not sizestr:
                 raise HangupException()
             size = int(sizestr, 16)
+            metrics = get_metrics()
+            metrics.incr('protocol.pkt_lines_read')
             if size == 0:
+                metrics.incr('protocol.bytes_read', 4)
                 if self.report_activity:
                     self.report_activity(4, 'read')
                 return None
+            metrics.incr('protocol.bytes_read', size)
             if self.report_activity:
                 self.report_activity(size, 'read')
             pkt_contents = read(size-4)
@@ -173,11 +180,28 @@ class Protocol(object):
         try:
             line = pkt_line(line)
             self.write(line)
+            metrics = get_metrics()
+            metrics.incr('protocol.pkt_lines_written')
+            metrics.incr('protocol.bytes_written', len(line))
             if self.report_activity:
                 self.report_activity(len(line), 'write')
         except socket.error as e:
             raise GitProtocolError(e)
 
+    def write_pkt_lines(self, data):
+        """Sends data that has already been framed as pkt-lines.
+
+        :param data: A string with one or more complete pkt-lines, e.g. as
+            generated by pkt_line().
+        """
+        try:
+            self.write(data)
+            get_metrics().incr('protocol.bytes_written', len(data))
+            if self.report_activity:
+                self.report_activity(len(data), 'write')
+        except socket.error as e:
+            raise GitProtocolError(e)
+
     def write_file(self):
         """Return a writable file-like object for this protocol."""
 
@@ -22,17 +22,30 @@
 
 """
 import errno
+from io import BytesIO
+import itertools
 import os
+import sys
+import time
+
+try:
+    import mmap
+except ImportError:
+    has_mmap = False
+else:
+    has_mmap = True
 
 from dulwich.errors import (
     PackedRefsException,
     RefFormatError,
     )
 from dulwich.objects import (
+    ZERO_SHA,
     hex_to_sha,
     )
 from dulwich.file import (
     GitFile,
+    RACY_TIMESTAMP_INTERVAL,
     ensure_dir_exists,
     )
 
@@ -40,6 +53,13 @@ from dulwich.file import (
 SYMREF = 'ref: '
 LOCAL_BRANCH_PREFIX = 'refs/heads/'
 
+# Reasons reported by RefsContainer.update_refs for refs it did not update
+UPDATE_BAD_REF = 'bad ref'
+UPDATE_LOCK_FAILED = 'failed to lock'
+UPDATE_OLD_VALUE_MISMATCH = 'old value mismatch'
+UPDATE_WRITE_FAILED = 'failed to write'
+UPDATE_ATOMIC_FAILED = 'atomic transaction failed'
+
 
 def check_ref_format(refname):
     """Check if a refname is correctly formatted.
@@ -104,6 +124,17 @@ class RefsContainer(object):
         """
         return None
 
+    def get_state_token(self):
+        """Return a token that changes whenever the refs in this container do.
+
+        Callers can use this to cache data derived from the refs, comparing
+        tokens to find out whether a cached value is still valid.
+
+        :return: A hashable token, or None if changes can not currently be
+            detected reliably, in which case nothing should be cached.
+        """
+        return None
+
     def import_refs(self, base, other):
         for name, value in other.iteritems():
             self["%s/%s" % (base, name)] = value
@@ -179,9 +210,17 @@ class RefsContainer(object):
         """
         contents = self.read_loose_ref(refname)
         if not contents:
-            contents = self.get_packed_refs().get(refname, None)
+            contents = self.read_packed_ref(refname)
         return contents
 
+    def read_packed_ref(self, name):
+        """Read a packed reference.
+
+        :param name: the refname to read
+        :return: The SHA1 of the packed ref, or None if it is not packed.
+        """
+        return self.get_packed_refs().get(name, None)
+
     def read_loose_ref(self, name):
         """Read a loose reference and return its contents.
 
@@ -285,6 +324,83 @@ class RefsContainer(object):
         """
         self.remove_if_equals(name, None)
 
+    def update_refs(self, updates, atomic=False):
+        """Apply a batch of ref updates.
+
+        Each update is a tuple of (name, old_ref, new_ref). old_ref is the sha
+        the ref must currently refer to, ZERO_SHA if the ref must not exist
+        yet, or None to update the ref unconditionally. new_ref is the new
+        sha, or ZERO_SHA to delete the ref. As with set_if_equals() and
+        remove_if_equals(), symbolic references are followed when setting a
+        ref but not when deleting one.
+
+        Subclasses override this to lock all refs involved, verify the old
+        values and write the new values in one go. This implementation
+        checks all old values first and then applies the updates one at a
+        time, so it is only atomic with respect to other users of the same
+        container if the container itself is not shared.
+
+        :param updates: Iterable of (name, old_ref, new_ref) tuples
+        :param atomic: Whether to apply either all of the updates or none
+        :return: Dictionary mapping the names of refs that were not updated
+            to the reason, as one of the UPDATE_* constants
+        """
+        updates = list(updates)
+        failed = {}
+        for name, old_ref, new_ref in updates:
+            try:
+                self._check_refname(name)
+            except RefFormatError:
+                failed[name] = UPDATE_BAD_REF
+                continue
+            if not _old_ref_matches(
+                    self._read_update_target(name, new_ref)[1], old_ref):
+                failed[name] = UPDATE_OLD_VALUE_MISMATCH
+        if atomic and failed:
+            return _fail_atomic(updates, failed)
+        for name, old_ref, new_ref in updates:
+            if name in failed:
+                continue
+            if old_ref == ZERO_SHA:
+                old_ref = None
+                if new_ref == ZERO_SHA:
+                    continue
+                ok = self.add_if_new(name, new_ref)
+            elif new_ref == ZERO_SHA:
+                ok = self.remove_if_equals(name, old_ref)
+            else:
+                ok = self.set_if_equals(name, old_ref, new_ref)
+            if not ok:
+                failed[name] = UPDATE_OLD_VALUE_MISMATCH
+        return failed
+
+    def _read_update_target(self, name, new_ref):
+        """Find the ref an update applies to and read its current value.
+
+        :return: Tuple with the name of the ref to update and its contents,
+            or None if it does not exist
+        """
+        if new_ref == ZERO_SHA:
+            return name, self.read_ref(name)
+        try:
+            return self._follow(name)
+        except KeyError:
+            return name, None
+
+
+def _old_ref_matches(orig_ref, old_ref):
+    if old_ref is None:
+        return True
+    if old_ref == ZERO_SHA:
+        return orig_ref is None
+    return orig_ref == old_ref
+
+
+def _fail_atomic(updates, failed):
+    for name, old_ref, new_ref in updates:
+        failed.setdefault(name, UPDATE_ATOMIC_FAILED)
+    return failed
+
 
 class DictRefsContainer(RefsContainer):
     """RefsContainer backed by a simple dict.
@@ -296,6 +412,7 @@ class DictRefsContainer(RefsContainer):
     def __init__(self, refs):
         self._refs = refs
         self._peeled = {}
+        self._version = 0
 
     def allkeys(self):
         return self._refs.keys()
@@ -306,8 +423,13 @@ class DictRefsContainer(RefsContainer):
     def get_packed_refs(self):
         return {}
 
+    def get_state_token(self):
+        # Changes made directly to the dict passed in can not be detected.
+        return (id(self), self._version)
+
     def set_symbolic_ref(self, name, other):
         self._refs[name] = SYMREF + other
+        self._version += 1
 
     def set_if_equals(self, name, old_ref, new_ref):
         if old_ref is not None and self._refs.get(name, None) != old_ref:
@@ -315,18 +437,21 @@ class DictRefsContainer(RefsContainer):
         realname, _ = self._follow(name)
         self._check_refname(realname)
         self._refs[realname] = new_ref
+        self._version += 1
         return True
 
     def add_if_new(self, name, ref):
         if name in self._refs:
             return False
         self._refs[name] = ref
+        self._version += 1
         return True
 
     def remove_if_equals(self, name, old_ref):
         if old_ref is not None and self._refs.get(name, None) != old_ref:
             return False
         del self._refs[name]
+        self._version += 1
         return True
 
     def get_peeled(self, name):
@@ -337,10 +462,12 @@ class DictRefsContainer(RefsContainer):
         # TODO(dborowitz): replace this with a public function that uses
         # set_if_equal.
         self._refs.update(refs)
+        self._version += 1
 
     def _update_peeled(self, peeled):
         """Update cached peeled refs; intended only for testing."""
         self._peeled.update(peeled)
+        self._version += 1
 
 
 class InfoRefsContainer(RefsContainer):
@@ -377,47 +504,368 @@ class InfoRefsContainer(RefsContainer):
             return self._refs[name]
 
 
+def _map_file(f):
+    """Read the contents of a file, memory-mapping it if possible."""
+    # Windows does not allow renaming over a mapped file, which would break
+    # concurrent writers of packed-refs.
+    if has_mmap and sys.platform != 'win32':
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        if size == 0:
+            return ''
+        try:
+            return mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        except mmap.error:
+            pass
+    return f.read()
+
+
+def _unmap(contents):
+    if has_mmap and isinstance(contents, mmap.mmap):
+        contents.close()
+
+
+class PackedRefsTable(object):
+    """Sorted table of the refs in a packed-refs file.
+
+    The file is memory-mapped where possible rather than parsed into a
+    dictionary up front. Single lookups binary search the sorted records and
+    prefix queries are answered by scanning the matching range only. The
+    table is reloaded whenever the file changes on disk, so callers never see
+    stale data after another process repacks refs.
+
+    Files that do not carry the "sorted" trait in their header are sorted in
+    memory once when loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._stat = None
+        self._contents = ''
+        self._start = 0
+        self._peeled = False
+        self._loaded = False
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.path)
+
+    def _stat_file(self):
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def invalidate(self):
+        """Drop the loaded contents, forcing a reload on next access."""
+        self._loaded = False
+
+    def close(self):
+        """Release the memory map, if any."""
+        contents = self._contents
+        self._contents = ''
+        self._loaded = False
+        _unmap(contents)
+
+    def _ensure_loaded(self):
+        st = self._stat_file()
+        if not self._loaded or st != self._stat:
+            self._load(st)
+        return self._contents
+
+    def _load(self, st):
+        self.close()
+        self._stat = st
+        self._start = 0
+        self._peeled = False
+        if st is None:
+            contents = ''
+        else:
+            try:
+                f = GitFile(self.path, 'rb')
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                contents = ''
+            else:
+                with f:
+                    contents = _map_file(f)
+        traits = []
+        if contents[:11] == '# pack-refs':
+            end = contents.find('\n')
+            if end == -1:
+                end = len(contents)
+            header = contents[:end].rstrip('\r')
+            self._peeled = ' peeled' in header
+            self._start = end + 1
+            if ':' in header:
+                traits = header.split(':', 1)[1].split()
+        if 'sorted' not in traits and self._start < len(contents):
+            sorted_contents = self._sort_contents(contents[self._start:])
+            _unmap(contents)
+            contents = sorted_contents
+            self._start = 0
+        self._contents = contents
+        self._loaded = True
+
+    def _sort_contents(self, contents):
+        """Return a sorted in-memory copy of unsorted packed-refs records."""
+        f = BytesIO(contents)
+        refs = {}
+        peeled = {}
+        if self._peeled:
+            for sha, name, peeled_sha in read_packed_refs_with_peeled(f):
+                refs[name] = sha
+                if peeled_sha:
+                    peeled[name] = peeled_sha
+        else:
+            for sha, name in read_packed_refs(f):
+                refs[name] = sha
+        out = BytesIO()
+        for refname in sorted(refs):
+            out.write('%s %s\n' % (refs[refname], refname))
+            if refname in peeled:
+                out.write('^%s\n' % peeled[refname])
+        return out.getvalue()
+
+    def _record_start(self, contents, pos):
+        """Find the start of the record containing the given offset."""
+        start = contents.rfind('\n', self._start, pos) + 1
+        if start < self._start:
+            start = self._start
+        if contents[start:start+1] == '^' and start > self._start:
+            start = max(self._start,
+                        contents.rfind('\n', self._start, start - 1) + 1)
+        return start
+
+    def _record_name(self, contents, pos):
+        end = contents.find('\n', pos)
+        if end == -1:
+            end = len(contents)
+        return contents[pos+41:end].rstrip('\r')
+
+    def _read_record(self, contents, pos):
+        """Read the record at an offset.
+
+        :return: Tuple with SHA1, ref name, peeled SHA1 (or None) and the
+            offset of the next record
+        """
+        end = contents.find('\n', pos)
+        if end == -1:
+            end = len(contents)
+        sha, name = _split_ref_line(contents[pos:end].rstrip('\r'))
+        pos = end + 1
+        peeled = None
+        if contents[pos:pos+1] == '^':
+            end = contents.find('\n', pos)
+            if end == -1:
+                end = len(contents)
+            peeled = contents[pos+1:end].rstrip('\r')
+            try:
+                hex_to_sha(peeled)
+            except (AssertionError, TypeError) as e:
+                raise PackedRefsException(e)
+            pos = end + 1
+        return sha, name, peeled, pos
+
+    def _next_record(self, contents, pos):
+        pos = contents.find('\n', pos)
+        if pos == -1:
+            return len(contents)
+        pos += 1
+        if contents[pos:pos+1] == '^':
+            pos = contents.find('\n', pos)
+            if pos == -1:
+                return len(contents)
+            pos += 1
+        return pos
+
+    def _lower_bound(self, contents, name):
+        """Find the offset of the first record whose name is >= name."""
+        lo = self._start
+        hi = len(contents)
+        while lo < hi:
+            rec = self._record_start(contents, (lo + hi) // 2)
+            if self._record_name(contents, rec) < name:
+                lo = self._next_record(contents, rec)
+            else:
+                hi = rec
+        return lo
+
+    def lookup(self, name):
+        """Look up a single packed ref.
+
+        :param name: Name of the ref
+        :return: Tuple with SHA1 and peeled SHA1 (or None), or None if the
+            ref is not packed
+        """
+        contents = self._ensure_loaded()
+        pos = self._lower_bound(contents, name)
+        if pos >= len(contents) or self._record_name(contents, pos) != name:
+            return None
+        sha, _, peeled, _ = self._read_record(contents, pos)
+        return sha, peeled
+
+    def get(self, name, default=None):
+        ret = self.lookup(name)
+        if ret is None:
+            return default
+        return ret[0]
+
+    def __contains__(self, name):
+        return self.lookup(name) is not None
+
+    def has_peeled(self):
+        """Check whether this file records peeled values for its tags."""
+        self._ensure_loaded()
+        return self._peeled
+
+    def iterrefs(self, prefix=''):
+        """Iterate over packed refs in sorted order.
+
+        :param prefix: Only return refs whose name starts with this prefix
+        :return: Iterator over tuples with ref name, SHA1 and peeled SHA1
+            (or None)
+        """
+        contents = self._ensure_loaded()
+        if prefix:
+            pos = self._lower_bound(contents, prefix)
+        else:
+            pos = self._start
+        end = len(contents)
+        while pos < end:
+            if contents[pos] in '#\r\n':
+                pos = self._next_record(contents, pos)
+                continue
+            sha, name, peeled, pos = self._read_record(contents, pos)
+            if not name.startswith(prefix):
+                break
+            yield name, sha, peeled
+
+    def __iter__(self):
+        return (name for (name, sha, peeled) in self.iterrefs())
+
+    def as_dicts(self):
+        """Return the contents of the table as dictionaries.
+
+        :return: Tuple with a dictionary mapping ref names to SHA1s and a
+            dictionary mapping ref names to peeled SHA1s
+        """
+        refs = {}
+        peeled_refs = {}
+        for name, sha, peeled in self.iterrefs():
+            refs[name] = sha
+            if peeled is not None:
+                peeled_refs[name] = peeled
+        return refs, peeled_refs
+
+
 class DiskRefsContainer(RefsContainer):
     """Refs container that reads refs from disk."""
 
     def __init__(self, path):
         self.path = path
-        self._packed_refs = None
-        self._peeled_refs = None
+        self._packed_refs = PackedRefsTable(os.path.join(path, 'packed-refs'))
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.path)
 
-    def subkeys(self, base):
-        keys = set()
+    def _iter_loose_refnames(self, base):
+        """Iterate over the names of the loose refs under a base.
+
+        :param base: Base to look under, e.g. "refs"
+        :return: Iterator over full names of valid loose refs
+        """
         path = self.refpath(base)
         for root, dirs, files in os.walk(path):
             dir = root[len(path):].strip(os.path.sep).replace(os.path.sep, "/")
             for filename in files:
-                refname = ("%s/%s" % (dir, filename)).strip("/")
-                # check_ref_format requires at least one /, so we prepend the
-                # base before calling it.
-                if check_ref_format("%s/%s" % (base, refname)):
-                    keys.add(refname)
-        for key in self.get_packed_refs():
-            if key.startswith(base):
-                keys.add(key[len(base):].strip("/"))
+                refname = ("%s/%s/%s" % (base, dir, filename)).replace(
+                    "//", "/")
+                if check_ref_format(refname):
+                    yield refname
+
+    def subkeys(self, base):
+        keys = set()
+        prefix = base.rstrip("/") + "/"
+        for refname in self._iter_loose_refnames(base.rstrip("/")):
+            keys.add(refname[len(prefix):])
+        for key in self._packed_refs.iterrefs(prefix):
+            keys.add(key[0][len(prefix):])
         return keys
 
     def allkeys(self):
         keys = set()
         if os.path.exists(self.refpath("HEAD")):
             keys.add("HEAD")
-        path = self.refpath("")
-        for root, dirs, files in os.walk(self.refpath("refs")):
-            dir = root[len(path):].strip(os.path.sep).replace(os.path.sep, "/")
-            for filename in files:
-                refname = ("%s/%s" % (dir, filename)).strip("/")
-                if check_ref_format(refname):
-                    keys.add(refname)
-        keys.update(self.get_packed_refs())
+        keys.update(self._iter_loose_refnames("refs"))
+        keys.update(self._packed_refs)
         return keys
 
+    def as_dict(self, base=None):
+        """Return the contents of this container as a dictionary.
+
+        Packed refs are read straight from the packed-refs table and only the
+        loose refs that actually exist are opened, rather than looking for a
+        loose file for every packed ref.
+        """
+        if base is None:
+            prefix = ""
+            loose = self._iter_loose_refnames("refs")
+            if os.path.exists(self.refpath("HEAD")):
+                loose = itertools.chain(["HEAD"], loose)
+        else:
+            prefix = base.rstrip("/") + "/"
+            loose = self._iter_loose_refnames(base.rstrip("/"))
+        contents = dict(
+            (name, sha) for (name, sha, peeled)
+            in self._packed_refs.iterrefs(prefix))
+        for name in loose:
+            value = self.read_loose_ref(name)
+            if value is not None:
+                contents[name] = value
+        ret = {}
+        for name, value in contents.iteritems():
+            if value.startswith(SYMREF):
+                try:
+                    value = self[name]
+                except KeyError:
+                    continue  # Unable to resolve
+            ret[name[len(prefix):]] = value
+        return ret
+
+    def get_state_token(self):
+        """Return a token that changes whenever the refs on disk do.
+
+        The token is built from the stat information of HEAD, packed-refs,
+        every directory under refs/ and every loose ref. When any of those
+        was modified too recently for its timestamp to be trusted, None is
+        returned.
+        """
+        token = []
+        paths = [self.refpath("HEAD"), self._packed_refs.path]
+        for root, dirs, files in os.walk(self.refpath("refs")):
+            paths.append(root)
+            paths.extend(os.path.join(root, f) for f in files)
+        newest = 0
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    token.append((path, None))
+                    continue
+                raise
+            newest = max(newest, st.st_mtime)
+            token.append((path, st.st_mtime, st.st_size, st.st_ino))
+        if time.time() - newest < RACY_TIMESTAMP_INTERVAL:
+            # A change made in the same timestamp tick as the last one would
+            # go unnoticed.
+            return None
+        return tuple(token)
+
     def refpath(self, name):
         """Return the disk path of a ref.
 
@@ -433,33 +881,18 @@ class DiskRefsContainer(RefsContainer):
 
         :note: Will return an empty dictionary when no packed-refs file is
             present.
+        :note: This builds a new dictionary on every call; use read_ref() or
+            keys() to look up individual refs or ranges of refs.
         """
-        # TODO: invalidate the cache on repacking
-        if self._packed_refs is None:
-            # set both to empty because we want _peeled_refs to be
-            # None if and only if _packed_refs is also None.
-            self._packed_refs = {}
-            self._peeled_refs = {}
-            path = os.path.join(self.path, 'packed-refs')
-            try:
-                f = GitFile(path, 'rb')
-            except IOError as e:
-                if e.errno == errno.ENOENT:
-                    return {}
-                raise
-            with f:
-                first_line = next(iter(f)).rstrip()
-                if (first_line.startswith("# pack-refs") and " peeled" in
-                        first_line):
-                    for sha, name, peeled in read_packed_refs_with_peeled(f):
-                        self._packed_refs[name] = sha
-                        if peeled:
-                            self._peeled_refs[name] = peeled
-                else:
-                    f.seek(0)
-                    for sha, name in read_packed_refs(f):
-                        self._packed_refs[name] = sha
-        return self._packed_refs
+        return self._packed_refs.as_dicts()[0]
+
+    def read_packed_ref(self, name):
+        """Read a packed reference.
+
+        :param name: the refname to read
+        :return: The SHA1 of the packed ref, or None if it is not packed.
+        """
+        return self._packed_refs.get(name)
 
     def get_peeled(self, name):
         """Return the cached peeled value of a ref, if available.
@@ -469,12 +902,13 @@ class DiskRefsContainer(RefsContainer):
             tag, this will be the SHA the ref refers to. If the ref may point to
             a tag, but no cached information is available, None is returned.
         """
-        self.get_packed_refs()
-        if self._peeled_refs is None or name not in self._packed_refs:
+        packed = self._packed_refs.lookup(name)
+        if packed is None or not self._packed_refs.has_peeled():
             # No cache: no peeled refs were read, or this ref is loose
             return None
-        if name in self._peeled_refs:
-            return self._peeled_refs[name]
+        sha, peeled = packed
+        if peeled is not None:
+            return peeled
         else:
             # Known not peelable
             return self[name]
@@ -505,25 +939,38 @@ class DiskRefsContainer(RefsContainer):
                 return None
             raise
 
+    def _write_packed_refs_without(self, f, names):
+        """Rewrite packed-refs without the given refs.
+
+        :param f: Locked packed-refs file to write to
+        :param names: Names of refs to remove
+        :return: True if the file was rewritten
+        """
+        # reread cached refs from disk, while holding the lock
+        self._packed_refs.invalidate()
+        packed_refs, peeled_refs = self._packed_refs.as_dicts()
+        removed = False
+        for name in names:
+            if name in packed_refs:
+                del packed_refs[name]
+                peeled_refs.pop(name, None)
+                removed = True
+        if not removed:
+            return False
+        if not self._packed_refs.has_peeled():
+            peeled_refs = None
+        write_packed_refs(f, packed_refs, peeled_refs)
+        return True
+
     def _remove_packed_ref(self, name):
-        if self._packed_refs is None:
+        if name not in self._packed_refs:
             return
-        filename = os.path.join(self.path, 'packed-refs')
-        # reread cached refs from disk, while holding the lock
-        f = GitFile(filename, 'wb')
+        f = GitFile(self._packed_refs.path, 'wb')
         try:
-            self._packed_refs = None
-            self.get_packed_refs()
-
-            if name not in self._packed_refs:
-                return
-
-            del self._packed_refs[name]
-            if name in self._peeled_refs:
-                del self._peeled_refs[name]
-            write_packed_refs(f, self._packed_refs, self._peeled_refs)
-            f.close()
+            if self._write_packed_refs_without(f, [name]):
+                f.close()
         finally:
+            self._packed_refs.invalidate()
             f.abort()
 
     def set_symbolic_ref(self, name, other):
@@ -570,7 +1017,7 @@ class DiskRefsContainer(RefsContainer):
                     # read again while holding the lock
                     orig_ref = self.read_loose_ref(realname)
                     if orig_ref is None:
-                        orig_ref = self.get_packed_refs().get(realname, None)
+                        orig_ref = self.read_packed_ref(realname)
                     if orig_ref != old_ref:
                         f.abort()
                         return False
@@ -604,7 +1051,7 @@ class DiskRefsContainer(RefsContainer):
         filename = self.refpath(realname)
         ensure_dir_exists(os.path.dirname(filename))
         with GitFile(filename, 'wb') as f:
-            if os.path.exists(filename) or name in self.get_packed_refs():
+            if os.path.exists(filename) or name in self._packed_refs:
                 f.abort()
                 return False
             try:
@@ -633,7 +1080,7 @@ class DiskRefsContainer(RefsContainer):
             if old_ref is not None:
                 orig_ref = self.read_loose_ref(name)
                 if orig_ref is None:
-                    orig_ref = self.get_packed_refs().get(name, None)
+                    orig_ref = self.read_packed_ref(name)
                 if orig_ref != old_ref:
                     return False
             # may only be packed
@@ -648,6 +1095,85 @@ class DiskRefsContainer(RefsContainer):
             f.abort()
         return True
 
+    def update_refs(self, updates, atomic=False):
+        """Apply a batch of ref updates.
+
+        All loose refs involved are locked first, and packed-refs is locked
+        as well if any packed ref is deleted. Old values are verified while
+        holding the locks, after which the new values are written and all
+        deletions from packed-refs are done in a single rewrite.
+
+        See RefsContainer.update_refs for the parameters and return value.
+        """
+        updates = list(updates)
+        failed = {}
+        locks = {}
+        pending = []
+        packed_lock = None
+        try:
+            for name, old_ref, new_ref in updates:
+                try:
+                    self._check_refname(name)
+                except RefFormatError:
+                    failed[name] = UPDATE_BAD_REF
+                    continue
+                realname = self._read_update_target(name, new_ref)[0]
+                if realname in locks:
+                    # Refuse to update a ref twice in one batch
+                    failed[name] = UPDATE_LOCK_FAILED
+                    continue
+                filename = self.refpath(realname)
+                try:
+                    ensure_dir_exists(os.path.dirname(filename))
+                    locks[realname] = GitFile(filename, 'wb')
+                except (OSError, IOError):
+                    failed[name] = UPDATE_LOCK_FAILED
+                    continue
+                # read again while holding the lock
+                orig_ref = self.read_loose_ref(realname)
+                if orig_ref is None:
+                    orig_ref = self.read_packed_ref(realname)
+                if not _old_ref_matches(orig_ref, old_ref):
+                    failed[name] = UPDATE_OLD_VALUE_MISMATCH
+                    continue
+                if (new_ref == ZERO_SHA and packed_lock is None and
+                        realname in self._packed_refs):
+                    try:
+                        packed_lock = GitFile(self._packed_refs.path, 'wb')
+                    except (OSError, IOError):
+                        failed[name] = UPDATE_LOCK_FAILED
+                        continue
+                pending.append((name, realname, new_ref))
+            if atomic and failed:
+                return _fail_atomic(updates, failed)
+
+            deleted = [target for (ref, target, sha) in pending
+                       if sha == ZERO_SHA]
+            if packed_lock is not None:
+                if self._write_packed_refs_without(packed_lock, deleted):
+                    packed_lock.close()
+            for name, realname, new_ref in pending:
+                f = locks[realname]
+                try:
+                    if new_ref == ZERO_SHA:
+                        try:
+                            os.remove(self.refpath(realname))
+                        except OSError as e:
+                            if e.errno != errno.ENOENT:
+                                raise
+                    else:
+                        f.write(new_ref + "\n")
+                        f.close()
+                except (OSError, IOError):
+                    failed[name] = UPDATE_WRITE_FAILED
+        finally:
+            for f in locks.itervalues():
+                f.abort()
+            if packed_lock is not None:
+                self._packed_refs.invalidate()
+                packed_lock.abort()
+        return failed
+
 
 def _split_ref_line(line):
     """Split a single ref line into a tuple of SHA1 and name."""
@@ -722,8 +1248,9 @@ def write_packed_refs(f, packed_refs, peeled_refs=None):
     """
     if peeled_refs is None:
         peeled_refs = {}
+        f.write('# pack-refs with: sorted\n')
     else:
-        f.write('# pack-refs with: peeled\n')
+        f.write('# pack-refs with: peeled sorted\n')
     for refname in sorted(packed_refs.iterkeys()):
         f.write('%s %s\n' % (packed_refs[refname], refname))
         if refname in peeled_refs:
@@ -0,0 +1,912 @@
+# reftable.py -- Reftable ref storage
+# Copyright (C) 2014 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Reftable ref storage.
+
+Reftable is a block-based format for storing refs, described in
+Documentation/technical/reftable.txt in the C git tree. Ref records are
+sorted and prefix-compressed, with restart points and an optional index so
+single refs can be found without reading the whole table.
+
+A repository stores its refs in a stack of tables, listed oldest first in
+reftable/tables.list. Every update appends a new table and swaps in a new
+tables.list, which makes updates of many refs at once atomic. Adjacent
+tables are merged automatically to keep the stack short.
+
+Only ref blocks and ref index blocks are written. Object and log blocks are
+ignored when reading.
+"""
+
+from collections import namedtuple
+import errno
+import heapq
+import os
+import struct
+import zlib
+
+from dulwich.errors import (
+    RefFormatError,
+    ReftableFormatError,
+    )
+from dulwich.file import (
+    GitFile,
+    ensure_dir_exists,
+    )
+from dulwich.objects import (
+    ZERO_SHA,
+    hex_to_sha,
+    sha_to_hex,
+    )
+from dulwich.refs import (
+    RefsContainer,
+    SYMREF,
+    UPDATE_BAD_REF,
+    UPDATE_LOCK_FAILED,
+    UPDATE_OLD_VALUE_MISMATCH,
+    _fail_atomic,
+    _map_file,
+    _old_ref_matches,
+    _unmap,
+    )
+
+
+REFTABLE_DIR = 'reftable'
+TABLES_LIST = 'tables.list'
+
+REFTABLE_MAGIC = 'REFT'
+REFTABLE_VERSION = 1
+SHA1_HASH_ID = 0x73686131
+
+DEFAULT_BLOCK_SIZE = 4096
+RESTART_INTERVAL = 16
+
+# Tables are only indexed once they span this many ref blocks.
+MIN_INDEXED_BLOCKS = 4
+
+# A table is merged with the newer tables above it unless it is at least
+# this many times their combined size.
+COMPACTION_FACTOR = 2
+
+BLOCK_TYPE_REF = 'r'
+BLOCK_TYPE_INDEX = 'i'
+
+VALUE_DELETION = 0
+VALUE_SHA = 1
+VALUE_SHA_PEELED = 2
+VALUE_SYMREF = 3
+
+
+RefRecord = namedtuple('RefRecord', ['name', 'update_index', 'value',
+                                     'peeled'])
+"""A ref record.
+
+:ivar value: None for a deleted ref, SYMREF followed by the target for a
+    symbolic ref and the hex SHA1 otherwise
+:ivar peeled: Peeled hex SHA1, or None if not recorded
+"""
+
+
+def encode_varint(value):
+    """Encode an integer using the varint encoding used by reftable.
+
+    :param value: Non-negative integer
+    :return: Encoded bytes
+    """
+    ret = [chr(value & 0x7f)]
+    value >>= 7
+    while value:
+        value -= 1
+        ret.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    return ''.join(reversed(ret))
+
+
+def decode_varint(buf, pos):
+    """Decode a varint.
+
+    :param buf: Buffer to read from
+    :param pos: Offset of the varint in buf
+    :return: Tuple with the decoded value and the offset after the varint
+    """
+    c = ord(buf[pos])
+    pos += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = ord(buf[pos])
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, pos
+
+
+def _pack_uint24(value):
+    return struct.pack('>L', value)[1:]
+
+
+def _unpack_uint24(buf, pos):
+    return struct.unpack('>L', '\0' + buf[pos:pos+3])[0]
+
+
+def _common_prefix_len(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _encode_ref_value(record, min_update_index):
+    if record.value is None:
+        value_type = VALUE_DELETION
+        value = ''
+    elif record.value.startswith(SYMREF):
+        value_type = VALUE_SYMREF
+        target = record.value[len(SYMREF):]
+        value = encode_varint(len(target)) + target
+    elif record.peeled is not None:
+        value_type = VALUE_SHA_PEELED
+        value = hex_to_sha(record.value) + hex_to_sha(record.peeled)
+    else:
+        value_type = VALUE_SHA
+        value = hex_to_sha(record.value)
+    return value_type, (
+        encode_varint(record.update_index - min_update_index) + value)
+
+
+def _pack_header(block_size, min_update_index, max_update_index):
+    return (REFTABLE_MAGIC + chr(REFTABLE_VERSION) +
+            _pack_uint24(block_size) +
+            struct.pack('>QQ', min_update_index, max_update_index))
+
+
+class _TableWriter(object):
+    """Writes a reftable to a file, one block at a time."""
+
+    def __init__(self, f, block_size, min_update_index, max_update_index):
+        self.f = f
+        self.block_size = block_size
+        self.header = _pack_header(block_size, min_update_index,
+                                   max_update_index)
+        self.offset = 0
+        self._pending_padding = 0
+
+    def write_section(self, block_type, entries):
+        """Write a section of blocks.
+
+        :param block_type: Block type
+        :param entries: Sorted iterable of (key, value_type, payload) tuples
+        :return: List of (last key, offset) tuples, one per block written
+        """
+        blocks = []
+        state = {'records': [], 'restarts': [], 'size': 0, 'last_key': ''}
+
+        def block_prefix():
+            if self.offset == 0 and not blocks:
+                return self.header
+            return ''
+
+        def flush():
+            prefix = block_prefix()
+            start = len(prefix) + 4
+            restarts = state['restarts']
+            body = ''.join(state['records'])
+            block_len = start + len(body) + 3 * len(restarts) + 2
+            if self._pending_padding:
+                self.f.write('\0' * self._pending_padding)
+                self.offset += self._pending_padding
+            blocks.append((state['last_key'], self.offset))
+            self.f.write(prefix + block_type + _pack_uint24(block_len))
+            self.f.write(body)
+            self.f.write(''.join(_pack_uint24(start + r) for r in restarts))
+            self.f.write(struct.pack('>H', len(restarts)))
+            self.offset += block_len
+            self._pending_padding = self.block_size - block_len
+            state['records'] = []
+            state['restarts'] = []
+            state['size'] = 0
+            state['last_key'] = ''
+
+        for key, value_type, payload in entries:
+            for attempt in range(2):
+                count = len(state['records'])
+                if count % RESTART_INTERVAL == 0:
+                    prefix_len = 0
+                else:
+                    prefix_len = _common_prefix_len(state['last_key'], key)
+                suffix = key[prefix_len:]
+                data = (encode_varint(prefix_len) +
+                        encode_varint((len(suffix) << 3) | value_type) +
+                        suffix + payload)
+                restarts = len(state['restarts']) + (prefix_len == 0)
+                needed = (len(block_prefix()) + 4 + state['size'] +
+                          len(data) + 3 * restarts + 2)
+                if needed <= self.block_size:
+                    break
+                if not count:
+                    raise ValueError('reftable entry %r too large' % key)
+                flush()
+            if prefix_len == 0:
+                state['restarts'].append(state['size'])
+            state['records'].append(data)
+            state['size'] += len(data)
+            state['last_key'] = key
+        if state['records']:
+            flush()
+        return blocks
+
+    def write_index(self, blocks):
+        """Write index blocks pointing at blocks, returning its offset."""
+        while True:
+            blocks = self.write_section(
+                BLOCK_TYPE_INDEX,
+                ((key, 0, encode_varint(offset)) for key, offset in blocks))
+            if len(blocks) == 1:
+                return blocks[0][1]
+
+    def write_footer(self, ref_index_position):
+        footer = self.header + struct.pack(
+            '>QQQQQ', ref_index_position, 0, 0, 0, 0)
+        footer += struct.pack('>L', zlib.crc32(footer) & 0xffffffff)
+        self.f.write(footer)
+        self.offset += len(footer)
+
+
+def write_reftable(f, records, min_update_index, max_update_index,
+                   block_size=DEFAULT_BLOCK_SIZE):
+    """Write a reftable.
+
+    :param f: File-like object to write to
+    :param records: Iterable over `RefRecord` objects, sorted by name
+    :param min_update_index: Lowest update index of the records
+    :param max_update_index: Highest update index of the records
+    :param block_size: Block size to use
+    """
+    writer = _TableWriter(f, block_size, min_update_index, max_update_index)
+    entries = (
+        (record.name,) + _encode_ref_value(record, min_update_index)
+        for record in records)
+    blocks = writer.write_section(BLOCK_TYPE_REF, entries)
+    if not blocks:
+        # Empty tables still consist of a header and a footer
+        f.write(writer.header)
+        writer.offset += len(writer.header)
+    ref_index_position = 0
+    if len(blocks) >= MIN_INDEXED_BLOCKS:
+        ref_index_position = writer.write_index(blocks)
+    writer.write_footer(ref_index_position)
+
+
+class ReftableReader(object):
+    """Reader for a single reftable file."""
+
+    def __init__(self, path):
+        self.path = path
+        with GitFile(path, 'rb') as f:
+            self._contents = _map_file(f)
+        self.size = len(self._contents)
+        self._parse_footer()
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.path)
+
+    def close(self):
+        _unmap(self._contents)
+        self._contents = ''
+
+    def _parse_footer(self):
+        contents = self._contents
+        if contents[:4] != REFTABLE_MAGIC:
+            raise ReftableFormatError('%s is not a reftable' % self.path)
+        version = ord(contents[4])
+        if version == 1:
+            self._header_size = 24
+        elif version == 2:
+            self._header_size = 28
+            hash_id = struct.unpack('>L', contents[24:28])[0]
+            if hash_id != SHA1_HASH_ID:
+                raise ReftableFormatError('unsupported hash id %x' % hash_id)
+        else:
+            raise ReftableFormatError('unsupported reftable version %d' %
+                                      version)
+        footer_size = self._header_size + 44
+        footer_start = self.size - footer_size
+        if footer_start < self._header_size:
+            raise ReftableFormatError('truncated reftable %s' % self.path)
+        footer = contents[footer_start:]
+        if footer[:self._header_size] != contents[:self._header_size]:
+            raise ReftableFormatError('reftable header and footer differ')
+        crc = struct.unpack('>L', footer[-4:])[0]
+        if zlib.crc32(footer[:-4]) & 0xffffffff != crc:
+            raise ReftableFormatError('reftable footer checksum mismatch')
+        self.block_size = _unpack_uint24(contents, 5)
+        self.min_update_index, self.max_update_index = struct.unpack(
+            '>QQ', contents[8:24])
+        (self._ref_index_position, obj_position, obj_index_position,
+         log_position, log_index_position) = struct.unpack(
+            '>QQQQQ', footer[self._header_size:self._header_size + 40])
+        self._ref_end = footer_start
+        for position in (self._ref_index_position, obj_position >> 5,
+                         log_position):
+            if position:
+                self._ref_end = position
+                break
+
+    def _block_start(self, offset):
+        """Return the offset of the first record of the block at offset."""
+        if offset == 0:
+            return self._header_size + 4
+        return offset + 4
+
+    def _read_block(self, offset):
+        """Read a block header.
+
+        :return: Tuple with block type, offset of the first record, offset
+            of the end of the records, restart offsets and the offset of
+            the next block
+        """
+        contents = self._contents
+        pos = self._block_start(offset) - 4
+        block_type = contents[pos]
+        block_len = _unpack_uint24(contents, pos + 1)
+        block_end = offset + block_len
+        restart_count = struct.unpack('>H', contents[block_end-2:block_end])[0]
+        restarts_start = block_end - 2 - 3 * restart_count
+        restarts = [offset + _unpack_uint24(contents, restarts_start + 3 * i)
+                    for i in range(restart_count)]
+        next_block = block_end
+        if next_block < self._ref_end and contents[next_block] == '\0':
+            # Skip padding of aligned blocks
+            next_block = offset + self.block_size
+        return (block_type, self._block_start(offset), restarts_start,
+                restarts, next_block)
+
+    def _decode_key(self, pos, last_key):
+        contents = self._contents
+        prefix_len, pos = decode_varint(contents, pos)
+        x, pos = decode_varint(contents, pos)
+        suffix_len = x >> 3
+        key = last_key[:prefix_len] + contents[pos:pos+suffix_len]
+        return key, x & 0x7, pos + suffix_len
+
+    def _decode_ref(self, pos, last_key):
+        """Decode a ref record.
+
+        :return: Tuple with the record and the offset of the next record
+        """
+        contents = self._contents
+        name, value_type, pos = self._decode_key(pos, last_key)
+        delta, pos = decode_varint(contents, pos)
+        peeled = None
+        if value_type == VALUE_DELETION:
+            value = None
+        elif value_type == VALUE_SHA:
+            value = sha_to_hex(contents[pos:pos+20])
+            pos += 20
+        elif value_type == VALUE_SHA_PEELED:
+            value = sha_to_hex(contents[pos:pos+20])
+            peeled = sha_to_hex(contents[pos+20:pos+40])
+            pos += 40
+        elif value_type == VALUE_SYMREF:
+            target_len, pos = decode_varint(contents, pos)
+            value = SYMREF + contents[pos:pos+target_len]
+            pos += target_len
+        else:
+            raise ReftableFormatError('invalid ref value type %d' %
+                                      value_type)
+        return (RefRecord(name, self.min_update_index + delta, value, peeled),
+                pos)
+
+    def _seek_in_block(self, restarts, key):
+        """Find the restart point to start scanning from for key."""
+        lo = 0
+        hi = len(restarts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._decode_key(restarts[mid], '')[0] <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return restarts[0] if restarts else None
+        return restarts[lo - 1]
+
+    def _find_ref_block(self, key):
+        """Find the offset of the ref block that may contain key."""
+        if self._ref_index_position:
+            offset = self._ref_index_position
+            while True:
+                (block_type, pos, end, restarts,
+                 next_block) = self._read_block(offset)
+                if block_type == BLOCK_TYPE_REF:
+                    return offset
+                if block_type != BLOCK_TYPE_INDEX:
+                    raise ReftableFormatError(
+                        'unexpected block type %r in index' % block_type)
+                pos = self._seek_in_block(restarts, key)
+                last_key = ''
+                offset = None
+                while pos < end:
+                    last_key, _, pos = self._decode_key(pos, last_key)
+                    block_offset, pos = decode_varint(self._contents, pos)
+                    if last_key >= key:
+                        offset = block_offset
+                        break
+                if offset is None:
+                    return None
+        # Without an index, walk the (few) ref blocks in order
+        offset = 0
+        found = None
+        while offset < self._ref_end:
+            (block_type, pos, end, restarts,
+             next_block) = self._read_block(offset)
+            if block_type != BLOCK_TYPE_REF:
+                break
+            if found is not None and self._decode_key(pos, '')[0] > key:
+                break
+            found = offset
+            offset = next_block
+        return found
+
+    def iter_records(self, prefix=''):
+        """Iterate over ref records in sorted order.
+
+        :param prefix: Only return records whose name starts with prefix
+        :return: Iterator over `RefRecord` objects
+        """
+        if self._ref_end <= self._header_size:
+            return
+        if prefix:
+            offset = self._find_ref_block(prefix)
+            if offset is None:
+                return
+        else:
+            offset = 0
+        while offset < self._ref_end:
+            (block_type, pos, end, restarts,
+             next_block) = self._read_block(offset)
+            if block_type != BLOCK_TYPE_REF:
+                break
+            if prefix:
+                pos = self._seek_in_block(restarts, prefix)
+            last_key = ''
+            while pos < end:
+                record, pos = self._decode_ref(pos, last_key)
+                last_key = record.name
+                if record.name < prefix:
+                    continue
+                if not record.name.startswith(prefix):
+                    return
+                yield record
+            offset = next_block
+
+    def get(self, name):
+        """Look up a single ref record.
+
+        :param name: Name of the ref
+        :return: A `RefRecord`, or None if this table has no record for name
+        """
+        if self._ref_end <= self._header_size:
+            return None
+        offset = self._find_ref_block(name)
+        if offset is None:
+            return None
+        (block_type, pos, end, restarts, next_block) = self._read_block(offset)
+        pos = self._seek_in_block(restarts, name)
+        last_key = ''
+        while pos < end:
+            record, pos = self._decode_ref(pos, last_key)
+            last_key = record.name
+            if record.name == name:
+                return record
+            if record.name > name:
+                break
+        return None
+
+
+def _new_table_name(min_update_index, max_update_index):
+    return '0x%012x-0x%012x-%s.ref' % (
+        min_update_index, max_update_index, os.urandom(4).encode('hex'))
+
+
+class ReftableStack(object):
+    """A stack of reftables, merged to give the current state of all refs.
+
+    The stack is reloaded whenever tables.list changes on disk.
+    """
+
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE):
+        self.path = path
+        self.block_size = block_size
+        self._readers = []
+        self._names = None
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.path)
+
+    def _tables_list_path(self):
+        return os.path.join(self.path, TABLES_LIST)
+
+    def _read_tables_list(self):
+        try:
+            f = GitFile(self._tables_list_path(), 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+        with f:
+            return [l.rstrip('\r\n') for l in f if l.strip()]
+
+    def _open_tables(self, names):
+        existing = dict((os.path.basename(r.path), r) for r in self._readers)
+        readers = []
+        try:
+            for name in names:
+                reader = existing.get(name)
+                if reader is None:
+                    reader = ReftableReader(os.path.join(self.path, name))
+                readers.append(reader)
+        except IOError:
+            for reader in readers:
+                if reader not in self._readers:
+                    reader.close()
+            raise
+        for reader in self._readers:
+            if reader not in readers:
+                reader.close()
+        self._readers = readers
+
+    def _reload(self):
+        # tables.list is small, so compare its contents rather than relying
+        # on timestamps that may not change between quick updates.
+        while True:
+            names = self._read_tables_list()
+            if names == self._names:
+                return
+            try:
+                self._open_tables(names)
+            except IOError as e:
+                # A concurrent compaction removed a table after we read
+                # tables.list; retry with the new list.
+                if e.errno != errno.ENOENT or self._read_tables_list() == names:
+                    raise
+            else:
+                self._names = names
+                return
+
+    def close(self):
+        for reader in self._readers:
+            reader.close()
+        self._readers = []
+        self._names = None
+
+    def table_names(self):
+        """Return the names of the tables currently in the stack, oldest first.
+
+        This reads tables.list but does not open any tables.
+        """
+        return self._read_tables_list()
+
+    def tables(self):
+        """Return the readers for the tables in the stack, oldest first."""
+        self._reload()
+        return list(self._readers)
+
+    def get(self, name):
+        """Look up the current record for a ref.
+
+        :param name: Name of the ref
+        :return: A `RefRecord` (with value None if the ref was deleted), or
+            None if no table has a record for name
+        """
+        self._reload()
+        for reader in reversed(self._readers):
+            record = reader.get(name)
+            if record is not None:
+                return record
+        return None
+
+    def _merged_records(self, readers, prefix=''):
+        def keyed(reader, priority):
+            for record in reader.iter_records(prefix):
+                yield record.name, priority, record
+        # Newer tables sort first among records with the same name
+        iters = [keyed(reader, -i) for i, reader in enumerate(readers)]
+        last = None
+        for name, _, record in heapq.merge(*iters):
+            if name == last:
+                # Shadowed by a record in a newer table
+                continue
+            last = name
+            yield record
+
+    def iter_records(self, prefix=''):
+        """Iterate over the current records, in sorted order.
+
+        :param prefix: Only return records whose name starts with prefix
+        :return: Iterator over `RefRecord` objects, excluding deleted refs
+        """
+        self._reload()
+        for record in self._merged_records(list(self._readers), prefix):
+            if record.value is not None:
+                yield record
+
+    def _write_table(self, records, min_update_index, max_update_index):
+        name = _new_table_name(min_update_index, max_update_index)
+        with GitFile(os.path.join(self.path, name), 'wb') as f:
+            write_reftable(f, records, min_update_index, max_update_index,
+                           block_size=self.block_size)
+        return name
+
+    def _write_tables_list(self, f, names):
+        f.write(''.join('%s\n' % name for name in names))
+
+    def update(self, get_updates):
+        """Atomically add a table with a set of ref updates.
+
+        :param get_updates: Callable that is invoked once tables.list is
+            locked and the stack has been reloaded. It should return a
+            dictionary mapping ref names to new values (None to delete a
+            ref, or a tuple of SHA1 and peeled SHA1), or None to abort.
+        :return: True if the updates were applied, False if aborted
+        """
+        ensure_dir_exists(self.path)
+        f = GitFile(self._tables_list_path(), 'wb')
+        try:
+            self._reload()
+            updates = get_updates()
+            if updates is None:
+                return False
+            if updates:
+                update_index = 1
+                if self._readers:
+                    update_index = self._readers[-1].max_update_index + 1
+                records = []
+                for name in sorted(updates):
+                    value = updates[name]
+                    peeled = None
+                    if isinstance(value, tuple):
+                        value, peeled = value
+                    records.append(
+                        RefRecord(name, update_index, value, peeled))
+                new_name = self._write_table(records, update_index,
+                                             update_index)
+                names = [os.path.basename(r.path) for r in self._readers]
+                self._write_tables_list(f, names + [new_name])
+                f.close()
+        finally:
+            f.abort()
+        if updates:
+            self.auto_compact()
+        return True
+
+    def _compaction_segment(self):
+        """Find the newest tables that should be merged.
+
+        Tables are merged until every table is at least COMPACTION_FACTOR
+        times the size of all newer tables combined, so each record is
+        rewritten a logarithmic number of times.
+
+        :return: Index of the oldest table to merge
+        """
+        sizes = [r.size for r in self._readers]
+        start = len(sizes) - 1
+        total = sizes[-1] if sizes else 0
+        while start > 0 and sizes[start - 1] < COMPACTION_FACTOR * total:
+            start -= 1
+            total += sizes[start]
+        return start
+
+    def auto_compact(self):
+        """Merge tables at the top of the stack if they grew too similar.
+
+        This is best-effort: if another process holds the lock, compaction
+        is skipped.
+        """
+        self._reload()
+        if len(self._readers) - self._compaction_segment() > 1:
+            self.compact(start=None)
+
+    def compact(self, start=0):
+        """Merge tables into one.
+
+        :param start: Index of the oldest table to merge; None to pick the
+            segment automatically. Deleted refs are dropped when the whole
+            stack is merged.
+        :return: True if tables were merged
+        """
+        try:
+            f = GitFile(self._tables_list_path(), 'wb')
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        try:
+            self._reload()
+            if start is None:
+                start = self._compaction_segment()
+            old = self._readers[start:]
+            if len(old) < 2:
+                return False
+            records = self._merged_records(old)
+            if start == 0:
+                records = (r for r in records if r.value is not None)
+            new_name = self._write_table(
+                records, old[0].min_update_index, old[-1].max_update_index)
+            names = [os.path.basename(r.path) for r in self._readers[:start]]
+            self._write_tables_list(f, names + [new_name])
+            f.close()
+        finally:
+            f.abort()
+        self._reload()
+        for reader in old:
+            try:
+                os.remove(reader.path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return True
+
+
+class ReftableRefsContainer(RefsContainer):
+    """Refs container that stores refs in a stack of reftables."""
+
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE):
+        self.path = path
+        self._stack = ReftableStack(os.path.join(path, REFTABLE_DIR),
+                                    block_size=block_size)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.path)
+
+    def allkeys(self):
+        return set(r.name for r in self._stack.iter_records())
+
+    def subkeys(self, base):
+        prefix = base.rstrip("/") + "/"
+        return set(r.name[len(prefix):]
+                   for r in self._stack.iter_records(prefix))
+
+    def get_packed_refs(self):
+        return {}
+
+    def get_state_token(self):
+        # Tables are immutable and uniquely named, so the list of tables
+        # identifies the state of the stack.
+        return tuple(self._stack.table_names())
+
+    def read_loose_ref(self, name):
+        record = self._stack.get(name)
+        if record is None:
+            return None
+        return record.value
+
+    def get_peeled(self, name):
+        record = self._stack.get(name)
+        if record is None:
+            return None
+        return record.peeled
+
+    def set_symbolic_ref(self, name, other):
+        """Make a ref point at another ref.
+
+        :param name: Name of the ref to set
+        :param other: Name of the ref to point at
+        """
+        self._check_refname(name)
+        self._check_refname(other)
+        self._stack.update(lambda: {name: SYMREF + other})
+
+    def set_if_equals(self, name, old_ref, new_ref):
+        """Set a refname to new_ref only if it currently equals old_ref.
+
+        This method follows all symbolic references, and can be used to perform
+        an atomic compare-and-swap operation.
+
+        :param name: The refname to set.
+        :param old_ref: The old sha the refname must refer to, or None to set
+            unconditionally.
+        :param new_ref: The new sha the refname will refer to.
+        :return: True if the set was successful, False otherwise.
+        """
+        self._check_refname(name)
+        def get_updates():
+            try:
+                realname, orig_ref = self._follow(name)
+            except KeyError:
+                realname, orig_ref = name, None
+            if old_ref is not None and orig_ref != old_ref:
+                return None
+            return {realname: new_ref}
+        return self._stack.update(get_updates)
+
+    def add_if_new(self, name, ref):
+        """Add a new reference only if it does not already exist.
+
+        This method follows symrefs, and only ensures that the last ref in the
+        chain does not exist.
+
+        :param name: The refname to set.
+        :param ref: The new sha the refname will refer to.
+        :return: True if the add was successful, False otherwise.
+        """
+        def get_updates():
+            try:
+                realname, contents = self._follow(name)
+            except KeyError:
+                realname, contents = name, None
+            if contents is not None:
+                return None
+            self._check_refname(realname)
+            return {realname: ref}
+        return self._stack.update(get_updates)
+
+    def remove_if_equals(self, name, old_ref):
+        """Remove a refname only if it currently equals old_ref.
+
+        This method does not follow symbolic references. It can be used to
+        perform an atomic compare-and-delete operation.
+
+        :param name: The refname to delete.
+        :param old_ref: The old sha the refname must refer to, or None to delete
+            unconditionally.
+        :return: True if the delete was successful, False otherwise.
+        """
+        self._check_refname(name)
+        def get_updates():
+            orig_ref = self.read_loose_ref(name)
+            if old_ref is not None and orig_ref != old_ref:
+                return None
+            if orig_ref is None:
+                return {}
+            return {name: None}
+        return self._stack.update(get_updates)
+
+    def update_refs(self, updates, atomic=False):
+        """Apply a batch of ref updates.
+
+        All updates that pass their old value check are written to a single
+        new table, so they become visible at once.
+
+        See RefsContainer.update_refs for the parameters and return value.
+        """
+        updates = list(updates)
+        failed = {}
+        def get_updates():
+            failed.clear()
+            new_values = {}
+            for name, old_ref, new_ref in updates:
+                try:
+                    self._check_refname(name)
+                except RefFormatError:
+                    failed[name] = UPDATE_BAD_REF
+                    continue
+                realname, orig_ref = self._read_update_target(name, new_ref)
+                if realname in new_values:
+                    failed[name] = UPDATE_LOCK_FAILED
+                elif not _old_ref_matches(orig_ref, old_ref):
+                    failed[name] = UPDATE_OLD_VALUE_MISMATCH
+                elif new_ref == ZERO_SHA:
+                    new_values[realname] = None
+                else:
+                    new_values[realname] = new_ref
+            if atomic and failed:
+                return None
+            return new_values
+        if not self._stack.update(get_updates):
+            return _fail_atomic(updates, failed)
+        return failed
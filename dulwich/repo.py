@@ -49,6 +49,8 @@ from dulwich.object_store import (
     DiskObjectStore,
     MemoryObjectStore,
     ObjectStoreGraphWalker,
+    find_shallow,
+    find_shallow_since,
     )
 from dulwich.objects import (
     check_hexsha,
@@ -59,6 +61,9 @@ from dulwich.objects import (
     Tree,
     )
 
+from dulwich.partial_clone import (
+    PromisorRemote,
+    )
 from dulwich.hooks import (
     PreCommitShellHook,
     PostCommitShellHook,
@@ -76,6 +81,10 @@ from dulwich.refs import (
     write_packed_refs,
     SYMREF,
     )
+from dulwich.reftable import (
+    REFTABLE_DIR,
+    ReftableRefsContainer,
+    )
 
 
 import warnings
@@ -206,6 +215,13 @@ class BaseRepo(object):
         """
         raise NotImplementedError(self._put_named_file)
 
+    def _del_named_file(self, path):
+        """Delete a file in the control directory with the given name.
+
+        :param path: The path to the file, relative to the control dir.
+        """
+        raise NotImplementedError(self._del_named_file)
+
     def open_index(self):
         """Open the index for this repository.
 
@@ -214,24 +230,52 @@ class BaseRepo(object):
         """
         raise NotImplementedError(self.open_index)
 
-    def fetch(self, target, determine_wants=None, progress=None):
+    def fetch(self, target, determine_wants=None, progress=None, depth=None,
+              deepen_since=None, deepen_not=None):
         """Fetch objects into another repository.
 
         :param target: The target repository
         :param determine_wants: Optional function to determine what refs to
             fetch.
         :param progress: Optional progress function
+        :param depth: Optional depth to limit the fetched history to; the
+            shallow commits are recorded in the target repository
+        :param deepen_since: Optional timestamp; history older than this is
+            not fetched
+        :param deepen_not: Optional list of refs whose history is not fetched
         :return: The local refs
         """
         if determine_wants is None:
-            determine_wants = target.object_store.determine_wants_all
-        target.object_store.add_objects(
-          self.fetch_objects(determine_wants, target.get_graph_walker(),
-                             progress))
+            determine_wants = lambda refs: (
+                target.object_store.determine_wants_all(refs, depth))
+        graph_walker = target.get_graph_walker()
+        shallow = set(graph_walker.shallow)
+        objects = self.fetch_objects(determine_wants, graph_walker, progress,
+                                     depth=depth, deepen_since=deepen_since,
+                                     deepen_not=deepen_not)
+        if objects is not None:
+            target.object_store.add_objects(objects)
+        if graph_walker.shallow != shallow or graph_walker.unshallow:
+            target.update_shallow(graph_walker.shallow - shallow,
+                                  graph_walker.unshallow)
         return self.get_refs()
 
+    def _resolve_deepen_not(self, name):
+        """Resolve a ref name excluded from a shallow fetch.
+
+        :param name: Full or abbreviated ref name
+        :return: SHA1 of the commit the ref refers to
+        :raise KeyError: if the ref does not exist
+        """
+        for refname in (name, 'refs/' + name, 'refs/tags/' + name,
+                        'refs/heads/' + name, 'refs/remotes/' + name):
+            if refname in self.refs:
+                return self.get_peeled(refname)
+        raise KeyError(name)
+
     def fetch_objects(self, determine_wants, graph_walker, progress,
-                      get_tagged=None):
+                      get_tagged=None, refs=None, object_filter=None,
+                      depth=None, deepen_since=None, deepen_not=None):
         """Fetch the missing objects required for a set of revisions.
 
         :param determine_wants: Function that takes a dictionary with heads
@@ -243,12 +287,49 @@ class BaseRepo(object):
             updated progress strings.
         :param get_tagged: Function that returns a dict of pointed-to sha -> tag
             sha for including tags.
+        :param refs: Optional dict of refname -> sha to pass to
+            determine_wants; defaults to get_refs()
+        :param object_filter: Optional ObjectFilter for a partial clone;
+            defaults to the object_filter of the graph walker, if any
+        :param depth: Optional depth to limit the history to; the new shallow
+            boundary is reported to the update_shallow() method of the graph
+            walker
+        :param deepen_since: Optional timestamp to limit the history to, like
+            depth
+        :param deepen_not: Optional list of refs to exclude the history of,
+            like depth
         :return: iterator over objects, with __len__ implemented
+        :raise ValueError: if depth is combined with deepen_since or
+            deepen_not, or if they leave out all commits
+        :raise KeyError: if a ref in deepen_not does not exist
         """
-        wants = determine_wants(self.get_refs())
+        if depth is not None and (deepen_since is not None or deepen_not):
+            raise ValueError(
+                "depth can not be combined with deepen_since or deepen_not")
+        if refs is None:
+            refs = self.get_refs()
+        wants = determine_wants(refs)
         if not isinstance(wants, list):
             raise TypeError("determine_wants() did not return a list")
 
+        if wants and (depth is not None or deepen_since is not None or
+                      deepen_not):
+            if depth is not None:
+                shallow, not_shallow = find_shallow(self.object_store, wants,
+                                                    depth)
+            else:
+                exclude = [self._resolve_deepen_not(name)
+                           for name in deepen_not or []]
+                shallow, not_shallow = find_shallow_since(
+                    self.object_store, wants, deepen_since, exclude)
+                if not shallow and not not_shallow:
+                    raise ValueError(
+                        "no commits selected for shallow requests")
+            client_shallow = graph_walker.shallow
+            graph_walker.update_shallow(
+                shallow - not_shallow - client_shallow,
+                not_shallow & client_shallow)
+
         shallows = getattr(graph_walker, 'shallow', frozenset())
         unshallows = getattr(graph_walker, 'unshallow', frozenset())
 
@@ -270,6 +351,9 @@ class BaseRepo(object):
             haves = []  # TODO: filter the haves commits from iter_shas.
                         # the specific commits aren't missing.
 
+        if object_filter is None:
+            object_filter = getattr(graph_walker, 'object_filter', None)
+
         def get_parents(commit):
             if commit.id in shallows:
                 return []
@@ -279,7 +363,8 @@ class BaseRepo(object):
           self.object_store.find_missing_objects(
               haves, wants, progress,
               get_tagged,
-              get_parents=get_parents))
+              get_parents=get_parents,
+              object_filter=object_filter))
 
     def get_graph_walker(self, heads=None):
         """Retrieve a graph walker.
@@ -292,7 +377,41 @@ class BaseRepo(object):
         """
         if heads is None:
             heads = self.refs.as_dict('refs/heads').values()
-        return ObjectStoreGraphWalker(heads, self.get_parents)
+        return ObjectStoreGraphWalker(heads, self.get_parents,
+                                      shallow=self.get_shallow())
+
+    def get_shallow(self):
+        """Get the set of shallow commits.
+
+        The parents of shallow commits are not present in this repository.
+
+        :return: Set of shallow commit SHA1s
+        """
+        f = self.get_named_file('shallow')
+        if f is None:
+            return set()
+        with f:
+            return set(line.strip() for line in f if line.strip())
+
+    def update_shallow(self, new_shallow, new_unshallow):
+        """Update the set of shallow commits.
+
+        :param new_shallow: Commits that have become shallow
+        :param new_unshallow: Commits that are no longer shallow
+        """
+        shallow = self.get_shallow()
+        if new_shallow:
+            shallow.update(new_shallow)
+            self._add_graftpoints(dict((sha, []) for sha in new_shallow))
+        if new_unshallow:
+            shallow.difference_update(new_unshallow)
+            self._remove_graftpoints(
+                [sha for sha in new_unshallow if sha in self._graftpoints])
+        if shallow:
+            self._put_named_file(
+                'shallow', ''.join('%s\n' % sha for sha in sorted(shallow)))
+        else:
+            self._del_named_file('shallow')
 
     def get_refs(self):
         """Get dictionary with all refs.
@@ -404,8 +523,10 @@ class BaseRepo(object):
             ancestors. Defaults to [HEAD]
         :param exclude: Iterable of SHAs of commits to exclude along with their
             ancestors, overriding includes.
-        :param order: ORDER_* constant specifying the order of results. Anything
-            other than ORDER_DATE may result in O(n) memory usage.
+        :param order: ORDER_* constant specifying the order of results.
+            ORDER_TOPO keeps the commits that have been read but not yet
+            returned in memory; with a queue_cls other than the default, it
+            may result in O(n) memory usage.
         :param reverse: If True, reverse the order of output, requiring O(n)
             memory.
         :param max_entries: The maximum number of entries to yield, or None for
@@ -658,7 +779,10 @@ class Repo(BaseRepo):
         self.path = root
         object_store = DiskObjectStore(os.path.join(self.controldir(),
                                                     OBJECTDIR))
-        refs = DiskRefsContainer(self.controldir())
+        if os.path.isdir(os.path.join(self.controldir(), REFTABLE_DIR)):
+            refs = ReftableRefsContainer(self.controldir())
+        else:
+            refs = DiskRefsContainer(self.controldir())
         BaseRepo.__init__(self, object_store, refs)
 
         self._graftpoints = {}
@@ -671,6 +795,8 @@ class Repo(BaseRepo):
             with graft_file:
                 self._graftpoints.update(parse_graftpoints(graft_file))
 
+        self.object_store.promisor = PromisorRemote.from_repo(self)
+
         self.hooks['pre-commit'] = PreCommitShellHook(self.controldir())
         self.hooks['commit-msg'] = CommitMsgShellHook(self.controldir())
         self.hooks['post-commit'] = PostCommitShellHook(self.controldir())
@@ -689,6 +815,17 @@ class Repo(BaseRepo):
         with GitFile(os.path.join(self.controldir(), path), 'wb') as f:
             f.write(contents)
 
+    def _del_named_file(self, path):
+        """Delete a file in the control directory with the given name.
+
+        :param path: The path to the file, relative to the control dir.
+        """
+        try:
+            os.unlink(os.path.join(self.controldir(), path))
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+
     def get_named_file(self, path):
         """Get a file from the control dir with a specific name.
 
@@ -758,8 +895,41 @@ class Repo(BaseRepo):
                 index[path] = index_entry_from_stat(st, blob.id, 0)
         index.write()
 
+    def copy_objects(self, target, shared=False):
+        """Make the objects in this repository available to another
+        repository on the same machine.
+
+        Unlike `fetch`, this does not go through the pack protocol: all
+        pack files and loose objects are hardlinked (or copied) as they are,
+        or with shared=True, this repository is added as an alternate of
+        the target, so that no objects are copied at all. The target then
+        depends on this repository not removing any objects.
+
+        :param target: The target `Repo`
+        :param shared: Whether to add this repository as an alternate
+            rather than copying its objects
+        :return: The local refs
+        :raise ValueError: if this repository is a partial clone, whose
+            missing objects the target could not fetch
+        """
+        self._check_copy_objects()
+        if shared:
+            target.object_store.add_alternate_path(
+                os.path.abspath(self.object_store.path))
+        else:
+            target.object_store.copy_from(self.object_store)
+        shallow = self.get_shallow()
+        if shallow:
+            target.update_shallow(shallow, None)
+        return self.get_refs()
+
+    def _check_copy_objects(self):
+        if self.object_store.promisor is not None:
+            raise ValueError(
+                "local and shared clones of a partial clone are not supported")
+
     def clone(self, target_path, mkdir=True, bare=False,
-            origin="origin"):
+            origin="origin", depth=None, local=False, shared=False):
         """Clone this repository.
 
         :param target_path: Target path
@@ -767,13 +937,25 @@ class Repo(BaseRepo):
         :param bare: Whether to create a bare repository
         :param origin: Base name for refs in target repository
             cloned from this repository
+        :param depth: Optional depth for a shallow clone
+        :param local: Whether to hardlink the objects of this repository
+            rather than fetching them (see `copy_objects`)
+        :param shared: Whether to add this repository as an alternate of
+            the new repository rather than fetching its objects
         :return: Created repository as `Repo`
         """
+        if depth is not None and (local or shared):
+            raise ValueError("depth can not be combined with local or shared")
+        if local or shared:
+            self._check_copy_objects()
         if not bare:
             target = self.init(target_path, mkdir=mkdir)
         else:
             target = self.init_bare(target_path)
-        self.fetch(target)
+        if local or shared:
+            self.copy_objects(target, shared=shared)
+        else:
+            self.fetch(target, depth=depth)
         target.refs.import_refs(
             'refs/remotes/' + origin, self.refs.as_dict('refs/heads'))
         target.refs.import_refs(
@@ -808,18 +990,21 @@ class Repo(BaseRepo):
     def get_config(self):
         """Retrieve the config object.
 
+        The file is only parsed again when it has changed on disk; the
+        returned object is a private copy that can be modified and written
+        back.
+
         :return: `ConfigFile` object for the ``.git/config`` file.
         """
-        from dulwich.config import ConfigFile
+        from dulwich.config import ConfigFile, get_config_file
         path = os.path.join(self._controldir, 'config')
-        try:
-            return ConfigFile.from_path(path)
-        except (IOError, OSError) as e:
-            if e.errno != errno.ENOENT:
-                raise
+        cf = get_config_file(path)
+        if cf is None:
             ret = ConfigFile()
-            ret.path = path
-            return ret
+        else:
+            ret = cf.copy()
+        ret.path = path
+        return ret
 
     def get_description(self):
         """Retrieve the description of this repository.
@@ -909,6 +1094,13 @@ class MemoryRepo(BaseRepo):
         """
         self._named_files[path] = contents
 
+    def _del_named_file(self, path):
+        """Delete a file in the control directory with the given name.
+
+        :param path: The path to the file, relative to the control dir.
+        """
+        self._named_files.pop(path, None)
+
     def get_named_file(self, path):
         """Get a file from the control dir with a specific name.
 
@@ -36,9 +36,11 @@ Currently supported capabilities:
  * no-progress
  * report-status
  * delete-refs
-
-Known capabilities that are not supported:
- * shallow (http://pad.lv/909524)
+ * atomic
+ * filter
+ * shallow
+ * deepen-since
+ * deepen-not
 """
 
 import collections
@@ -46,6 +48,7 @@ import os
 import socket
 import SocketServer
 import sys
+import threading
 import zlib
 
 from dulwich.errors import (
@@ -57,13 +60,27 @@ from dulwich.errors import (
     ObjectFormatException,
     )
 from dulwich import log_utils
+from dulwich.lru_cache import LRUCache
+from dulwich.metrics import (
+    Metrics,
+    collect_metrics,
+    get_metrics,
+    )
 from dulwich.objects import (
     hex_to_sha,
-    Commit,
+    )
+from dulwich.object_store import (
+    ThinPackBaseFinder,
+    find_shallow,
+    find_shallow_since,
     )
 from dulwich.pack import (
     write_pack_objects,
     )
+from dulwich.partial_clone import (
+    parse_filter_spec,
+    )
+from dulwich.progress import TextProgressReporter
 from dulwich.protocol import (
     BufferedPktLineWriter,
     MULTI_ACK,
@@ -77,9 +94,7 @@ from dulwich.protocol import (
     ack_type,
     extract_capabilities,
     extract_want_line_capabilities,
-    )
-from dulwich.refs import (
-    write_info_refs,
+    pkt_line,
     )
 from dulwich.repo import (
     Repo,
@@ -132,13 +147,15 @@ class BackendRepo(object):
         return None
 
     def fetch_objects(self, determine_wants, graph_walker, progress,
-                      get_tagged=None):
+                      get_tagged=None, refs=None):
         """
         Yield the objects required for a list of commits.
 
         :param progress: is a callback to send progress messages to the client
         :param get_tagged: Function that returns a dict of pointed-to sha -> tag
             sha for including tags.
+        :param refs: Optional dict of refname -> sha to pass to
+            determine_wants; defaults to get_refs()
         """
         raise NotImplementedError
 
@@ -174,14 +191,193 @@ class FileSystemBackend(Backend):
         return Repo(abspath)
 
 
+class RefAdvertisement(object):
+    """The refs of a repository, as advertised to clients.
+
+    The peeled values of all refs are computed once, and the serialized
+    forms of the advertisement are generated on first use and kept, so an
+    advertisement can be reused for as long as the refs do not change.
+
+    :ivar refs: dict of refname -> sha
+    :ivar peeled: dict of refname -> peeled sha, for refs that point at tags
+    """
+
+    def __init__(self, refs, peeled, missing=()):
+        self.refs = refs
+        self.peeled = peeled
+        self._missing = frozenset(missing)
+        self._tagged = None
+        self._upload_pack = None
+        self._info_refs = None
+
+    @classmethod
+    def from_repo(cls, repo):
+        """Create an advertisement for the current refs of a repository.
+
+        :param repo: A BackendRepo
+        """
+        refs = repo.get_refs()
+        peeled = {}
+        missing = []
+        for name, sha in refs.iteritems():
+            try:
+                peeled_sha = repo.get_peeled(name)
+            except (KeyError, ValueError):
+                # Missing object or invalid sha
+                missing.append(name)
+                continue
+            if peeled_sha is not None and peeled_sha != sha:
+                peeled[name] = peeled_sha
+        return cls(refs, peeled, missing)
+
+    def get_peeled(self, name):
+        """Return the peeled value of a ref.
+
+        :param name: Name of the ref to peel
+        :return: The peeled sha, or the sha the ref points at if it does not
+            point at a tag
+        :raise KeyError: if the ref is not part of the advertisement
+        """
+        try:
+            return self.peeled[name]
+        except KeyError:
+            return self.refs[name]
+
+    def get_tagged(self):
+        """Get a dict of peeled values of tags to their original tag shas."""
+        if self._tagged is None:
+            self._tagged = dict((peeled_sha, self.refs[name])
+                                for name, peeled_sha in self.peeled.iteritems())
+        return self._tagged
+
+    def _serialize_upload_pack(self):
+        first = None
+        lines = []
+        for name in sorted(self.refs):
+            sha = self.refs[name]
+            if first is None:
+                first = "%s %s" % (sha, name)
+            else:
+                lines.append(pkt_line("%s %s\n" % (sha, name)))
+            if name in self.peeled:
+                lines.append(pkt_line("%s %s^{}\n" % (self.peeled[name], name)))
+        lines.append(pkt_line(None))
+        return first, "".join(lines)
+
+    def write_upload_pack(self, proto, capability_line):
+        """Write the advertisement sent at the start of upload-pack.
+
+        :param proto: Protocol to write to
+        :param capability_line: Capabilities to send along with the first ref
+        """
+        if self._upload_pack is None:
+            self._upload_pack = self._serialize_upload_pack()
+        first, rest = self._upload_pack
+        if first is not None:
+            proto.write_pkt_line("%s\x00%s\n" % (first, capability_line))
+        proto.write_pkt_lines(rest)
+
+    def info_refs(self):
+        """Return the lines of an info/refs file for these refs."""
+        if self._info_refs is None:
+            lines = []
+            for name in sorted(self.refs):
+                # get_refs() includes HEAD as a special case, but we don't
+                # want to advertise it
+                if name == 'HEAD' or name in self._missing:
+                    continue
+                lines.append('%s\t%s\n' % (self.refs[name], name))
+                if name in self.peeled:
+                    lines.append('%s\t%s^{}\n' % (self.peeled[name], name))
+            self._info_refs = lines
+        return self._info_refs
+
+
+class RefAdvertisementCache(object):
+    """Cache of ref advertisements, keyed by repository.
+
+    Entries are validated against the state token of the refs container of
+    a repository (see RefsContainer.get_state_token), so a new advertisement
+    is built as soon as any ref changes. Repositories whose refs changes can
+    not be detected are never cached.
+    """
+
+    def __init__(self, max_repos=100):
+        self._cache = LRUCache(max_repos)
+        self._lock = threading.Lock()
+
+    def _key(self, refs):
+        path = getattr(refs, 'path', None)
+        if path is None:
+            return refs
+        return (refs.__class__, os.path.abspath(path))
+
+    def get(self, repo):
+        """Get the advertisement for the current refs of a repository.
+
+        :param repo: A BackendRepo
+        :return: A RefAdvertisement
+        """
+        refs = getattr(repo, 'refs', None)
+        if refs is None:
+            return RefAdvertisement.from_repo(repo)
+        # Get the token before reading the refs, so that changes made while
+        # building the advertisement invalidate it.
+        token = refs.get_state_token()
+        if token is None:
+            return RefAdvertisement.from_repo(repo)
+        key = self._key(refs)
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is not None and entry[0] == token:
+            get_metrics().incr('server.ref_advertisement_cache_hits')
+            return entry[1]
+        get_metrics().incr('server.ref_advertisement_cache_misses')
+        advertisement = RefAdvertisement.from_repo(repo)
+        with self._lock:
+            self._cache[key] = (token, advertisement)
+        return advertisement
+
+    def clear(self):
+        """Remove all cached advertisements."""
+        with self._lock:
+            self._cache.clear()
+
+
+_ref_advertisement_cache = RefAdvertisementCache()
+
+
+def get_ref_advertisement(repo):
+    """Get the (possibly cached) ref advertisement for a repository.
+
+    :param repo: A BackendRepo
+    :return: A RefAdvertisement
+    """
+    return _ref_advertisement_cache.get(repo)
+
+
 class Handler(object):
-    """Smart protocol command handler base class."""
+    """Smart protocol command handler base class.
+
+    :ivar metrics: `Metrics` collected while handling the request; see
+        dulwich.metrics
+    """
 
     def __init__(self, backend, proto, http_req=None):
         self.backend = backend
         self.proto = proto
         self.http_req = http_req
         self._client_capabilities = None
+        self.metrics = Metrics()
+
+    def handle(self):
+        """Handle the request, collecting metrics in self.metrics."""
+        with collect_metrics(self.metrics):
+            with self.metrics.timer('handler.%s' % self.__class__.__name__):
+                self._handle()
+
+    def _handle(self):
+        raise NotImplementedError(self._handle)
 
     @classmethod
     def capability_line(cls):
@@ -229,12 +425,15 @@ class UploadPackHandler(Handler):
         Handler.__init__(self, backend, proto, http_req=http_req)
         self.repo = backend.open_repository(args[0])
         self._graph_walker = None
+        self._ref_advertisement = None
+        self._allow_any_sha1_in_want = None
         self.advertise_refs = advertise_refs
 
     @classmethod
     def capabilities(cls):
         return ("multi_ack_detailed", "multi_ack", "side-band-64k", "thin-pack",
-                "ofs-delta", "no-progress", "include-tag", "shallow")
+                "ofs-delta", "no-progress", "include-tag", "shallow",
+                "deepen-since", "deepen-not", "filter")
 
     @classmethod
     def required_capabilities(cls):
@@ -245,6 +444,27 @@ class UploadPackHandler(Handler):
             return
         self.proto.write_sideband(2, message)
 
+    @property
+    def allow_any_sha1_in_want(self):
+        """Whether clients may ask for objects that are not advertised.
+
+        This is needed by partial clones to fetch the objects they omitted,
+        and is enabled with the uploadpack.allowAnySHA1InWant setting.
+        """
+        if self._allow_any_sha1_in_want is None:
+            get_config = getattr(self.repo, 'get_config', None)
+            self._allow_any_sha1_in_want = (
+                get_config is not None and get_config().get_boolean(
+                    ('uploadpack', ), 'allowanysha1inwant', False))
+        return self._allow_any_sha1_in_want
+
+    def capability_line(self):
+        capabilities = list(self.capabilities())
+        if self.allow_any_sha1_in_want:
+            capabilities.extend(["allow-tip-sha1-in-want",
+                                 "allow-reachable-sha1-in-want"])
+        return " ".join(capabilities)
+
     def get_tagged(self, refs=None, repo=None):
         """Get a dict of peeled values of tags to their original tag shas.
 
@@ -257,6 +477,8 @@ class UploadPackHandler(Handler):
         """
         if not self.has_capability("include-tag"):
             return {}
+        if refs is None and repo is None:
+            return self.get_ref_advertisement().get_tagged()
         if refs is None:
             refs = self.repo.get_refs()
         if repo is None:
@@ -274,24 +496,46 @@ class UploadPackHandler(Handler):
                 tagged[peeled_sha] = sha
         return tagged
 
-    def handle(self):
+    def get_ref_advertisement(self):
+        """Get the advertisement of the refs served by this handler."""
+        if self._ref_advertisement is None:
+            self._ref_advertisement = get_ref_advertisement(self.repo)
+        return self._ref_advertisement
+
+    def _handle(self):
         write = lambda x: self.proto.write_sideband(1, x)
 
+        with self.metrics.timer('upload_pack.advertise'):
+            advertisement = self.get_ref_advertisement()
         graph_walker = ProtocolGraphWalker(self, self.repo.object_store,
-            self.repo.get_peeled)
-        objects_iter = self.repo.fetch_objects(
-          graph_walker.determine_wants, graph_walker, self.progress,
-          get_tagged=self.get_tagged)
+            advertisement.get_peeled, advertisement=advertisement)
+        with self.metrics.timer('upload_pack.negotiate'):
+            objects_iter = self.repo.fetch_objects(
+              graph_walker.determine_wants, graph_walker, self.progress,
+              get_tagged=self.get_tagged, refs=advertisement.refs)
 
         # Did the process short-circuit (e.g. in a stateless RPC call)? Note
         # that the client still expects a 0-object pack in most cases.
-        if len(objects_iter) == 0:
+        with self.metrics.timer('upload_pack.count_objects'):
+            num_objects = len(objects_iter)
+        self.metrics.incr('upload_pack.objects', num_objects)
+        if num_objects == 0:
             return
 
-        self.progress("dul-daemon says what\n")
-        self.progress("counting objects: %d, done.\n" % len(objects_iter))
-        write_pack_objects(ProtocolFile(None, write), objects_iter)
-        self.progress("how was that, then?\n")
+        if self.has_capability("no-progress"):
+            progress = None
+        else:
+            progress = TextProgressReporter(self.progress)
+        # Clients of partial clones may not have the delta bases
+        if (self.has_capability("thin-pack") and
+                graph_walker.object_filter is None):
+            get_external_base = ThinPackBaseFinder(self.repo.object_store,
+                                                   graph_walker.haves)
+        else:
+            get_external_base = None
+        write_pack_objects(ProtocolFile(None, write), objects_iter,
+                           progress=progress,
+                           get_external_base=get_external_base)
         # we are done
         self.proto.write("0000")
 
@@ -307,6 +551,11 @@ def _split_proto_line(line, allowed):
     :return: a tuple having one of the following forms:
         ('want', obj_id)
         ('have', obj_id)
+        ('shallow', obj_id)
+        ('deepen', depth)
+        ('deepen-since', timestamp)
+        ('deepen-not', refname)
+        ('filter', filter_spec)
         ('done', None)
         (None, None)  (for a flush-pkt)
 
@@ -327,51 +576,15 @@ def _split_proto_line(line, allowed):
             if command in ('want', 'have', 'shallow', 'unshallow'):
                 hex_to_sha(fields[1])
                 return tuple(fields)
-            elif command == 'deepen':
+            elif command in ('deepen', 'deepen-since'):
                 return command, int(fields[1])
+            elif command in ('deepen-not', 'filter'):
+                return tuple(fields)
     except (TypeError, AssertionError) as e:
         raise GitProtocolError(e)
     raise GitProtocolError('Received invalid line from client: %s' % line)
 
 
-def _find_shallow(store, heads, depth):
-    """Find shallow commits according to a given depth.
-
-    :param store: An ObjectStore for looking up objects.
-    :param heads: Iterable of head SHAs to start walking from.
-    :param depth: The depth of ancestors to include.
-    :return: A tuple of (shallow, not_shallow), sets of SHAs that should be
-        considered shallow and unshallow according to the arguments. Note that
-        these sets may overlap if a commit is reachable along multiple paths.
-    """
-    parents = {}
-    def get_parents(sha):
-        result = parents.get(sha, None)
-        if not result:
-            result = store[sha].parents
-            parents[sha] = result
-        return result
-
-    todo = []  # stack of (sha, depth)
-    for head_sha in heads:
-        obj = store.peel_sha(head_sha)
-        if isinstance(obj, Commit):
-            todo.append((obj.id, 0))
-
-    not_shallow = set()
-    shallow = set()
-    while todo:
-        sha, cur_depth = todo.pop()
-        if cur_depth < depth:
-            not_shallow.add(sha)
-            new_depth = cur_depth + 1
-            todo.extend((p, new_depth) for p in get_parents(sha))
-        else:
-            shallow.add(sha)
-
-    return shallow, not_shallow
-
-
 class ProtocolGraphWalker(object):
     """A graph walker that knows the git protocol.
 
@@ -385,17 +598,20 @@ class ProtocolGraphWalker(object):
     call to set_ack_level() is required to set up the implementation, before any
     calls to next() or ack() are made.
     """
-    def __init__(self, handler, object_store, get_peeled):
+    def __init__(self, handler, object_store, get_peeled, advertisement=None):
         self.handler = handler
         self.store = object_store
         self.get_peeled = get_peeled
+        self.advertisement = advertisement
         self.proto = handler.proto
         self.http_req = handler.http_req
         self.advertise_refs = handler.advertise_refs
         self._wants = []
+        self.haves = []
         self.shallow = set()
         self.client_shallow = set()
         self.unshallow = set()
+        self.object_filter = None
         self._cached = False
         self._cache = []
         self._cache_index = 0
@@ -410,28 +626,36 @@ class ProtocolGraphWalker(object):
         the ProtocolGraphWalker.
 
         If the client has the 'shallow' capability, this method also reads and
-        responds to the 'shallow' and 'deepen' lines from the client. These are
+        responds to the 'shallow', 'deepen', 'deepen-since' and 'deepen-not'
+        lines from the client, and
+        with the 'filter' capability it reads the object filter. These are
         not part of the wants per se, but they set up necessary state for
         walking the graph. Additionally, later code depends on this method
         consuming everything up to the first 'have' line.
 
-        :param heads: a dict of refname->SHA1 to advertise
+        :param heads: a dict of refname->SHA1 to advertise; if this walker
+            was created with a RefAdvertisement, these must be its refs
         :return: a list of SHA1s requested by the client
         """
         values = set(heads.itervalues())
         if self.advertise_refs or not self.http_req:
-            for i, (ref, sha) in enumerate(sorted(heads.iteritems())):
-                line = "%s %s" % (sha, ref)
-                if not i:
-                    line = "%s\x00%s" % (line, self.handler.capability_line())
-                self.proto.write_pkt_line("%s\n" % line)
-                peeled_sha = self.get_peeled(ref)
-                if peeled_sha != sha:
-                    self.proto.write_pkt_line('%s %s^{}\n' %
-                                              (peeled_sha, ref))
-
-            # i'm done..
-            self.proto.write_pkt_line(None)
+            if self.advertisement is not None:
+                self.advertisement.write_upload_pack(
+                    self.proto, self.handler.capability_line())
+            else:
+                for i, (ref, sha) in enumerate(sorted(heads.iteritems())):
+                    line = "%s %s" % (sha, ref)
+                    if not i:
+                        line = "%s\x00%s" % (
+                            line, self.handler.capability_line())
+                    self.proto.write_pkt_line("%s\n" % line)
+                    peeled_sha = self.get_peeled(ref)
+                    if peeled_sha != sha:
+                        self.proto.write_pkt_line('%s %s^{}\n' %
+                                                  (peeled_sha, ref))
+
+                # i'm done..
+                self.proto.write_pkt_line(None)
 
             if self.advertise_refs:
                 return []
@@ -443,21 +667,24 @@ class ProtocolGraphWalker(object):
         line, caps = extract_want_line_capabilities(want)
         self.handler.set_client_capabilities(caps)
         self.set_ack_type(ack_type(caps))
-        allowed = ('want', 'shallow', 'deepen', None)
+        allowed = ('want', 'shallow', 'deepen', 'deepen-since', 'deepen-not',
+                   'filter', None)
         command, sha = _split_proto_line(line, allowed)
 
         want_revs = []
         while command == 'want':
-            if sha not in values:
+            if sha not in values and not self._allow_unadvertised_want(sha):
                 raise GitProtocolError(
                   'Client wants invalid object %s' % sha)
             want_revs.append(sha)
             command, sha = self.read_proto_line(allowed)
 
         self.set_wants(want_revs)
-        if command in ('shallow', 'deepen'):
+        if command in ('shallow', 'deepen', 'deepen-since', 'deepen-not'):
             self.unread_proto_line(command, sha)
             self._handle_shallow_request(want_revs)
+        elif command == 'filter':
+            self._handle_filter_request(sha)
 
         if self.http_req and self.proto.eof():
             # The client may close the socket at this point, expecting a
@@ -473,6 +700,7 @@ class ProtocolGraphWalker(object):
     def ack(self, have_ref):
         if len(have_ref) != 40:
             raise ValueError("invalid sha %r" % have_ref)
+        self.haves.append(have_ref)
         return self._impl.ack(have_ref)
 
     def reset(self):
@@ -500,16 +728,86 @@ class ProtocolGraphWalker(object):
         """
         return _split_proto_line(self.proto.read_pkt_line(), allowed)
 
-    def _handle_shallow_request(self, wants):
-        while True:
-            command, val = self.read_proto_line(('deepen', 'shallow'))
-            if command == 'deepen':
-                depth = val
-                break
-            self.client_shallow.add(val)
+    def read_have_line(self):
+        """Read a line from the client during negotiation.
+
+        :return: A tuple of (command, value); see _split_proto_line.
+        :raise UnexpectedCommandError: If an error occurred reading the line.
+        """
+        command, sha = self.read_proto_line(_GRAPH_WALKER_COMMANDS)
+        metrics = get_metrics()
+        if command == 'have':
+            metrics.incr('upload_pack.haves')
+        else:
+            # A flush-pkt or done ends a round of haves.
+            metrics.incr('upload_pack.negotiation_rounds')
+        return command, sha
+
+    def _allow_unadvertised_want(self, sha):
+        return (getattr(self.handler, 'allow_any_sha1_in_want', False) and
+                sha in self.store)
+
+    def _handle_filter_request(self, filter_spec):
+        if not self.handler.has_capability('filter'):
+            raise GitProtocolError(
+                'Client sent filter without the filter capability')
+        try:
+            self.object_filter = parse_filter_spec(filter_spec)
+        except ValueError as e:
+            raise GitProtocolError(str(e))
         self.read_proto_line((None,))  # consume client's flush-pkt
 
-        shallow, not_shallow = _find_shallow(self.store, wants, depth)
+    def _resolve_deepen_not(self, name):
+        """Resolve the ref name in a deepen-not request.
+
+        :param name: Full or abbreviated ref name
+        :return: SHA1 of the commit the ref refers to
+        :raise GitProtocolError: if the ref does not exist
+        """
+        refs = self.handler.repo.refs
+        for refname in (name, 'refs/' + name, 'refs/tags/' + name,
+                        'refs/heads/' + name, 'refs/remotes/' + name):
+            if refname in refs:
+                return self.get_peeled(refname)
+        raise GitProtocolError('deepen-not is not a ref: %s' % name)
+
+    def _handle_shallow_request(self, wants):
+        depth = None
+        since = None
+        exclude = []
+        allowed = ('shallow', 'deepen', 'deepen-since', 'deepen-not',
+                   'filter', None)
+        command, val = self.read_proto_line(allowed)
+        while command not in ('filter', None):
+            if command == 'shallow':
+                self.client_shallow.add(val)
+            elif command == 'deepen':
+                depth = val
+            elif command == 'deepen-since':
+                since = val
+            else:
+                exclude.append(self._resolve_deepen_not(val))
+            command, val = self.read_proto_line(allowed)
+        if command == 'filter':
+            self._handle_filter_request(val)  # also consumes the flush-pkt
+
+        if depth is None and since is None and not exclude:
+            # The client is shallow but does not ask for a different depth;
+            # don't send history it does not have. There is no reply.
+            self.shallow.update(self.client_shallow)
+            return
+        if depth is not None:
+            if since is not None or exclude:
+                raise GitProtocolError(
+                    'deepen and deepen-since (or deepen-not) cannot be used '
+                    'together')
+            shallow, not_shallow = find_shallow(self.store, wants, depth)
+        else:
+            shallow, not_shallow = find_shallow_since(
+                self.store, wants, since, exclude)
+            if not shallow and not not_shallow:
+                raise GitProtocolError(
+                    'no commits selected for shallow requests')
 
         # Update self.shallow instead of reassigning it since we passed a
         # reference to it before this method was called.
@@ -525,11 +823,13 @@ class ProtocolGraphWalker(object):
         self.proto.write_pkt_line(None)
 
     def send_ack(self, sha, ack_type=''):
+        get_metrics().incr('upload_pack.acks')
         if ack_type:
             ack_type = ' %s' % ack_type
         self.proto.write_pkt_line('ACK %s%s\n' % (sha, ack_type))
 
     def send_nak(self):
+        get_metrics().incr('upload_pack.naks')
         self.proto.write_pkt_line('NAK\n')
 
     def set_wants(self, wants):
@@ -602,7 +902,7 @@ class SingleAckGraphWalkerImpl(object):
             self._sent_ack = True
 
     def next(self):
-        command, sha = self.walker.read_proto_line(_GRAPH_WALKER_COMMANDS)
+        command, sha = self.walker.read_have_line()
         if command in (None, 'done'):
             if not self._sent_ack:
                 self.walker.send_nak()
@@ -631,7 +931,7 @@ class MultiAckGraphWalkerImpl(object):
 
     def next(self):
         while True:
-            command, sha = self.walker.read_proto_line(_GRAPH_WALKER_COMMANDS)
+            command, sha = self.walker.read_have_line()
             if command is None:
                 self.walker.send_nak()
                 # in multi-ack mode, a flush-pkt indicates the client wants to
@@ -673,7 +973,7 @@ class MultiAckDetailedGraphWalkerImpl(object):
 
     def next(self):
         while True:
-            command, sha = self.walker.read_proto_line(_GRAPH_WALKER_COMMANDS)
+            command, sha = self.walker.read_have_line()
             if command is None:
                 self.walker.send_nak()
                 if self.walker.http_req:
@@ -708,9 +1008,9 @@ class ReceivePackHandler(Handler):
 
     @classmethod
     def capabilities(cls):
-        return ("report-status", "delete-refs", "side-band-64k")
+        return ("report-status", "delete-refs", "side-band-64k", "atomic")
 
-    def _apply_pack(self, refs):
+    def _apply_pack(self, refs, atomic=False):
         all_exceptions = (IOError, OSError, ChecksumMismatch, ApplyDeltaError,
                           AssertionError, socket.error, zlib.error,
                           ObjectFormatException)
@@ -725,7 +1025,9 @@ class ReceivePackHandler(Handler):
             # TODO: more informative error messages than just the exception string
             try:
                 recv = getattr(self.proto, "recv", None)
-                self.repo.object_store.add_thin_pack(self.proto.read, recv)
+                with self.metrics.timer('receive_pack.receive_pack'):
+                    self.repo.object_store.add_thin_pack(self.proto.read,
+                                                         recv)
                 status.append(('unpack', 'ok'))
             except all_exceptions as e:
                 status.append(('unpack', str(e).replace('\n', '')))
@@ -737,25 +1039,21 @@ class ReceivePackHandler(Handler):
             status.append(('unpack', 'ok'))
 
         for oldsha, sha, ref in refs:
-            ref_status = 'ok'
-            try:
-                if sha == ZERO_SHA:
-                    if not 'delete-refs' in self.capabilities():
-                        raise GitProtocolError(
-                          'Attempted to delete refs without delete-refs '
-                          'capability.')
-                    try:
-                        del self.repo.refs[ref]
-                    except all_exceptions:
-                        ref_status = 'failed to delete'
-                else:
-                    try:
-                        self.repo.refs[ref] = sha
-                    except all_exceptions:
-                        ref_status = 'failed to write'
-            except KeyError as e:
-                ref_status = 'bad ref'
-            status.append((ref, ref_status))
+            if sha == ZERO_SHA and not 'delete-refs' in self.capabilities():
+                raise GitProtocolError(
+                  'Attempted to delete refs without delete-refs '
+                  'capability.')
+
+        # Lock, verify and write all refs in one batch
+        try:
+            with self.metrics.timer('receive_pack.update_refs'):
+                failed = self.repo.refs.update_refs(
+                    [(ref, oldsha, sha) for (oldsha, sha, ref) in refs],
+                    atomic=atomic)
+        except all_exceptions:
+            failed = dict((ref, 'failed to write') for (_, _, ref) in refs)
+        for oldsha, sha, ref in refs:
+            status.append((ref, failed.get(ref, 'ok')))
 
         return status
 
@@ -782,7 +1080,7 @@ class ReceivePackHandler(Handler):
         write(None)
         flush()
 
-    def handle(self):
+    def _handle(self):
         refs = sorted(self.repo.get_refs().iteritems())
 
         if self.advertise_refs or not self.http_req:
@@ -817,7 +1115,9 @@ class ReceivePackHandler(Handler):
             ref = self.proto.read_pkt_line()
 
         # backend can now deal with this refs and read a pack using self.read
-        status = self._apply_pack(client_refs)
+        self.metrics.incr('receive_pack.ref_updates', len(client_refs))
+        status = self._apply_pack(client_refs,
+                                  atomic=self.has_capability('atomic'))
 
         # when we have read all the pack from the client, send a status report
         # if the client asked for it
@@ -848,6 +1148,8 @@ class TCPGitRequestHandler(SocketServer.StreamRequestHandler):
             raise GitProtocolError('Invalid service %s' % command)
         h = cls(self.server.backend, args, proto)
         h.handle()
+        logger.debug('Metrics for %s request: %r', command,
+                     h.metrics.as_dict())
 
 
 class TCPGitServer(SocketServer.TCPServer):
@@ -925,8 +1227,7 @@ def serve_command(handler_cls, argv=sys.argv, backend=None, inf=sys.stdin,
 
 def generate_info_refs(repo):
     """Generate an info refs file."""
-    refs = repo.get_refs()
-    return write_info_refs(refs, repo.object_store)
+    return iter(get_ref_advertisement(repo).info_refs())
 
 
 def generate_objects_info_packs(repo):
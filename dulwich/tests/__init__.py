@@ -106,6 +106,8 @@ class BlackboxTestCase(TestCase):
 
 def self_test_suite():
     names = [
+        'archive',
+        'benchmarks',
         'blackbox',
         'client',
         'config',
@@ -117,15 +119,19 @@ def self_test_suite():
         'hooks',
         'index',
         'lru_cache',
+        'metrics',
         'objects',
         'objectspec',
         'object_store',
         'missing_obj_finder',
         'pack',
+        'partial_clone',
         'patch',
         'porcelain',
+        'progress',
         'protocol',
         'refs',
+        'reftable',
         'repository',
         'server',
         'walk',
@@ -35,6 +35,7 @@ from dulwich.tests.utils import (
     )
 from dulwich.tests.compat.utils import (
     import_repo,
+    require_git_version,
     run_git_or_fail,
     )
 
@@ -179,8 +180,8 @@ class ServerTests(object):
         run_git_or_fail(['clone', '--mirror', '--depth=1', '--no-single-branch',
                         self.url(port), self._stub_repo.path])
         clone = self._stub_repo = Repo(self._stub_repo.path)
-        expected_shallow = ['94de09a530df27ac3bb613aaecdd539e0a0655e1',
-                            'da5cd81e1883c62a25bb37c4d1f8ad965b29bf8d']
+        expected_shallow = ['35e0b59e187dd72a0af294aedffc213eaa4d03ff',
+                            '514dc6d3fbfe77361bcaef320c4d21b72bc10be9']
         self.assertEqual(expected_shallow, _get_shallow(clone))
         self.assertReposNotEqual(clone, self._source_repo)
 
@@ -200,8 +201,8 @@ class ServerTests(object):
         run_git_or_fail(
           ['fetch', '--depth=1', self.url(port)] + self.branch_args(),
           cwd=self._stub_repo.path)
-        expected_shallow = ['94de09a530df27ac3bb613aaecdd539e0a0655e1',
-                            'da5cd81e1883c62a25bb37c4d1f8ad965b29bf8d']
+        expected_shallow = ['35e0b59e187dd72a0af294aedffc213eaa4d03ff',
+                            '514dc6d3fbfe77361bcaef320c4d21b72bc10be9']
         self.assertEqual(expected_shallow, _get_shallow(clone))
         self.assertReposNotEqual(clone, self._source_repo)
 
@@ -222,13 +223,71 @@ class ServerTests(object):
           ['fetch', '--depth=1', self.url(port)] + self.branch_args(),
           cwd=self._stub_repo.path)
 
-        # The whole repo only has depth 3, so it should equal server_new.
+        # The whole repo only has depth 4, so it should equal server_new.
         run_git_or_fail(
-          ['fetch', '--depth=3', self.url(port)] + self.branch_args(),
+          ['fetch', '--depth=4', self.url(port)] + self.branch_args(),
           cwd=self._stub_repo.path)
         self.assertEqual([], _get_shallow(clone))
         self.assertReposEqual(clone, self._source_repo)
 
+    def test_shallow_since_clone_from_dulwich(self):
+        require_git_version((2, 11, 0))
+        self._source_repo = import_repo('server_new.export')
+        self.addCleanup(tear_down_repo, self._source_repo)
+        self._stub_repo = _StubRepo('shallow')
+        self.addCleanup(tear_down_repo, self._stub_repo)
+        port = self._start_server(self._source_repo)
+
+        # Only the heads are at least as new as the master head
+        run_git_or_fail(['clone', '--mirror', '--shallow-since=@1265755295',
+                         '--no-single-branch', self.url(port),
+                         self._stub_repo.path])
+        clone = self._stub_repo = Repo(self._stub_repo.path)
+        expected_shallow = ['35e0b59e187dd72a0af294aedffc213eaa4d03ff',
+                            '514dc6d3fbfe77361bcaef320c4d21b72bc10be9']
+        self.assertEqual(expected_shallow, _get_shallow(clone))
+        run_git_or_fail(['fsck'], cwd=self._stub_repo.path)
+
+    def test_shallow_exclude_clone_from_dulwich(self):
+        require_git_version((2, 11, 0))
+        self._source_repo = import_repo('server_new.export')
+        self.addCleanup(tear_down_repo, self._source_repo)
+        self._stub_repo = _StubRepo('shallow')
+        self.addCleanup(tear_down_repo, self._stub_repo)
+        port = self._start_server(self._source_repo)
+
+        run_git_or_fail(['clone', '--bare', '--shallow-exclude=branch',
+                         '--branch=master', self.url(port),
+                         self._stub_repo.path])
+        clone = self._stub_repo = Repo(self._stub_repo.path)
+        self.assertEqual(['cbcb465d85de3761d1127430e52c87549f7cd1b9'],
+                         _get_shallow(clone))
+        run_git_or_fail(['fsck'], cwd=self._stub_repo.path)
+
+    def test_partial_clone_from_dulwich(self):
+        require_git_version((2, 20, 0))
+        self._source_repo = import_repo('server_new.export')
+        self.addCleanup(tear_down_repo, self._source_repo)
+        config = self._source_repo.get_config()
+        config.set(('uploadpack', ), 'allowanysha1inwant', 'true')
+        config.write_to_path()
+        self._stub_repo = _StubRepo('partial')
+        self.addCleanup(tear_down_repo, self._stub_repo)
+        port = self._start_server(self._source_repo)
+
+        run_git_or_fail(['clone', '--no-checkout', '--filter=blob:none',
+                         self.url(port), self._stub_repo.path])
+        output = run_git_or_fail(
+            ['rev-list', '--objects', '--all', '--missing=print'],
+            cwd=self._stub_repo.path)
+        missing = [line[1:] for line in output.splitlines()
+                   if line.startswith('?')]
+        self.assertNotEqual([], missing)
+        # Missing blobs are fetched from the promisor remote on demand
+        run_git_or_fail(['checkout', 'master'], cwd=self._stub_repo.path)
+        run_git_or_fail(['cat-file', '-p', missing[0]],
+                        cwd=self._stub_repo.path)
+
 
 # TODO(dborowitz): Come up with a better way of testing various permutations of
 # capabilities. The only reason it is the way it is now is that side-band-64k
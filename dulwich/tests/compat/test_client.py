@@ -55,6 +55,7 @@ from dulwich.tests.compat.utils import (
     CompatTestCase,
     check_for_daemon,
     import_repo_to_dir,
+    require_git_version,
     run_git_or_fail,
     _DEFAULT_GIT,
     )
@@ -217,6 +218,37 @@ class DulwichClientTestBase(object):
         for r in refs.items():
             dest.refs.set_if_equals(r[0], None, r[1])
 
+    def test_fetch_pack_depth(self):
+        c = self._client()
+        dest = repo.Repo(os.path.join(self.gitroot, 'dest'))
+        refs = c.fetch(self._build_path('/server_new.export'), dest, depth=1)
+        for r in refs.items():
+            dest.refs.set_if_equals(r[0], None, r[1])
+        self.assertEqual(
+            set(['35e0b59e187dd72a0af294aedffc213eaa4d03ff',
+                 '514dc6d3fbfe77361bcaef320c4d21b72bc10be9']),
+            dest.get_shallow())
+        run_git_or_fail(['fsck'], cwd=dest.path)
+
+    def test_fetch_pack_deepen(self):
+        self.test_fetch_pack_depth()
+        c = self._client()
+        dest = repo.Repo(os.path.join(self.gitroot, 'dest'))
+        c.fetch(self._build_path('/server_new.export'), dest, depth=4)
+        self.assertEqual(set(), dest.get_shallow())
+        self.assertDestEqualsSrc()
+
+    def test_fetch_pack_deepen_since(self):
+        require_git_version((2, 11, 0))
+        c = self._client()
+        dest = repo.Repo(os.path.join(self.gitroot, 'dest'))
+        c.fetch(self._build_path('/server_new.export'), dest,
+                deepen_since=1265755295)
+        self.assertEqual(
+            set(['35e0b59e187dd72a0af294aedffc213eaa4d03ff',
+                 '514dc6d3fbfe77361bcaef320c4d21b72bc10be9']),
+            dest.get_shallow())
+
     def test_send_remove_branch(self):
         dest = repo.Repo(os.path.join(self.gitroot, 'dest'))
         dummy_commit = self.make_dummy_commit(dest)
@@ -141,3 +141,12 @@ class DumbWebTestCase(WebTests, CompatTestCase):
         # Note: remove this if C git and dulwich implement dumb web shallow
         # clones.
         raise SkipTest('Dumb web shallow cloning not supported.')
+
+    def test_shallow_since_clone_from_dulwich(self):
+        raise SkipTest('Dumb web shallow cloning not supported.')
+
+    def test_shallow_exclude_clone_from_dulwich(self):
+        raise SkipTest('Dumb web shallow cloning not supported.')
+
+    def test_partial_clone_from_dulwich(self):
+        raise SkipTest('Dumb web partial cloning not supported.')
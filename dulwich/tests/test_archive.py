@@ -0,0 +1,250 @@
+# test_archive.py -- tests for archive.py
+# Copyright (C) 2014 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for archive generation."""
+
+from io import BytesIO
+import gzip
+import shutil
+import stat
+import tarfile
+import tempfile
+import zipfile
+
+from dulwich import archive
+from dulwich.archive import (
+    archive_stream,
+    iter_tree_blobs,
+    tar_stream,
+    zip_stream,
+    )
+from dulwich.index import (
+    commit_tree,
+    )
+from dulwich.objects import (
+    Blob,
+    S_IFGITLINK,
+    Tree,
+    )
+from dulwich.object_store import (
+    DiskObjectStore,
+    MemoryObjectStore,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+from dulwich.tests.utils import (
+    make_object,
+    )
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        super(ArchiveTests, self).setUp()
+        self.store = MemoryObjectStore()
+        self.blobs = {}
+        for name, data in [('a', 'a contents\n'), ('dir/b', 'b' * 3000),
+                           ('run', '#!/bin/sh\n'), ('link', 'dir/b')]:
+            blob = make_object(Blob, data=data)
+            self.store.add_object(blob)
+            self.blobs[name] = blob
+        self.tree_id = commit_tree(self.store, [
+            ('a', self.blobs['a'].id, 0o100644),
+            ('dir/b', self.blobs['dir/b'].id, 0o100644),
+            ('run', self.blobs['run'].id, 0o100755),
+            ('link', self.blobs['link'].id, stat.S_IFLNK),
+            ('sub', 'c' * 40, S_IFGITLINK),
+            ])
+
+    def _tar(self, *args, **kwargs):
+        return BytesIO(''.join(tar_stream(self.store, *args, **kwargs)))
+
+    def _zip(self, *args, **kwargs):
+        zf = zipfile.ZipFile(
+            BytesIO(''.join(zip_stream(self.store, *args, **kwargs))))
+        self.addCleanup(zf.close)
+        self.assertEqual(None, zf.testzip())
+        return zf
+
+    def test_iter_tree_blobs(self):
+        self.assertEqual([
+            ('a', 0o100644, 'a contents\n'),
+            ('dir', stat.S_IFDIR, None),
+            ('dir/b', 0o100644, 'b' * 3000),
+            ('link', stat.S_IFLNK, 'dir/b'),
+            ('run', 0o100755, '#!/bin/sh\n'),
+            ('sub', S_IFGITLINK, None),
+            ], list(iter_tree_blobs(self.store, self.tree_id, batch_size=2)))
+
+    def test_iter_tree_blobs_pack_order(self):
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        read = []
+
+        class RecordingObjectStore(DiskObjectStore):
+
+            def iter_objects(self, shas, allow_missing=False):
+                for obj in DiskObjectStore.iter_objects(self, shas,
+                                                        allow_missing):
+                    read.append(obj.id)
+                    yield obj
+
+        store = RecordingObjectStore.init(test_dir)
+        blobs = [make_object(Blob, data=data) for data in ['1', '2', '3']]
+        pack = store.add_objects([(blob, None) for blob in blobs])
+        tree = Tree()
+        for i, blob in enumerate(blobs):
+            tree.add(str(i), 0o100644, blob.id)
+        store.add_object(tree)
+        del read[:]
+        self.assertEqual(['1', '2', '3'],
+                         [data for (path, mode, data)
+                          in iter_tree_blobs(store, tree.id)])
+        expected = sorted([blob.id for blob in blobs],
+                          key=pack.index.object_index)
+        self.assertEqual(expected, read)
+
+    def test_tar_empty(self):
+        tree = Tree()
+        self.store.add_object(tree)
+        tf = tarfile.TarFile(fileobj=self._tar(tree.id, 0))
+        self.addCleanup(tf.close)
+        self.assertEqual([], tf.getnames())
+
+    def test_tar(self):
+        tf = tarfile.TarFile(fileobj=self._tar(self.tree_id, 1400000000))
+        self.addCleanup(tf.close)
+        self.assertEqual(['a', 'dir', 'dir/b', 'link', 'run', 'sub'],
+                         tf.getnames())
+        self.assertEqual('a contents\n', tf.extractfile('a').read())
+        self.assertEqual(0o664, tf.getmember('a').mode)
+        self.assertEqual(1400000000, tf.getmember('a').mtime)
+        self.assertEqual('b' * 3000, tf.extractfile('dir/b').read())
+        self.assertEqual(0o775, tf.getmember('run').mode)
+        self.assertTrue(tf.getmember('dir').isdir())
+        self.assertTrue(tf.getmember('sub').isdir())
+        self.assertTrue(tf.getmember('link').issym())
+        self.assertEqual('dir/b', tf.getmember('link').linkname)
+
+    def test_tar_prefix(self):
+        tf = tarfile.TarFile(fileobj=self._tar(self.tree_id, 0, 'foo/'))
+        self.addCleanup(tf.close)
+        self.assertEqual(['foo/a', 'foo/dir', 'foo/dir/b', 'foo/link',
+                          'foo/run', 'foo/sub'], tf.getnames())
+
+    def test_tar_long_path(self):
+        tf = tarfile.TarFile(fileobj=self._tar(self.tree_id, 0, 'x' * 200))
+        self.addCleanup(tf.close)
+        self.assertEqual('x' * 200 + 'a', tf.getnames()[0])
+
+    def test_tar_latin1(self):
+        blob = make_object(Blob, data='data')
+        self.store.add_object(blob)
+        tree_id = commit_tree(self.store, [('caf\xe9', blob.id, 0o100644)])
+        tf = tarfile.TarFile(fileobj=self._tar(tree_id, 0))
+        self.addCleanup(tf.close)
+        self.assertEqual(['caf\xe9'], tf.getnames())
+        self.assertEqual('data', tf.extractfile('caf\xe9').read())
+        tf = tarfile.TarFile(fileobj=self._tar(tree_id, 0, 'x' * 200))
+        self.addCleanup(tf.close)
+        self.assertEqual(['x' * 200 + 'caf\xe9'], tf.getnames())
+
+    def test_tar_gz(self):
+        tf = tarfile.open(fileobj=self._tar(self.tree_id, 0, format='gz'),
+                          mode='r:gz')
+        self.addCleanup(tf.close)
+        self.assertEqual('b' * 3000, tf.extractfile('dir/b').read())
+
+    def test_tar_gz_blocks(self):
+        self.addCleanup(setattr, archive, 'COMPRESS_BLOCK_SIZE',
+                        archive.COMPRESS_BLOCK_SIZE)
+        archive.COMPRESS_BLOCK_SIZE = 1000
+        uncompressed = self._tar(self.tree_id, 0).getvalue()
+        compressed = self._tar(self.tree_id, 0, format='gz').getvalue()
+        threaded = self._tar(self.tree_id, 0, format='gz',
+                             threads=4).getvalue()
+        self.assertEqual(compressed, threaded)
+        self.assertEqual(uncompressed,
+                         gzip.GzipFile(fileobj=BytesIO(compressed)).read())
+
+    def test_tar_unknown_compression(self):
+        self.assertRaises(ValueError, tar_stream, self.store, self.tree_id,
+                          0, format='xz')
+
+    def test_zip(self):
+        zf = self._zip(self.tree_id, 1400000000)
+        self.assertEqual(['a', 'dir/', 'dir/b', 'link', 'run', 'sub/'],
+                         zf.namelist())
+        self.assertEqual('a contents\n', zf.read('a'))
+        self.assertEqual('b' * 3000, zf.read('dir/b'))
+        self.assertEqual(zipfile.ZIP_DEFLATED,
+                         zf.getinfo('dir/b').compress_type)
+        self.assertEqual(zipfile.ZIP_STORED, zf.getinfo('a').compress_type)
+        self.assertEqual(0o100644, zf.getinfo('a').external_attr >> 16)
+        self.assertEqual(0o100755, zf.getinfo('run').external_attr >> 16)
+        self.assertEqual(0o120777, zf.getinfo('link').external_attr >> 16)
+        self.assertEqual('dir/b', zf.read('link'))
+
+    def test_zip_threads(self):
+        self.assertEqual(
+            ''.join(zip_stream(self.store, self.tree_id, 0)),
+            ''.join(zip_stream(self.store, self.tree_id, 0, threads=3)))
+
+    def test_zip_utf8(self):
+        blob = make_object(Blob, data='data')
+        self.store.add_object(blob)
+        tree_id = commit_tree(self.store,
+                              [(u'caf\xe9'.encode('utf-8'), blob.id, 0o100644)])
+        zf = self._zip(tree_id, 0)
+        self.assertEqual([u'caf\xe9'], zf.namelist())
+
+    def test_zip_latin1(self):
+        blob = make_object(Blob, data='data')
+        self.store.add_object(blob)
+        tree_id = commit_tree(self.store, [('caf\xe9', blob.id, 0o100644)])
+        zf = self._zip(tree_id, 0)
+        self.assertEqual(['caf\xe9'], zf.namelist())
+        self.assertEqual(0, zf.getinfo('caf\xe9').flag_bits & 0x800)
+        self.assertEqual('data', zf.read('caf\xe9'))
+
+    def test_zip64(self):
+        self.addCleanup(setattr, archive, 'ZIP64_LIMIT', archive.ZIP64_LIMIT)
+        self.addCleanup(setattr, archive, 'ZIP_FILECOUNT_LIMIT',
+                        archive.ZIP_FILECOUNT_LIMIT)
+        archive.ZIP64_LIMIT = 50
+        archive.ZIP_FILECOUNT_LIMIT = 3
+        zf = self._zip(self.tree_id, 0)
+        self.assertEqual(6, len(zf.namelist()))
+        self.assertEqual('b' * 3000, zf.read('dir/b'))
+        self.assertEqual('#!/bin/sh\n', zf.read('run'))
+
+    def test_archive_stream(self):
+        tf = tarfile.open(fileobj=BytesIO(''.join(archive_stream(
+            self.store, self.tree_id, 0, format='tgz'))), mode='r:gz')
+        self.addCleanup(tf.close)
+        self.assertEqual('a contents\n', tf.extractfile('a').read())
+        zf = zipfile.ZipFile(BytesIO(''.join(archive_stream(
+            self.store, self.tree_id, 0, format='zip'))))
+        self.addCleanup(zf.close)
+        self.assertEqual('a contents\n', zf.read('a'))
+
+    def test_archive_stream_unknown_format(self):
+        self.assertRaises(ValueError, archive_stream, self.store,
+                          self.tree_id, 0, format='rar')
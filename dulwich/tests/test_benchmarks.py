@@ -0,0 +1,148 @@
+# test_benchmarks.py -- tests for the benchmarks
+# Copyright (C) 2014 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for the benchmarks and synthetic repositories."""
+
+from io import BytesIO
+import json
+
+from dulwich import benchmarks
+from dulwich.benchmarks import (
+    SyntheticRepo,
+    benchmark_name,
+    compare_results,
+    get_benchmarks,
+    run_benchmarks,
+    )
+from dulwich.benchmarks.core import (
+    upload_pack,
+    )
+from dulwich.benchmarks.synthetic import (
+    build_synthetic_repo,
+    generate_history,
+    )
+from dulwich.diff_tree import (
+    CHANGE_RENAME,
+    RenameDetector,
+    tree_changes,
+    )
+from dulwich.pack import (
+    OFS_DELTA,
+    )
+from dulwich.repo import (
+    MemoryRepo,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+
+TINY = dict(num_commits=4, tree_width=5, blob_size=300, num_packs=2)
+
+
+class SyntheticTests(TestCase):
+
+    def test_deterministic(self):
+        ids = [[[obj.id for obj in batch] for batch in generate_history(
+                num_commits=5, tree_width=4, seed=seed)]
+               for seed in (0, 0, 1)]
+        self.assertEqual(ids[0], ids[1])
+        self.assertNotEqual(ids[0], ids[2])
+
+    def test_objects_introduced_once(self):
+        ids = [obj.id for batch in generate_history(num_commits=10)
+               for obj in batch]
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_build_memory_repo(self):
+        repo = MemoryRepo()
+        commit_ids = build_synthetic_repo(repo, num_commits=5, tree_width=4,
+                                          rename_rate=0.5)
+        self.assertEqual(5, len(commit_ids))
+        self.assertEqual(commit_ids[-1], repo.head())
+        head = repo[commit_ids[-1]]
+        self.assertEqual([commit_ids[-2]], head.parents)
+        self.assertEqual(4, len(list(
+            repo.object_store.iter_tree_contents(head.tree))))
+        parent = repo[commit_ids[-2]]
+        changes = tree_changes(repo.object_store, parent.tree, head.tree,
+                               rename_detector=RenameDetector(repo.object_store))
+        self.assertTrue(CHANGE_RENAME in [c.type for c in changes])
+
+    def test_build_packs(self):
+        fixture = SyntheticRepo.create(**TINY)
+        self.addCleanup(fixture.close)
+        packs = fixture.repo.object_store.packs
+        self.assertEqual(2, len(packs))
+        type_nums = [type_num for pack in packs
+                     for (offset, type_num, obj, crc32)
+                     in pack.data.iterobjects()]
+        self.assertTrue(OFS_DELTA in type_nums)
+        for commit_id in fixture.commit_ids:
+            self.assertTrue(commit_id in fixture.repo)
+
+
+class BenchmarkTests(TestCase):
+
+    def test_get_benchmarks(self):
+        names = [benchmark_name(func) for func in get_benchmarks()]
+        self.assertTrue('pack_indexer' in names)
+        self.assertEqual(len(names), len(set(names)))
+        self.assertEqual(['walker'],
+                         [benchmark_name(func)
+                          for func in get_benchmarks(['walker'])])
+        self.assertRaises(KeyError, get_benchmarks, ['nonexistent'])
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(params=TINY, repeat=2)
+        results = json.loads(json.dumps(results))
+        self.assertEqual(TINY, results['params'])
+        self.assertEqual([benchmark_name(func) for func in get_benchmarks()],
+                         [r['name'] for r in results['results']])
+        for result in results['results']:
+            self.assertEqual(2, len(result['times']))
+            self.assertEqual(min(result['times']), result['min'])
+            self.assertTrue(result['items'] > 0, result['name'])
+
+    def test_upload_pack(self):
+        fixture = SyntheticRepo.create(**TINY)
+        self.addCleanup(fixture.close)
+        clone = upload_pack(fixture.repo, [fixture.commit_ids[-1]])
+        fetch = upload_pack(fixture.repo, [fixture.commit_ids[-1]],
+                            [fixture.commit_ids[-2]])
+        self.assertTrue('PACK' in clone)
+        self.assertTrue('PACK' in fetch)
+        self.assertTrue(len(fetch) < len(clone))
+
+    def test_compare_results(self):
+        baseline = {'results': [{'name': 'a', 'min': 1.0},
+                                {'name': 'b', 'min': 1.0}]}
+        current = {'results': [{'name': 'a', 'min': 1.05},
+                               {'name': 'b', 'min': 1.5},
+                               {'name': 'c', 'min': 9.0}]}
+        self.assertEqual([('b', 1.0, 1.5)],
+                         compare_results(baseline, current))
+        self.assertEqual([('a', 1.0, 1.05), ('b', 1.0, 1.5)],
+                         compare_results(baseline, current, tolerance=0))
+
+    def test_main_list(self):
+        self.addCleanup(setattr, benchmarks.sys, 'stdout',
+                        benchmarks.sys.stdout)
+        out = benchmarks.sys.stdout = BytesIO()
+        self.assertEqual(0, benchmarks.main(['benchmarks', '--list']))
+        self.assertTrue('walker_topo\n' in out.getvalue())
@@ -17,13 +17,16 @@
 # MA  02110-1301, USA.
 
 from io import BytesIO
+import shutil
 import sys
+import tempfile
 from unittest import skipIf
 
 from dulwich import (
     client,
     )
 from dulwich.client import (
+    GitProtocolError,
     LocalGitClient,
     TraditionalGitClient,
     TCPGitClient,
@@ -42,16 +45,29 @@ from dulwich.tests import (
 from dulwich.protocol import (
     TCP_GIT_PORT,
     Protocol,
+    pkt_line,
     )
 from dulwich.pack import (
+    REF_DELTA,
+    PackData,
     write_pack_objects,
     )
+from dulwich.object_store import (
+    MemoryObjectStore,
+    ObjectStoreGraphWalker,
+    )
 from dulwich.objects import (
+    Blob,
     Commit,
     Tree
     )
-from dulwich.repo import MemoryRepo
+from dulwich.repo import (
+    MemoryRepo,
+    Repo,
+    )
 from dulwich.tests.utils import (
+    build_commit_graph,
+    make_object,
     open_repo,
     )
 
@@ -93,6 +109,18 @@ class GitClientTests(TestCase):
         self.client.archive('bla', 'HEAD', None, None)
         self.assertEqual(self.rout.getvalue(), '0011argument HEAD0000')
 
+    def test_archive_format_prefix(self):
+        self.rin.write(
+            '0009NACK\n'
+            '0000')
+        self.rin.seek(0)
+        self.client.archive('bla', 'HEAD', None, None, format='zip',
+                            prefix='foo/')
+        self.assertEqual(self.rout.getvalue(),
+                         '0019argument --format=zip'
+                         '001aargument --prefix=foo/'
+                         '0011argument HEAD0000')
+
     def test_fetch_empty(self):
         self.rin.write('0000')
         self.rin.seek(0)
@@ -108,6 +136,87 @@ class GitClientTests(TestCase):
         self.client.fetch_pack('bla', lambda heads: [], None, None, None)
         self.assertEqual(self.rout.getvalue(), '0000')
 
+    def _fetch_pack_filter(self, capabilities, filter_spec):
+        line = '%s HEAD\x00%s\n' % ('1' * 40, capabilities)
+        self.rin.write('%04x%s0000' % (len(line) + 4, line))
+        self.rin.write('0008NAK\n')
+        self.rin.seek(0)
+        self.client.fetch_pack('bla', lambda heads: ['1' * 40], iter([None]),
+                               BytesIO().write, filter_spec=filter_spec)
+        return self.rout.getvalue()
+
+    def test_fetch_pack_filter(self):
+        self.assertEqual(
+            '0039want %s filter\n0015filter blob:none\n00000009done\n'
+            % ('1' * 40),
+            self._fetch_pack_filter('filter', 'blob:none'))
+
+    def test_fetch_pack_filter_unsupported(self):
+        self.assertEqual(
+            '003cwant %s ofs-delta\n00000009done\n' % ('1' * 40),
+            self._fetch_pack_filter('ofs-delta', 'blob:none'))
+
+    def test_fetch_pack_filter_invalid(self):
+        self.assertRaises(ValueError, self._fetch_pack_filter, 'filter',
+                          'blob:all')
+
+    def _fetch_pack_shallow(self, capabilities, response, shallow=None,
+                            **kwargs):
+        line = '%s HEAD\x00%s\n' % ('1' * 40, capabilities)
+        self.rin.write(pkt_line(line) + pkt_line(None))
+        for line in response:
+            self.rin.write(pkt_line(line))
+        self.rin.write(pkt_line('NAK\n'))
+        self.rin.seek(0)
+        graph_walker = ObjectStoreGraphWalker([], None, shallow=shallow)
+        self.client.fetch_pack('bla', lambda heads: ['1' * 40], graph_walker,
+                               BytesIO().write, **kwargs)
+        return graph_walker, self.rout.getvalue()
+
+    def test_fetch_pack_depth(self):
+        graph_walker, out = self._fetch_pack_shallow(
+            'shallow', ['shallow %s\n' % ('1' * 40), None], depth=1)
+        self.assertEqual(
+            pkt_line('want %s shallow\n' % ('1' * 40)) +
+            pkt_line('deepen 1\n') + pkt_line(None) + pkt_line('done\n'),
+            out)
+        self.assertEqual(set(['1' * 40]), graph_walker.shallow)
+
+    def test_fetch_pack_shallow_no_deepen(self):
+        graph_walker, out = self._fetch_pack_shallow(
+            'shallow', [], shallow=['2' * 40])
+        self.assertEqual(
+            pkt_line('want %s shallow\n' % ('1' * 40)) +
+            pkt_line('shallow %s\n' % ('2' * 40)) + pkt_line(None) +
+            pkt_line('done\n'), out)
+        self.assertEqual(set(['2' * 40]), graph_walker.shallow)
+
+    def test_fetch_pack_unshallow(self):
+        graph_walker, out = self._fetch_pack_shallow(
+            'shallow', ['shallow %s\n' % ('3' * 40),
+                        'unshallow %s\n' % ('2' * 40), None],
+            shallow=['2' * 40], depth=2)
+        self.assertEqual(set(['3' * 40]), graph_walker.shallow)
+        self.assertEqual(set(['2' * 40]), graph_walker.unshallow)
+
+    def test_fetch_pack_deepen_since(self):
+        graph_walker, out = self._fetch_pack_shallow(
+            'shallow deepen-since deepen-not', [None], deepen_since=1234,
+            deepen_not=['refs/heads/old'])
+        want, rest = out.split('\n', 1)
+        self.assertEqual(set(['shallow', 'deepen-since', 'deepen-not']),
+                         set(want.split(' ')[2:]))
+        self.assertEqual(
+            pkt_line('deepen-since 1234\n') +
+            pkt_line('deepen-not refs/heads/old\n') + pkt_line(None) +
+            pkt_line('done\n'), rest)
+
+    def test_fetch_pack_depth_unsupported(self):
+        self.assertRaises(GitProtocolError, self._fetch_pack_shallow,
+                          'ofs-delta', [], depth=1)
+        self.assertRaises(GitProtocolError, self._fetch_pack_shallow,
+                          'shallow', [], deepen_since=1234)
+
     def test_send_pack_no_sideband64k_with_update_ref_error(self):
         # No side-bank-64k reported by server shouldn't try to parse
         # side band data
@@ -261,6 +370,44 @@ class GitClientTests(TestCase):
              'refs/heads/blah12\x00ofs-delta report-status0000%s'
              % (commit.id, f.getvalue())])
 
+    def _send_pack_update(self, capabilities):
+        store = MemoryObjectStore()
+        old_blob = make_object(Blob, data='line\n' * 100)
+        new_blob = make_object(Blob, data='line\n' * 101)
+        c1, c2 = build_commit_graph(store, [[1], [2, 1]], trees={
+            1: [('f', old_blob)], 2: [('f', new_blob)]})
+        line = '%s refs/heads/master\x00%s\n' % (c1.id, capabilities)
+        self.rin.write('%04x%s' % (len(line) + 4, line))
+        self.rin.write('0000000eunpack ok\n0019ok refs/heads/master\n0000')
+        self.rin.seek(0)
+
+        def determine_wants(refs):
+            return {'refs/heads/master': c2.id}
+
+        self.client.send_pack('/', determine_wants,
+                              store.generate_pack_contents)
+        pack = self.rout.getvalue()
+        pack = pack[pack.index('PACK'):]
+        deltas = [data for (offset, type_num, data, crc32)
+                  in PackData.from_file(BytesIO(pack), len(pack)).iterobjects()
+                  if type_num == REF_DELTA]
+        return old_blob, deltas
+
+    def test_send_pack_thin(self):
+        old_blob, deltas = self._send_pack_update('report-status ofs-delta')
+        self.assertIn(old_blob.sha().digest(),
+                      [base for (base, delta) in deltas])
+
+    def test_send_pack_no_thin(self):
+        old_blob, deltas = self._send_pack_update(
+            'report-status ofs-delta no-thin')
+        self.assertEqual([], deltas)
+
+    def test_send_pack_thin_packs_disabled(self):
+        self.client._send_thin_packs = False
+        old_blob, deltas = self._send_pack_update('report-status ofs-delta')
+        self.assertEqual([], deltas)
+
     def test_send_pack_no_deleteref_delete_only(self):
         pkts = ['310ca9477129b8586fa2afc779c1f57cf64bba6c refs/heads/master'
                 '\x00 report-status ofs-delta\n',
@@ -579,6 +726,30 @@ class LocalGitClientTests(TestCase):
         s = open_repo('a.git')
         self.assertEqual(s.get_refs(), c.fetch(s.path, t))
 
+    def test_fetch_deepen_since(self):
+        c = LocalGitClient()
+        s = open_repo('a.git')
+        target_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_path)
+        t = Repo.init(target_path)
+        head = 'a90fa2d900a17e99b433217e988c4eb4a2e9a097'
+        c.fetch(s.path, t, lambda refs: [refs['HEAD']],
+                deepen_since=1174775040)
+        self.assertEqual(set([head]), t.get_shallow())
+
+    def test_fetch_deepen_not_partial(self):
+        c = LocalGitClient()
+        s = open_repo('a.git')
+        target_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_path)
+        t = Repo.init(target_path)
+        head = 'a90fa2d900a17e99b433217e988c4eb4a2e9a097'
+        c.fetch(s.path, t, lambda refs: [refs['HEAD']],
+                filter_spec='blob:none', deepen_not=['refs/tags/mytag-packed'])
+        self.assertEqual(set([head]), t.get_shallow())
+        self.assertFalse('2a72d929692c41d8554c07f6301757ba18a65d91'
+                         in t.object_store)
+
     def test_fetch_empty(self):
         c = LocalGitClient()
         s = open_repo('a.git')
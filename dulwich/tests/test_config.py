@@ -19,9 +19,15 @@
 """Tests for reading and writing configuration files."""
 
 from io import BytesIO
+import os
+import shutil
+import tempfile
+import time
+
 from dulwich.config import (
     ConfigDict,
     ConfigFile,
+    ConfigFileCache,
     StackedConfig,
     _check_section_name,
     _check_variable_name,
@@ -30,6 +36,7 @@ from dulwich.config import (
     _parse_string,
     _unescape_value,
     )
+from dulwich.metrics import collect_metrics
 from dulwich.tests import TestCase
 
 
@@ -212,6 +219,77 @@ class StackedConfigTests(TestCase):
         StackedConfig.default_backends()
 
 
+class ConfigFileCopyTests(TestCase):
+
+    def test_copy(self):
+        cf = ConfigFile.from_file(BytesIO("[core]\nfoo = bar\n"))
+        cf.path = "config"
+        copy = cf.copy()
+        self.assertEqual(cf, copy)
+        self.assertEqual("config", copy.path)
+        copy.set(("core", ), "foo", "blah")
+        copy.set(("other", ), "foo", "blah")
+        self.assertEqual("bar", cf.get(("core", ), "foo"))
+        self.assertEqual([("core", )], list(cf.itersections()))
+
+
+class ConfigFileCacheTests(TestCase):
+
+    def setUp(self):
+        super(ConfigFileCacheTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, "config")
+        self.cache = ConfigFileCache()
+
+    def write(self, contents, age=10):
+        with open(self.path, "wb") as f:
+            f.write(contents)
+        mtime = time.time() - age
+        os.utime(self.path, (mtime, mtime))
+
+    def get(self):
+        with collect_metrics() as metrics:
+            cf = self.cache.get(self.path)
+        return cf, metrics.counters.get("config.cache_hits", 0)
+
+    def test_cached(self):
+        self.write("[core]\nfoo = bar\n")
+        cf, hits = self.get()
+        self.assertEqual("bar", cf.get(("core", ), "foo"))
+        self.assertEqual(self.path, cf.path)
+        self.assertEqual((cf, 1), self.get())
+
+    def test_changed(self):
+        self.write("[core]\nfoo = bar\n", age=20)
+        self.get()
+        self.write("[core]\nfoo = blah\n")
+        cf, hits = self.get()
+        self.assertEqual(0, hits)
+        self.assertEqual("blah", cf.get(("core", ), "foo"))
+
+    def test_missing(self):
+        self.assertEqual((None, 0), self.get())
+        self.assertEqual((None, 1), self.get())
+        self.write("[core]\nfoo = bar\n")
+        cf, hits = self.get()
+        self.assertEqual(0, hits)
+        self.assertEqual("bar", cf.get(("core", ), "foo"))
+
+    def test_racy(self):
+        self.write("[core]\nfoo = bar\n", age=0)
+        self.get()
+        cf, hits = self.get()
+        self.assertEqual(0, hits)
+        self.assertEqual("bar", cf.get(("core", ), "foo"))
+
+    def test_clear(self):
+        self.write("[core]\nfoo = bar\n")
+        self.get()
+        self.cache.clear()
+        self.assertEqual(0, self.get()[1])
+
+
 class UnescapeTests(TestCase):
 
     def test_nothing(self):
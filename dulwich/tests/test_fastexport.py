@@ -143,6 +143,47 @@ M 100644 :1 a
         self.assertTrue(isinstance(self.repo[markers["1"]], Blob))
         self.assertTrue(isinstance(self.repo[markers["2"]], Commit))
 
+    def test_import_stream_refs_after_pack(self):
+        refs_at_finish = []
+        get_importer = self.repo.object_store.get_importer
+
+        def recording_importer(*args, **kwargs):
+            importer = get_importer(*args, **kwargs)
+            finish = importer.finish
+
+            def recording_finish():
+                refs_at_finish.append(self.repo.get_refs())
+                return finish()
+            importer.finish = recording_finish
+            return importer
+        self.repo.object_store.get_importer = recording_importer
+        markers = self.processor.import_stream(BytesIO("""blob
+mark :1
+data 11
+text for a
+
+commit refs/heads/master
+mark :2
+committer Joe Foo <joe@foo.com> 1288287382 +0000
+data 20
+<The commit message>
+M 100644 :1 a
+
+checkpoint
+
+commit refs/heads/master
+mark :3
+committer Joe Foo <joe@foo.com> 1288287383 +0000
+data 6
+second
+M 100644 :1 b
+
+"""))
+        self.assertEqual([{}, {"refs/heads/master": markers["2"]}],
+                         refs_at_finish)
+        self.assertEqual({"refs/heads/master": markers["3"]},
+                         self.repo.get_refs())
+
     def test_file_add(self):
         from fastimport import commands
         cmd = commands.BlobCommand("23", "data")
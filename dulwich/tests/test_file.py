@@ -24,7 +24,8 @@ import sys
 import tempfile
 from unittest import SkipTest
 
-from dulwich.file import GitFile, fancy_rename
+from dulwich import file as _mod_file
+from dulwich.file import GitFile, fancy_rename, link_or_copy
 from dulwich.tests import (
     TestCase,
     )
@@ -87,6 +88,48 @@ class FancyRenameTests(TestCase):
         new_f.close()
 
 
+class LinkOrCopyTests(TestCase):
+
+    def setUp(self):
+        super(LinkOrCopyTests, self).setUp()
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self.src = os.path.join(self._tempdir, 'src')
+        self.dst = os.path.join(self._tempdir, 'dst')
+        with open(self.src, 'wb') as f:
+            f.write('contents')
+
+    def fail_link(self, error):
+        def link(src, dst):
+            raise OSError(error, os.strerror(error))
+        self.addCleanup(setattr, _mod_file.os, 'link',
+                        getattr(_mod_file.os, 'link', None))
+        _mod_file.os.link = link
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_link(self):
+        if getattr(os, 'link', None) is None:
+            raise SkipTest('hardlinks are not supported')
+        link_or_copy(self.src, self.dst)
+        self.assertEqual(os.stat(self.src).st_ino, os.stat(self.dst).st_ino)
+
+    def test_cross_device(self):
+        self.fail_link(errno.EXDEV)
+        link_or_copy(self.src, self.dst)
+        self.assertEqual('contents', self.read(self.dst))
+        self.assertNotEqual(os.stat(self.src).st_ino,
+                            os.stat(self.dst).st_ino)
+        self.assertFalse(os.path.exists(self.dst + '.lock'))
+
+    def test_error(self):
+        self.fail_link(errno.EEXIST)
+        self.assertRaises(OSError, link_or_copy, self.src, self.dst)
+        self.assertFalse(os.path.exists(self.dst))
+
+
 class GitFileTests(TestCase):
 
     def setUp(self):
@@ -0,0 +1,145 @@
+# test_metrics.py -- tests for metrics.py
+# Copyright (C) 2014 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for metrics collection."""
+
+import threading
+
+from dulwich import metrics as metrics_module
+from dulwich.metrics import (
+    Metrics,
+    NullMetrics,
+    collect_metrics,
+    get_metrics,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def time(self):
+        return self.now
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        super(MetricsTests, self).setUp()
+        self.clock = FakeClock()
+        self.addCleanup(setattr, metrics_module, 'time', metrics_module.time)
+        metrics_module.time = self.clock
+        self.metrics = Metrics()
+
+    def test_incr(self):
+        self.metrics.incr('a')
+        self.metrics.incr('a', 2)
+        self.metrics.incr('b')
+        self.assertEqual({'a': 3, 'b': 1}, self.metrics.counters)
+
+    def test_observe(self):
+        for value in [2, 5, 1]:
+            self.metrics.observe('chain', value)
+        self.assertEqual({'chain': {'count': 3, 'total': 8, 'max': 5}},
+                         self.metrics.as_dict()['distributions'])
+
+    def test_timer(self):
+        with self.metrics.timer('outer'):
+            self.clock.now += 1
+            with self.metrics.timer('inner'):
+                self.clock.now += 2
+            with self.metrics.timer('inner'):
+                self.clock.now += 3
+        self.metrics.add_time('other', 4)
+        self.assertEqual({
+            'outer': {'count': 1, 'total': 6, 'self': 1},
+            'inner': {'count': 2, 'total': 5, 'self': 5},
+            'other': {'count': 1, 'total': 4, 'self': 4},
+            }, self.metrics.as_dict()['timers'])
+
+    def test_timer_exception(self):
+        def fail():
+            with self.metrics.timer('outer'):
+                self.clock.now += 1
+                raise ValueError
+        self.assertRaises(ValueError, fail)
+        self.assertEqual([1, 1, 1], self.metrics.timers['outer'])
+        self.assertEqual([], self.metrics._active)
+
+    def test_timed_iter(self):
+        def items():
+            for i in range(3):
+                self.clock.now += 1
+                yield i
+        with self.metrics.timer('consumer'):
+            for i in self.metrics.timed_iter(items(), 'producer'):
+                self.clock.now += 10
+        self.assertEqual([4, 3, 3], self.metrics.timers['producer'])
+        self.assertEqual([1, 33, 30], self.metrics.timers['consumer'])
+
+    def test_hit_ratio(self):
+        self.assertEqual(None, self.metrics.hit_ratio('cache'))
+        self.metrics.incr('cache_hits', 3)
+        self.metrics.incr('cache_misses')
+        self.assertEqual(0.75, self.metrics.hit_ratio('cache'))
+
+
+class NullMetricsTests(TestCase):
+
+    def test_ignores(self):
+        metrics = NullMetrics()
+        metrics.incr('a')
+        metrics.observe('b', 1)
+        metrics.add_time('c', 1)
+        with metrics.timer('d'):
+            pass
+        items = [1, 2]
+        self.assertTrue(items is metrics.timed_iter(items, 'e'))
+        self.assertFalse(metrics.enabled)
+
+
+class CollectMetricsTests(TestCase):
+
+    def test_default(self):
+        self.assertFalse(get_metrics().enabled)
+
+    def test_collect(self):
+        with collect_metrics() as outer:
+            self.assertTrue(get_metrics() is outer)
+            inner = Metrics()
+            with collect_metrics(inner) as installed:
+                self.assertTrue(installed is inner)
+                get_metrics().incr('a')
+            self.assertTrue(get_metrics() is outer)
+        self.assertFalse(get_metrics().enabled)
+        self.assertEqual({'a': 1}, inner.counters)
+        self.assertEqual({}, outer.counters)
+
+    def test_per_thread(self):
+        seen = []
+        with collect_metrics():
+            thread = threading.Thread(
+                target=lambda: seen.append(get_metrics().enabled))
+            thread.start()
+            thread.join()
+        self.assertEqual([False], seen)
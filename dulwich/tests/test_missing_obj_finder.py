@@ -22,6 +22,9 @@ from dulwich.object_store import (
 from dulwich.objects import (
     Blob,
     )
+from dulwich.partial_clone import (
+    parse_filter_spec,
+    )
 from dulwich.tests import TestCase
 from dulwich.tests.utils import (
     make_object,
@@ -107,6 +110,84 @@ class MOFLinearRepoTest(MissingObjectFinderTest):
     def test_no_changes(self):
         self.assertMissingMatch([self.cmt(3).id], [self.cmt(3).id], [])
 
+    def test_progress(self):
+        messages = []
+        finder = self.store.find_missing_objects([self.cmt(1).id],
+            [self.cmt(2).id], progress=messages.append)
+        self.assertEqual(4, len(list(finder)))
+        self.assertEqual(["Counting objects: 4, done.\n"], messages)
+
+    def test_progress_no_changes(self):
+        messages = []
+        finder = self.store.find_missing_objects([self.cmt(3).id],
+            [self.cmt(3).id], progress=messages.append)
+        self.assertEqual([], list(finder))
+        self.assertEqual([], messages)
+
+
+class MOFNestedTreeTest(MissingObjectFinderTest):
+
+    def setUp(self):
+        super(MOFNestedTreeTest, self).setUp()
+        self.f1 = make_object(Blob, data='f1')
+        self.f2 = make_object(Blob, data='f2')
+        self.commits = build_commit_graph(self.store, [[1]], trees={
+            1: [('a/b/c', self.f1), ('d', self.f2)]})
+
+    def test_paths(self):
+        paths = dict(self.store.find_missing_objects([], [self.cmt(1).id]))
+        tree = self.store[self.cmt(1).tree]
+        a = self.store[tree['a'][1]]
+        self.assertEqual('a', paths[a.id])
+        self.assertEqual('a/b', paths[a['b'][1]])
+        self.assertEqual('a/b/c', paths[self.f1.id])
+        self.assertEqual('d', paths[self.f2.id])
+
+
+class MOFFilterTest(MissingObjectFinderTest):
+
+    def setUp(self):
+        super(MOFFilterTest, self).setUp()
+        self.small = make_object(Blob, data='small')
+        self.large = make_object(Blob, data='large' * 100)
+        self.nested = make_object(Blob, data='nested')
+        self.commits = build_commit_graph(self.store, [[1]], trees={
+            1: [('small', self.small), ('large', self.large),
+                ('a/b/nested', self.nested)]})
+        tree = self.store[self.cmt(1).tree]
+        self.tree_a = tree['a'][1]
+        self.tree_b = self.store[self.tree_a]['b'][1]
+
+    def assertFilterMatch(self, spec, wants, expected):
+        found = [sha for (sha, path) in self.store.find_missing_objects(
+            [], wants, object_filter=parse_filter_spec(spec))]
+        self.assertEqual(sorted(expected), sorted(found))
+
+    def test_blob_none(self):
+        self.assertFilterMatch('blob:none', [self.cmt(1).id],
+            [self.cmt(1).id, self.cmt(1).tree, self.tree_a, self.tree_b])
+
+    def test_blob_limit(self):
+        self.assertFilterMatch('blob:limit=100', [self.cmt(1).id],
+            [self.cmt(1).id, self.cmt(1).tree, self.tree_a, self.tree_b,
+             self.small.id, self.nested.id])
+
+    def test_tree_depth(self):
+        self.assertFilterMatch('tree:0', [self.cmt(1).id], [self.cmt(1).id])
+        self.assertFilterMatch('tree:1', [self.cmt(1).id],
+            [self.cmt(1).id, self.cmt(1).tree])
+        self.assertFilterMatch('tree:2', [self.cmt(1).id],
+            [self.cmt(1).id, self.cmt(1).tree, self.tree_a, self.small.id,
+             self.large.id])
+
+    def test_wanted_blobs_are_not_filtered(self):
+        self.assertFilterMatch('blob:none', [self.large.id, self.nested.id],
+                               [self.large.id, self.nested.id])
+
+    def test_wanted_blob_without_filter(self):
+        self.assertMissingMatch([self.cmt(1).id], [self.large.id],
+                                [self.large.id])
+
 
 class MOFMergeForkRepoTest(MissingObjectFinderTest):
     # 1 --- 2 --- 4 --- 6 --- 7
@@ -20,8 +20,11 @@
 
 
 from io import BytesIO
+import errno
 import os
+import random
 import shutil
+import socket
 import tempfile
 
 from dulwich.index import (
@@ -30,6 +33,9 @@ from dulwich.index import (
 from dulwich.errors import (
     NotTreeError,
     )
+from dulwich.metrics import (
+    collect_metrics,
+    )
 from dulwich.objects import (
     sha_to_hex,
     object_class,
@@ -42,17 +48,24 @@ from dulwich.object_store import (
     DiskObjectStore,
     MemoryObjectStore,
     ObjectStoreGraphWalker,
+    ObjectStoreIterator,
+    ThinPackBaseFinder,
     tree_lookup_path,
     )
 from dulwich.pack import (
+    PackData,
     REF_DELTA,
     write_pack_objects,
     )
 from dulwich.tests import (
     TestCase,
     )
+from dulwich.tests.test_pack import (
+    FilelessPackData,
+    )
 from dulwich.tests.utils import (
     make_object,
+    build_commit_graph,
     build_pack,
     )
 
@@ -70,12 +83,40 @@ class ObjectStoreTests(object):
         self.assertEqual([],
             self.store.determine_wants_all({"refs/heads/foo": "0" * 40}))
 
+    def test_determine_wants_all_depth(self):
+        c1, c2, c3 = build_commit_graph(self.store, [[1], [2, 1], [3, 2]])
+        refs = {"refs/heads/foo": c3.id}
+        self.assertEqual([], self.store.determine_wants_all(refs))
+        self.assertEqual([], self.store.determine_wants_all(refs, depth=3))
+        self.assertEqual([c3.id],
+                         self.store.determine_wants_all(refs, depth=4))
+
+    def test_get_depth(self):
+        self.assertEqual(0, self.store._get_depth("1" * 40))
+        c1, c2, c3 = build_commit_graph(self.store, [[1], [2, 1], [3, 1, 2]])
+        self.assertEqual(3, self.store._get_depth(c3.id))
+        self.assertEqual(2, self.store._get_depth(c3.id, max_depth=2))
+
     def test_iter(self):
         self.assertEqual([], list(self.store))
 
     def test_get_nonexistant(self):
         self.assertRaises(KeyError, lambda: self.store["a" * 40])
 
+    def test_iter_objects(self):
+        b1 = make_object(Blob, data="yummy data")
+        b2 = make_object(Blob, data="more yummy data")
+        b3 = make_object(Blob, data="loose data")
+        self.store.add_objects([(b1, None), (b2, None)])
+        self.store.add_object(b3)
+        self.assertEqual(set([b1, b2, b3]),
+                         set(self.store.iter_objects([b3.id, b1.id, b2.id])))
+        self.assertEqual([], list(self.store.iter_objects([])))
+        self.assertRaises(KeyError, list,
+                          self.store.iter_objects([b1.id, "a" * 40]))
+        self.assertEqual([b1], list(self.store.iter_objects(
+            ["a" * 40, b1.id], allow_missing=True)))
+
     def test_contains_nonexistant(self):
         self.assertFalse(("a" * 40) in self.store)
 
@@ -139,6 +180,112 @@ class ObjectStoreTests(object):
         self.assertEqual([TreeEntry(p, m, h) for (p, h, m) in blobs],
                           list(self.store.iter_tree_contents(tree_id)))
 
+    def test_find_merge_bases(self):
+        c1, c2, c3, c4, c5 = build_commit_graph(self.store, [[1], [2, 1],
+            [3, 1], [4, 2, 3], [5, 2]])
+        find = self.store.find_merge_bases
+        self.assertEqual([c2.id], find([c4.id, c5.id]))
+        self.assertEqual([c1.id], find([c2.id, c3.id]))
+        self.assertEqual([c1.id], find([c4.id, c1.id]))
+        self.assertEqual([c4.id], find([c4.id, c4.id]))
+        self.assertEqual([c1.id], find([c5.id, c3.id]))
+        self.assertEqual([c2.id], find([c5.id, c3.id, c4.id]))
+
+    def test_find_merge_bases_criss_cross(self):
+        c1, c2, c3, c4, c5 = build_commit_graph(self.store, [[1], [2, 1],
+            [3, 1], [4, 2, 3], [5, 3, 2]])
+        self.assertEqual(set([c2.id, c3.id]),
+                         set(self.store.find_merge_bases([c4.id, c5.id])))
+
+    def test_find_merge_bases_unrelated(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2]])
+        self.assertEqual([], self.store.find_merge_bases([c1.id, c2.id]))
+
+    def test_is_ancestor(self):
+        c1, c2, c3, c4 = build_commit_graph(self.store, [[1], [2, 1],
+            [3, 1], [4, 2]])
+        self.assertTrue(self.store.is_ancestor(c1.id, c4.id))
+        self.assertTrue(self.store.is_ancestor(c2.id, c4.id))
+        self.assertTrue(self.store.is_ancestor(c4.id, c4.id))
+        self.assertFalse(self.store.is_ancestor(c4.id, c2.id))
+        self.assertFalse(self.store.is_ancestor(c3.id, c4.id))
+
+    def test_ahead_behind(self):
+        c1, c2, c3, c4, c5 = build_commit_graph(self.store, [[1], [2, 1],
+            [3, 2], [4, 1], [5, 4, 3]])
+        self.assertEqual((2, 0), self.store.ahead_behind(c3.id, c1.id))
+        self.assertEqual((0, 2), self.store.ahead_behind(c1.id, c3.id))
+        self.assertEqual((2, 1), self.store.ahead_behind(c3.id, c4.id))
+        self.assertEqual((2, 0), self.store.ahead_behind(c5.id, c3.id))
+        self.assertEqual((0, 0), self.store.ahead_behind(c5.id, c5.id))
+
+    def test_ahead_behind_same_commit_time(self):
+        spec = [[1], [2, 1], [3, 2], [4, 1], [5, 4], [6, 5, 3], [7, 3]]
+        commits = build_commit_graph(
+            self.store, spec, attrs=dict((i, {'commit_time': 100})
+                                         for i in range(1, 8)))
+        self.assertEqual((3, 1), self.store.ahead_behind(commits[5].id,
+                                                         commits[6].id))
+
+    def _check_graph_queries(self, commits, get_generation=None):
+        ancestors = {}
+        for commit in commits:
+            ancestors[commit.id] = set([commit.id])
+            for parent in commit.parents:
+                ancestors[commit.id].update(ancestors[parent])
+        rand = random.Random(42)
+        for _ in range(30):
+            one, two = rand.choice(commits).id, rand.choice(commits).id
+            self.assertEqual(
+                two in ancestors[one],
+                self.store.is_ancestor(two, one,
+                                       get_generation=get_generation))
+            self.assertEqual(
+                (len(ancestors[one] - ancestors[two]),
+                 len(ancestors[two] - ancestors[one])),
+                self.store.ahead_behind(one, two,
+                                        get_generation=get_generation))
+            common = ancestors[one] & ancestors[two]
+            expected = set(sha for sha in common
+                           if not any(sha in ancestors[other]
+                                      for other in common if other != sha))
+            self.assertEqual(expected, set(self.store.find_merge_bases(
+                [one, two], get_generation=get_generation)))
+
+    def _random_graph(self, attrs=None):
+        rand = random.Random(1)
+        spec = [[1]]
+        for i in range(2, 41):
+            parents = set(rand.sample(range(1, i), min(i - 1, 2)))
+            if rand.random() < 0.6:
+                parents = set([max(parents)])
+            spec.append([i] + sorted(parents))
+        return build_commit_graph(self.store, spec, attrs=attrs)
+
+    def test_graph_queries(self):
+        self._check_graph_queries(self._random_graph())
+
+    def test_graph_queries_generation(self):
+        # With generation numbers, commit dates do not matter.
+        rand = random.Random(3)
+        commits = self._random_graph(
+            attrs=dict((i, {'commit_time': rand.randint(0, 1000)})
+                       for i in range(1, 41)))
+        generations = {}
+        for commit in commits:
+            generations[commit.id] = 1 + max(
+                [generations[p] for p in commit.parents] or [0])
+        self._check_graph_queries(commits, generations.__getitem__)
+
+    def test_iter_prefix(self):
+        blobs = [make_object(Blob, data=str(i)) for i in range(20)]
+        for blob in blobs:
+            self.store.add_object(blob)
+        for prefix in ['', 'a', blobs[0].id[:2], blobs[1].id[:5], blobs[2].id]:
+            self.assertEqual(
+                set(blob.id for blob in blobs if blob.id.startswith(prefix)),
+                set(self.store.iter_prefix(prefix)))
+
     def test_iter_tree_contents_include_trees(self):
         blob_a = make_object(Blob, data='a')
         blob_b = make_object(Blob, data='b')
@@ -188,11 +335,66 @@ class ObjectStoreTests(object):
         self.assertEqual((Blob.type_num, 'yummy data'),
                          self.store.get_raw(testobject.id))
 
+    def test_get_object_size(self):
+        self.store.add_object(testobject)
+        self.assertEqual(10, self.store.get_object_size(testobject.id))
+        self.assertRaises(KeyError, self.store.get_object_size, "1" * 40)
+
     def test_close(self):
         # For now, just check that close doesn't barf.
         self.store.add_object(testobject)
         self.store.close()
 
+    def test_importer(self):
+        b1 = make_object(Blob, data="yummy data")
+        b2 = make_object(Blob, data="more yummy data")
+        importer = self.store.get_importer(2)
+        importer.add_object(b1)
+        importer.add_object(b2)
+        self.assertFalse(b1.id in self.store)
+        importer.finish()
+        self.assertEqual(b1, self.store[b1.id])
+        self.assertEqual(b2, self.store[b2.id])
+
+    def test_importer_read_your_writes(self):
+        self.store.add_object(testobject)
+        importer = self.store.get_importer()
+        b1 = make_object(Blob, data="more yummy data")
+        importer.add_object(b1)
+        tree_id = commit_tree(importer, [("a", b1.id, 0o100644)])
+        self.assertTrue(b1.id in importer)
+        self.assertTrue(tree_id in importer)
+        self.assertTrue(testobject.id in importer)
+        self.assertEqual(b1, importer[b1.id])
+        self.assertEqual(testobject, importer[testobject.id])
+        self.assertEqual([("a", 0o100644, b1.id)],
+                         [tuple(e) for e in
+                          importer.iter_tree_contents(tree_id)])
+        self.assertRaises(KeyError, importer.get_raw, "1" * 40)
+        importer.finish()
+        self.assertEqual(b1, self.store[b1.id])
+        self.assertEqual(Tree.type_num, self.store[tree_id].type_num)
+
+    def test_importer_count_mismatch(self):
+        b1 = make_object(Blob, data="yummy data")
+        importer = self.store.get_importer(5)
+        importer.add_object(b1)
+        importer.add_object(b1)
+        self.assertEqual(1, len(importer))
+        importer.finish()
+        self.assertEqual(b1, self.store[b1.id])
+
+    def test_importer_empty(self):
+        importer = self.store.get_importer()
+        self.assertEqual(None, importer.finish())
+        self.assertEqual([], list(self.store.packs))
+
+    def test_importer_abort(self):
+        importer = self.store.get_importer()
+        importer.add_object(testobject)
+        importer.abort()
+        self.assertFalse(testobject.id in self.store)
+
 
 class MemoryObjectStoreTests(ObjectStoreTests, TestCase):
 
@@ -200,6 +402,28 @@ class MemoryObjectStoreTests(ObjectStoreTests, TestCase):
         TestCase.setUp(self)
         self.store = MemoryObjectStore()
 
+    def test_graph_queries_read_recent_history(self):
+        read = []
+
+        class CountingObjectStore(MemoryObjectStore):
+
+            def __getitem__(self, sha):
+                read.append(sha)
+                return MemoryObjectStore.__getitem__(self, sha)
+
+        store = CountingObjectStore()
+        spec = [[1]] + [[i, i - 1] for i in range(2, 101)]
+        spec.extend([[101, 100], [102, 101], [103, 100]])
+        commits = build_commit_graph(store, spec)
+        del read[:]
+        self.assertEqual((2, 1), store.ahead_behind(commits[101].id,
+                                                    commits[102].id))
+        self.assertEqual([commits[99].id], store.find_merge_bases(
+            [commits[101].id, commits[102].id]))
+        self.assertFalse(store.is_ancestor(commits[102].id,
+                                           commits[101].id))
+        self.assertTrue(len(read) < 20, read)
+
     def test_add_pack(self):
         o = MemoryObjectStore()
         f, commit, abort = o.add_pack()
@@ -227,6 +451,18 @@ class MemoryObjectStoreTests(ObjectStoreTests, TestCase):
                          o.get_raw(packed_blob_sha))
 
 
+    def test_add_pack_thin(self):
+        o = MemoryObjectStore()
+        blob = make_object(Blob, data='yummy data')
+        o.add_object(blob)
+        f, commit, abort = o.add_pack()
+        entries = build_pack(f, [
+          (REF_DELTA, (blob.id, 'more yummy data')),
+          ], store=o)
+        commit()
+        self.assertEqual((Blob.type_num, 'more yummy data'),
+                         o.get_raw(sha_to_hex(entries[0][3])))
+
     def test_add_thin_pack_empty(self):
         o = MemoryObjectStore()
 
@@ -255,6 +491,39 @@ class PackBasedObjectStoreTests(ObjectStoreTests):
         self.assertNotEqual([], self.store.packs)
         self.assertEqual(0, self.store.pack_loose_objects())
 
+    def test_iter_prefix_packed_and_loose(self):
+        b1 = make_object(Blob, data="yummy data")
+        b2 = make_object(Blob, data="more yummy data")
+        self.store.add_objects([(b1, None)])
+        self.store.add_object(b2)
+        self.assertEqual([b1.id], list(self.store.iter_prefix(b1.id[:4])))
+        self.assertEqual([b2.id], list(self.store.iter_prefix(b2.id[:4])))
+
+    def test_get_object_size_packed(self):
+        b1 = make_object(Blob, data="yummy data")
+        self.store.add_objects([(b1, None)])
+        self.assertEqual(10, self.store.get_object_size(b1.id))
+        self.assertEqual(10, self.store.get_object_size(b1.sha().digest()))
+
+    def test_get_raw_metrics(self):
+        b1 = make_object(Blob, data="yummy data")
+        b2 = make_object(Blob, data="more yummy data")
+        pack = self.store.add_objects([(b1, None)])
+        self.store.add_object(b2)
+        with collect_metrics() as metrics:
+            self.store.get_raw(b1.id)
+            self.store.get_raw(b2.id)
+            self.assertRaises(KeyError, self.store.get_raw, "1" * 40)
+        pack_name = os.path.basename(pack._basename)
+        self.assertEqual({
+            'object_store.pack_lookups': 3,
+            'object_store.pack_hits': 1,
+            'object_store.pack_hits.%s' % pack_name: 1,
+            'object_store.loose_hits': 1,
+            'object_store.misses': 1,
+            }, dict((k, v) for (k, v) in metrics.counters.items()
+                    if k.startswith('object_store.')))
+
 
 class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
 
@@ -268,6 +537,25 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
         TestCase.tearDown(self)
         PackBasedObjectStoreTests.tearDown(self)
 
+    def test_get_raw_not_from_promisor(self):
+        store = self.store
+
+        class Promisor(object):
+
+            def __init__(self):
+                self.fetched = []
+
+            def fetch(self, shas):
+                self.fetched.extend(shas)
+                store.add_objects([(testobject, None)])
+
+        store.promisor = Promisor()
+        self.assertRaises(KeyError, store.get_raw, testobject.id)
+        self.assertFalse(testobject.id in store)
+        self.assertEqual([], list(store.iter_objects([testobject.id],
+                                                     allow_missing=True)))
+        self.assertEqual([], store.promisor.fetched)
+
     def test_alternates(self):
         alternate_dir = tempfile.mkdtemp()
         self.addCleanup(shutil.rmtree, alternate_dir)
@@ -279,6 +567,97 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
         store.add_alternate_path(alternate_dir)
         self.assertIn(b2.id, store)
         self.assertEqual(b2, store[b2.id])
+        self.assertEqual([b2.id], list(store.iter_prefix(b2.id[:6])))
+
+    def test_iter_objects_alternates(self):
+        alternate_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, alternate_dir)
+        alternate_store = DiskObjectStore.init(alternate_dir)
+        b1 = make_object(Blob, data="yummy data")
+        alternate_store.add_objects([(b1, None)])
+        b2 = make_object(Blob, data="more yummy data")
+        self.store.add_object(b2)
+        self.store.add_alternate_path(alternate_dir)
+        self.assertEqual([b2, b1],
+                         list(self.store.iter_objects([b1.id, b2.id])))
+
+    def test_iter_objects_fileless_pack(self):
+        b1 = make_object(Blob, data="yummy data")
+        b2 = make_object(Blob, data="more yummy data")
+        self.store.add_objects([(b1, None), (b2, None)])
+        pack = self.store.packs[0]
+        pack._data = FilelessPackData(pack._data_path)
+        objects = ObjectStoreIterator(self.store,
+                                      iter([(b2.id, None), (b1.id, None)]))
+        self.assertEqual([(b2, None), (b1, None)], list(objects))
+
+    def test_iter_objects_from_promisor(self):
+        store = self.store
+        b1 = make_object(Blob, data="promised data")
+
+        class Promisor(object):
+
+            def __init__(self):
+                self.fetched = []
+
+            def fetch(self, shas):
+                self.fetched.append(list(shas))
+                store.add_objects([(testobject, None), (b1, None)])
+
+        store.promisor = Promisor()
+        self.assertEqual(set([testobject, b1]), set(store.iter_objects(
+            [testobject.id, b1.id], fetch_missing=True)))
+        self.assertEqual([sorted([testobject.id, b1.id])],
+                         store.promisor.fetched)
+        self.assertRaises(KeyError, list, store.iter_objects(
+            [b1.id, 'a' * 40], fetch_missing=True))
+        self.assertEqual(['a' * 40], store.promisor.fetched[-1])
+
+    def test_iter_objects_promisor_unreachable(self):
+        class Promisor(object):
+
+            def fetch(self, shas):
+                raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+
+        self.store.promisor = Promisor()
+        self.assertRaises(KeyError, list, self.store.iter_objects(
+            [testobject.id], fetch_missing=True))
+        self.assertEqual([], list(self.store.iter_objects(
+            [testobject.id], allow_missing=True, fetch_missing=True)))
+
+    def test_copy_from(self):
+        alternate_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, alternate_dir)
+        alternate_store = DiskObjectStore(alternate_dir)
+        b1 = make_object(Blob, data="yummy data")
+        alternate_store.add_object(b1)
+        b2 = make_object(Blob, data="packed data")
+        b3 = make_object(Blob, data="loose data")
+        self.store.add_alternate_path(alternate_dir)
+        pack = self.store.add_objects([(b2, None)])
+        pack.keep('kept')
+        pack.mark_promisor()
+        self.store.add_object(b3)
+        target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_dir)
+        target = DiskObjectStore.init(os.path.join(target_dir, 'objects'))
+        target.copy_from(self.store)
+        self.assertEqual([alternate_dir], target._read_alternate_paths())
+        target_basename = os.path.join(target.pack_dir,
+                                       os.path.basename(pack._basename))
+        with open(target_basename + '.keep', 'r') as f:
+            self.assertEqual('kept\n', f.read())
+        self.assertTrue(os.path.exists(target_basename + '.promisor'))
+        self.assertEqual(set([b1.id, b2.id, b3.id]), set(target))
+        self.assertEqual(b2, target[b2.id])
+        self.assertEqual(1, len(target.packs))
+        if getattr(os, 'link', None) is not None:
+            self.assertEqual(
+                os.stat(pack._basename + '.pack').st_ino,
+                os.stat(target.packs[0]._basename + '.pack').st_ino)
+        # Copying again does not fail on the existing objects
+        target.copy_from(self.store)
+        self.assertEqual(1, len(DiskObjectStore(target.path).packs))
 
     def test_add_alternate_path(self):
         store = DiskObjectStore(self.store_dir)
@@ -303,6 +682,20 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
         self.assertIn(b2.id, store)
         self.assertEqual(b2, store[b2.id])
 
+    def test_importer_writes_pack(self):
+        b1 = make_object(Blob, data="yummy data")
+        b2 = make_object(Blob, data="more yummy data")
+        importer = self.store.get_importer()
+        importer.add_objects([(b1, None), (b2, None)])
+        pack = importer.finish()
+        pack.check()
+        self.assertEqual(sorted([b1.id, b2.id]), sorted(pack))
+        self.assertEqual([pack.name()], [p.name() for p in self.store.packs])
+        self.assertEqual([], list(self.store._iter_loose_objects()))
+        self.assertEqual([],
+            [f for f in os.listdir(self.store.pack_dir)
+             if not f.startswith("pack-")])
+
     def test_pack_dir(self):
         o = DiskObjectStore(self.store_dir)
         self.assertEqual(os.path.join(self.store_dir, "pack"), o.pack_dir)
@@ -341,6 +734,25 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
         finally:
             o.close()
 
+    def test_add_pack_thin(self):
+        blob = make_object(Blob, data='yummy data')
+        self.store.add_object(blob)
+        f, commit, abort = self.store.add_pack()
+        try:
+            entries = build_pack(f, [
+              (REF_DELTA, (blob.id, 'more yummy data')),
+              ], store=self.store)
+        except:
+            abort()
+            raise
+        pack = commit()
+        packed_blob_sha = sha_to_hex(entries[0][3])
+        pack.check_length_and_checksum()
+        self.assertEqual(sorted([blob.id, packed_blob_sha]), list(pack))
+        self.assertEqual((Blob.type_num, 'more yummy data'),
+                         self.store.get_raw(packed_blob_sha))
+        self.assertEqual(15, self.store.get_object_size(packed_blob_sha))
+
     def test_add_thin_pack_empty(self):
         o = DiskObjectStore(self.store_dir)
 
@@ -393,13 +805,70 @@ class TreeLookupPathTests(TestCase):
 
 # TODO: MissingObjectFinderTests
 
+class ThinPackBaseFinderTests(TestCase):
+
+    def setUp(self):
+        super(ThinPackBaseFinderTests, self).setUp()
+        self.store = MemoryObjectStore()
+        self.old_blob = make_object(Blob, data="old contents\n")
+        self.new_blob = make_object(Blob, data="new contents\n")
+        self.other_blob = make_object(Blob, data="other\n")
+        self.commits = build_commit_graph(self.store, [[1], [2, 1]], trees={
+            1: [('a/b', self.old_blob), ('c', self.other_blob)],
+            2: [('a/b', self.new_blob), ('c', self.other_blob)]})
+        self.finder = ThinPackBaseFinder(self.store, [self.commits[0].id])
+
+    def test_blob(self):
+        self.assertEqual(
+            (self.old_blob.sha().digest(), self.old_blob.as_raw_string()),
+            self.finder(self.new_blob, 'a/b'))
+
+    def test_tree(self):
+        old_tree = self.store[self.store[self.commits[0].tree]['a'][1]]
+        new_tree = self.store[self.store[self.commits[1].tree]['a'][1]]
+        self.assertEqual(
+            (old_tree.sha().digest(), old_tree.as_raw_string()),
+            self.finder(new_tree, 'a'))
+
+    def test_unchanged(self):
+        self.assertEqual(None, self.finder(self.other_blob, 'c'))
+
+    def test_missing_path(self):
+        self.assertEqual(None, self.finder(self.new_blob, 'd'))
+        self.assertEqual(None, self.finder(self.new_blob, 'c/d'))
+
+    def test_no_path(self):
+        self.assertEqual(None, self.finder(self.commits[1], None))
+
+    def test_thin_pack(self):
+        objects = self.store.generate_pack_contents(
+            [self.commits[0].id], [self.commits[1].id])
+        f = BytesIO()
+        entries, sha = write_pack_objects(f, objects,
+                                          get_external_base=self.finder)
+        self.assertTrue(any(
+            type_num == REF_DELTA for (offset, type_num, data, crc32)
+            in PackData.from_file(BytesIO(f.getvalue()),
+                                  len(f.getvalue())).iterobjects()))
+        target = MemoryObjectStore()
+        target.add_object(self.commits[0])
+        target.add_object(self.store[self.commits[0].tree])
+        for entry in self.store.iter_tree_contents(self.commits[0].tree,
+                                                   include_trees=True):
+            target.add_object(self.store[entry.sha])
+        target.add_thin_pack(BytesIO(f.getvalue()).read, None)
+        self.assertEqual(self.new_blob, target[self.new_blob.id])
+
+
 class ObjectStoreGraphWalkerTests(TestCase):
 
-    def get_walker(self, heads, parent_map):
+    def get_walker(self, heads, parent_map, shallow=None):
         new_parent_map = dict([
             (k * 40, [(p * 40) for p in ps]) for (k, ps) in parent_map.items()])
+        if shallow is not None:
+            shallow = [x * 40 for x in shallow]
         return ObjectStoreGraphWalker([x * 40 for x in heads],
-            new_parent_map.__getitem__)
+            new_parent_map.__getitem__, shallow=shallow)
 
     def test_ack_invalid_value(self):
         gw = self.get_walker([], {})
@@ -434,6 +903,21 @@ class ObjectStoreGraphWalkerTests(TestCase):
         gw.ack("a" * 40)
         self.assertIs(None, next(gw))
 
+    def test_shallow(self):
+        # The parents of "b" are not present, so must not be looked up
+        gw = self.get_walker(["a"], {"a": ["b"]}, shallow=["b"])
+        self.assertEqual("a" * 40, next(gw))
+        self.assertEqual("b" * 40, next(gw))
+        self.assertIs(None, next(gw))
+
+    def test_update_shallow(self):
+        gw = self.get_walker(["a"], {"a": ["b"]}, shallow=["b"])
+        gw.update_shallow(set(["a" * 40]), set(["b" * 40]))
+        self.assertEqual(set(["a" * 40]), gw.shallow)
+        self.assertEqual(set(["b" * 40]), gw.unshallow)
+        self.assertEqual("a" * 40, next(gw))
+        self.assertIs(None, next(gw))
+
     def test_only_once(self):
         # a  b
         # |  |
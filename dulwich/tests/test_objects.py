@@ -531,6 +531,50 @@ class CommitParseTests(ShaFileCheckTests):
             else:
                 self.assertCheckFails(Commit, text)
 
+    def test_lazy_fields(self):
+        text = self.make_commit_text(encoding='UTF-8')
+        c = ShaFile.from_raw_string(Commit.type_num, text, lazy=True)
+        self.assertEqual(['ab64bbdcc51b170d21588e5c5d391ee5c0c96dfd',
+                          '4cffe90e0a41ad3f5190079d7c8f036bde29cbe6'],
+                         c.parents)
+        self.assertEqual('d80c186a03f423a81b39df39dc87fd269736ca86', c.tree)
+        self.assertEqual(1174773719, c.commit_time)
+        self.assertEqual(0, c.commit_timezone)
+        self.assertEqual('James Westby <jw+debian@jameswestby.net>', c.author)
+        # None of the above required parsing the whole commit
+        self.assertTrue(c._needs_parsing)
+        self.assertEqual(text, c.as_raw_string())
+        self.assertEqual(Commit.from_string(text).id, c.id)
+        self.assertTrue(c._needs_parsing)
+        self.assertEqual('UTF-8', c.encoding)
+        self.assertFalse(c._needs_parsing)
+        self.assertEqual('Merge ../b\n', c.message)
+
+    def test_lazy_modify(self):
+        text = self.make_commit_text()
+        c = ShaFile.from_raw_string(Commit.type_num, text, lazy=True)
+        self.assertEqual(2, len(c.parents))
+        c.parents = [a_sha]
+        self.assertEqual([a_sha], c.parents)
+        self.assertEqual('Merge ../b\n', c.message)
+        self.assertEqual(Commit.from_string(c.as_raw_string()).id, c.id)
+        self.assertNotEqual(Commit.from_string(text).id, c.id)
+
+    def test_lazy_unusual_order(self):
+        lines = self.make_commit_lines(parents=[a_sha])
+        lines[0], lines[1] = lines[1], lines[0]
+        c = ShaFile.from_raw_string(Commit.type_num, '\n'.join(lines),
+                                    lazy=True)
+        self.assertEqual([a_sha], c.parents)
+        self.assertEqual('d80c186a03f423a81b39df39dc87fd269736ca86', c.tree)
+        self.assertFalse(c._needs_parsing)
+
+    def test_lazy_malformed(self):
+        text = self.make_commit_text(author='bogus')
+        c = ShaFile.from_raw_string(Commit.type_num, text, lazy=True)
+        self.assertEqual('d80c186a03f423a81b39df39dc87fd269736ca86', c.tree)
+        self.assertRaises(ValueError, getattr, c, 'author')
+
 
 _TREE_ITEMS = {
   'a.c': (0o100755, 'd80c186a03f423a81b39df39dc87fd269736ca86'),
@@ -748,6 +792,18 @@ class TagParseTests(ShaFileCheckTests):
     def make_tag_text(self, **kwargs):
         return "\n".join(self.make_tag_lines(**kwargs))
 
+    def test_lazy_fields(self):
+        text = self.make_tag_text()
+        x = ShaFile.from_raw_string(Tag.type_num, text, lazy=True)
+        self.assertEqual(
+            (Commit, "a38d6181ff27824c79fc7df825164a212eff6a3f"), x.object)
+        self.assertEqual("v2.6.22-rc7", x.name)
+        self.assertTrue(x._needs_parsing)
+        self.assertEqual(
+            "Linus Torvalds <torvalds@woody.linux-foundation.org>", x.tagger)
+        self.assertFalse(x._needs_parsing)
+        self.assertEqual(text, x.as_raw_string())
+
     def test_parse(self):
         x = Tag()
         x.set_raw_string(self.make_tag_text())
@@ -22,12 +22,18 @@
 # TODO: Round-trip parse-serialize-parse and serialize-parse-serialize tests.
 
 
+from dulwich.errors import (
+    AmbiguousShortId,
+    )
 from dulwich.objects import (
     Blob,
+    Tag,
     )
 from dulwich.objectspec import (
+    parse_commit,
     parse_object,
     parse_commit_range,
+    parse_short_sha,
     )
 from dulwich.repo import MemoryRepo
 from dulwich.tests import (
@@ -35,6 +41,7 @@ from dulwich.tests import (
     )
 from dulwich.tests.utils import (
     build_commit_graph,
+    make_object,
     )
 
 
@@ -51,6 +58,102 @@ class ParseObjectTests(TestCase):
         r.object_store.add_object(b)
         self.assertEqual(b, parse_object(r, b.id))
 
+    def test_blob_by_short_sha(self):
+        r = MemoryRepo()
+        b = Blob.from_string("Blah")
+        r.object_store.add_object(b)
+        self.assertEqual(b, parse_object(r, b.id[:7]))
+        self.assertEqual(b, parse_object(r, b.id[:7].upper()))
+        self.assertRaises(KeyError, parse_object, r, b.id[:3])
+        self.assertRaises(KeyError, parse_object, r, "1234567")
+
+
+class ParseShortShaTests(TestCase):
+
+    def test_unique(self):
+        r = MemoryRepo()
+        b = Blob.from_string("Blah")
+        r.object_store.add_object(b)
+        self.assertEqual(b.id, parse_short_sha(r.object_store, b.id[:4]))
+        self.assertRaises(KeyError, parse_short_sha, r.object_store, "abcd")
+
+    def test_ambiguous(self):
+        r = MemoryRepo()
+        blobs = [Blob.from_string(str(i)) for i in range(20)]
+        for blob in blobs:
+            r.object_store.add_object(blob)
+        first = [blob.id[0] for blob in blobs]
+        prefix = [c for c in first if first.count(c) > 1][0]
+        with self.assertRaises(AmbiguousShortId) as cm:
+            parse_short_sha(r.object_store, prefix)
+        self.assertEqual(prefix, cm.exception.prefix)
+        self.assertEqual(2, len(cm.exception.options))
+
+
+class ParseRevisionTests(TestCase):
+    """Test revision expressions in parse_object."""
+
+    def setUp(self):
+        super(ParseRevisionTests, self).setUp()
+        self.repo = MemoryRepo()
+        self.c1, self.c2, self.c3 = build_commit_graph(
+            self.repo.object_store, [[1], [2, 1], [3, 2, 1]])
+        self.tag = make_object(Tag, name="v1", object=(type(self.c3),
+                               self.c3.id), tag_time=0, tag_timezone=0,
+                               tagger="Foo <foo@example.com>",
+                               message="Tag\n")
+        self.repo.object_store.add_object(self.tag)
+        self.repo.refs["refs/heads/master"] = self.c3.id
+        self.repo.refs["refs/tags/v1"] = self.tag.id
+        self.repo.refs.set_symbolic_ref("HEAD", "refs/heads/master")
+
+    def assertParses(self, expected, objectish):
+        self.assertEqual(expected.id, parse_object(self.repo, objectish).id)
+
+    def test_ref_names(self):
+        self.assertParses(self.c3, "master")
+        self.assertParses(self.c3, "heads/master")
+        self.assertParses(self.c3, "refs/heads/master")
+        self.assertParses(self.c3, "HEAD")
+        self.assertParses(self.tag, "v1")
+
+    def test_parents(self):
+        self.assertParses(self.c3, "master^0")
+        self.assertParses(self.c2, "master^")
+        self.assertParses(self.c1, "master^2")
+        self.assertParses(self.c1, "master^^")
+        self.assertParses(self.c1, "HEAD^1^1")
+        self.assertRaises(KeyError, parse_object, self.repo, "master^3")
+
+    def test_ancestors(self):
+        self.assertParses(self.c2, "master~")
+        self.assertParses(self.c1, "master~2")
+        self.assertParses(self.c1, self.c3.id[:8] + "~1^")
+        self.assertRaises(KeyError, parse_object, self.repo, "master~3")
+
+    def test_peel(self):
+        self.assertParses(self.c3, "v1^{}")
+        self.assertParses(self.c3, "v1^{commit}")
+        self.assertParses(self.tag, "v1^{tag}")
+        self.assertParses(self.tag, "v1^{object}")
+        self.assertParses(self.c2, "v1~1")
+        self.assertEqual(self.c3.tree,
+                         parse_object(self.repo, "v1^{tree}").id)
+        self.assertEqual(self.c1.tree,
+                         parse_object(self.repo, "master~2^{tree}").id)
+        self.assertRaises(ValueError, parse_object, self.repo, "v1^{blob}")
+        self.assertRaises(ValueError, parse_object, self.repo, "v1^{foo}")
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, parse_object, self.repo, "master^x")
+        self.assertRaises(ValueError, parse_object, self.repo,
+                          "master^{tree}^")
+        self.assertRaises(KeyError, parse_object, self.repo, "^master")
+
+    def test_parse_commit(self):
+        self.assertEqual(self.c3, parse_commit(self.repo, "v1"))
+        self.assertRaises(ValueError, parse_commit, self.repo, "v1^{tree}")
+
 
 class ParseCommitRangeTests(TestCase):
     """Test parse_commit_range."""
@@ -64,3 +167,30 @@ class ParseCommitRangeTests(TestCase):
         c1, c2, c3 = build_commit_graph(r.object_store, [[1], [2, 1],
             [3, 1, 2]])
         self.assertEqual([c1], list(parse_commit_range(r, c1.id)))
+
+    def test_range(self):
+        r = MemoryRepo()
+        c1, c2, c3, c4 = build_commit_graph(r.object_store, [[1], [2, 1],
+            [3, 1], [4, 2, 3]])
+        r.refs["HEAD"] = c4.id
+        self.assertEqual([c4, c3, c2],
+                         list(parse_commit_range(r, c1.id + ".." + c4.id)))
+        self.assertEqual([c4, c2],
+                         list(parse_commit_range(r, c3.id[:7] + "..")))
+        self.assertEqual([], list(parse_commit_range(r, "HEAD..HEAD^")))
+        self.assertEqual([c3, c2],
+                         list(parse_commit_range(r, "HEAD^1...HEAD^2")))
+        self.assertEqual([c4, c3],
+                         list(parse_commit_range(r, "HEAD^...HEAD")))
+        self.assertRaises(KeyError, parse_commit_range, r,
+                          "HEAD..thisdoesnotexist")
+
+    def test_symmetric_range_shallow(self):
+        r = MemoryRepo()
+        c1, c2, c3 = build_commit_graph(r.object_store, [[1], [2, 1],
+            [3, 1]])
+        # A depth=1 clone of c2 and c3 does not have their parent c1.
+        del r.object_store[c1.id]
+        r.update_shallow([c2.id, c3.id], None)
+        self.assertEqual([c3, c2],
+                         list(parse_commit_range(r, c2.id + "..." + c3.id)))
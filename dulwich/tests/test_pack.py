@@ -24,6 +24,7 @@ from io import BytesIO
 from hashlib import sha1
 import os
 import shutil
+import sys
 import tempfile
 import zlib
 
@@ -35,6 +36,7 @@ from dulwich.file import (
     )
 from dulwich.object_store import (
     MemoryObjectStore,
+    ObjectStoreIterator,
     )
 from dulwich.objects import (
     hex_to_sha,
@@ -43,15 +45,21 @@ from dulwich.objects import (
     Tree,
     Blob,
     )
+from dulwich.metrics import (
+    collect_metrics,
+    )
+from dulwich import pack as pack_module
 from dulwich.pack import (
     OFS_DELTA,
     REF_DELTA,
     MemoryPackIndex,
     Pack,
     PackData,
+    PackInflater,
     apply_delta,
     create_delta,
     deltify_pack_objects,
+    deltify_thin_pack_objects,
     load_pack_index,
     UnpackedObject,
     read_zlib_chunks,
@@ -59,6 +67,7 @@ from dulwich.pack import (
     write_pack_index_v1,
     write_pack_index_v2,
     write_pack_object,
+    write_pack_objects,
     write_pack,
     unpack_object,
     compute_file_sha,
@@ -82,6 +91,27 @@ tree_sha = 'b2a2766a2879c209ab1176e7e778b81ae422eeaa'
 commit_sha = 'f18faa16531ac570a3fdc8c7ca16682548dafd12'
 
 
+class FilelessPackData(PackData):
+    """PackData that has no local file, like SwiftPackData."""
+
+    def __init__(self, filename):
+        super(FilelessPackData, self).__init__(filename)
+        self._reader = self._file
+        del self._file
+
+    def get_object_at(self, offset):
+        self._reader.seek(offset)
+        unpacked, _ = unpack_object(self._reader.read)
+        return (unpacked.pack_type_num, unpacked._obj())
+
+    def get_stored_checksum(self):
+        self._reader.seek(-20, os.SEEK_END)
+        return self._reader.read(20)
+
+    def close(self):
+        self._reader.close()
+
+
 class PackTests(TestCase):
     """Base class for testing packs"""
 
@@ -122,6 +152,15 @@ class PackIndexTests(PackTests):
         self.assertEqual(p.object_index(tree_sha), 138)
         self.assertEqual(p.object_index(commit_sha), 12)
 
+    def test_iter_prefix(self):
+        p = self.get_pack_index(pack1_sha)
+        self.assertEqual([tree_sha], list(p.iter_prefix('b2a27')))
+        self.assertEqual([commit_sha], list(p.iter_prefix(commit_sha)))
+        self.assertEqual([a_sha], list(p.iter_prefix('6')))
+        self.assertEqual([], list(p.iter_prefix('c')))
+        self.assertEqual([a_sha, tree_sha, commit_sha],
+                         list(p.iter_prefix('')))
+
     def test_index_len(self):
         p = self.get_pack_index(pack1_sha)
         self.assertEqual(3, len(p))
@@ -198,6 +237,38 @@ class TestPackData(PackTests):
         path = os.path.join(self.datadir, 'pack-%s.pack' % pack1_sha)
         PackData.from_file(open(path), os.path.getsize(path))
 
+    def test_resolve_object_metrics(self):
+        f = BytesIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'blob'),
+          (OFS_DELTA, (0, 'blob1')),
+          (OFS_DELTA, (1, 'blob12')),
+          ])
+        data = PackData.from_file(f, len(f.getvalue()))
+        offset = entries[2][0]
+        with collect_metrics() as metrics:
+            type_num, obj = data.get_object_at(offset)
+            type_num, chunks = data.resolve_object(offset, type_num, obj)
+            self.assertEqual('blob12', ''.join(chunks))
+            data.get_object_at(offset)
+        self.assertEqual([1, 2, 2],
+                         metrics.distributions['pack.delta_chain_length'])
+        self.assertEqual(1, metrics.counters['pack.offset_cache_hits'])
+        self.assertEqual(3, metrics.counters['pack.offset_cache_misses'])
+        self.assertEqual(0.25, metrics.hit_ratio('pack.offset_cache'))
+        self.assertEqual(3, metrics.timers['pack.inflate'][0])
+
+    def test_get_object_size_at(self):
+        f = BytesIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'blob' * 100),
+          (OFS_DELTA, (0, 'blob' * 100 + 'x' * 300)),
+          (OFS_DELTA, (1, 'y')),
+          ])
+        data = PackData.from_file(f, len(f.getvalue()))
+        self.assertEqual([400, 700, 1],
+                         [data.get_object_size_at(e[0]) for e in entries])
+
     def test_pack_len(self):
         with self.get_pack_data(pack1_sha) as p:
             self.assertEqual(3, len(p))
@@ -296,6 +367,38 @@ class TestPack(PackTests):
             expected = set([p[s] for s in [commit_sha, tree_sha, a_sha]])
             self.assertEqual(expected, set(list(p.iterobjects())))
 
+    def test_resolve_objects(self):
+        with self.get_pack(pack1_sha) as p:
+            shas = [commit_sha, tree_sha, a_sha]
+            expected = sorted([p[s] for s in shas],
+                              key=lambda obj: p.index.object_index(obj.id))
+            self.assertEqual(expected, list(p.resolve_objects(shas)))
+            self.assertEqual([p[a_sha]], list(p.resolve_objects([a_sha])))
+            self.assertRaises(KeyError, p.resolve_objects, ['1' * 40])
+
+    def test_resolve_objects_fileless(self):
+        with self.get_pack(pack1_sha) as p:
+            shas = [commit_sha, tree_sha, a_sha]
+            expected = list(p.resolve_objects(shas))
+            data = FilelessPackData(p._data_path)
+            self.addCleanup(data.close)
+            fileless = Pack.from_objects(data, p.index)
+            self.assertEqual(expected, list(fileless.resolve_objects(shas)))
+            self.assertRaises(KeyError, fileless.resolve_objects, ['1' * 40])
+
+    def test_get_object_size(self):
+        with self.get_pack(pack1_sha) as p:
+            self.assertEqual(len(p[a_sha].as_raw_string()),
+                             p.get_object_size(a_sha))
+            self.assertEqual(len(p[tree_sha].as_raw_string()),
+                             p.get_object_size(tree_sha))
+            self.assertRaises(KeyError, p.get_object_size, '1' * 40)
+            data = FilelessPackData(p._data_path)
+            self.addCleanup(data.close)
+            fileless = Pack.from_objects(data, p.index)
+            self.assertEqual(len(p[a_sha].as_raw_string()),
+                             fileless.get_object_size(a_sha))
+
     def test_pack_tuples(self):
         with self.get_pack(pack1_sha) as p:
             tuples = p.pack_tuples()
@@ -377,6 +480,17 @@ class TestPack(PackTests):
             buf = f.read()
             self.assertEqual(msg + '\n', buf)
 
+    def test_mark_promisor(self):
+        with self.get_pack(pack1_sha) as p:
+            p = self._copy_pack(p)
+
+        with p:
+            promisorfile_name = p.mark_promisor()
+
+        self.assertEqual(p._basename + '.promisor', promisorfile_name)
+        with open(promisorfile_name, 'r') as f:
+            self.assertEqual('', f.read())
+
     def test_name(self):
         with self.get_pack(pack1_sha) as p:
             self.assertEqual(pack1_sha, p.name())
@@ -511,6 +625,35 @@ class WritePackTests(TestCase):
         sha_b.update(f.getvalue()[offset:])
         self.assertEqual(sha_a.digest(), sha_b.digest())
 
+    def test_write_pack_object_comp_data(self):
+        f = BytesIO()
+        write_pack_object(f, Blob.type_num, 'blob')
+        g = BytesIO()
+        write_pack_object(g, Blob.type_num, 'blob',
+                          comp_data=zlib.compress('blob'))
+        self.assertEqual(f.getvalue(), g.getvalue())
+
+    def test_write_pack_objects_progress(self):
+        objects = [(Blob.from_string('blob %d' % i), None) for i in range(3)]
+        reports = []
+        write_pack_objects(BytesIO(), objects, deltify=True,
+                           progress=lambda *args: reports.append(args))
+        self.assertEqual([('Compressing objects', 3, 3, True),
+                          ('Writing objects', 3, 3, True)],
+                         [r for r in reports if r[3]])
+
+    def test_write_pack_objects_threads(self):
+        objects = [(Blob.from_string('blob %d' % i), None)
+                   for i in range(200)]
+        f = BytesIO()
+        entries, sha = write_pack_objects(f, objects)
+        g = BytesIO()
+        threaded_entries, threaded_sha = write_pack_objects(
+            g, objects, threads=4)
+        self.assertEqual(entries, threaded_entries)
+        self.assertEqual(sha, threaded_sha)
+        self.assertEqual(f.getvalue(), g.getvalue())
+
 
 pack_checksum = hex_to_sha('721980e866af9a5f93ad674144e1459b8ba3e7b7')
 
@@ -573,6 +716,17 @@ class BaseTestPackIndexWriting(object):
             else:
                 self.assertTrue(actual_crc is None)
 
+    def test_iter_prefix(self):
+        shas = sorted(sha1(str(i)).digest() for i in range(300))
+        idx = self.index('prefix.idx', [(sha, i, 0) for i, sha in
+                                        enumerate(shas)], pack_checksum)
+        hex_shas = [sha_to_hex(sha) for sha in shas]
+        for prefix in ['', '0', 'f', '4e', '4e6', hex_shas[0][:5],
+                       hex_shas[-1], hex_shas[150][:7], '1234567']:
+            self.assertEqual(
+                set(sha for sha in hex_shas if sha.startswith(prefix)),
+                set(idx.iter_prefix(prefix)))
+
 
 class BaseTestFilePackIndexWriting(BaseTestPackIndexWriting):
 
@@ -742,6 +896,140 @@ class DeltifyTests(TestCase):
             ],
             list(deltify_pack_objects([(b1, ""), (b2, "")])))
 
+    def test_processes(self):
+        self.addCleanup(setattr, pack_module, 'DELTIFY_CHUNK_SIZE',
+                        pack_module.DELTIFY_CHUNK_SIZE)
+        pack_module.DELTIFY_CHUNK_SIZE = 7
+        objects = [(Blob.from_string("line\n" * i), "path%d" % (i // 5))
+                   for i in range(1, 40)]
+        serial = list(deltify_pack_objects(objects))
+        self.assertTrue([r for r in serial if r[2] is not None])
+        self.assertEqual(serial,
+            list(deltify_pack_objects(objects, processes=3)))
+
+    def make_similar_blobs(self, count):
+        return [(Blob.from_string("line\n" * (100 + i)), "path")
+                for i in range(count)]
+
+    def chain_depths(self, records):
+        depths = {}
+        for type_num, sha, delta_base, content in records:
+            if delta_base is None:
+                depths[sha] = 0
+            else:
+                depths[sha] = depths[delta_base] + 1
+        return depths
+
+    def test_depth(self):
+        objects = self.make_similar_blobs(20)
+        depths = self.chain_depths(deltify_pack_objects(objects))
+        self.assertEqual(19, max(depths.values()))
+        depths = self.chain_depths(deltify_pack_objects(objects, depth=3))
+        self.assertEqual(3, max(depths.values()))
+
+    def test_depth_across_chunks(self):
+        self.addCleanup(setattr, pack_module, 'DELTIFY_CHUNK_SIZE',
+                        pack_module.DELTIFY_CHUNK_SIZE)
+        pack_module.DELTIFY_CHUNK_SIZE = 4
+        objects = self.make_similar_blobs(20)
+        records = list(deltify_pack_objects(objects, depth=3))
+        self.assertEqual(3, max(self.chain_depths(records).values()))
+        self.assertEqual(records,
+            list(deltify_pack_objects(objects, depth=3, processes=2)))
+
+    def test_window_memory(self):
+        objects = self.make_similar_blobs(5)
+        records = list(deltify_pack_objects(objects, window_memory=1))
+        # Only the previous object fits in the window
+        self.assertEqual(
+            [None] + [r[1] for r in records[:-1]],
+            [r[2] for r in records])
+
+    def test_get_raw(self):
+        objects = self.make_similar_blobs(5)
+        by_sha = dict((obj.sha().digest(), obj) for (obj, path) in objects)
+        retrieved = []
+        def get_raw(sha):
+            retrieved.append(sha)
+            return by_sha[sha].type_num, by_sha[sha].as_raw_string()
+        self.assertEqual(list(deltify_pack_objects(objects)),
+            list(deltify_pack_objects(objects, get_raw=get_raw)))
+        self.assertEqual(sorted(by_sha), sorted(retrieved))
+
+    def test_write_pack_objects_get_raw(self):
+        objects = self.make_similar_blobs(5)
+        store = MemoryObjectStore()
+        store.add_objects(objects)
+        expected = BytesIO()
+        write_pack_objects(expected, objects, deltify=True)
+        f = BytesIO()
+        write_pack_objects(f, ObjectStoreIterator(
+            store, iter([(obj.id, path) for (obj, path) in objects])),
+            deltify=True, get_raw=store.get_raw)
+        self.assertEqual(expected.getvalue(), f.getvalue())
+
+
+class DeltifyThinTests(TestCase):
+
+    def setUp(self):
+        super(DeltifyThinTests, self).setUp()
+        self.base = Blob.from_string("line\n" * 100)
+        self.bases = {"path": self.base}
+
+    def get_external_base(self, obj, path):
+        base = self.bases.get(path)
+        if base is None:
+            return None
+        return base.sha().digest(), base.as_raw_string()
+
+    def test_external_base(self):
+        b = Blob.from_string("line\n" * 101)
+        delta = create_delta(self.base.as_raw_string(), b.as_raw_string())
+        self.assertEqual(
+            [(b.type_num, b.sha().digest(), self.base.sha().digest(), delta)],
+            list(deltify_thin_pack_objects([(b, "path")],
+                                           self.get_external_base)))
+
+    def test_no_base(self):
+        b = Blob.from_string("line\n" * 101)
+        self.assertEqual(
+            [(b.type_num, b.sha().digest(), None, b.as_raw_string())],
+            list(deltify_thin_pack_objects([(b, "other")],
+                                           self.get_external_base)))
+
+    def test_delta_too_large(self):
+        b = Blob.from_string("foo")
+        self.assertEqual(
+            [(b.type_num, b.sha().digest(), None, b.as_raw_string())],
+            list(deltify_thin_pack_objects([(b, "path")],
+                                           self.get_external_base)))
+
+    def test_write_pack_objects(self):
+        b = Blob.from_string("line\n" * 101)
+        f = BytesIO()
+        entries, sha = write_pack_objects(f, [(b, "path")],
+            get_external_base=self.get_external_base)
+        f.seek(0)
+        pack_data = PackData.from_file(f, len(f.getvalue()))
+        [(offset, type_num, data, crc32)] = list(pack_data.iterobjects())
+        self.assertEqual(REF_DELTA, type_num)
+        self.assertEqual(self.base.sha().digest(), data[0])
+
+
+class WritePackObjectsMetricsTests(TestCase):
+
+    def test_phases(self):
+        blobs = [make_object(Blob, data='blob%d' % i * 10) for i in range(5)]
+        with collect_metrics() as metrics:
+            write_pack_objects(BytesIO(), [(b, None) for b in blobs],
+                               deltify=True)
+        self.assertEqual(['pack.count_objects', 'pack.find_deltas',
+                          'pack.read_objects', 'pack.write'],
+                         sorted(metrics.timers))
+        self.assertEqual(6, metrics.timers['pack.read_objects'][0])
+        count, total, self_time = metrics.timers['pack.write']
+        self.assertTrue(self_time <= total)
+
 
 class TestPackStreamReader(TestCase):
 
@@ -837,13 +1125,21 @@ class DeltaChainIteratorTests(TestCase):
         self.fetched.add(hex_sha)
         return self.store.get_raw(hex_sha)
 
-    def make_pack_iter(self, f, thin=None):
+    def make_pack_iter(self, f, thin=None, **kwargs):
         if thin is None:
             thin = bool(list(self.store))
         resolve_ext_ref = thin and self.get_raw_no_repeat or None
         data = PackData('test.pack', file=f)
         return TestPackIterator.for_pack_data(
-          data, resolve_ext_ref=resolve_ext_ref)
+          data, resolve_ext_ref=resolve_ext_ref, **kwargs)
+
+    def make_offsets_iter(self, f, entries, indexes):
+        data = PackData('test.pack', file=f)
+        offsets = dict((entry[3], entry[0]) for entry in entries)
+        return TestPackIterator.for_offsets(
+            data, [entries[i][0] for i in indexes],
+            get_offset=offsets.__getitem__,
+            resolve_ext_ref=self.get_raw_no_repeat)
 
     def assertEntriesMatch(self, expected_indexes, entries, pack_iter):
         expected = [entries[i] for i in expected_indexes]
@@ -867,6 +1163,19 @@ class DeltaChainIteratorTests(TestCase):
           ])
         self.assertEntriesMatch([0, 1, 2], entries, self.make_pack_iter(f))
 
+    def test_progress(self):
+        f = BytesIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'blob'),
+          (OFS_DELTA, (0, 'blob1')),
+          (OFS_DELTA, (0, 'blob2')),
+          ])
+        reports = []
+        pack_iter = self.make_pack_iter(
+            f, progress=lambda *args: reports.append(args))
+        self.assertEntriesMatch([0, 1, 2], entries, pack_iter)
+        self.assertEqual(('Resolving deltas', 2, 2, True), reports[-1])
+
     def test_ofs_deltas_chain(self):
         f = BytesIO()
         entries = build_pack(f, [
@@ -935,6 +1244,47 @@ class DeltaChainIteratorTests(TestCase):
         entries = build_pack(f, objects_spec)
         self.assertEntriesMatch(range(n + 1), entries, self.make_pack_iter(f))
 
+    def test_chain_deeper_than_recursion_limit(self):
+        n = sys.getrecursionlimit() + 100
+        objects_spec = [(Blob.type_num, 'blob')]
+        for i in range(n):
+            objects_spec.append((OFS_DELTA, (i, 'blob%i' % i)))
+        f = BytesIO()
+        entries = build_pack(f, objects_spec)
+        self.assertEntriesMatch(range(n + 1), entries, self.make_pack_iter(f))
+
+    def test_max_base_memory(self):
+        # Bases are dropped as soon as another one is inflated, and
+        # re-inflated from the pack when needed again.
+        objects_spec = [(Blob.type_num, 'blob')]
+        for i in range(10):
+            objects_spec.append((OFS_DELTA, (0, 'blob%i' % i)))
+            objects_spec.append((OFS_DELTA, (len(objects_spec) - 1,
+                                             'blob%i+' % i)))
+            objects_spec.append((OFS_DELTA, (len(objects_spec) - 2,
+                                             'blob%i++' % i)))
+        f = BytesIO()
+        entries = build_pack(f, objects_spec)
+        pack_iter = self.make_pack_iter(f, max_base_memory=1)
+        self.assertEqual(sorted(entries),
+                         sorted(pack_iter._walk_all_chains()))
+        self.assertEqual(0, pack_iter._held_memory)
+        self.assertEqual(0, len(pack_iter._held_bases))
+
+    def test_max_base_memory_ext_ref(self):
+        blob, = self.store_blobs(['blob'])
+        f = BytesIO()
+        entries = build_pack(f, [
+          (REF_DELTA, (blob.id, 'blob1')),
+          (OFS_DELTA, (0, 'blob11')),
+          (REF_DELTA, (blob.id, 'blob2')),
+          ], store=self.store)
+        self.get_raw_no_repeat = lambda sha: self.store.get_raw(
+            sha_to_hex(sha))
+        pack_iter = self.make_pack_iter(f, max_base_memory=1)
+        self.assertEqual(sorted(entries),
+                         sorted(pack_iter._walk_all_chains()))
+
     def test_ext_ref(self):
         blob, = self.store_blobs(['blob'])
         f = BytesIO()
@@ -944,6 +1294,61 @@ class DeltaChainIteratorTests(TestCase):
         self.assertEntriesMatch([0], entries, pack_iter)
         self.assertEqual([hex_to_sha(blob.id)], pack_iter.ext_refs())
 
+    def test_for_offsets(self):
+        f = BytesIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'blob'),
+          (OFS_DELTA, (0, 'blob1')),
+          (OFS_DELTA, (1, 'blob2')),
+          (OFS_DELTA, (0, 'blob3')),
+          (Blob.type_num, 'other'),
+          ])
+        pack_iter = self.make_offsets_iter(f, entries, [3, 2])
+        self.assertEntriesMatch([2, 3], entries, pack_iter)
+        self.assertEqual(set(entries[i][0] for i in [0, 1, 2, 3]),
+                         pack_iter._unpacked_offsets)
+
+    def test_for_offsets_ref_delta(self):
+        f = BytesIO()
+        entries = build_pack(f, [
+          (REF_DELTA, (1, 'blob1')),
+          (Blob.type_num, 'blob'),
+          (REF_DELTA, (1, 'blob2')),
+          ])
+        pack_iter = self.make_offsets_iter(f, entries, [2, 0])
+        self.assertEntriesMatch([0, 2], entries, pack_iter)
+        self.assertEqual([], pack_iter.ext_refs())
+
+    def test_for_offsets_ext_ref(self):
+        blob, = self.store_blobs(['blob'])
+        f = BytesIO()
+        entries = build_pack(f, [
+          (REF_DELTA, (blob.id, 'blob1')),
+          (Blob.type_num, 'other'),
+          ], store=self.store)
+        pack_iter = self.make_offsets_iter(f, entries, [0])
+        self.assertEntriesMatch([0], entries, pack_iter)
+        self.assertEqual([hex_to_sha(blob.id)], pack_iter.ext_refs())
+
+    def test_for_offsets_cached_base(self):
+        f = BytesIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'blob'),
+          (OFS_DELTA, (0, 'blob1')),
+          (OFS_DELTA, (1, 'blob2')),
+          ])
+        data = PackData('test.pack', file=f)
+        data._offset_cache[entries[1][0]] = (Blob.type_num, ['blob1'])
+        read = []
+        get_object_header_at = data.get_object_header_at
+        def record_header(offset):
+            read.append(offset)
+            return get_object_header_at(offset)
+        data.get_object_header_at = record_header
+        pack_iter = PackInflater.for_offsets(data, [entries[2][0]])
+        self.assertEqual([entries[2][0]], read)
+        self.assertEqual(['blob2'], [obj.data for obj in pack_iter])
+
     def test_ext_ref_chain(self):
         blob, = self.store_blobs(['blob'])
         f = BytesIO()
@@ -0,0 +1,197 @@
+# test_partial_clone.py -- tests for partial_clone.py
+# Copyright (C) 2014 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for dulwich.partial_clone."""
+
+import shutil
+import tempfile
+
+from dulwich.index import (
+    commit_tree,
+    )
+from dulwich.object_store import (
+    DiskObjectStore,
+    MemoryObjectStore,
+    )
+from dulwich.objects import (
+    Blob,
+    )
+from dulwich.partial_clone import (
+    BlobLimitFilter,
+    BlobNoneFilter,
+    PromisorRemote,
+    TreeDepthFilter,
+    configure_promisor_remote,
+    parse_filter_spec,
+    )
+from dulwich.repo import (
+    MemoryRepo,
+    Repo,
+    )
+from dulwich.tests import TestCase
+from dulwich.tests.utils import make_object
+
+
+class ParseFilterSpecTests(TestCase):
+
+    def test_blob_none(self):
+        self.assertEqual(BlobNoneFilter(), parse_filter_spec("blob:none"))
+
+    def test_blob_limit(self):
+        self.assertEqual(BlobLimitFilter(100),
+                         parse_filter_spec("blob:limit=100"))
+
+    def test_blob_limit_units(self):
+        self.assertEqual(BlobLimitFilter(2048),
+                         parse_filter_spec("blob:limit=2k"))
+        self.assertEqual(BlobLimitFilter(3 * 1024 * 1024),
+                         parse_filter_spec("blob:limit=3M"))
+        self.assertEqual(BlobLimitFilter(1024 ** 3),
+                         parse_filter_spec("blob:limit=1g"))
+
+    def test_tree_depth(self):
+        self.assertEqual(TreeDepthFilter(0), parse_filter_spec("tree:0"))
+        self.assertEqual(TreeDepthFilter(2), parse_filter_spec("tree:2"))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, parse_filter_spec, "")
+        self.assertRaises(ValueError, parse_filter_spec, "blob:all")
+        self.assertRaises(ValueError, parse_filter_spec, "blob:limit=")
+        self.assertRaises(ValueError, parse_filter_spec, "blob:limit=1x")
+        self.assertRaises(ValueError, parse_filter_spec, "tree:-1")
+        self.assertRaises(ValueError, parse_filter_spec, "sparse:oid=HEAD")
+
+    def test_spec_roundtrip(self):
+        for spec in ["blob:none", "blob:limit=1024", "tree:1"]:
+            self.assertEqual(spec, parse_filter_spec(spec).spec)
+
+
+class ObjectFilterTests(TestCase):
+
+    def setUp(self):
+        super(ObjectFilterTests, self).setUp()
+        self.store = MemoryObjectStore()
+        self.blob = make_object(Blob, data="x" * 10)
+        self.store.add_object(self.blob)
+
+    def test_blob_none(self):
+        f = BlobNoneFilter()
+        self.assertFalse(f.include_blob(self.store, self.blob.id, 1))
+        self.assertTrue(f.include_tree(5))
+
+    def test_blob_limit(self):
+        self.assertTrue(
+            BlobLimitFilter(11).include_blob(self.store, self.blob.id, 1))
+        self.assertFalse(
+            BlobLimitFilter(10).include_blob(self.store, self.blob.id, 1))
+
+    def test_blob_limit_reads_header(self):
+        store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, store_dir)
+        store = DiskObjectStore.init(store_dir)
+        self.addCleanup(store.close)
+        packed = make_object(Blob, data="x" * 100000)
+        loose = make_object(Blob, data="y" * 100000)
+        store.add_objects([(packed, None)])
+        store.add_object(loose)
+
+        def fail(*args):
+            self.fail("blob contents were read")
+        store.get_raw = fail
+        store._get_loose_object = fail
+        pack = store.packs[0]
+        pack.get_raw = fail
+        pack.data.get_object_at = fail
+        f = BlobLimitFilter(1000)
+        self.assertFalse(f.include_blob(store, packed.id, 1))
+        self.assertFalse(f.include_blob(store, loose.id, 1))
+        self.assertTrue(BlobLimitFilter(100001).include_blob(
+            store, packed.id, 1))
+        self.assertTrue(BlobLimitFilter(100001).include_blob(
+            store, loose.id, 1))
+
+    def test_tree_depth(self):
+        f = TreeDepthFilter(2)
+        self.assertTrue(f.include_tree(0))
+        self.assertTrue(f.include_tree(1))
+        self.assertFalse(f.include_tree(2))
+        self.assertTrue(f.include_blob(self.store, self.blob.id, 1))
+        self.assertFalse(f.include_blob(self.store, self.blob.id, 2))
+        self.assertFalse(TreeDepthFilter(0).include_tree(0))
+
+
+class PromisorRemoteTests(TestCase):
+
+    def test_not_partial_clone(self):
+        self.assertEqual(None, PromisorRemote.from_repo(MemoryRepo()))
+
+    def test_from_repo(self):
+        repo = MemoryRepo()
+        configure_promisor_remote(repo.get_config(), "origin",
+                                  "git://example.com/repo", "blob:none")
+        remote = PromisorRemote.from_repo(repo)
+        self.assertEqual("git://example.com/repo", remote.url)
+        self.assertEqual("blob:none", remote.filter_spec)
+        self.assertIs(repo, remote.repo)
+
+    def test_configure(self):
+        repo = MemoryRepo()
+        config = repo.get_config()
+        configure_promisor_remote(config, "upstream",
+                                  "git://example.com/repo", "tree:0")
+        self.assertEqual("1",
+                         config.get(("core", ), "repositoryformatversion"))
+        self.assertEqual("upstream",
+                         config.get(("extensions", ), "partialclone"))
+        self.assertEqual("true", config.get(("remote", "upstream"), "promisor"))
+        self.assertEqual("tree:0", config.get(("remote", "upstream"),
+                                              "partialclonefilter"))
+
+    def test_fetch_nothing(self):
+        remote = PromisorRemote(MemoryRepo(), "git://example.com/repo")
+        # No connection is made
+        remote.fetch([])
+
+    def test_fetch_missing_blobs(self):
+        repo_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repo_dir)
+        repo = Repo.init(repo_dir)
+        source = MemoryObjectStore()
+        blob_a = make_object(Blob, data="a")
+        blob_b = make_object(Blob, data="b")
+        source.add_objects([(blob_a, None), (blob_b, None)])
+        root_id = commit_tree(source, [("a", blob_a.id, 0o100644),
+                                       ("dir/b", blob_b.id, 0o100644)])
+        root = source[root_id]
+        repo.object_store.add_object(root)
+        fetched = []
+
+        class RecordingPromisorRemote(PromisorRemote):
+
+            def fetch(self, shas):
+                shas = sorted(shas)
+                fetched.append(shas)
+                self.repo.object_store.add_objects(
+                    [(source[sha], None) for sha in shas])
+
+        remote = RecordingPromisorRemote(repo, "git://example.com/repo")
+        repo.object_store.promisor = remote
+        remote.fetch_missing_blobs(root_id)
+        self.assertEqual([[root["dir"][1]], sorted([blob_a.id, blob_b.id])],
+                         fetched)
@@ -21,27 +21,50 @@
 from io import BytesIO
 import os
 import shutil
+import subprocess
+import sys
 import tarfile
 import tempfile
+import zipfile
 
 from dulwich import porcelain
 from dulwich.diff_tree import tree_changes
+from dulwich.errors import NotTreeError
 from dulwich.objects import (
     Blob,
     Tag,
     Tree,
     )
+from dulwich.partial_clone import configure_promisor_remote
 from dulwich.repo import Repo
 from dulwich.tests import (
     TestCase,
     )
-from dulwich.tests.compat.utils import require_git_version
 from dulwich.tests.utils import (
     build_commit_graph,
     make_object,
     )
 
 
+class ImportTests(TestCase):
+
+    def test_lazy_imports(self):
+        # Scripts that only use local operations should not pay for loading
+        # the network and server code.
+        lazy = ['urllib2', 'SocketServer', 'wsgiref', 'tarfile', 'difflib',
+                'subprocess', 'dulwich.client', 'dulwich.server',
+                'dulwich.web', 'dulwich.patch']
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+            os.path.abspath(porcelain.__file__)))
+        output = subprocess.check_output([sys.executable, '-c',
+            'import sys, dulwich.porcelain; print(" ".join(sys.modules))'],
+            env=env)
+        loaded = set(output.split())
+        self.assertTrue('dulwich.porcelain' in loaded)
+        self.assertEqual([], [name for name in lazy if name in loaded])
+
+
 class PorcelainTestCase(TestCase):
 
     def setUp(self):
@@ -55,8 +78,6 @@ class ArchiveTests(PorcelainTestCase):
     """Tests for the archive command."""
 
     def test_simple(self):
-        # TODO(jelmer): Remove this once dulwich has its own implementation of archive.
-        require_git_version((1, 5, 0))
         c1, c2, c3 = build_commit_graph(self.repo.object_store, [[1], [2, 1], [3, 1, 2]])
         self.repo.refs["refs/heads/master"] = c3.id
         out = BytesIO()
@@ -64,10 +85,31 @@ class ArchiveTests(PorcelainTestCase):
         porcelain.archive(self.repo.path, "refs/heads/master", outstream=out,
             errstream=err)
         self.assertEqual("", err.getvalue())
+        out.seek(0)
         tf = tarfile.TarFile(fileobj=out)
         self.addCleanup(tf.close)
         self.assertEqual([], tf.getnames())
 
+    def test_zip(self):
+        blob = Blob.from_string("contents")
+        c1, = build_commit_graph(self.repo.object_store, [[1]],
+                                 trees={1: [("foo", blob)]},
+                                 attrs={1: {"commit_time": 1400000000}})
+        self.repo.refs["refs/heads/master"] = c1.id
+        out = BytesIO()
+        porcelain.archive(self.repo.path, outstream=out, format="zip",
+                          prefix="bar/")
+        zf = zipfile.ZipFile(out)
+        self.addCleanup(zf.close)
+        self.assertEqual(["bar/foo"], zf.namelist())
+        self.assertEqual("contents", zf.read("bar/foo"))
+
+    def test_not_a_tree(self):
+        blob = Blob.from_string("contents")
+        self.repo.object_store.add_object(blob)
+        self.assertRaises(NotTreeError, porcelain.archive, self.repo.path,
+                          blob.id, outstream=BytesIO())
+
 
 class UpdateServerInfoTests(PorcelainTestCase):
 
@@ -134,6 +176,105 @@ class CloneTests(PorcelainTestCase):
         self.assertTrue('f1' in os.listdir(target_path))
         self.assertTrue('f2' in os.listdir(target_path))
 
+    def test_local(self):
+        c1, c2 = build_commit_graph(self.repo.object_store, [[1], [2, 1]])
+        self.repo.refs["refs/heads/master"] = c2.id
+        target_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_path)
+        r = porcelain.clone(self.repo.path, target_path, checkout=False,
+                            outstream=BytesIO(), local=True)
+        self.assertEqual(c2.id, r.head())
+        self.assertEqual(set(self.repo.object_store), set(r.object_store))
+
+    def test_shared(self):
+        c1, c2 = build_commit_graph(self.repo.object_store, [[1], [2, 1]])
+        self.repo.refs["refs/heads/master"] = c2.id
+        target_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_path)
+        r = porcelain.clone(self.repo.path, target_path, checkout=True,
+                            outstream=BytesIO(), shared=True)
+        self.assertEqual(c2.id, r.head())
+        self.assertEqual([os.path.abspath(self.repo.object_store.path)],
+                         r.object_store._read_alternate_paths())
+        self.assertRaises(ValueError, porcelain.clone, self.repo.path,
+                          os.path.join(target_path, 'other'), shared=True,
+                          depth=1)
+
+    def test_local_file_url(self):
+        c1, = build_commit_graph(self.repo.object_store, [[1]])
+        self.repo.refs["refs/heads/master"] = c1.id
+        target_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_path)
+        r = porcelain.clone('file://' + os.path.abspath(self.repo.path),
+                            target_path, checkout=False, outstream=BytesIO(),
+                            local=True)
+        self.assertEqual(c1.id, r.head())
+
+    def test_local_remote_source(self):
+        target_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_path)
+        for source in ['git://example.com' + os.path.abspath(self.repo.path),
+                       'ssh://example.com' + os.path.abspath(self.repo.path)]:
+            for kwargs in [{'local': True}, {'shared': True}]:
+                self.assertRaises(ValueError, porcelain.clone, source,
+                                  os.path.join(target_path, 'new'),
+                                  outstream=BytesIO(), **kwargs)
+        self.assertFalse(os.path.exists(os.path.join(target_path, 'new')))
+
+    def test_local_partial_clone_source(self):
+        c1, = build_commit_graph(self.repo.object_store, [[1]])
+        self.repo.refs["refs/heads/master"] = c1.id
+        config = self.repo.get_config()
+        configure_promisor_remote(config, 'origin', 'git://example.com/repo',
+                                  'blob:none')
+        config.write_to_path()
+        target_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_path)
+        self.assertRaises(ValueError, porcelain.clone, self.repo.path,
+                          os.path.join(target_path, 'new'),
+                          outstream=BytesIO(), local=True)
+        self.assertFalse(os.path.exists(os.path.join(target_path, 'new')))
+
+    def test_partial_clone(self):
+        old_blob = make_object(Blob, data='old')
+        new_blob = make_object(Blob, data='new')
+        c1, c2 = build_commit_graph(self.repo.object_store, [[1], [2, 1]],
+            trees={1: [('f1', old_blob)], 2: [('f1', new_blob)]})
+        self.repo.refs["refs/heads/master"] = c2.id
+        config = self.repo.get_config()
+        config.set(('uploadpack', ), 'allowfilter', 'true')
+        config.set(('uploadpack', ), 'allowanysha1inwant', 'true')
+        config.write_to_path()
+        target_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_path)
+        r = porcelain.clone(self.repo.path, target_path, checkout=True,
+                            outstream=BytesIO(), filter_spec='blob:none')
+        with open(os.path.join(target_path, 'f1'), 'r') as f:
+            self.assertEqual('new', f.read())
+        self.assertFalse(old_blob.id in r.object_store)
+        r = Repo(target_path)
+        self.assertEqual(os.path.abspath(self.repo.path),
+                         r.object_store.promisor.url)
+        self.assertEqual('blob:none', r.object_store.promisor.filter_spec)
+        # Objects left out are only fetched when asked for explicitly
+        self.assertRaises(KeyError, r.__getitem__, old_blob.id)
+        self.assertEqual([old_blob], list(r.object_store.iter_objects(
+            [old_blob.id], fetch_missing=True)))
+        self.assertEqual('old', r[old_blob.id].data)
+
+    def test_shallow_clone(self):
+        c1, c2, c3 = build_commit_graph(self.repo.object_store,
+                                        [[1], [2, 1], [3, 2]])
+        self.repo.refs["refs/heads/master"] = c3.id
+        target_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_path)
+        r = porcelain.clone(self.repo.path, target_path, checkout=False,
+                            outstream=BytesIO(), depth=2)
+        self.assertEqual(set([c2.id]), r.get_shallow())
+        self.assertFalse(c1.id in r.object_store)
+        self.assertEqual([c3.id, c2.id],
+                         [e.commit.id for e in r.get_walker()])
+
     def test_bare_local_with_checkout(self):
         f1_1 = make_object(Blob, data='f1')
         commit_spec = [[1], [2, 1], [3, 1, 2]]
@@ -627,8 +768,8 @@ class ReceivePackTests(PorcelainTestCase):
         exitcode = porcelain.receive_pack(self.repo.path, BytesIO("0000"), outf)
         outlines = outf.getvalue().splitlines()
         self.assertEqual([
-            '005a9e65bdcf4a22cdd4f3700604a275cd2aaf146b23 HEAD\x00report-status '
-            'delete-refs side-band-64k',
+            '00619e65bdcf4a22cdd4f3700604a275cd2aaf146b23 HEAD\x00report-status '
+            'delete-refs side-band-64k atomic',
             '003f9e65bdcf4a22cdd4f3700604a275cd2aaf146b23 refs/heads/master',
             '0000'], outlines)
         self.assertEqual(0, exitcode)
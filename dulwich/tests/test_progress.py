@@ -0,0 +1,123 @@
+# test_progress.py -- tests for progress.py
+# Copyright (C) 2014 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for dulwich.progress."""
+
+from dulwich.progress import (
+    COUNTING_OBJECTS,
+    WRITING_OBJECTS,
+    ProgressMeter,
+    TextProgressReporter,
+    format_progress,
+    )
+from dulwich.tests import TestCase
+
+
+class FormatProgressTests(TestCase):
+
+    def test_unknown_total(self):
+        self.assertEqual("Counting objects: 12\r",
+                         format_progress(COUNTING_OBJECTS, 12, None, False))
+
+    def test_unknown_total_done(self):
+        self.assertEqual("Counting objects: 12, done.\n",
+                         format_progress(COUNTING_OBJECTS, 12, None, True))
+
+    def test_total(self):
+        self.assertEqual("Writing objects:  50% (5/10)\r",
+                         format_progress(WRITING_OBJECTS, 5, 10, False))
+
+    def test_total_done(self):
+        self.assertEqual("Writing objects: 100% (10/10), done.\n",
+                         format_progress(WRITING_OBJECTS, 10, 10, True))
+
+
+class TextProgressReporterTests(TestCase):
+
+    def test_write(self):
+        messages = []
+        reporter = TextProgressReporter(messages.append)
+        reporter(WRITING_OBJECTS, 1, 4, False)
+        self.assertEqual(["Writing objects:  25% (1/4)\r"], messages)
+
+
+class ProgressMeterTests(TestCase):
+
+    def setUp(self):
+        super(ProgressMeterTests, self).setUp()
+        self.reports = []
+        self.now = 0
+
+    def report(self, phase, current, total, done):
+        self.reports.append((phase, current, total, done))
+
+    def make_meter(self, total=None):
+        return ProgressMeter(self.report, WRITING_OBJECTS, total=total,
+                             interval=1.0, clock=lambda: self.now)
+
+    def test_percent(self):
+        meter = self.make_meter(total=1000)
+        for i in range(1, 1001):
+            meter.update(i)
+        meter.finish()
+        # Only changes of the percentage are reported
+        self.assertEqual(102, len(self.reports))
+        self.assertEqual((WRITING_OBJECTS, 1, 1000, False), self.reports[0])
+        self.assertEqual((WRITING_OBJECTS, 10, 1000, False), self.reports[1])
+        self.assertEqual((WRITING_OBJECTS, 1000, 1000, True), self.reports[-1])
+
+    def test_interval(self):
+        meter = self.make_meter()
+        meter.update(1)
+        meter.update(2)
+        self.assertEqual([], self.reports)
+        self.now = 0.5
+        meter.update(3)
+        self.assertEqual([], self.reports)
+        self.now = 1.0
+        meter.update(4)
+        self.assertEqual([(WRITING_OBJECTS, 4, None, False)], self.reports)
+        self.now = 1.5
+        meter.increment()
+        self.assertEqual(1, len(self.reports))
+        self.now = 2.5
+        meter.increment()
+        self.assertEqual((WRITING_OBJECTS, 6, None, False), self.reports[-1])
+
+    def test_interval_with_total(self):
+        meter = self.make_meter(total=1000000)
+        meter.update(1)
+        meter.update(2)
+        self.now = 1.0
+        meter.update(3)
+        self.assertEqual([(WRITING_OBJECTS, 1, 1000000, False),
+                          (WRITING_OBJECTS, 3, 1000000, False)],
+                         self.reports)
+
+    def test_finish(self):
+        meter = self.make_meter()
+        meter.update(3)
+        meter.finish()
+        self.assertEqual([(WRITING_OBJECTS, 3, None, True)], self.reports)
+
+    def test_no_reporter(self):
+        meter = ProgressMeter(None, WRITING_OBJECTS)
+        meter.update(3)
+        meter.finish()
+        self.assertEqual(3, meter.current)
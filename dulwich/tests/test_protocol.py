@@ -24,6 +24,9 @@ from io import BytesIO
 from dulwich.errors import (
     HangupException,
     )
+from dulwich.metrics import (
+    collect_metrics,
+    )
 from dulwich.protocol import (
     PktLineParser,
     Protocol,
@@ -41,6 +44,21 @@ from dulwich.tests import TestCase
 
 class BaseProtocolTests(object):
 
+    def test_metrics(self):
+        self.rin.write('0008cmd 0000')
+        self.rin.seek(0)
+        with collect_metrics() as metrics:
+            self.proto.write_pkt_line('bla')
+            self.proto.write_pkt_lines('0000')
+            self.proto.read_pkt_line()
+            self.proto.read_pkt_line()
+        self.assertEqual({
+            'protocol.pkt_lines_written': 1,
+            'protocol.bytes_written': 11,
+            'protocol.pkt_lines_read': 2,
+            'protocol.bytes_read': 12,
+            }, metrics.counters)
+
     def test_write_pkt_line_none(self):
         self.proto.write_pkt_line(None)
         self.assertEqual(self.rout.getvalue(), '0000')
@@ -49,6 +67,10 @@ class BaseProtocolTests(object):
         self.proto.write_pkt_line('bla')
         self.assertEqual(self.rout.getvalue(), '0007bla')
 
+    def test_write_pkt_lines(self):
+        self.proto.write_pkt_lines('0007bla0000')
+        self.assertEqual(self.rout.getvalue(), '0007bla0000')
+
     def test_read_pkt_line(self):
         self.rin.write('0008cmd ')
         self.rin.seek(0)
@@ -21,15 +21,19 @@
 
 from io import BytesIO
 import os
+import shutil
 import tempfile
+import time
 
 from dulwich import errors
 from dulwich.file import (
     GitFile,
     )
+from dulwich.objects import ZERO_SHA
 from dulwich.refs import (
     DictRefsContainer,
     InfoRefsContainer,
+    PackedRefsTable,
     check_ref_format,
     _split_ref_line,
     read_packed_refs_with_peeled,
@@ -119,13 +123,74 @@ class PackedRefsFileTests(TestCase):
         write_packed_refs(f, {'ref/1': ONES, 'ref/2': TWOS},
                           {'ref/1': THREES})
         self.assertEqual(
-          "# pack-refs with: peeled\n%s ref/1\n^%s\n%s ref/2\n" % (
+          "# pack-refs with: peeled sorted\n%s ref/1\n^%s\n%s ref/2\n" % (
           ONES, THREES, TWOS), f.getvalue())
 
     def test_write_without_peeled(self):
         f = BytesIO()
         write_packed_refs(f, {'ref/1': ONES, 'ref/2': TWOS})
-        self.assertEqual("%s ref/1\n%s ref/2\n" % (ONES, TWOS), f.getvalue())
+        self.assertEqual("# pack-refs with: sorted\n%s ref/1\n%s ref/2\n" % (
+          ONES, TWOS), f.getvalue())
+
+
+class PackedRefsTableTests(TestCase):
+
+    def setUp(self):
+        super(PackedRefsTableTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'packed-refs')
+        self.table = PackedRefsTable(self.path)
+        self.addCleanup(self.table.close)
+
+    def write(self, contents):
+        with GitFile(self.path, 'wb') as f:
+            f.write(contents)
+
+    def test_missing(self):
+        self.assertEqual(None, self.table.lookup('refs/heads/master'))
+        self.assertEqual([], list(self.table.iterrefs()))
+
+    def test_lookup(self):
+        refs = dict(('refs/heads/branch-%03d' % i, ('%02d' % i) * 20)
+                    for i in range(100))
+        refs['refs/tags/tag'] = TWOS
+        with GitFile(self.path, 'wb') as f:
+            write_packed_refs(f, refs, {'refs/tags/tag': THREES})
+        for name, sha in refs.iteritems():
+            self.assertEqual(sha, self.table.get(name))
+        self.assertEqual((TWOS, THREES), self.table.lookup('refs/tags/tag'))
+        self.assertEqual(None, self.table.lookup('refs/heads/branch-1'))
+        self.assertEqual(None, self.table.lookup('refs/heads/zzz'))
+        self.assertEqual(None, self.table.lookup('refs/a'))
+        self.assertTrue(self.table.has_peeled())
+
+    def test_iterrefs_prefix(self):
+        self.write('# pack-refs with: peeled sorted\n'
+                   '%s refs/heads/a\n%s refs/heads/b\n^%s\n'
+                   '%s refs/headsx/c\n%s refs/tags/d\n' % (
+                       ONES, TWOS, THREES, ONES, FOURS))
+        self.assertEqual(
+            [('refs/heads/a', ONES, None), ('refs/heads/b', TWOS, THREES)],
+            list(self.table.iterrefs('refs/heads/')))
+        self.assertEqual([('refs/tags/d', FOURS, None)],
+                         list(self.table.iterrefs('refs/tags/')))
+        self.assertEqual([], list(self.table.iterrefs('refs/remotes/')))
+
+    def test_unsorted(self):
+        self.write('%s refs/tags/b\n%s refs/heads/a\n' % (ONES, TWOS))
+        self.assertEqual(['refs/heads/a', 'refs/tags/b'], list(self.table))
+        self.assertEqual(ONES, self.table.get('refs/tags/b'))
+        self.assertFalse(self.table.has_peeled())
+
+    def test_reload_on_change(self):
+        self.write('# pack-refs with: sorted\n%s refs/heads/a\n' % ONES)
+        self.assertEqual(ONES, self.table.get('refs/heads/a'))
+        self.write('# pack-refs with: sorted\n%s refs/heads/b\n' % TWOS)
+        self.assertEqual(None, self.table.get('refs/heads/a'))
+        self.assertEqual(TWOS, self.table.get('refs/heads/b'))
+        os.remove(self.path)
+        self.assertEqual(None, self.table.get('refs/heads/b'))
 
 
 # Dict of refs that we expect all RefsContainerTests subclasses to define.
@@ -160,6 +225,12 @@ class RefsContainerTests(object):
         # refs/heads/loop does not show up even if it exists
         self.assertEqual(_TEST_REFS, self._refs.as_dict())
 
+    def test_as_dict_base(self):
+        self.assertEqual({
+            'refs-0.1': _TEST_REFS['refs/tags/refs-0.1'],
+            'refs-0.2': _TEST_REFS['refs/tags/refs-0.2'],
+            }, self._refs.as_dict('refs/tags'))
+
     def test_setitem(self):
         self._refs['refs/some/ref'] = '42d06bd4b77fed026b154d16493e5deab78f02ec'
         self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec',
@@ -236,7 +307,49 @@ class RefsContainerTests(object):
           'refs/tags/refs-0.2', '3ec9c43c84ff242e3ef4a9fc5bc111fd780a76a8'))
         self.assertFalse('refs/tags/refs-0.2' in self._refs)
 
+    def test_update_refs(self):
+        nines = '9' * 40
+        self.assertEqual({}, self._refs.update_refs([
+            ('refs/heads/master', '42d06bd4b77fed026b154d16493e5deab78f02ec',
+             nines),
+            ('refs/heads/new', ZERO_SHA, nines),
+            ('refs/tags/refs-0.2', None, ZERO_SHA),
+            ]))
+        self.assertEqual(nines, self._refs['refs/heads/master'])
+        self.assertEqual(nines, self._refs['refs/heads/new'])
+        self.assertFalse('refs/tags/refs-0.2' in self._refs)
+
+    def test_update_refs_partial(self):
+        nines = '9' * 40
+        self.assertEqual({
+            'refs/heads/master': 'old value mismatch',
+            'refs/heads/packed': 'old value mismatch',
+            'notrefs/foo': 'bad ref',
+            }, self._refs.update_refs([
+            ('refs/heads/master', ONES, nines),
+            ('refs/heads/packed', ZERO_SHA, nines),
+            ('notrefs/foo', None, nines),
+            ('refs/heads/new', ZERO_SHA, nines),
+            ]))
+        self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec',
+                         self._refs['refs/heads/master'])
+        self.assertEqual(nines, self._refs['refs/heads/new'])
 
+    def test_update_refs_atomic(self):
+        nines = '9' * 40
+        self.assertEqual({
+            'refs/heads/master': 'old value mismatch',
+            'refs/heads/new': 'atomic transaction failed',
+            'refs/tags/refs-0.1': 'atomic transaction failed',
+            }, self._refs.update_refs([
+            ('refs/heads/master', ONES, nines),
+            ('refs/heads/new', ZERO_SHA, nines),
+            ('refs/tags/refs-0.1', None, ZERO_SHA),
+            ], atomic=True))
+        self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec',
+                         self._refs['refs/heads/master'])
+        self.assertFalse('refs/heads/new' in self._refs)
+        self.assertTrue('refs/tags/refs-0.1' in self._refs)
 
 
 class DictRefsContainerTests(RefsContainerTests, TestCase):
@@ -253,6 +366,15 @@ class DictRefsContainerTests(RefsContainerTests, TestCase):
         expected_refs["refs/stash"] = "00" * 20
         self.assertEqual(expected_refs, self._refs.as_dict())
 
+    def test_get_state_token(self):
+        token = self._refs.get_state_token()
+        self.assertEqual(token, self._refs.get_state_token())
+        self._refs['refs/heads/new'] = ONES
+        self.assertNotEqual(token, self._refs.get_state_token())
+        token = self._refs.get_state_token()
+        self.assertFalse(self._refs.remove_if_equals('refs/heads/new', TWOS))
+        self.assertEqual(token, self._refs.get_state_token())
+
 
 class DiskRefsContainerTests(RefsContainerTests, TestCase):
 
@@ -271,6 +393,43 @@ class DiskRefsContainerTests(RefsContainerTests, TestCase):
           'refs/tags/refs-0.1': 'df6800012397fb85c56e7418dd4eb9405dee075c',
           }, self._refs.get_packed_refs())
 
+    def test_packed_refs_reloaded(self):
+        self.assertEqual('df6800012397fb85c56e7418dd4eb9405dee075c',
+                         self._refs['refs/tags/refs-0.1'])
+        with GitFile(os.path.join(self._refs.path, 'packed-refs'), 'wb') as f:
+            write_packed_refs(f, {'refs/tags/refs-0.1': ONES})
+        self.assertEqual(ONES, self._refs['refs/tags/refs-0.1'])
+        self.assertEqual(None, self._refs.get_peeled('refs/tags/refs-0.1'))
+        self.assertFalse('refs/heads/packed' in self._refs)
+
+    def _age_refs(self):
+        # Pretend all refs were last changed long ago, so their timestamps
+        # can be trusted.
+        then = time.time() - 60
+        for root, dirs, files in os.walk(self._refs.path):
+            for name in dirs + files:
+                os.utime(os.path.join(root, name), (then, then))
+        os.utime(self._refs.path, (then, then))
+
+    def test_get_state_token(self):
+        self._age_refs()
+        token = self._refs.get_state_token()
+        self.assertNotEqual(None, token)
+        self.assertEqual(token, self._refs.get_state_token())
+        self._refs['refs/heads/new'] = ONES
+        # Changed too recently to be reliable
+        self.assertEqual(None, self._refs.get_state_token())
+        self._age_refs()
+        self.assertNotEqual(token, self._refs.get_state_token())
+
+    def test_get_state_token_packed_refs(self):
+        self._age_refs()
+        token = self._refs.get_state_token()
+        with GitFile(os.path.join(self._refs.path, 'packed-refs'), 'wb') as f:
+            write_packed_refs(f, {'refs/tags/refs-0.1': ONES})
+        self._age_refs()
+        self.assertNotEqual(token, self._refs.get_state_token())
+
     def test_get_peeled_not_packed(self):
         # not packed
         self.assertEqual(None, self._refs.get_peeled('refs/tags/refs-0.2'))
@@ -409,6 +568,21 @@ class DiskRefsContainerTests(RefsContainerTests, TestCase):
           'df6800012397fb85c56e7418dd4eb9405dee075c'))
         self.assertRaises(KeyError, lambda: self._refs['refs/tags/refs-0.1'])
 
+    def test_update_refs_packed(self):
+        self.assertEqual({}, self._refs.update_refs([
+            ('refs/heads/packed', None, ZERO_SHA),
+            ('refs/tags/refs-0.1', 'df6800012397fb85c56e7418dd4eb9405dee075c',
+             ZERO_SHA),
+            ('HEAD', None, ONES),
+            ]))
+        self.assertEqual({}, self._refs.get_packed_refs())
+        self.assertEqual(ONES, self._refs['refs/heads/master'])
+        self.assertEqual(['HEAD', 'refs/heads/master'], sorted(
+            f for f in os.listdir(self._refs.path) + [
+                'refs/heads/' + f for f in os.listdir(
+                    os.path.join(self._refs.path, 'refs', 'heads'))]
+            if f.startswith('HEAD') or f.startswith('refs/heads/master')))
+
     def test_read_ref(self):
         self.assertEqual('ref: refs/heads/master', self._refs.read_ref("HEAD"))
         self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec',
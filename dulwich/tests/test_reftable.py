@@ -0,0 +1,224 @@
+# test_reftable.py -- tests for reftable.py
+# Copyright (C) 2014 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for dulwich.reftable."""
+
+import os
+import shutil
+import tempfile
+
+from dulwich import errors
+from dulwich.file import GitFile
+from dulwich.reftable import (
+    RefRecord,
+    ReftableReader,
+    ReftableRefsContainer,
+    ReftableStack,
+    decode_varint,
+    encode_varint,
+    write_reftable,
+    )
+from dulwich.repo import Repo
+from dulwich.tests import (
+    TestCase,
+    )
+from dulwich.tests.test_refs import (
+    RefsContainerTests,
+    _TEST_REFS,
+    )
+
+
+ONES = "1" * 40
+TWOS = "2" * 40
+THREES = "3" * 40
+
+
+class VarintTests(TestCase):
+
+    def test_roundtrip(self):
+        for value in (0, 1, 127, 128, 255, 16383, 16384, 2 ** 40):
+            data = encode_varint(value)
+            self.assertEqual((value, len(data)), decode_varint(data, 0))
+
+    def test_encoding(self):
+        self.assertEqual('\x7f', encode_varint(127))
+        self.assertEqual('\x80\x00', encode_varint(128))
+
+
+class ReftableFileTests(TestCase):
+
+    def setUp(self):
+        super(ReftableFileTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'test.ref')
+
+    def write(self, records, block_size=4096):
+        with GitFile(self.path, 'wb') as f:
+            write_reftable(f, records, 1, 5, block_size=block_size)
+        reader = ReftableReader(self.path)
+        self.addCleanup(reader.close)
+        return reader
+
+    def test_empty(self):
+        reader = self.write([])
+        self.assertEqual([], list(reader.iter_records()))
+        self.assertEqual(None, reader.get('refs/heads/master'))
+
+    def test_value_types(self):
+        records = [
+            RefRecord('HEAD', 1, 'ref: refs/heads/master', None),
+            RefRecord('refs/heads/gone', 2, None, None),
+            RefRecord('refs/heads/master', 3, ONES, None),
+            RefRecord('refs/tags/v1', 5, TWOS, THREES),
+            ]
+        reader = self.write(records)
+        self.assertEqual(records, list(reader.iter_records()))
+        self.assertEqual(records[3], reader.get('refs/tags/v1'))
+        self.assertEqual(None, reader.get('refs/tags/v2'))
+        self.assertEqual((1, 5), (reader.min_update_index,
+                                  reader.max_update_index))
+
+    def _many_records(self, count):
+        return [RefRecord('refs/heads/branch-%05d' % i, 1, ONES, None)
+                for i in range(count)]
+
+    def test_unindexed_blocks(self):
+        records = self._many_records(40)
+        reader = self.write(records, block_size=512)
+        self.assertEqual(records, list(reader.iter_records()))
+        for record in records:
+            self.assertEqual(record, reader.get(record.name))
+        self.assertEqual(None, reader.get('refs/heads/branch-00005x'))
+
+    def test_indexed_blocks(self):
+        records = self._many_records(3000)
+        reader = self.write(records, block_size=256)
+        self.assertTrue(reader._ref_index_position)
+        self.assertEqual(records, list(reader.iter_records()))
+        for record in records[::97]:
+            self.assertEqual(record, reader.get(record.name))
+        self.assertEqual(None, reader.get('refs/heads/branch-0'))
+        self.assertEqual(None, reader.get('refs/heads/zzz'))
+        self.assertEqual(records[1200:1300], list(
+            reader.iter_records('refs/heads/branch-012')))
+
+    def test_corrupt_footer(self):
+        self.write(self._many_records(2))
+        with open(self.path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write('X')
+        self.assertRaises(errors.ReftableFormatError, ReftableReader,
+                          self.path)
+
+
+class ReftableStackTests(TestCase):
+
+    def setUp(self):
+        super(ReftableStackTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.stack = ReftableStack(os.path.join(self.tempdir, 'reftable'))
+        self.addCleanup(self.stack.close)
+
+    def test_update(self):
+        self.assertTrue(self.stack.update(
+            lambda: {'refs/heads/a': ONES, 'refs/heads/b': TWOS}))
+        self.assertTrue(self.stack.update(lambda: {'refs/heads/a': None}))
+        self.assertEqual(None, self.stack.get('refs/heads/a'))
+        self.assertEqual(['refs/heads/b'],
+                         [r.name for r in self.stack.iter_records()])
+
+    def test_update_aborted(self):
+        self.assertFalse(self.stack.update(lambda: None))
+        self.assertEqual([], self.stack.tables())
+        self.assertFalse(os.path.exists(
+            os.path.join(self.stack.path, 'tables.list.lock')))
+
+    def test_auto_compaction(self):
+        for i in range(64):
+            self.stack.update(lambda: {'refs/heads/b%d' % i: ONES})
+        tables = self.stack.tables()
+        self.assertTrue(len(tables) <= 7, tables)
+        for earlier, later in zip(tables, tables[1:]):
+            self.assertTrue(earlier.max_update_index < later.min_update_index)
+        self.assertEqual(64, len(list(self.stack.iter_records())))
+        self.assertEqual(
+            sorted(os.path.basename(t.path) for t in tables) +
+            ['tables.list'], sorted(os.listdir(self.stack.path)))
+
+    def test_deletion_shadows_older_tables(self):
+        self.stack.update(lambda: dict(('refs/heads/b%d' % i, ONES)
+                                       for i in range(100)))
+        self.stack.update(lambda: {'refs/heads/b1': None})
+        self.assertEqual(2, len(self.stack.tables()))
+        self.assertEqual(None, self.stack.get('refs/heads/b1').value)
+        self.assertEqual(99, len(list(self.stack.iter_records())))
+
+    def test_compact_drops_deletions(self):
+        self.stack.update(lambda: {'refs/heads/a': ONES, 'refs/heads/b': ONES})
+        self.stack.update(lambda: {'refs/heads/a': None})
+        self.stack.compact()
+        [table] = self.stack.tables()
+        self.assertEqual(['refs/heads/b'],
+                         [r.name for r in table.iter_records()])
+        self.assertEqual(1, table.min_update_index)
+        self.assertEqual(2, table.max_update_index)
+
+    def test_reload(self):
+        other = ReftableStack(self.stack.path)
+        self.addCleanup(other.close)
+        self.assertEqual(None, other.get('refs/heads/a'))
+        self.stack.update(lambda: {'refs/heads/a': ONES})
+        self.assertEqual(ONES, other.get('refs/heads/a').value)
+
+
+class ReftableRefsContainerTests(RefsContainerTests, TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self._refs = ReftableRefsContainer(self.tempdir)
+        self._refs._stack.update(lambda: dict(_TEST_REFS))
+        self.addCleanup(self._refs._stack.close)
+
+    def test_set_symbolic_ref_follow(self):
+        self._refs.set_symbolic_ref('HEAD', 'refs/heads/master')
+        self._refs['HEAD'] = ONES
+        self.assertEqual(ONES, self._refs['refs/heads/master'])
+        self.assertEqual('ref: refs/heads/master',
+                         self._refs.read_ref('HEAD'))
+
+    def test_get_state_token(self):
+        token = self._refs.get_state_token()
+        self.assertEqual(token, self._refs.get_state_token())
+        self._refs['refs/heads/new'] = ONES
+        self.assertNotEqual(token, self._refs.get_state_token())
+
+    def test_repo(self):
+        repo_dir = os.path.join(self.tempdir, 'repo')
+        os.mkdir(repo_dir)
+        Repo.init_bare(repo_dir)
+        os.mkdir(os.path.join(repo_dir, 'reftable'))
+        repo = Repo(repo_dir)
+        self.assertTrue(isinstance(repo.refs, ReftableRefsContainer))
+        repo.refs.set_symbolic_ref('HEAD', 'refs/heads/master')
+        repo.refs['refs/heads/master'] = ONES
+        self.assertEqual(ONES, Repo(repo_dir).refs['HEAD'])
@@ -31,6 +31,7 @@ from dulwich.object_store import (
     )
 from dulwich import objects
 from dulwich.config import Config
+from dulwich.partial_clone import configure_promisor_remote
 from dulwich.repo import (
     Repo,
     MemoryRepo,
@@ -234,6 +235,114 @@ class RepositoryTests(TestCase):
         self.assertEqual(shas, [t.head(),
                          '2a72d929692c41d8554c07f6301757ba18a65d91'])
 
+    def test_clone_depth(self):
+        r = self._repo = open_repo('a.git')
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        t = r.clone(tmp_dir, mkdir=False, depth=1)
+        head = 'a90fa2d900a17e99b433217e988c4eb4a2e9a097'
+        # The parent of HEAD is tagged, so it is a shallow commit too
+        self.assertEqual(
+            set([head, '2a72d929692c41d8554c07f6301757ba18a65d91']),
+            t.get_shallow())
+        self.assertEqual([head], [e.commit.id for e in t.get_walker()])
+        t = Repo(tmp_dir)
+        self.assertEqual([], t.get_parents(head))
+        self.assertEqual([head], [e.commit.id for e in t.get_walker()])
+
+    def test_clone_local(self):
+        r = self._repo = open_repo('a.git')
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        t = r.clone(tmp_dir, mkdir=False, local=True)
+        self.assertEqual(r.refs.as_dict('refs/tags'),
+                         t.refs.as_dict('refs/tags'))
+        self.assertEqual(set(r.object_store), set(t.object_store))
+        self.assertEqual([], t.object_store._read_alternate_paths())
+        self.assertEqual([e.commit.id for e in r.get_walker()],
+                         [e.commit.id for e in t.get_walker()])
+
+    def test_clone_shared(self):
+        r = self._repo = open_repo('a.git')
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        t = r.clone(tmp_dir, mkdir=False, bare=True, shared=True)
+        self.assertEqual([os.path.abspath(r.object_store.path)],
+                         t.object_store._read_alternate_paths())
+        self.assertEqual([], list(t.object_store._iter_loose_objects()))
+        self.assertEqual([e.commit.id for e in r.get_walker()],
+                         [e.commit.id for e in t.get_walker()])
+
+    def test_clone_local_shallow(self):
+        r = self._repo = open_repo('a.git')
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        s = r.clone(os.path.join(tmp_dir, 's'), depth=1)
+        t = s.clone(os.path.join(tmp_dir, 't'), local=True)
+        self.assertEqual(s.get_shallow(), t.get_shallow())
+        self.assertEqual([t.head()], [e.commit.id for e in t.get_walker()])
+        self.assertRaises(ValueError, r.clone, os.path.join(tmp_dir, 'u'),
+                          depth=1, local=True)
+
+    def test_clone_local_partial_clone(self):
+        r = self._repo = open_repo('a.git')
+        config = r.get_config()
+        configure_promisor_remote(config, 'origin', 'git://example.com/a',
+                                  'blob:none')
+        config.write_to_path()
+        r = self._repo = Repo(r.path)
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        target_path = os.path.join(tmp_dir, 't')
+        self.assertRaises(ValueError, r.clone, target_path, local=True)
+        self.assertRaises(ValueError, r.clone, target_path, shared=True)
+        self.assertFalse(os.path.exists(target_path))
+
+    def test_fetch_deepen(self):
+        r = self._repo = open_repo('a.git')
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        t = r.clone(tmp_dir, mkdir=False, depth=1)
+        r.fetch(t, lambda refs: [refs['HEAD']], depth=3)
+        self.assertEqual(set(), t.get_shallow())
+        self.assertFalse(os.path.exists(os.path.join(tmp_dir, '.git',
+                                                     'shallow')))
+        self.assertEqual(
+            ['a90fa2d900a17e99b433217e988c4eb4a2e9a097',
+             '2a72d929692c41d8554c07f6301757ba18a65d91'],
+            [e.commit.id for e in t.get_walker()])
+
+    def test_fetch_deepen_since(self):
+        r = self._repo = open_repo('a.git')
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        t = Repo.init(tmp_dir)
+        head = 'a90fa2d900a17e99b433217e988c4eb4a2e9a097'
+        r.fetch(t, lambda refs: [refs['HEAD']], deepen_since=1174775040)
+        self.assertEqual(set([head]), t.get_shallow())
+        self.assertEqual([head], [e.commit.id for e in t.get_walker(head)])
+
+    def test_fetch_deepen_not(self):
+        r = self._repo = open_repo('a.git')
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        t = Repo.init(tmp_dir)
+        head = 'a90fa2d900a17e99b433217e988c4eb4a2e9a097'
+        r.fetch(t, lambda refs: [refs['HEAD']], deepen_not=['mytag-packed'])
+        self.assertEqual(set([head]), t.get_shallow())
+        self.assertFalse('2a72d929692c41d8554c07f6301757ba18a65d91'
+                         in t.object_store)
+
+    def test_fetch_deepen_invalid(self):
+        r = self._repo = open_repo('a.git')
+        t = MemoryRepo()
+        wants = lambda refs: [refs['HEAD']]
+        self.assertRaises(ValueError, r.fetch, t, wants, depth=1,
+                          deepen_since=1174775040)
+        self.assertRaises(ValueError, r.fetch, t, wants,
+                          deepen_since=2000000000)
+        self.assertRaises(KeyError, r.fetch, t, wants, deepen_not=['nope'])
+
     def test_clone_no_head(self):
         temp_dir = tempfile.mkdtemp()
         self.addCleanup(shutil.rmtree, temp_dir)
@@ -294,6 +403,23 @@ class RepositoryTests(TestCase):
         r = self._repo = open_repo('ooo_merge.git')
         self.assertIsInstance(r.get_config_stack(), Config)
 
+    def test_get_config_copy(self):
+        r = self._repo = open_repo('ooo_merge.git')
+        c = r.get_config()
+        c.set(("user", ), "name", "Jelmer")
+        self.assertRaises(KeyError, r.get_config().get, ("user", ), "name")
+        self.assertEqual(os.path.join(r.controldir(), 'config'), c.path)
+
+    def test_get_config_written(self):
+        r = self._repo = open_repo('ooo_merge.git')
+        r.get_config()
+        c = r.get_config()
+        c.set(("user", ), "name", "Jelmer")
+        c.write_to_path()
+        self.assertEqual("Jelmer", r.get_config().get(("user", ), "name"))
+        self.assertEqual("Jelmer",
+                         Repo(r.path).get_config().get(("user", ), "name"))
+
     def test_submodule(self):
         temp_dir = tempfile.mkdtemp()
         repo_dir = os.path.join(os.path.dirname(__file__), 'data', 'repos')
@@ -607,6 +733,20 @@ class BuildRepoTests(TestCase):
             "Jelmer <jelmer@apache.org>",
             r[commit_sha].committer)
 
+    def test_update_shallow(self):
+        r = MemoryRepo.init_bare([], {})
+        self.assertEqual(set(), r.get_shallow())
+        r.update_shallow(['a' * 40, 'b' * 40], None)
+        self.assertEqual(set(['a' * 40, 'b' * 40]), r.get_shallow())
+        self.assertEqual([], r.get_parents('a' * 40))
+        self.assertEqual(set(['a' * 40, 'b' * 40]),
+                         r.get_graph_walker([]).shallow)
+        r.update_shallow(['c' * 40], ['a' * 40])
+        self.assertEqual(set(['b' * 40, 'c' * 40]), r.get_shallow())
+        self.assertNotIn('a' * 40, r._graftpoints)
+        r.update_shallow(None, ['b' * 40, 'c' * 40])
+        self.assertIs(None, r.get_named_file('shallow'))
+
     def test_commit_fail_ref(self):
         r = self._repo
 
@@ -28,12 +28,21 @@ from dulwich.errors import (
     UnexpectedCommandError,
     HangupException,
     )
+from dulwich.metrics import (
+    get_metrics,
+    )
+from dulwich.partial_clone import (
+    BlobNoneFilter,
+    TreeDepthFilter,
+    )
 from dulwich.objects import (
     Commit,
     Tag,
     )
 from dulwich.object_store import (
     MemoryObjectStore,
+    find_shallow,
+    find_shallow_since,
     )
 from dulwich.repo import (
     MemoryRepo,
@@ -46,22 +55,28 @@ from dulwich.server import (
     Handler,
     MultiAckGraphWalkerImpl,
     MultiAckDetailedGraphWalkerImpl,
+    _GRAPH_WALKER_COMMANDS,
     _split_proto_line,
     serve_command,
-    _find_shallow,
     ProtocolGraphWalker,
     ReceivePackHandler,
+    RefAdvertisement,
+    RefAdvertisementCache,
     SingleAckGraphWalkerImpl,
     UploadPackHandler,
     update_server_info,
     )
 from dulwich.tests import TestCase
 from dulwich.tests.utils import (
+    build_commit_graph,
     make_commit,
     make_object,
     )
 from dulwich.protocol import (
+    MULTI_ACK,
+    Protocol,
     ZERO_SHA,
+    pkt_line,
     )
 
 ONE = '1' * 40
@@ -98,6 +113,16 @@ class TestProto(object):
     def write_pkt_line(self, data):
         self._received[0].append(data)
 
+    def write_pkt_lines(self, data):
+        while data:
+            size = int(data[:4], 16)
+            if size == 0:
+                self._received[0].append(None)
+                data = data[4:]
+            else:
+                self._received[0].append(data[4:size])
+                data = data[size:]
+
     def get_received_line(self, band=0):
         lines = self._received[band]
         return lines.pop(0)
@@ -211,6 +236,135 @@ class UploadPackHandlerTestCase(TestCase):
         self._handler.set_client_capabilities(caps)
         self.assertEqual({}, self._handler.get_tagged(refs, repo=self._repo))
 
+    def test_get_tagged_from_advertisement(self):
+        tag = make_object(Tag, name='tag1', tagger='Test <test@example.com>',
+                          tag_time=12345, tag_timezone=0, message='message',
+                          object=(Commit, FOUR))
+        self._repo.object_store.add_object(make_commit(id=FOUR))
+        self._repo.object_store.add_object(tag)
+        self._repo.refs._update({
+            'refs/tags/tag1': tag.id,
+            'refs/heads/master': FOUR,
+            })
+        caps = list(self._handler.required_capabilities()) + ['include-tag']
+        self._handler.set_client_capabilities(caps)
+        self.assertEqual({FOUR: tag.id}, self._handler.get_tagged())
+
+    def test_handle_metrics(self):
+        c1, c2 = build_commit_graph(self._repo.object_store, [[1], [2, 1]])
+        self._repo.refs['refs/heads/master'] = c2.id
+        request = BytesIO(''.join([
+            pkt_line('want %s multi_ack_detailed side-band-64k thin-pack '
+                     'ofs-delta no-progress\n' % c2.id),
+            '0000',
+            pkt_line('have %s\n' % c1.id),
+            pkt_line('done\n'),
+            ]))
+        handler = UploadPackHandler(DictBackend({'/': self._repo}), ['/'],
+                                    Protocol(request.read, BytesIO().write))
+        handler.handle()
+        counters = handler.metrics.counters
+        self.assertEqual(1, counters['upload_pack.haves'])
+        self.assertEqual(1, counters['upload_pack.negotiation_rounds'])
+        self.assertTrue(counters['upload_pack.objects'] > 0)
+        self.assertEqual(4, counters['protocol.pkt_lines_read'])
+        for name in ['handler.UploadPackHandler', 'upload_pack.advertise',
+                     'upload_pack.negotiate', 'upload_pack.count_objects',
+                     'pack.write']:
+            self.assertTrue(name in handler.metrics.timers, name)
+        self.assertFalse(get_metrics().enabled)
+
+
+class RefAdvertisementTests(TestCase):
+
+    def setUp(self):
+        super(RefAdvertisementTests, self).setUp()
+        self._repo = MemoryRepo.init_bare([], {})
+        self._tag = make_object(Tag, name='tag1',
+                                tagger='Test <test@example.com>',
+                                tag_time=12345, tag_timezone=0,
+                                message='message', object=(Commit, ONE))
+        self._repo.object_store.add_object(make_commit(id=ONE))
+        self._repo.object_store.add_object(self._tag)
+        self._repo.refs._update({
+            'HEAD': ONE,
+            'refs/heads/master': ONE,
+            'refs/tags/tag1': self._tag.id,
+            'refs/tags/missing': TWO,
+            })
+
+    def test_from_repo(self):
+        advertisement = RefAdvertisement.from_repo(self._repo)
+        self.assertEqual(self._repo.get_refs(), advertisement.refs)
+        self.assertEqual({'refs/tags/tag1': ONE}, advertisement.peeled)
+        self.assertEqual(ONE, advertisement.get_peeled('refs/tags/tag1'))
+        self.assertEqual(ONE, advertisement.get_peeled('refs/heads/master'))
+        self.assertRaises(KeyError, advertisement.get_peeled, 'refs/foo')
+        self.assertEqual({ONE: self._tag.id}, advertisement.get_tagged())
+
+    def test_info_refs(self):
+        advertisement = RefAdvertisement.from_repo(self._repo)
+        self.assertEqual(['%s\trefs/heads/master\n' % ONE,
+                          '%s\trefs/tags/tag1\n' % self._tag.id,
+                          '%s\trefs/tags/tag1^{}\n' % ONE],
+                         advertisement.info_refs())
+
+    def test_write_upload_pack(self):
+        # Streaming the serialized advertisement must match advertising the
+        # refs one by one.
+        del self._repo.refs['refs/tags/missing']
+        backend = DictBackend({'/': self._repo})
+        advertisement = RefAdvertisement.from_repo(self._repo)
+        received = []
+        for kwargs in [{}, {'advertisement': advertisement}]:
+            handler = TestUploadPackHandler(backend, ['/'], TestProto())
+            walker = ProtocolGraphWalker(
+                handler, self._repo.object_store, self._repo.get_peeled,
+                **kwargs)
+            walker.proto.set_output([None])
+            self.assertEqual([], walker.determine_wants(advertisement.refs))
+            received.append(walker.proto._received[0])
+        self.assertEqual(received[0], received[1])
+        self.assertEqual(5, len(received[1]))
+        self.assertEqual(None, received[1][-1])
+
+    def test_write_upload_pack_empty(self):
+        proto = TestProto()
+        RefAdvertisement({}, {}).write_upload_pack(proto, 'cap1 cap2')
+        self.assertEqual([None], proto._received[0])
+
+
+class RefAdvertisementCacheTests(TestCase):
+
+    def setUp(self):
+        super(RefAdvertisementCacheTests, self).setUp()
+        self._repo = MemoryRepo.init_bare([make_commit(id=ONE)], {})
+        self._repo.refs['refs/heads/master'] = ONE
+        self._cache = RefAdvertisementCache()
+
+    def test_cached(self):
+        advertisement = self._cache.get(self._repo)
+        self.assertEqual({'refs/heads/master': ONE}, advertisement.refs)
+        self.assertTrue(advertisement is self._cache.get(self._repo))
+
+    def test_invalidated(self):
+        advertisement = self._cache.get(self._repo)
+        self._repo.refs['refs/heads/other'] = ONE
+        new_advertisement = self._cache.get(self._repo)
+        self.assertFalse(advertisement is new_advertisement)
+        self.assertEqual({'refs/heads/master': ONE, 'refs/heads/other': ONE},
+                         new_advertisement.refs)
+
+    def test_uncacheable(self):
+        self._repo.refs.get_state_token = lambda: None
+        advertisement = self._cache.get(self._repo)
+        self.assertFalse(advertisement is self._cache.get(self._repo))
+
+    def test_clear(self):
+        advertisement = self._cache.get(self._repo)
+        self._cache.clear()
+        self.assertFalse(advertisement is self._cache.get(self._repo))
+
 
 class FindShallowTests(TestCase):
 
@@ -237,13 +391,13 @@ class FindShallowTests(TestCase):
         c1, c2, c3 = self.make_linear_commits(3)
 
         self.assertEqual((set([c3.id]), set([])),
-                         _find_shallow(self._store, [c3.id], 0))
+                         find_shallow(self._store, [c3.id], 1))
         self.assertEqual((set([c2.id]), set([c3.id])),
-                         _find_shallow(self._store, [c3.id], 1))
+                         find_shallow(self._store, [c3.id], 2))
         self.assertEqual((set([c1.id]), set([c2.id, c3.id])),
-                         _find_shallow(self._store, [c3.id], 2))
+                         find_shallow(self._store, [c3.id], 3))
         self.assertEqual((set([]), set([c1.id, c2.id, c3.id])),
-                         _find_shallow(self._store, [c3.id], 3))
+                         find_shallow(self._store, [c3.id], 4))
 
     def test_multiple_independent(self):
         a = self.make_linear_commits(2, message='a')
@@ -252,7 +406,7 @@ class FindShallowTests(TestCase):
         heads = [a[1].id, b[1].id, c[1].id]
 
         self.assertEqual((set([a[0].id, b[0].id, c[0].id]), set(heads)),
-                         _find_shallow(self._store, heads, 1))
+                         find_shallow(self._store, heads, 2))
 
     def test_multiple_overlapping(self):
         # Create the following commit tree:
@@ -263,9 +417,21 @@ class FindShallowTests(TestCase):
         c3 = self.make_commit(parents=[c1.id])
         c4 = self.make_commit(parents=[c3.id])
 
-        # 1 is shallow along the path from 4, but not along the path from 2.
-        self.assertEqual((set([c1.id]), set([c1.id, c2.id, c3.id, c4.id])),
-                         _find_shallow(self._store, [c2.id, c4.id], 2))
+        # 1 is shallow along the path from 4, but not along the path from 2,
+        # so its parents (if any) must be included.
+        self.assertEqual((set([]), set([c1.id, c2.id, c3.id, c4.id])),
+                         find_shallow(self._store, [c2.id, c4.id], 3))
+
+    def test_many_paths(self):
+        # A ladder of merges, with 2**30 paths from the head to the root.
+        commits = self.make_linear_commits(1)
+        for _ in range(30):
+            parents = [commits[-1].id]
+            c1 = self.make_commit(parents=parents, message='1')
+            c2 = self.make_commit(parents=parents, message='2')
+            commits.extend([c1, c2, self.make_commit(parents=[c1.id, c2.id])])
+        self.assertEqual((set([commits[0].id]), set(c.id for c in commits[1:])),
+                         find_shallow(self._store, [commits[-1].id], 61))
 
     def test_merge(self):
         c1 = self.make_commit()
@@ -273,7 +439,7 @@ class FindShallowTests(TestCase):
         c3 = self.make_commit(parents=[c1.id, c2.id])
 
         self.assertEqual((set([c1.id, c2.id]), set([c3.id])),
-                         _find_shallow(self._store, [c3.id], 1))
+                         find_shallow(self._store, [c3.id], 2))
 
     def test_tag(self):
         c1, c2 = self.make_linear_commits(2)
@@ -284,7 +450,50 @@ class FindShallowTests(TestCase):
         self._store.add_object(tag)
 
         self.assertEqual((set([c1.id]), set([c2.id])),
-                         _find_shallow(self._store, [tag.id], 1))
+                         find_shallow(self._store, [tag.id], 2))
+
+
+class FindShallowSinceTests(TestCase):
+
+    def setUp(self):
+        self._store = MemoryObjectStore()
+        # Create the following commit tree, with commit times 100 to 500:
+        # 1--2--3--5
+        #     \   /
+        #      -4-
+        self.commits = []
+        for commit_time, parents in [(100, []), (200, [0]), (300, [1]),
+                                     (400, [1]), (500, [3, 2])]:
+            self.commits.append(make_commit(
+                commit_time=commit_time,
+                parents=[self.commits[i].id for i in parents]))
+            self._store.add_object(self.commits[-1])
+
+    def find_shallow_since(self, since=None, exclude=None):
+        shallow, not_shallow = find_shallow_since(
+            self._store, [self.commits[4].id], since,
+            [self.commits[i - 1].id for i in exclude or []])
+        ids = [c.id for c in self.commits]
+        return (sorted(ids.index(sha) + 1 for sha in shallow),
+                sorted(ids.index(sha) + 1 for sha in not_shallow))
+
+    def test_everything(self):
+        self.assertEqual(([], [1, 2, 3, 4, 5]), self.find_shallow_since(100))
+
+    def test_since(self):
+        self.assertEqual(([3, 4], [5]), self.find_shallow_since(250))
+        self.assertEqual(([2], [3, 4, 5]), self.find_shallow_since(200))
+
+    def test_since_all_older(self):
+        self.assertEqual(([], []), self.find_shallow_since(600))
+
+    def test_exclude(self):
+        self.assertEqual(([3, 4], [5]), self.find_shallow_since(exclude=[2]))
+        self.assertEqual(([5], []), self.find_shallow_since(exclude=[3, 4]))
+
+    def test_since_and_exclude(self):
+        self.assertEqual(([4, 5], []),
+                         self.find_shallow_since(250, exclude=[3]))
 
 
 class TestUploadPackHandler(UploadPackHandler):
@@ -313,6 +522,30 @@ class ReceivePackHandlerTestCase(TestCase):
         self.assertEqual(status[1][0], 'refs/heads/fake-branch')
         self.assertEqual(status[1][1], 'ok')
 
+    def test_apply_pack_old_value_mismatch(self):
+        self._repo.refs._update({'refs/heads/master': TWO,
+                                 'refs/heads/other': ONE})
+        update_refs = [[ONE, ZERO_SHA, 'refs/heads/master'],
+                       [ONE, ZERO_SHA, 'refs/heads/other']]
+        status = self._handler._apply_pack(update_refs)
+        self.assertEqual([('unpack', 'ok'),
+                          ('refs/heads/master', 'old value mismatch'),
+                          ('refs/heads/other', 'ok')], status)
+        self.assertEqual(TWO, self._repo.refs['refs/heads/master'])
+        self.assertFalse('refs/heads/other' in self._repo.refs)
+
+    def test_apply_pack_atomic(self):
+        self._repo.refs._update({'refs/heads/master': TWO,
+                                 'refs/heads/other': ONE})
+        update_refs = [[ONE, ZERO_SHA, 'refs/heads/master'],
+                       [ONE, ZERO_SHA, 'refs/heads/other']]
+        status = self._handler._apply_pack(update_refs, atomic=True)
+        self.assertEqual([('unpack', 'ok'),
+                          ('refs/heads/master', 'old value mismatch'),
+                          ('refs/heads/other', 'atomic transaction failed')],
+                         status)
+        self.assertEqual(ONE, self._repo.refs['refs/heads/other'])
+
 
 class ProtocolGraphWalkerEmptyTestCase(TestCase):
     def setUp(self):
@@ -381,6 +614,13 @@ class ProtocolGraphWalkerTestCase(TestCase):
         self.assertFalse(self._walker.all_wants_satisfied([THREE]))
         self.assertTrue(self._walker.all_wants_satisfied([TWO, THREE]))
 
+    def test_ack_records_haves(self):
+        self._walker.set_ack_type(MULTI_ACK)
+        self.assertEqual([], self._walker.haves)
+        self._walker.ack(ONE)
+        self._walker.ack(TWO)
+        self.assertEqual([ONE, TWO], self._walker.haves)
+
     def test_split_proto_line(self):
         allowed = ('want', 'done', None)
         self.assertEqual(('want', ONE),
@@ -476,7 +716,7 @@ class ProtocolGraphWalkerTestCase(TestCase):
           expected, list(iter(self._walker.proto.get_received_line, None)))
 
     def test_handle_shallow_request_no_client_shallows(self):
-        self._handle_shallow_request(['deepen 1\n'], [FOUR, FIVE])
+        self._handle_shallow_request(['deepen 2\n'], [FOUR, FIVE])
         self.assertEqual(set([TWO, THREE]), self._walker.shallow)
         self.assertReceived([
           'shallow %s' % TWO,
@@ -487,7 +727,7 @@ class ProtocolGraphWalkerTestCase(TestCase):
         lines = [
           'shallow %s\n' % TWO,
           'shallow %s\n' % THREE,
-          'deepen 1\n',
+          'deepen 2\n',
           ]
         self._handle_shallow_request(lines, [FOUR, FIVE])
         self.assertEqual(set([TWO, THREE]), self._walker.shallow)
@@ -496,7 +736,7 @@ class ProtocolGraphWalkerTestCase(TestCase):
     def test_handle_shallow_request_unshallows(self):
         lines = [
           'shallow %s\n' % TWO,
-          'deepen 2\n',
+          'deepen 3\n',
           ]
         self._handle_shallow_request(lines, [FOUR, FIVE])
         self.assertEqual(set([ONE]), self._walker.shallow)
@@ -506,6 +746,93 @@ class ProtocolGraphWalkerTestCase(TestCase):
           # THREE is unshallow but was is not shallow in the client
           ])
 
+    def test_handle_shallow_request_no_deepen(self):
+        lines = [
+          'shallow %s\n' % TWO,
+          ]
+        self._handle_shallow_request(lines, [FOUR, FIVE])
+        self.assertEqual(set([TWO]), self._walker.shallow)
+        # Nothing is sent back, not even a flush-pkt
+        self.assertEqual([], self._walker.proto._received[0])
+
+    def test_handle_shallow_request_deepen_since(self):
+        self._handle_shallow_request(['deepen-since 300\n'], [FOUR, FIVE])
+        self.assertEqual(set([THREE, FOUR]), self._walker.shallow)
+        self.assertReceived([
+          'shallow %s' % THREE,
+          'shallow %s' % FOUR,
+          ])
+
+    def test_handle_shallow_request_deepen_not(self):
+        self._repo.refs['refs/tags/old'] = TWO
+        lines = [
+          'shallow %s\n' % THREE,
+          'deepen-not old\n',
+          ]
+        self._handle_shallow_request(lines, [FOUR, FIVE])
+        self.assertEqual(set([FOUR, THREE]), self._walker.shallow)
+        self.assertReceived([
+          'shallow %s' % FOUR,
+          ])
+
+    def test_handle_shallow_request_deepen_not_unknown(self):
+        self.assertRaises(GitProtocolError, self._handle_shallow_request,
+                          ['deepen-not unknown\n'], [FOUR, FIVE])
+
+    def test_handle_shallow_request_deepen_and_since(self):
+        self.assertRaises(GitProtocolError, self._handle_shallow_request,
+                          ['deepen 1\n', 'deepen-since 300\n'], [FOUR, FIVE])
+
+    def test_handle_shallow_request_since_no_commits(self):
+        self.assertRaises(GitProtocolError, self._handle_shallow_request,
+                          ['deepen-since 1000\n'], [FOUR, FIVE])
+
+    def test_handle_shallow_request_filter(self):
+        self._walker.handler.set_client_capabilities(['shallow', 'filter'])
+        self._handle_shallow_request(['deepen 2\n', 'filter tree:0\n'],
+                                     [FOUR, FIVE])
+        self.assertEqual(set([TWO, THREE]), self._walker.shallow)
+        self.assertEqual(TreeDepthFilter(0), self._walker.object_filter)
+
+    def _determine_wants_filter(self, lines):
+        heads = {'refs/heads/ref1': ONE}
+        self._repo.refs._update(heads)
+        self._walker.proto.set_output(lines + [None])
+        return self._walker.determine_wants(heads)
+
+    def test_determine_wants_filter(self):
+        self.assertEqual([ONE], self._determine_wants_filter([
+            'want %s multi_ack filter' % ONE, 'filter blob:none']))
+        self.assertEqual(BlobNoneFilter(), self._walker.object_filter)
+
+    def test_determine_wants_no_filter(self):
+        self.assertEqual([ONE], self._determine_wants_filter([
+            'want %s multi_ack filter' % ONE]))
+        self.assertEqual(None, self._walker.object_filter)
+
+    def test_determine_wants_filter_invalid(self):
+        self.assertRaises(GitProtocolError, self._determine_wants_filter, [
+            'want %s multi_ack filter' % ONE, 'filter blob:all'])
+
+    def test_determine_wants_filter_without_capability(self):
+        self.assertRaises(GitProtocolError, self._determine_wants_filter, [
+            'want %s multi_ack' % ONE, 'filter blob:none'])
+
+    def test_determine_wants_unadvertised(self):
+        self.assertFalse(self._walker.handler.allow_any_sha1_in_want)
+        self.assertRaises(GitProtocolError, self._determine_wants_filter, [
+            'want %s multi_ack filter' % THREE, 'filter blob:none'])
+
+    def test_determine_wants_allow_any_sha1_in_want(self):
+        self._repo.get_config().set(
+            ('uploadpack', ), 'allowanysha1inwant', 'true')
+        self.assertIn('allow-reachable-sha1-in-want',
+                      self._walker.handler.capability_line().split(' '))
+        self.assertEqual([THREE], self._determine_wants_filter([
+            'want %s multi_ack filter' % THREE, 'filter blob:none']))
+        self.assertRaises(GitProtocolError, self._determine_wants_filter, [
+            'want %s multi_ack' % ('9' * 40)])
+
 
 class TestProtocolGraphWalker(object):
 
@@ -522,6 +849,9 @@ class TestProtocolGraphWalker(object):
             assert command in allowed
         return command, sha
 
+    def read_have_line(self):
+        return self.read_proto_line(_GRAPH_WALKER_COMMANDS)
+
     def send_ack(self, sha, ack_type=''):
         self.acks.append((sha, ack_type))
 
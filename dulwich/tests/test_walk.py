@@ -42,6 +42,8 @@ from dulwich.walk import (
     ORDER_TOPO,
     WalkEntry,
     Walker,
+    _generations,
+    _incremental_topo_reorder,
     _topo_reorder
     )
 from dulwich.tests import TestCase
@@ -395,6 +397,64 @@ class WalkerTest(TestCase):
           times=[2, 1, 3, 4, 5])
         self.assertWalkYields([c5, c4, c3, c1, c2], [c5.id])
         self.assertWalkYields([c5, c4, c3, c2, c1], [c5.id], order=ORDER_TOPO)
+        self.assertWalkYields([c5, c4, c3, c2], [c5.id], order=ORDER_TOPO,
+                              max_entries=4)
+        self.assertWalkYields([c2, c3, c4, c5], [c5.id], order=ORDER_TOPO,
+                              max_entries=4, reverse=True)
+
+    def test_incremental_topo_reorder(self):
+        c1, c2, c3, c4, c5 = self.make_commits(
+          [[1], [2, 1], [3, 2], [4, 1], [5, 3, 4]],
+          times=[2, 1, 3, 4, 5])
+        entries = [TestWalkEntry(c, None) for c in [c5, c4, c3, c1, c2]]
+        generations = _generations(self.store, [c5.id])
+        self.assertEqual({c1.id: 1, c2.id: 2, c3.id: 3, c4.id: 2, c5.id: 4},
+                         generations)
+        self.assertEqual([c5, c4, c3, c2, c1],
+                         [e.commit for e in _incremental_topo_reorder(
+                             entries, generations, lambda: 4)])
+
+    def test_incremental_topo_reorder_lazy(self):
+        commits = self.make_commits(
+          [[1], [2, 1], [3, 1], [4, 2, 3], [5, 4], [6, 5]])
+        commits.reverse()
+        generations = _generations(self.store, [commits[0].id])
+        read = []
+
+        def entries():
+            for c in commits:
+                read.append(c)
+                yield TestWalkEntry(c, None)
+
+        def get_unread_generation():
+            return max([generations[c.id] for c in commits[len(read):]] or
+                       [0])
+
+        results = _incremental_topo_reorder(entries(), generations,
+                                            get_unread_generation)
+        self.assertEqual(commits[0], next(results).commit)
+        self.assertEqual(commits[:1], read)
+        self.assertEqual(commits[1:], [e.commit for e in results])
+
+    def test_topo_child_older_than_parent(self):
+        # Create the following graph:
+        # c1---------------x10--m11
+        #   \                    /
+        #    \-y2--y3--...--y9--/
+        # Due to skew, y2 to y9 are older than their ancestor c1, so c1 is
+        # read well before y2.
+        commits = self.make_commits(
+          [[1], [2, 1]] + [[i, i - 1] for i in range(3, 10)] +
+          [[10, 1], [11, 10, 9]],
+          times=[10] + list(range(1, 9)) + [11, 12])
+        c1 = commits[0]
+        y = list(reversed(commits[1:9]))
+        x10, m11 = commits[9:]
+        self.assertWalkYields([m11, x10, c1] + y, [m11.id])
+        self.assertWalkYields([m11, x10] + y + [c1], [m11.id],
+                              order=ORDER_TOPO)
+        self.assertWalkYields([m11, x10] + y, [m11.id], order=ORDER_TOPO,
+                              max_entries=10)
 
     def test_out_of_order_with_exclude(self):
         # Create the following graph:
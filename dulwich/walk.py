@@ -23,7 +23,7 @@ from collections import defaultdict
 
 import collections
 import heapq
-from itertools import chain
+from itertools import chain, islice
 
 from dulwich.diff_tree import (
     RENAME_CHANGE_TYPES,
@@ -203,8 +203,12 @@ class Walker(object):
             ancestors.
         :param exclude: Iterable of SHAs of commits to exclude along with their
             ancestors, overriding includes.
-        :param order: ORDER_* constant specifying the order of results. Anything
-            other than ORDER_DATE may result in O(n) memory usage.
+        :param order: ORDER_* constant specifying the order of results.
+            ORDER_TOPO reads the parents of all commits to be walked before
+            yielding the first entry. With the default queue_cls and no
+            exclude or since, it then only keeps the entries that have been
+            read but not yet returned in memory; otherwise it may result in
+            O(n) memory usage.
         :param reverse: If True, reverse the order of output, requiring O(n)
             memory.
         :param max_entries: The maximum number of entries to yield, or None for
@@ -304,6 +308,9 @@ class Walker(object):
 
     def _next(self):
         max_entries = self.max_entries
+        if self.order == ORDER_TOPO:
+            # The limit applies to the reordered entries; see _reorder.
+            max_entries = None
         while max_entries is None or self._num_entries < max_entries:
             entry = next(self._queue)
             if entry is not None:
@@ -326,15 +333,73 @@ class Walker(object):
             by the Walker.
         """
         if self.order == ORDER_TOPO:
-            results = _topo_reorder(results, self.get_parents)
+            if (isinstance(self._queue, _CommitTimeQueue) and
+                    not self.excluded and self.since is None):
+                generations = _generations(self.store, self.include,
+                                           self.get_parents)
+                results = _incremental_topo_reorder(
+                    results, generations,
+                    lambda: self._unread_generation(generations),
+                    self.get_parents)
+            else:
+                results = _topo_reorder(results, self.get_parents)
+            if self.max_entries is not None:
+                results = islice(results, self.max_entries)
         if self.reverse:
             results = reversed(list(results))
         return results
 
+    def _unread_generation(self, generations):
+        """Find the largest generation number of commits yet to be returned.
+
+        Only valid for the default queue_cls: any commit that has not been
+        read yet is an ancestor of a commit in its priority queue.
+
+        :param generations: Dict mapping commit SHA to generation number, as
+            returned by _generations.
+        :return: The largest generation number, or 0 if no commits are left.
+        """
+        unread = [generations[entry.commit.id] for entry in self._out_queue]
+        unread.extend(generations[commit.id]
+                      for _, commit in self._queue._pq)
+        return max(unread or [0])
+
     def __iter__(self):
         return iter(self._reorder(iter(self._next, None)))
 
 
+def _generations(store, heads, get_parents=lambda commit: commit.parents):
+    """Compute generation numbers for commits and all of their ancestors.
+
+    The generation number of a commit is one more than the largest generation
+    number of its parents, so a commit always has a larger generation number
+    than its ancestors, regardless of commit times.
+
+    :param store: ObjectStore instance for looking up commits.
+    :param heads: Iterable of SHAs of commits to start from.
+    :param get_parents: Optional function for getting the parents of a commit.
+    :return: Dict mapping commit SHA to generation number.
+    """
+    generations = {}
+    todo = [(sha, None) for sha in heads]
+    while todo:
+        sha, parents = todo.pop()
+        if sha in generations:
+            continue
+        if parents is None:
+            try:
+                commit = store[sha]
+            except KeyError:
+                raise MissingCommitError(sha)
+            parents = get_parents(commit)
+            todo.append((sha, parents))
+            todo.extend((p, None) for p in parents if p not in generations)
+        else:
+            generations[sha] = 1 + max(
+                [generations[p] for p in parents] or [0])
+    return generations
+
+
 def _topo_reorder(entries, get_parents=lambda commit: commit.parents):
     """Reorder an iterable of entries topologically.
 
@@ -368,3 +433,56 @@ def _topo_reorder(entries, get_parents=lambda commit: commit.parents):
                 if parent_entry:
                     todo.appendleft(parent_entry)
         yield entry
+
+
+def _incremental_topo_reorder(entries, generations, get_unread_generation,
+                              get_parents=lambda commit: commit.parents):
+    """Reorder entries topologically, as they come in.
+
+    Unlike _topo_reorder, this does not read all entries before yielding the
+    first one. An entry is only considered once no entry left to be read has
+    a larger generation number, so all of its children have been read by
+    then, whatever their commit times.
+
+    :param entries: An iterable of WalkEntry objects.
+    :param generations: Dict mapping commit SHA to generation number, as
+        returned by _generations.
+    :param get_unread_generation: Function returning the largest generation
+        number of the entries that have not been read yet, or 0 if there are
+        none.
+    :param get_parents: Optional function for getting the parents of a commit.
+    :return: iterator over WalkEntry objects from entries in FIFO order, except
+        where a parent would be yielded before any of its children.
+    """
+    entries = iter(entries)
+    todo = collections.deque()
+    pending = {}
+    num_children = defaultdict(int)
+    exhausted = False
+    while True:
+        while not exhausted and (
+                not todo or get_unread_generation() >
+                generations[todo[0].commit.id]):
+            entry = next(entries, None)
+            if entry is None:
+                exhausted = True
+                break
+            todo.append(entry)
+            for p in get_parents(entry.commit):
+                num_children[p] += 1
+        if not todo:
+            return
+        entry = todo.popleft()
+        commit = entry.commit
+        commit_id = commit.id
+        if num_children[commit_id]:
+            pending[commit_id] = entry
+            continue
+        del num_children[commit_id]
+        for parent_id in get_parents(commit):
+            num_children[parent_id] -= 1
+            if not num_children[parent_id]:
+                parent_entry = pending.pop(parent_id, None)
+                if parent_entry:
+                    todo.appendleft(parent_entry)
+        yield entry